@@ -802,6 +802,7 @@ EXECUTE PROCEDURE update_row_modified_timestamp();
 
 /* Indexes */
 CREATE INDEX IF NOT EXISTS idx_mark_stock_bander_id ON mark_stock_aggregation_rollup(bander_id);
+CREATE INDEX IF NOT EXISTS idx_mark_stock_bander_prefix ON mark_stock_aggregation_rollup(bander_id, prefix_number);
 
 
 /*
@@ -558,6 +558,7 @@ BEGIN
 END; $$
 LANGUAGE PLPGSQL;
 
+-- For restoring a whole environment export see src/db-tools/db_bulk_load.py (parallel, FK-ordered, optional deferred indexes/triggers)
 DROP FUNCTION IF EXISTS rw_import_query(table_name text, column_names text, bucket_name text, object_path text);
 
 CREATE FUNCTION rw_import_query(table_name text, column_names text, bucket_name text, object_path text) RETURNS VOID AS $$
@@ -1186,25 +1187,72 @@ BEGIN
 END; $$
 LANGUAGE PLPGSQL;
 
+-- Materialized view refresh coordination
+-- Each matview gets its own transaction-level advisory lock, keyed (namespace, hashtext(matview_name)),
+-- which every rw_refresh_*_matview function (4_create_materialized_views.sql) holds while it refreshes.
+-- Checking for a refresh in progress is then a lookup in pg_locks rather than a LIKE scan of
+-- pg_stat_activity (which also matched unrelated queries mentioning the view and let duplicate refreshes through)
+DROP FUNCTION IF EXISTS ro_matview_lock_namespace;
+CREATE FUNCTION ro_matview_lock_namespace() RETURNS integer AS $$
+  -- Arbitrary, just keeps these keys apart from any other advisory locks
+  SELECT 20486;
+$$
+LANGUAGE SQL IMMUTABLE;
+
+DROP FUNCTION IF EXISTS ro_matview_lock_key;
+CREATE FUNCTION ro_matview_lock_key(matview_name text) RETURNS integer AS $$
+  SELECT hashtext(matview_name);
+$$
+LANGUAGE SQL IMMUTABLE;
+
 -- check matview not currently active
--- pg_stat_activity returns the call itself which contains the matview name so need to check count is > 1
 DROP FUNCTION IF EXISTS ro_is_matview_refreshing;
 CREATE FUNCTION ro_is_matview_refreshing(matview_name text) RETURNS BOOLEAN AS $$
-DECLARE
-  matching_active_processes NUMERIC := 0;
-BEGIN
-    SELECT COUNT(*) INTO matching_active_processes
-    FROM pg_stat_activity
-    WHERE state = 'active'
-			AND query NOT LIKE '%pg_stat%'
-			AND query like '%' || matview_name || '%';
-		IF matching_active_processes > 1 THEN
-			RETURN TRUE;
-		END IF;
-		RETURN FALSE;
+BEGIN
+    RETURN EXISTS (
+      SELECT 1
+      FROM pg_locks
+      WHERE locktype = 'advisory'
+        AND database = (SELECT oid FROM pg_database WHERE datname = current_database())
+        AND classid = ro_matview_lock_namespace()::oid
+        AND objid = ro_matview_lock_key(matview_name)::oid
+        AND objsubid = 2
+        AND granted
+    );
 END; $$
 LANGUAGE PLPGSQL;
 
+-- Refresh a matview unless someone else is already refreshing it (returns FALSE without waiting if so)
+-- Falls back to a non-concurrent refresh when the view hasn't been populated yet
+DROP FUNCTION IF EXISTS rw_try_refresh_matview(matview_name text, concurrent boolean);
+CREATE FUNCTION rw_try_refresh_matview(matview_name text, concurrent boolean DEFAULT TRUE)
+RETURNS boolean
+SECURITY DEFINER
+AS $$
+DECLARE
+  is_populated boolean := NULL;
+BEGIN
+  IF NOT pg_try_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key(matview_name)) THEN
+    RETURN FALSE;
+  END IF;
+
+  SELECT ispopulated INTO is_populated
+  FROM pg_matviews
+  WHERE schemaname = current_schema() AND matviewname = matview_name;
+
+  IF is_populated IS NULL THEN
+    RAISE EXCEPTION 'No materialized view named %', matview_name;
+  END IF;
+
+  IF concurrent AND is_populated THEN
+    EXECUTE format('REFRESH MATERIALIZED VIEW CONCURRENTLY %I', matview_name);
+  ELSE
+    EXECUTE format('REFRESH MATERIALIZED VIEW %I', matview_name);
+  END IF;
+  RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
+
 DROP FUNCTION IF EXISTS ro_bird_travel_timeline;
 CREATE FUNCTION ro_bird_travel_timeline(b_id uuid)
 RETURNS TABLE (
@@ -1405,6 +1453,8 @@ BEGIN
 END; $$
 LANGUAGE PLPGSQL;
 
+-- Superseded by src/db-tools/db_export.py (parallel, chunked, resumable, with a manifest of row counts/checksums)
+-- Kept for the existing callers; writes the same csv_backups/<timestamp>/<table>.csv layout
 DROP FUNCTION IF EXISTS rw_export_environment;
 
 CREATE FUNCTION rw_export_environment(env text) RETURNS text AS $$
@@ -43,11 +43,23 @@ RETURNS void
 SECURITY DEFINER
 AS $$
 BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('bander_birds_matview'));
   REFRESH MATERIALIZED VIEW CONCURRENTLY bander_birds_matview;
 RETURN;
 END;
 $$ LANGUAGE plpgsql;
 
+CREATE OR REPLACE FUNCTION rw_refresh_bander_birds_matview_non_conc()
+RETURNS void
+SECURITY DEFINER
+AS $$
+BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('bander_birds_matview'));
+  REFRESH MATERIALIZED VIEW bander_birds_matview;
+RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
 
 -- ----------------------------------------------
 /* Unfiltered Search Events Ordered by event_timestamp Materialized View */
@@ -59,8 +71,11 @@ $$ LANGUAGE plpgsql;
 -- V2.0
 DROP VIEW IF EXISTS vw_advanced_search_events;
 DROP MATERIALIZED VIEW IF EXISTS advanced_search_events;
+DROP VIEW IF EXISTS vw_advanced_search_events_source;
 
-CREATE MATERIALIZED VIEW advanced_search_events 
+-- The search events query itself, shared by the advanced_search_events matview and
+-- advanced_search_events_incremental (below) so the two can't drift apart
+CREATE VIEW vw_advanced_search_events_source
   AS
 SELECT 
   e.id, e.event_type, e.bird_id, e.row_creation_timestamp_, e.event_timestamp, e.event_reporter_id, e.event_provider_id, e.event_owner_id,
@@ -102,6 +117,10 @@ GROUP BY
 	br.nznbbs_certification_number, bp.nznbbs_certification_number, bo.nznbbs_certification_number,
 	cm.id;
 
+CREATE MATERIALIZED VIEW advanced_search_events
+  AS
+SELECT * FROM vw_advanced_search_events_source;
+
 CREATE UNIQUE INDEX IF NOT EXISTS idx_as_event_id ON advanced_search_events(id);
 CREATE INDEX IF NOT EXISTS idx_as_event_reporter_id ON advanced_search_events(event_reporter_id);
 CREATE INDEX IF NOT EXISTS idx_as_event_provider_id ON advanced_search_events(event_provider_id);
@@ -130,11 +149,281 @@ RETURNS void
 SECURITY DEFINER
 AS $$
 BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('advanced_search_events'));
   REFRESH MATERIALIZED VIEW CONCURRENTLY advanced_search_events;
 RETURN;
 END;
 $$ LANGUAGE plpgsql;
 
+CREATE OR REPLACE FUNCTION rw_refresh_advanced_search_events_matview_non_conc()
+RETURNS void
+SECURITY DEFINER
+AS $$
+BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('advanced_search_events'));
+  REFRESH MATERIALIZED VIEW advanced_search_events;
+RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
+-- ----------------------------------------------
+/* Incrementally maintained Advanced Search Events */
+-- ----------------------------------------------
+
+/* Same rows as advanced_search_events, but kept up to date by src/db-tools/db_search_events_incremental.py */
+/* recomputing only the events named in search_event_change since its watermark, rather than a full refresh */
+/* ============================ */
+
+DROP TABLE IF EXISTS advanced_search_events_incremental;
+
+CREATE TABLE advanced_search_events_incremental
+  AS
+SELECT * FROM vw_advanced_search_events_source
+WITH NO DATA;
+
+ALTER TABLE advanced_search_events_incremental ADD PRIMARY KEY (id);
+CREATE INDEX IF NOT EXISTS idx_asi_event_reporter_id ON advanced_search_events_incremental(event_reporter_id);
+CREATE INDEX IF NOT EXISTS idx_asi_event_provider_id ON advanced_search_events_incremental(event_provider_id);
+CREATE INDEX IF NOT EXISTS idx_asi_event_owner_id ON advanced_search_events_incremental(event_owner_id);
+CREATE INDEX IF NOT EXISTS idx_asi_event_project_id ON advanced_search_events_incremental(project_id);
+CREATE INDEX IF NOT EXISTS idx_asi_bird_id ON advanced_search_events_incremental(bird_id);
+CREATE INDEX IF NOT EXISTS idx_asi_species_id ON advanced_search_events_incremental(species_id);
+CREATE INDEX IF NOT EXISTS idx_asi_event_timestamp ON advanced_search_events_incremental(event_timestamp);
+CREATE INDEX IF NOT EXISTS idx_asi_row_creation_timestamp ON advanced_search_events_incremental(row_creation_timestamp_);
+CREATE INDEX IF NOT EXISTS idx_asi_event_type ON advanced_search_events_incremental(event_type);
+CREATE INDEX IF NOT EXISTS idx_asi_event_banding_scheme ON advanced_search_events_incremental(event_banding_scheme);
+CREATE INDEX IF NOT EXISTS idx_asi_event_location_description ON advanced_search_events_incremental(location_description);
+CREATE INDEX IF NOT EXISTS idx_asi_event_latlong ON advanced_search_events_incremental(latitude, longitude);
+CREATE INDEX IF NOT EXISTS idx_asi_species_code_nznbbs ON advanced_search_events_incremental(species_code_nznbbs);
+CREATE INDEX IF NOT EXISTS idx_asi_bird_friendly_name ON advanced_search_events_incremental(friendly_name);
+CREATE INDEX IF NOT EXISTS idx_asi_common_name_nznbbs ON advanced_search_events_incremental(common_name_nznbbs);
+CREATE INDEX IF NOT EXISTS idx_asi_project_name ON advanced_search_events_incremental(project_name);
+
+/* One row per mark configuration of each event in advanced_search_events_incremental, so a search by */
+/* colour, side, position or text is an index lookup rather than unnesting agg_mc for every event */
+/* (as vw_advanced_search_events does). Recomputed with its events by db_search_events_incremental.py, */
+/* and queried by src/db-tools/db_mark_search.py */
+DROP VIEW IF EXISTS vw_advanced_search_mark_configuration_source;
+
+-- Same values as the agg_mc entries (alphanumeric_text lowercased)
+CREATE VIEW vw_advanced_search_mark_configuration_source
+  AS
+SELECT
+  mc.id AS mark_configuration_id, mc.event_id, mc.mark_id, mc.side, mc.position, mc.location_idx,
+  mc.mark_type, mc.mark_form, mc.mark_material, mc.mark_fixing, mc.colour, mc.text_colour,
+  LOWER(mc.alphanumeric_text) AS alphanumeric_text
+FROM mark_configuration AS mc;
+
+DROP TABLE IF EXISTS advanced_search_mark_configuration;
+
+CREATE TABLE advanced_search_mark_configuration
+  AS
+SELECT * FROM vw_advanced_search_mark_configuration_source
+WITH NO DATA;
+
+ALTER TABLE advanced_search_mark_configuration ADD PRIMARY KEY (mark_configuration_id);
+CREATE INDEX IF NOT EXISTS idx_asmc_event_id ON advanced_search_mark_configuration(event_id);
+CREATE INDEX IF NOT EXISTS idx_asmc_colour ON advanced_search_mark_configuration(colour, side, position);
+CREATE INDEX IF NOT EXISTS idx_asmc_mark_material ON advanced_search_mark_configuration(mark_material, side, position);
+CREATE INDEX IF NOT EXISTS idx_asmc_alphanumeric_text ON advanced_search_mark_configuration(alphanumeric_text text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_asmc_mark_id ON advanced_search_mark_configuration(mark_id);
+
+-- Rows changed behind the incrementally maintained tables (advanced_search_events_incremental,
+-- bird_movement_summary), logged by the triggers below: which table, and the column and value that
+-- identify what to recompute (e.g. mark_configuration, event_id, <the event's id>). Kept apart from
+-- record_action, which only lists the rows the birdbanding service deleted, for the data platform sync
+CREATE TABLE IF NOT EXISTS search_event_change (
+    id                          bigint PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY,
+    row_creation_timestamp_     timestamp with time zone NOT NULL DEFAULT now(),
+    db_action                   enum_db_log_action NOT NULL,
+    db_table                    text NOT NULL,
+    db_table_identifier_name    text NOT NULL,
+    db_table_identifier_value   text NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_search_event_change_row_creation_timestamp_ ON search_event_change(row_creation_timestamp_);
+
+-- Where each incrementally maintained table is up to in search_event_change
+--  last_change_id: highest search_event_change.id applied
+--  pending_gaps: [[from_id, to_id, first_seen_epoch], ...] ids below last_change_id that weren't
+--                visible yet (still being written by an open transaction, or rolled back)
+CREATE TABLE IF NOT EXISTS incremental_refresh_watermark (
+    name                        text PRIMARY KEY,
+    last_change_id              bigint NOT NULL,
+    pending_gaps                jsonb NOT NULL DEFAULT '[]'::jsonb,
+    row_update_timestamp_       timestamp with time zone NOT NULL DEFAULT now()
+);
+
+-- Table has just been (re)created empty, so it needs a full rebuild before incremental updates
+DELETE FROM incremental_refresh_watermark WHERE name = 'advanced_search_events_incremental';
+
+/* Record the events touched by changes to the tables behind advanced search events in search_event_change */
+/* Statement-level so a bulk upload writes one search_event_change row per event, not per row and trigger */
+CREATE OR REPLACE FUNCTION rw_record_search_event_action()
+RETURNS TRIGGER
+AS $$
+DECLARE
+  key_column text := TG_ARGV[0];
+  changed_rows text := 'new_rows';
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    changed_rows := 'old_rows';
+  END IF;
+
+  EXECUTE format(
+    'INSERT INTO search_event_change (db_action, db_table, db_table_identifier_name, db_table_identifier_value) '
+    'SELECT %L::enum_db_log_action, %L, %L, changed.key_value '
+    'FROM (SELECT DISTINCT %I::text AS key_value FROM %I WHERE %I IS NOT NULL) AS changed',
+    TG_OP, TG_TABLE_NAME, key_column, key_column, changed_rows, key_column);
+
+  -- A row moved from one event to another changes both
+  IF TG_OP = 'UPDATE' AND key_column <> 'id' THEN
+    EXECUTE format(
+      'INSERT INTO search_event_change (db_action, db_table, db_table_identifier_name, db_table_identifier_value) '
+      'SELECT %L::enum_db_log_action, %L, %L, changed.key_value '
+      'FROM (SELECT DISTINCT o.%I::text AS key_value FROM old_rows AS o '
+      '      WHERE o.%I IS NOT NULL AND NOT EXISTS (SELECT 1 FROM new_rows AS n WHERE n.%I = o.%I)) AS changed',
+      TG_OP, TG_TABLE_NAME, key_column, key_column, key_column, key_column, key_column);
+  END IF;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+/* Row-level for the (low volume) tables whose changes fan out to many events */
+CREATE OR REPLACE FUNCTION rw_record_search_event_reference_action()
+RETURNS TRIGGER
+AS $$
+BEGIN
+  INSERT INTO search_event_change (db_action, db_table, db_table_identifier_name, db_table_identifier_value)
+  VALUES (TG_OP::enum_db_log_action, TG_TABLE_NAME, 'id', NEW.id::text);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS event_search_event_insert_trigger ON event;
+CREATE TRIGGER event_search_event_insert_trigger AFTER INSERT ON event
+REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE rw_record_search_event_action('id');
+DROP TRIGGER IF EXISTS event_search_event_update_trigger ON event;
+CREATE TRIGGER event_search_event_update_trigger AFTER UPDATE ON event
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE rw_record_search_event_action('id');
+DROP TRIGGER IF EXISTS event_search_event_delete_trigger ON event;
+CREATE TRIGGER event_search_event_delete_trigger AFTER DELETE ON event
+REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE rw_record_search_event_action('id');
+
+DROP TRIGGER IF EXISTS mark_configuration_search_event_insert_trigger ON mark_configuration;
+CREATE TRIGGER mark_configuration_search_event_insert_trigger AFTER INSERT ON mark_configuration
+REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE rw_record_search_event_action('event_id');
+DROP TRIGGER IF EXISTS mark_configuration_search_event_update_trigger ON mark_configuration;
+CREATE TRIGGER mark_configuration_search_event_update_trigger AFTER UPDATE ON mark_configuration
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE rw_record_search_event_action('event_id');
+DROP TRIGGER IF EXISTS mark_configuration_search_event_delete_trigger ON mark_configuration;
+CREATE TRIGGER mark_configuration_search_event_delete_trigger AFTER DELETE ON mark_configuration
+REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE rw_record_search_event_action('event_id');
+
+DROP TRIGGER IF EXISTS characteristic_measurement_search_event_insert_trigger ON characteristic_measurement;
+CREATE TRIGGER characteristic_measurement_search_event_insert_trigger AFTER INSERT ON characteristic_measurement
+REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE rw_record_search_event_action('event_id');
+DROP TRIGGER IF EXISTS characteristic_measurement_search_event_update_trigger ON characteristic_measurement;
+CREATE TRIGGER characteristic_measurement_search_event_update_trigger AFTER UPDATE ON characteristic_measurement
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE rw_record_search_event_action('event_id');
+DROP TRIGGER IF EXISTS characteristic_measurement_search_event_delete_trigger ON characteristic_measurement;
+CREATE TRIGGER characteristic_measurement_search_event_delete_trigger AFTER DELETE ON characteristic_measurement
+REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE rw_record_search_event_action('event_id');
+
+DROP TRIGGER IF EXISTS bird_search_event_update_trigger ON bird;
+CREATE TRIGGER bird_search_event_update_trigger AFTER UPDATE ON bird FOR EACH ROW
+WHEN (OLD.species_id IS DISTINCT FROM NEW.species_id OR OLD.friendly_name IS DISTINCT FROM NEW.friendly_name)
+EXECUTE PROCEDURE rw_record_search_event_reference_action();
+
+DROP TRIGGER IF EXISTS project_search_event_update_trigger ON project;
+CREATE TRIGGER project_search_event_update_trigger AFTER UPDATE ON project FOR EACH ROW
+WHEN (OLD.name IS DISTINCT FROM NEW.name OR OLD.default_moratorium_expiry IS DISTINCT FROM NEW.default_moratorium_expiry)
+EXECUTE PROCEDURE rw_record_search_event_reference_action();
+
+-- Not last_login etc. - logging in shouldn't recompute every event the bander is on
+DROP TRIGGER IF EXISTS bander_search_event_update_trigger ON bander;
+CREATE TRIGGER bander_search_event_update_trigger AFTER UPDATE ON bander FOR EACH ROW
+WHEN (OLD.nznbbs_certification_number IS DISTINCT FROM NEW.nznbbs_certification_number)
+EXECUTE PROCEDURE rw_record_search_event_reference_action();
+
+DROP TRIGGER IF EXISTS species_search_event_update_trigger ON species;
+CREATE TRIGGER species_search_event_update_trigger AFTER UPDATE ON species FOR EACH ROW
+WHEN (OLD.common_name_nznbbs IS DISTINCT FROM NEW.common_name_nznbbs
+  OR OLD.scientific_name_nznbbs IS DISTINCT FROM NEW.scientific_name_nznbbs
+  OR OLD.species_code_nznbbs IS DISTINCT FROM NEW.species_code_nznbbs)
+EXECUTE PROCEDURE rw_record_search_event_reference_action();
+
+-- The source view inner joins the groups, so a species joining or leaving one adds or removes its events
+DROP TRIGGER IF EXISTS species_group_membership_search_event_insert_trigger ON species_group_membership;
+CREATE TRIGGER species_group_membership_search_event_insert_trigger AFTER INSERT ON species_group_membership
+REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE rw_record_search_event_action('species_id');
+DROP TRIGGER IF EXISTS species_group_membership_search_event_update_trigger ON species_group_membership;
+CREATE TRIGGER species_group_membership_search_event_update_trigger AFTER UPDATE ON species_group_membership
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE rw_record_search_event_action('species_id');
+DROP TRIGGER IF EXISTS species_group_membership_search_event_delete_trigger ON species_group_membership;
+CREATE TRIGGER species_group_membership_search_event_delete_trigger AFTER DELETE ON species_group_membership
+REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE rw_record_search_event_action('species_id');
+
+DROP TRIGGER IF EXISTS species_group_search_event_update_trigger ON species_group;
+CREATE TRIGGER species_group_search_event_update_trigger AFTER UPDATE ON species_group FOR EACH ROW
+WHEN (OLD.name IS DISTINCT FROM NEW.name)
+EXECUTE PROCEDURE rw_record_search_event_reference_action();
+
+-- ----------------------------------------------
+/* Bird Movement Summary */
+-- ----------------------------------------------
+
+/* What ro_bird_travel_timeline, ro_bird_location_delta_first_to_last, ro_bird_location_delta_most_recent */
+/* and ro_bird_status_summary work out per bird page load, precomputed for every bird by */
+/* src/db-tools/db_bird_movement.py, which recomputes the birds named in search_event_change since its watermark */
+/* Distances are metres on the WGS84 spheroid, as ST_Distance between geography points */
+/* ============================ */
+
+DROP TABLE IF EXISTS bird_movement_summary;
+
+CREATE TABLE bird_movement_summary (
+    bird_id                     uuid PRIMARY KEY,
+    event_count                 integer NOT NULL,
+    located_event_count         integer NOT NULL,
+    first_event_timestamp       timestamp with time zone NOT NULL,
+    last_event_timestamp        timestamp with time zone NOT NULL,
+    total_distance              double precision NOT NULL, /* Sum of the travel timeline's distances */
+    delta_first_to_last         double precision, /* As ro_bird_location_delta_first_to_last */
+    delta_most_recent           double precision, /* As ro_bird_location_delta_most_recent */
+    latest_out_status_code      text,
+    latest_out_status_timestamp timestamp with time zone,
+    travel_timeline             jsonb NOT NULL, /* [{id, event_timestamp, distance, cumulative_distance}], as ro_bird_travel_timeline */
+    status_summary              jsonb NOT NULL, /* [{id, event_timestamp, out_status_code}], as ro_bird_status_summary */
+    row_update_timestamp_       timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_bms_latest_out_status_code ON bird_movement_summary(latest_out_status_code);
+
+-- Table has just been (re)created empty, so it needs a full rebuild before incremental updates
+DELETE FROM incremental_refresh_watermark WHERE name = 'bird_movement_summary';
+
+/* Record the bird(s) each change to event touches in search_event_change (db_table event, */
+/* db_table_identifier_name bird_id) - including the bird an event was moved off */
+DROP TRIGGER IF EXISTS event_bird_movement_insert_trigger ON event;
+CREATE TRIGGER event_bird_movement_insert_trigger AFTER INSERT ON event
+REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE rw_record_search_event_action('bird_id');
+DROP TRIGGER IF EXISTS event_bird_movement_update_trigger ON event;
+CREATE TRIGGER event_bird_movement_update_trigger AFTER UPDATE ON event
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE rw_record_search_event_action('bird_id');
+DROP TRIGGER IF EXISTS event_bird_movement_delete_trigger ON event;
+CREATE TRIGGER event_bird_movement_delete_trigger AFTER DELETE ON event
+REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE rw_record_search_event_action('bird_id');
+
+-- Get a bird's movement summary (one primary key read, no per-event work)
+DROP FUNCTION IF EXISTS ro_bird_movement_summary;
+
+CREATE FUNCTION ro_bird_movement_summary(b_id uuid)
+RETURNS SETOF bird_movement_summary AS $$
+  SELECT * FROM bird_movement_summary WHERE bird_id = b_id;
+$$
+LANGUAGE SQL STABLE;
+
 /* Unfiltered Search Events Materialized View Sorted by event_timestamp */
 
 DROP MATERIALIZED VIEW IF EXISTS search_events_sort_timestamp;
@@ -200,11 +489,23 @@ RETURNS void
 SECURITY DEFINER
 AS $$
 BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('search_events_sort_timestamp'));
   REFRESH MATERIALIZED VIEW CONCURRENTLY search_events_sort_timestamp;
 RETURN;
 END;
 $$ LANGUAGE plpgsql;
 
+CREATE OR REPLACE FUNCTION rw_refresh_search_event_sort_timestamp_matview_non_conc()
+RETURNS void
+SECURITY DEFINER
+AS $$
+BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('search_events_sort_timestamp'));
+  REFRESH MATERIALIZED VIEW search_events_sort_timestamp;
+RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
 -- ----------------------------------------------
 /* Unfiltered Search Events Ordered by prefix_number Materialized View */
 -- ----------------------------------------------
@@ -277,6 +578,7 @@ RETURNS void
 SECURITY DEFINER
 AS $$
 BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('search_events_sort_prefix_number'));
   REFRESH MATERIALIZED VIEW CONCURRENTLY search_events_sort_prefix_number;
 RETURN;
 END;
@@ -287,6 +589,7 @@ RETURNS void
 SECURITY DEFINER
 AS $$
 BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('search_events_sort_prefix_number'));
   REFRESH MATERIALIZED VIEW search_events_sort_prefix_number;
 RETURN;
 END;
@@ -364,6 +667,7 @@ RETURNS void
 SECURITY DEFINER
 AS $$
 BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('search_events_sort_short_number'));
   REFRESH MATERIALIZED VIEW CONCURRENTLY search_events_sort_short_number;
 RETURN;
 END;
@@ -375,6 +679,7 @@ RETURNS void
 SECURITY DEFINER
 AS $$
 BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('search_events_sort_short_number'));
   REFRESH MATERIALIZED VIEW search_events_sort_short_number;
 RETURN;
 END;
@@ -452,6 +757,7 @@ RETURNS void
 SECURITY DEFINER
 AS $$
 BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('search_events_sort_project_name'));
   REFRESH MATERIALIZED VIEW CONCURRENTLY search_events_sort_project_name;
 RETURN;
 END;
@@ -462,6 +768,7 @@ RETURNS void
 SECURITY DEFINER
 AS $$
 BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('search_events_sort_project_name'));
   REFRESH MATERIALIZED VIEW search_events_sort_project_name;
 RETURN;
 END;
@@ -539,6 +846,7 @@ RETURNS void
 SECURITY DEFINER
 AS $$
 BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('search_events_sort_species_common_name'));
   REFRESH MATERIALIZED VIEW CONCURRENTLY search_events_sort_species_common_name;
 RETURN;
 END;
@@ -549,6 +857,7 @@ RETURNS void
 SECURITY DEFINER
 AS $$
 BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('search_events_sort_species_common_name'));
   REFRESH MATERIALIZED VIEW search_events_sort_species_common_name;
 RETURN;
 END;
@@ -626,6 +935,7 @@ RETURNS void
 SECURITY DEFINER
 AS $$
 BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('search_events_sort_row_creation_timestamp'));
   REFRESH MATERIALIZED VIEW CONCURRENTLY search_events_sort_row_creation_timestamp;
 RETURN;
 END;
@@ -639,6 +949,7 @@ RETURNS void
 SECURITY DEFINER
 AS $$
 BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('search_events_sort_row_creation_timestamp'));
   REFRESH MATERIALIZED VIEW search_events_sort_row_creation_timestamp;
 RETURN;
 END;
@@ -673,11 +984,23 @@ RETURNS void
 SECURITY DEFINER
 AS $$
 BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('project_event_counts_matview'));
   REFRESH MATERIALIZED VIEW CONCURRENTLY project_event_counts_matview;
 RETURN;
 END;
 $$ LANGUAGE plpgsql;
 
+CREATE OR REPLACE FUNCTION rw_refresh_project_event_counts_matview_non_conc()
+RETURNS void
+SECURITY DEFINER
+AS $$
+BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('project_event_counts_matview'));
+  REFRESH MATERIALIZED VIEW project_event_counts_matview;
+RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
 
 /* Create materialized views to improve pagination performance for marks */
 /* ============================ */
@@ -732,11 +1055,23 @@ RETURNS void
 SECURITY DEFINER
 AS $$
 BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('mark_pagination_sort_band_number_matview'));
   REFRESH MATERIALIZED VIEW CONCURRENTLY mark_pagination_sort_band_number_matview;
 RETURN;
 END;
 $$ LANGUAGE plpgsql;
 
+CREATE OR REPLACE FUNCTION rw_refresh_mark_pagination_sort_band_number_matview_non_conc()
+RETURNS void
+SECURITY DEFINER
+AS $$
+BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('mark_pagination_sort_band_number_matview'));
+  REFRESH MATERIALIZED VIEW mark_pagination_sort_band_number_matview;
+RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
 
 DROP MATERIALIZED VIEW IF EXISTS mark_latest_matview;
 
@@ -767,11 +1102,23 @@ RETURNS void
 SECURITY DEFINER
 AS $$
 BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('mark_latest_matview'));
   REFRESH MATERIALIZED VIEW CONCURRENTLY mark_latest_matview;
 RETURN;
 END;
 $$ LANGUAGE plpgsql;
 
+CREATE OR REPLACE FUNCTION rw_refresh_mark_latest_matview_non_conc()
+RETURNS void
+SECURITY DEFINER
+AS $$
+BEGIN
+  PERFORM pg_advisory_xact_lock(ro_matview_lock_namespace(), ro_matview_lock_key('mark_latest_matview'));
+  REFRESH MATERIALIZED VIEW mark_latest_matview;
+RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
 -- Have replicated these views here because they are dependent on the materialized view above
 -- ----------------------------------------------
 /* Aggregated Mark Last Short numbers */
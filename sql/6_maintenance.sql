@@ -1,3 +1,6 @@
+-- For a continuous view (deltas, unused indexes, tables needing a vacuum, slowest functions and
+-- statements) run src/db-tools/db_health.py, which emits CloudWatch Embedded Metric Format lines.
+
 -- Review Autovacuum history:
 -- Initial query put together by jdreadon to review autovacuum history
 SELECT
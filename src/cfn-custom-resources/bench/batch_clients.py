@@ -0,0 +1,237 @@
+# Provisions a batch of user pool clients through Custom::UserPoolClientBatch against a stubbed
+# Cognito that throttles (TooManyRequestsException) once requests exceed a token-bucket rate,
+# and compares it with creating the same clients one at a time. Then updates and deletes the
+# batch. Exits 1 unless every client was created exactly once, every client result is Created,
+# Updated or Deleted as expected, and Cognito throttled at least once (so the limiter was
+# actually exercised). tests/test_batch_clients.py runs the same checks on a smaller batch.
+#
+# Usage (from src/cfn-custom-resources, stdlib only - Cognito is stubbed):
+#   python3 bench/batch_clients.py [--clients 40] [--rate 20] [--burst 10] [--api-latency-ms 300]
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cfn_custom_clients  # noqa: E402
+import cfn_custom_response  # noqa: E402
+
+
+class ThrottledError(Exception):
+# -----------------------------------------------------------------------------------------------------------------
+    # Looks enough like a botocore ClientError for cfn_custom_clients.error_code
+    def __init__(self):
+        super(ThrottledError, self).__init__('Rate exceeded')
+        self.response = {'Error': {'Code': 'TooManyRequestsException', 'Message': 'Rate exceeded'}}
+
+
+class ThrottlingCognitoIdp(object):
+# -----------------------------------------------------------------------------------------------------------------
+
+    def __init__(self, rate, burst, latency):
+        self.rate = rate
+        self.burst = burst
+        self.latency = latency
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+        self.clients = {}
+        self.created = {}
+        self.calls = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def _call(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            self.calls += 1
+            if self.tokens < 1:
+                self.throttled += 1
+                raise ThrottledError()
+            self.tokens -= 1
+        time.sleep(self.latency)
+
+    def create_user_pool_client(self, **params):
+        self._call()
+        client = dict(params, ClientId=uuid.uuid4().hex)
+        with self.lock:
+            self.clients[client['ClientId']] = client
+            self.created[client['ClientName']] = self.created.get(client['ClientName'], 0) + 1
+        return {'UserPoolClient': client}
+
+    def list_user_pool_clients(self, UserPoolId, MaxResults, NextToken=None):
+        self._call()
+        with self.lock:
+            clients = sorted(self.clients.values(), key=lambda c: c['ClientId'])
+        start = int(NextToken or 0)
+        response = {'UserPoolClients': [{'ClientId': c['ClientId'], 'ClientName': c['ClientName']} for c in clients[start:start + MaxResults]]}
+        if start + MaxResults < len(clients):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def update_user_pool_client(self, **params):
+        self._call()
+        with self.lock:
+            self.clients[params['ClientId']].update(params)
+            return {'UserPoolClient': dict(self.clients[params['ClientId']])}
+
+    def delete_user_pool_client(self, UserPoolId, ClientId):
+        self._call()
+        with self.lock:
+            self.clients.pop(ClientId, None)
+
+
+class StubContext(object):
+# -----------------------------------------------------------------------------------------------------------------
+    log_stream_name = 'bench'
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+def client_spec(i):
+# -----------------------------------------------------------------------------------------------------------------
+    return {
+        'ClientName': 'bench-client-{0}'.format(i),
+        'ExplicitAuthFlows': 'ADMIN_NO_SRP_AUTH',
+        'SupportedIdps': 'COGNITO',
+        'AllowedOAuthFlowsUserPoolClient': 'true',
+        'AllowedOAuthFlows': 'code',
+        'AllowedOAuthScopes': 'openid,email',
+        'CallbackURLs': ['https://example.com/callback'],
+        'LogoutURLs': ['https://example.com/logout'],
+        'GenerateSecret': 'false',
+    }
+
+
+def event(request_type, resource_type, props, old_props=None):
+# -----------------------------------------------------------------------------------------------------------------
+    e = {
+        'RequestType': request_type,
+        'ResourceType': resource_type,
+        'LogicalResourceId': 'Bench',
+        'ResourceProperties': props,
+        'StackId': 'bench-stack',
+        'RequestId': uuid.uuid4().hex,
+        'ResponseURL': 'http://127.0.0.1/unused',
+    }
+    if old_props is not None:
+        e['OldResourceProperties'] = old_props
+    return e
+
+
+def dispatch(registry, e):
+# -----------------------------------------------------------------------------------------------------------------
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        res = registry.dispatch(e, StubContext())
+    return res, round(time.perf_counter() - started, 3)
+
+
+def batch_results(res):
+# -----------------------------------------------------------------------------------------------------------------
+    return json.loads(res['Data'].get('Results') or '[]')
+
+
+def check(problems, name, ok, detail):
+# -----------------------------------------------------------------------------------------------------------------
+    if not ok:
+        problems.append('{0}: {1}'.format(name, detail))
+
+
+def run(clients=40, rate=20, burst=10, api_latency_ms=300):
+# -----------------------------------------------------------------------------------------------------------------
+    """Returns (report, problems) - problems lists every check that failed. Responses aren't swallowed here, see main."""
+    router = importlib.import_module('cfn-custom-router')
+    registry = router.cfn_custom_registry
+    specs = [client_spec(i) for i in range(clients)]
+    names = sorted(s['ClientName'] for s in specs)
+    report, problems = {}, []
+
+    # One resource per client, one after the other (how CloudFormation drives the single client resource)
+    stub = ThrottlingCognitoIdp(rate, burst, api_latency_ms / 1000.0)
+    cfn_custom_clients.set_client('cognito-idp', stub)
+    started = time.perf_counter()
+    failures = 0
+    for spec in specs:
+        res, _ = dispatch(registry, event('Create', 'Custom::UserPoolClient', dict(spec, UserPoolId='sequential')))
+        failures += not res['Result']
+    report['sequential_create'] = {'seconds': round(time.perf_counter() - started, 3), 'failed': failures,
+                                   'calls': stub.calls, 'throttled': stub.throttled}
+
+    # The same clients as a single batch resource
+    stub = ThrottlingCognitoIdp(rate, burst, api_latency_ms / 1000.0)
+    cfn_custom_clients.set_client('cognito-idp', stub)
+    props = {'UserPoolId': 'batch', 'Clients': specs}
+    res, seconds = dispatch(registry, event('Create', 'Custom::UserPoolClientBatch', props))
+    results = batch_results(res)
+    report['batch_create'] = {
+        'seconds': seconds, 'result': res['Result'], 'calls': stub.calls, 'throttled': stub.throttled,
+        'throttles': res['Data'].get('Throttles', 0),
+        'created_once': stub.created == dict((n, 1) for n in names),
+        'client_ids': len([i for i in res['Data'].get('ClientIds', '').split(',') if i]),
+    }
+    check(problems, 'batch_create', res['Result'], res['Message'])
+    check(problems, 'batch_create', report['batch_create']['created_once'],
+          'clients not created exactly once: {0}'.format(dict((n, c) for n, c in stub.created.items() if c != 1)
+                                                         or sorted(set(names) - set(stub.created))))
+    check(problems, 'batch_create', report['batch_create']['client_ids'] == clients,
+          '{0} client IDs for {1} clients'.format(report['batch_create']['client_ids'], clients))
+    check(problems, 'batch_create', all(r['Status'] == 'Created' for r in results),
+          'statuses {0}'.format(sorted(set(r['Status'] for r in results))))
+    check(problems, 'batch_create', report['batch_create']['throttles'] > 0,
+          'Cognito never throttled, so the limiter was not exercised (lower --rate/--burst)')
+
+    # Drop a client and change the rest
+    new_props = {'UserPoolId': 'batch', 'Clients': [dict(s, AllowedOAuthScopes='openid') for s in specs[1:]]}
+    res, seconds = dispatch(registry, event('Update', 'Custom::UserPoolClientBatch', new_props, props))
+    results = batch_results(res)
+    report['batch_update'] = {'seconds': seconds, 'result': res['Result'], 'remaining_clients': len(stub.clients),
+                              'throttles': res['Data'].get('Throttles', 0)}
+    check(problems, 'batch_update', res['Result'], res['Message'])
+    check(problems, 'batch_update', sorted(r['Status'] for r in results) == ['Deleted'] + ['Updated'] * (clients - 1),
+          'statuses {0}'.format(sorted(set(r['Status'] for r in results))))
+    check(problems, 'batch_update', len(stub.clients) == clients - 1,
+          '{0} clients left, expected {1}'.format(len(stub.clients), clients - 1))
+
+    res, seconds = dispatch(registry, event('Delete', 'Custom::UserPoolClientBatch', new_props))
+    results = batch_results(res)
+    report['batch_delete'] = {'seconds': seconds, 'result': res['Result'], 'remaining_clients': len(stub.clients),
+                              'throttled_total': stub.throttled}
+    check(problems, 'batch_delete', res['Result'], res['Message'])
+    check(problems, 'batch_delete', all(r['Status'] == 'Deleted' for r in results),
+          'statuses {0}'.format(sorted(set(r['Status'] for r in results))))
+    check(problems, 'batch_delete', not stub.clients, '{0} clients left'.format(len(stub.clients)))
+
+    return report, problems
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=40)
+    parser.add_argument('--rate', type=float, default=20, help='Sustained Cognito requests/sec before throttling')
+    parser.add_argument('--burst', type=int, default=10, help='Token bucket size')
+    parser.add_argument('--api-latency-ms', type=float, default=300)
+    args = parser.parse_args()
+
+    cfn_custom_response.put_response = lambda url, body, context=None: (True, [])
+    report, problems = run(args.clients, args.rate, args.burst, args.api_latency_ms)
+    report['problems'] = problems
+    print(json.dumps(report, indent=2))
+
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# Compares cold and warm invocation latency of the Cognito custom resource operations
+# when run through the old per-request fork/Pipe path versus the shared thread pool executor.
+#
+# Cognito itself is replaced by a stub client, so the numbers only reflect the cost of the
+# execution layer plus the configured fake API latency. Each "cold" sample is taken in a
+# fresh interpreter (including importing the handler module), mimicking a new Lambda container.
+#
+# Usage (from src/cfn-custom-resources, stdlib only - Cognito is stubbed):
+#   python3 bench/executor_latency.py [--runs 5] [--calls 20] [--api-latency-ms 20]
+
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from multiprocessing import Process, Pipe
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODULE_DIR = os.path.dirname(HERE)
+MODULE_PATH = os.path.join(MODULE_DIR, 'cfn-custom-manage-cognito-user-pool.py')
+
+
+class StubCognitoIdp(object):
+# -----------------------------------------------------------------------------------------------------------------
+    def __init__(self, latency):
+        self.latency = latency
+
+    def create_user_pool_client(self, **params):
+        time.sleep(self.latency)
+        return {'UserPoolClient': {'ClientId': 'stub-client-id', 'ClientName': params['ClientName'], 'UserPoolId': params['UserPoolId']}}
+
+
+class StubContext(object):
+# -----------------------------------------------------------------------------------------------------------------
+    log_stream_name = 'bench'
+
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+
+def load_module():
+# -----------------------------------------------------------------------------------------------------------------
+    sys.path.insert(0, MODULE_DIR)
+    spec = importlib.util.spec_from_file_location('cfn_custom_manage_cognito_user_pool', MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def legacy_run_operation(operation, params, context):
+# -----------------------------------------------------------------------------------------------------------------
+    # What the handlers used to do: fork, block on the pipe, then join
+    def target(params, results_pipe):
+        results_pipe.send(operation(params, None))
+        results_pipe.close()
+
+    parent_end, child_end = Pipe()
+    p = Process(target=target, args=(params, child_end,))
+    p.start()
+    res = parent_end.recv()
+    p.join(timeout=180)
+    return res
+
+
+def run_single(path, calls, api_latency):
+# -----------------------------------------------------------------------------------------------------------------
+    started = time.perf_counter()
+    module = load_module()
+    sys.modules['cfn_custom_clients'].set_client('cognito-idp', StubCognitoIdp(api_latency))
+
+    if path == 'legacy':
+        runner = legacy_run_operation
+    else:
+        runner = sys.modules['cfn_custom_executor'].run_operation
+
+    params = {'UserPoolId': 'stub-pool', 'ClientName': 'bench-client'}
+    context = StubContext()
+    timings = []
+
+    for i in range(calls):
+        call_started = time.perf_counter()
+        res = runner(module.create_client, dict(params), context)
+        timings.append(time.perf_counter() - call_started)
+        if not res['Result']:
+            raise RuntimeError(res['Message'])
+
+    # Cold = import + first call, warm = every call after that
+    return {
+        'cold': (timings[0] + (time.perf_counter() - started - sum(timings))),
+        'warm': timings[1:],
+    }
+
+
+def summarise(samples):
+# -----------------------------------------------------------------------------------------------------------------
+    return {
+        'mean_ms': round(statistics.mean(samples) * 1000, 3),
+        'p50_ms': round(statistics.median(samples) * 1000, 3),
+        'max_ms': round(max(samples) * 1000, 3),
+    }
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters (cold starts) per path')
+    parser.add_argument('--calls', type=int, default=20, help='Invocations per interpreter')
+    parser.add_argument('--api-latency-ms', type=float, default=20, help='Simulated Cognito API latency')
+    parser.add_argument('--single', choices=['legacy', 'executor'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(run_single(args.single, args.calls, args.api_latency_ms / 1000.0)))
+        return
+
+    results = {}
+    for path in ('legacy', 'executor'):
+        cold, warm = [], []
+        for run in range(args.runs):
+            out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--single', path,
+                                           '--calls', str(args.calls), '--api-latency-ms', str(args.api_latency_ms)])
+            sample = json.loads(out.decode().strip().splitlines()[-1])
+            cold.append(sample['cold'])
+            warm.extend(sample['warm'])
+        results[path] = {'cold': summarise(cold), 'warm': summarise(warm)}
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# Cold-start import budget check for the custom resource handler modules.
+#
+# Imports each module in a fresh interpreter (best of N runs) and fails (exit status 1) if any
+# module takes longer than its budget in import_budget.json, or if importing it drags in one of
+# the modules that should only ever be loaded lazily (e.g. boto3, see cfn_custom_clients).
+# tests/test_import_budget.py runs the same check under pytest, one test per module.
+#
+# Usage (from src/cfn-custom-resources):
+#   python3 bench/import_budget.py [--config bench/import_budget.json]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODULE_DIR = os.path.dirname(HERE)
+CONFIG = os.path.join(HERE, 'import_budget.json')
+
+# Run in the child interpreter: import the module, report time taken and what got loaded
+PROBE = """
+import importlib, json, sys, time
+sys.path.insert(0, {module_dir!r})
+started = time.perf_counter()
+importlib.import_module({module!r})
+elapsed = time.perf_counter() - started
+print(json.dumps({{'ms': elapsed * 1000, 'modules': sorted(sys.modules)}}))
+"""
+
+
+def measure(module, runs):
+# -----------------------------------------------------------------------------------------------------------------
+    best, loaded = None, set()
+    for run in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', PROBE.format(module_dir=MODULE_DIR, module=module)],
+                                      cwd=MODULE_DIR, stderr=subprocess.DEVNULL)
+        sample = json.loads(out.decode().strip().splitlines()[-1])
+        best = sample['ms'] if best is None else min(best, sample['ms'])
+        loaded.update(sample['modules'])
+    return best, loaded
+
+
+def load_config(path=CONFIG):
+# -----------------------------------------------------------------------------------------------------------------
+    with open(path) as f:
+        return json.load(f)
+
+
+def forbidden_modules(loaded, config):
+# -----------------------------------------------------------------------------------------------------------------
+    return sorted(set(m.split('.')[0] for m in loaded if m.split('.')[0] in config.get('ForbiddenModules', [])))
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default=CONFIG)
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+
+    failures = []
+    for module, budget in sorted(config['BudgetsMs'].items()):
+        elapsed, loaded = measure(module, config.get('Runs', 5))
+        forbidden = forbidden_modules(loaded, config)
+        status = 'OK'
+        if elapsed > budget:
+            status = 'OVER BUDGET'
+            failures.append(module)
+        if forbidden:
+            status = 'IMPORTS ' + ', '.join(forbidden)
+            failures.append(module)
+        print('{0:<45} {1:>8.1f} ms / {2:>6} ms  {3}'.format(module, elapsed, budget, status))
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
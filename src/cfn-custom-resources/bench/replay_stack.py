@@ -0,0 +1,194 @@
+# Replays a full stack's worth of custom resource events (create everything, update
+# everything, delete everything) through the router against a stubbed Cognito, and reports
+# the total and per-event wall time. Responses to CloudFormation are swallowed. Exits 1 if
+# any event fails, so the stub has to answer the way Cognito does.
+#
+# Usage (from src/cfn-custom-resources, stdlib only - Cognito is stubbed):
+#   python3 bench/replay_stack.py [--clients 12] [--api-latency-ms 20]
+
+import argparse
+import contextlib
+import datetime
+import importlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cfn_custom_clients  # noqa: E402
+import cfn_custom_response  # noqa: E402
+
+
+class StubCognitoIdp(object):
+# -----------------------------------------------------------------------------------------------------------------
+    # Just enough of cognito-idp for the custom resources to be happy
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.clients = {}
+        self.providers = {}
+        self.domains = {}
+        self.lock = threading.Lock()
+
+    def _call(self):
+        time.sleep(self.latency)
+
+    def create_user_pool_client(self, **params):
+        self._call()
+        client = dict(params, ClientId=uuid.uuid4().hex)
+        with self.lock:
+            self.clients[client['ClientId']] = client
+        return {'UserPoolClient': client}
+
+    def list_user_pool_clients(self, UserPoolId, MaxResults, NextToken=None):
+        self._call()
+        with self.lock:
+            clients = sorted(self.clients.values(), key=lambda c: c['ClientId'])
+        start = int(NextToken or 0)
+        page = clients[start:start + MaxResults]
+        response = {'UserPoolClients': [{'ClientId': c['ClientId'], 'ClientName': c['ClientName']} for c in page]}
+        if start + MaxResults < len(clients):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def update_user_pool_client(self, **params):
+        self._call()
+        with self.lock:
+            self.clients[params['ClientId']].update(params)
+            return {'UserPoolClient': dict(self.clients[params['ClientId']])}
+
+    def delete_user_pool_client(self, UserPoolId, ClientId):
+        self._call()
+        with self.lock:
+            self.clients.pop(ClientId, None)
+
+    def _identity_provider(self, params):
+        # The shape CreateIdentityProvider / UpdateIdentityProvider really return: just the
+        # IdentityProvider, datetimes and all
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self.lock:
+            provider = self.providers.setdefault(params['ProviderName'], {'CreationDate': now})
+            provider.update(params, LastModifiedDate=now)
+            return {'IdentityProvider': dict(provider)}
+
+    def create_identity_provider(self, **params):
+        self._call()
+        return self._identity_provider(params)
+
+    def update_identity_provider(self, **params):
+        self._call()
+        return self._identity_provider(params)
+
+    def delete_identity_provider(self, **params):
+        self._call()
+        with self.lock:
+            self.providers.pop(params['ProviderName'], None)
+
+    def create_user_pool_domain(self, **params):
+        self._call()
+        with self.lock:
+            self.domains[params['Domain']] = params
+        return {'CloudFrontDomain': params['Domain'] + '.cloudfront.example'}
+
+    def delete_user_pool_domain(self, **params):
+        self._call()
+
+
+class StubContext(object):
+# -----------------------------------------------------------------------------------------------------------------
+    log_stream_name = 'bench'
+
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+
+def stack_resources(clients):
+# -----------------------------------------------------------------------------------------------------------------
+    resources = []
+    for i in range(clients):
+        resources.append(('Client{0}'.format(i), 'Custom::UserPoolClient', {
+            'UserPoolId': 'stub-pool',
+            'ClientName': 'bench-client-{0}'.format(i),
+            'ExplicitAuthFlows': 'ADMIN_NO_SRP_AUTH',
+            'SupportedIdps': 'COGNITO',
+            'AllowedOAuthFlowsUserPoolClient': 'true',
+            'AllowedOAuthFlows': 'code',
+            'AllowedOAuthScopes': 'openid,email',
+            'CallbackURLs': ['https://example.com/callback'],
+            'LogoutURLs': ['https://example.com/logout'],
+            'GenerateSecret': 'false',
+        }))
+    resources.append(('SAMLIdp', 'Custom::SAMLIdpManagementFunction', {
+        'UserPoolId': 'stub-pool', 'Name': 'ExampleAD', 'IdpIdentifier': 'example', 'Metadata': 'https://example.com/metadata.xml',
+    }))
+    resources.append(('Domain', 'Custom::UserPoolDomain', {
+        'UserPoolId': 'stub-pool', 'DomainName': 'bench', 'CertArn': 'arn:aws:acm:us-east-1:123456789012:certificate/bench',
+    }))
+    resources.append(('RoleMapping', 'Custom::IdentityPoolRoleMapping', {
+        'IdentityProvider': 'cognito-idp.example.amazonaws.com/stub-pool:abc', 'Type': 'Token', 'AmbiguousRoleResolution': 'Deny',
+    }))
+    return resources
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=12, help='User pool client resources in the stack')
+    parser.add_argument('--api-latency-ms', type=float, default=20, help='Simulated Cognito API latency')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    router = importlib.import_module('cfn-custom-router')
+    import_seconds = time.perf_counter() - started
+
+    cfn_custom_clients.set_client('cognito-idp', StubCognitoIdp(args.api_latency_ms / 1000.0))
+    cfn_custom_response.put_response = lambda url, body, context=None: (True, [])
+
+    resources = stack_resources(args.clients)
+    events = []
+    for request_type, ordered in (('Create', resources), ('Update', resources), ('Delete', list(reversed(resources)))):
+        for logical_id, resource_type, props in ordered:
+            events.append({
+                'RequestType': request_type,
+                'ResourceType': resource_type,
+                'LogicalResourceId': logical_id,
+                'ResourceProperties': props,
+                'StackId': 'bench-stack',
+                'RequestId': uuid.uuid4().hex,
+                'ResponseURL': 'http://127.0.0.1/unused',
+            })
+
+    timings = []
+    replay_started = time.perf_counter()
+    for event in events:
+        event_started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            res = router.cfn_custom_registry.dispatch(event, StubContext())
+        timings.append({
+            'RequestType': event['RequestType'],
+            'LogicalResourceId': event['LogicalResourceId'],
+            'Result': res['Result'],
+            'WallMs': round((time.perf_counter() - event_started) * 1000, 3),
+        })
+    total = time.perf_counter() - replay_started
+
+    failed = [t for t in timings if not t['Result']]
+    print(json.dumps({
+        'import_ms': round(import_seconds * 1000, 3),
+        'events': len(events),
+        'failed': failed,
+        'total_ms': round(total * 1000, 3),
+        'per_event': timings,
+    }, indent=2))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# Exercises cfn_custom_response against a local HTTP server standing in for the presigned
+# S3 response URL. The server fails the first few PUTs of every response with a 503 so the
+# retry/backoff path gets a workout, and counts client connections so we can see whether
+# keep-alive connections are actually being reused across responses.
+#
+# Usage (from src/cfn-custom-resources, stdlib only):
+#   python3 bench/response_sender.py [--responses 20] [--failures 2]
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cfn_custom_response  # noqa: E402
+
+
+class StandInS3(BaseHTTPRequestHandler):
+# -----------------------------------------------------------------------------------------------------------------
+    protocol_version = 'HTTP/1.1'
+    failures = 0
+    received = {}
+    connections = set()
+    lock = threading.Lock()
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['content-length']))
+        request_id = json.loads(body)['RequestId']
+
+        with self.lock:
+            self.connections.add(self.client_address)
+            seen = self.received.get(request_id, 0)
+            self.received[request_id] = seen + 1
+
+        status = 503 if seen < self.failures else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StubContext(object):
+# -----------------------------------------------------------------------------------------------------------------
+    log_stream_name = 'bench'
+
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--responses', type=int, default=20)
+    parser.add_argument('--failures', type=int, default=2, help='503s returned before each response succeeds')
+    parser.add_argument('--data-bytes', type=int, default=6000, help='Size of the Data payload (to exercise trimming)')
+    args = parser.parse_args()
+
+    StandInS3.failures = args.failures
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInS3)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Keep the backoff short, we're measuring the sender rather than the sleep
+    cfn_custom_response.BASE_DELAY_SECONDS = 0.01
+    url = 'http://127.0.0.1:{0}/bucket/key?X-Amz-Signature=stub'.format(server.server_address[1])
+
+    latencies, sent_count, trimmed = [], 0, []
+    for i in range(args.responses):
+        event = {'ResponseURL': url, 'StackId': 'stack', 'RequestId': 'req-{0}'.format(i), 'LogicalResourceId': 'Bench'}
+        data = {'ClientId': 'abc', 'Big': 'x' * args.data_bytes}
+        body, trimmed = cfn_custom_response.fit_response_body(
+            cfn_custom_response.build_response_body(event, StubContext(), cfn_custom_response.CFN_SUCCESS, data))
+        sent, attempts = cfn_custom_response.put_response(url, body, StubContext())
+        sent_count += sent
+        latencies.extend(a['LatencyMs'] for a in attempts)
+
+    server.shutdown()
+    print(json.dumps({
+        'responses': args.responses,
+        'delivered': sent_count,
+        'attempts': len(latencies),
+        'connections_opened': len(StandInS3.connections),
+        'trimmed_keys': trimmed,
+        'attempt_latency_ms': {
+            'mean': round(statistics.mean(latencies), 3),
+            'p50': round(statistics.median(latencies), 3),
+            'max': round(max(latencies), 3),
+        },
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,73 +5,30 @@
 # of Lambda-backed custom resources ONLY! It doesn't make a whole heap of sense to try and execute these
 # functions outside of that context.
 
-import boto3
-from botocore.exceptions import ClientError
-from botocore.vendored import requests
-from multiprocessing import Process, Pipe
-import json
-import logging
-
-# Cloudformation response values
-CFN_SUCCESS = "SUCCESS"
-CFN_FAILED = "FAILED"
-
-# Cognito Identity Provider Client
-client_idp = boto3.client('cognito-idp')
-
-# Note: This function is normally included when defining Lambda-backed custom resources
-# inline within CloudFormation templates. However, our custom resources for Cognito
-# are larger than the 4096 character limit for inline definition. Oh dear. That means
-# that our custom resource is too big to live inside the cloudformation template.
-# BUT if it's not inside the cloudformation template, we can't just include the cfnresponse
-# module, since that's only supplied by Cloudformation itself, hence we must reproduce it here. GAH.
-#
-# This function is the same as the contents of the cfnresponse module, taken from this URL:
-# https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/cfn-lambda-function-code-cfnresponsemodule.html
-def cfn_response_send(event, context, responseStatus, responseData, physicalResourceId=None, noEcho=False):
+# Note: this is a pure transformation, so there's deliberately no boto3 (or any other
+# heavy import) here - keep it that way, so a cold start only pays for the stdlib.
+
+from cfn_custom_registry import ResourceOperations, register
+
+# -----------------------------------------------------------------------------------------------------------------
+# ROLE MAPPING
 # -----------------------------------------------------------------------------------------------------------------
-    responseUrl = event['ResponseURL']
- 
-    print(responseUrl)
- 
-    responseBody = {}
-    responseBody['Status'] = responseStatus
-    responseBody['Reason'] = 'See the details in CloudWatch Log Stream: ' + context.log_stream_name
-    responseBody['PhysicalResourceId'] = physicalResourceId or context.log_stream_name
-    responseBody['StackId'] = event['StackId']
-    responseBody['RequestId'] = event['RequestId']
-    responseBody['LogicalResourceId'] = event['LogicalResourceId']
-    responseBody['NoEcho'] = noEcho
-    responseBody['Data'] = responseData
- 
-    json_responseBody = json.dumps(responseBody)
- 
-    print("Response body:\n" + json_responseBody)
- 
-    headers = {
-        'content-type' : '',
-        'content-length' : str(len(json_responseBody))
-    }
- 
-    try:
-        response = requests.put(responseUrl,
-                                data=json_responseBody,
-                                headers=headers)
-        print("Status code: " + response.reason)
-    except Exception as e:
-        print("send(..) failed executing requests.put(..): " + str(e))
 
-# =================================================================================================================
-# HANDLERS
-# =================================================================================================================
+def role_mapping_params(request_type, props):
+# -----------------------------------------------------------------------------------------------------------------
+    return {
+        'IdentityProvider': props['IdentityProvider'],
+        'Type': props['Type'],
+        'AmbiguousRoleResolution': props['AmbiguousRoleResolution'],
+        'RulesConfiguration': props['RulesConfiguration'] if 'RulesConfiguration' in props else None,
+    }
 
-# Role Mapping Handler
-def role_mapping_handler(event, context):   
-# -----------------------------------------------------------------------------------------------------------------                  
-    identity_provider = event['ResourceProperties']['IdentityProvider']
-    mapping_type = event['ResourceProperties']['Type']
-    ambiguous_role_resolution = event['ResourceProperties']['AmbiguousRoleResolution']
-    rules_config = event['ResourceProperties']['RulesConfiguration'] if 'RulesConfiguration' in event['ResourceProperties'] else None
+def transform_role_mapping(params, deadline):
+# -----------------------------------------------------------------------------------------------------------------
+    identity_provider = params['IdentityProvider']
+    mapping_type = params['Type']
+    ambiguous_role_resolution = params['AmbiguousRoleResolution']
+    rules_config = params['RulesConfiguration']
 
     try:
         # Make sure the identity provider is valid
@@ -90,12 +47,32 @@ def role_mapping_handler(event, context):
         if (mapping_type == 'Rules') and (rules_config) and ('Rules' in rules_config) and (len(rules_config['Rules']) > 0):
             data.update({'RulesConfiguration': rules_config})
 
+        message = "Transformed role mappings"
+
     except Exception as e:
-        result = False
         message = "Failed to transform role mappings: " + str(e)
         data = {}
 
-    # Provide the full response data object to allow us to grab outputs in CloudFormation
-    responseData = {}
-    responseData['RoleMapping'] = data
-    cfn_response_send(event, context, CFN_SUCCESS, responseData)
\ No newline at end of file
+    # Nothing to create or delete on our side, so this always succeeds (with an empty mapping if
+    # the input was rubbish) - CloudFormation will complain when it tries to use it.
+    return {'Result': True, 'Message': message, 'Data': {'RoleMapping': data}}
+
+
+# =================================================================================================================
+# REGISTRATION
+# =================================================================================================================
+
+ROLE_MAPPING_OPERATIONS = ResourceOperations('IdentityPoolRoleMapping', role_mapping_params,
+    create=transform_role_mapping, update=transform_role_mapping, delete=transform_role_mapping)
+
+register(['Custom::IdentityPoolRoleMapping', 'Custom::IdentityPoolRoleMappingTransform'], ROLE_MAPPING_OPERATIONS)
+
+
+# =================================================================================================================
+# HANDLERS
+# =================================================================================================================
+
+# Role Mapping Handler
+def role_mapping_handler(event, context):
+# -----------------------------------------------------------------------------------------------------------------
+    ROLE_MAPPING_OPERATIONS.handle(event, context)
@@ -8,129 +8,72 @@
 # of Lambda-backed custom resources ONLY! It doesn't make a whole heap of sense to try and execute thses
 # functions outside of that context.
 
-import boto3
-from botocore.exceptions import ClientError
-from botocore.vendored import requests
-from multiprocessing import Process, Pipe
 import json
 import logging
 
-# Cloudformation response values
-CFN_SUCCESS = "SUCCESS"
-CFN_FAILED = "FAILED"
-
-# Cognito Identity Provider Client
-client_idp = boto3.client('cognito-idp')
-
-# Note: This function is normally included when defining Lambda-backed custom resources
-# inline within CloudFormation templates. However, our custom resources for Cognito
-# are larger than the 4096 character limit for inline definition. Oh dear. That means
-# that our custom resource is too big to live inside the cloudformation template.
-# BUT if it's not inside the cloudformation template, we can't just include the cfnresponse
-# module, since that's only supplied by Cloudformation itself, hence we must reproduce it here. GAH.
-#
-# This function is the same as the contents of the cfnresponse module, taken from this URL:
-# https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/cfn-lambda-function-code-cfnresponsemodule.html
-def cfn_response_send(event, context, responseStatus, responseData, physicalResourceId=None, noEcho=False):
-# -----------------------------------------------------------------------------------------------------------------
-    responseUrl = event['ResponseURL']
- 
-    print(responseUrl)
- 
-    responseBody = {}
-    responseBody['Status'] = responseStatus
-    responseBody['Reason'] = 'See the details in CloudWatch Log Stream: ' + context.log_stream_name
-    responseBody['PhysicalResourceId'] = physicalResourceId or context.log_stream_name
-    responseBody['StackId'] = event['StackId']
-    responseBody['RequestId'] = event['RequestId']
-    responseBody['LogicalResourceId'] = event['LogicalResourceId']
-    responseBody['NoEcho'] = noEcho
-    responseBody['Data'] = responseData
- 
-    json_responseBody = json.dumps(responseBody)
- 
-    print("Response body:\n" + json_responseBody)
- 
-    headers = {
-        'content-type' : '',
-        'content-length' : str(len(json_responseBody))
-    }
- 
-    try:
-        response = requests.put(responseUrl,
-                                data=json_responseBody,
-                                headers=headers)
-        print("Status code: " + response.reason)
-    except Exception as e:
-        print("send(..) failed executing requests.put(..): " + str(e))
+from cfn_custom_batch import AdaptiveLimiter, call_with_backoff, run_batch
+from cfn_custom_client_index import client_index
+from cfn_custom_clients import cognito_idp, error_code
+from cfn_custom_registry import ResourceOperations, register
 
 # -----------------------------------------------------------------------------------------------------------------    
 # IDENTITY PROVIDER
 # -----------------------------------------------------------------------------------------------------------------  
 
-def create_provider(params, results_pipe):
+def create_provider(params, deadline):
 # -----------------------------------------------------------------------------------------------------------------    
     try:
-        resp = client_idp.create_identity_provider(**params)
-        results_pipe.send({'Result': True, 'Message': "Created SAML Idp: " + str(resp['IdentityProvider']['IdpIdentifiers'][0]), 'Data': resp['IdentityProvider']})
+        resp = cognito_idp().create_identity_provider(**params)
+        return {'Result': True, 'Message': "Created SAML Idp: " + str(resp['IdentityProvider']['IdpIdentifiers'][0]), 'Data': resp['IdentityProvider']}
     except Exception as e:
         print(e)
-        results_pipe.send({'Result': False, 'Message': "Cannot create SAML Idp: " + str(e), 'Data': {}})
-
-    results_pipe.close()
+        return {'Result': False, 'Message': "Cannot create SAML Idp: " + str(e), 'Data': {}}
 
-def update_provider(params, results_pipe):
+def update_provider(params, deadline):
 # -----------------------------------------------------------------------------------------------------------------
     try:
-        resp = client_idp.update_identity_provider(**params)
-        results_pipe.send({'Result': True, 'Message': "Updated SAML Idp: " + resp['IdpIdentifiers'], 'Data': resp['IdentityProvider']})
+        resp = cognito_idp().update_identity_provider(**params)
+        return {'Result': True, 'Message': "Updated SAML Idp: " + ", ".join(resp['IdentityProvider'].get('IdpIdentifiers') or []), 'Data': resp['IdentityProvider']}
     except Exception as e:
-        results_pipe.send({'Result': False, 'Message': "Cannot update SAML Idp: " + str(e), 'Data': {}})
-
-    results_pipe.close()
+        return {'Result': False, 'Message': "Cannot update SAML Idp: " + str(e), 'Data': {}}
 
-def delete_provider(params, results_pipe):
+def delete_provider(params, deadline):
 # -----------------------------------------------------------------------------------------------------------------              
     try:
-        client_idp.delete_identity_provider(**params)
-        results_pipe.send({'Result': True, 'Message': "SAML identity provider deleted", 'Data': {}})
-    except ClientError as e:
-        if e.response['Error']['Code'] == "NoSuchEntity":
-            results_pipe.send({'Result': True, 'Message': "SAML Idp does not exist. Skipping deletion.", 'Data': {}})
-        else:
-            results_pipe.send({'Result': False, 'Message': "Cannot delete SAML Idp: " + str(e), 'Data': {}})
+        cognito_idp().delete_identity_provider(**params)
+        return {'Result': True, 'Message': "SAML identity provider deleted", 'Data': {}}
     except Exception as e:
-        results_pipe.send({'Result': True, 'Message': "Cannot delete SAML Idp: " + str(e), 'Data': {}})
-
-    results_pipe.close()
+        # Already gone is fine, as is anything that isn't a Cognito error
+        code = error_code(e)
+        if code == "NoSuchEntity":
+            return {'Result': True, 'Message': "SAML Idp does not exist. Skipping deletion.", 'Data': {}}
+        elif code is not None:
+            return {'Result': False, 'Message': "Cannot delete SAML Idp: " + str(e), 'Data': {}}
+        else:
+            return {'Result': True, 'Message': "Cannot delete SAML Idp: " + str(e), 'Data': {}}
 
 # -----------------------------------------------------------------------------------------------------------------    
 # CLIENT
 # -----------------------------------------------------------------------------------------------------------------    
 
-def create_client(params, results_pipe):
+def create_client(params, deadline):
 # -----------------------------------------------------------------------------------------------------------------    
     try:
         print(params)
-        resp = client_idp.create_user_pool_client(**params)
-        results_pipe.send({'Result': True, 'Message': "Successfully created User Pool client", 'Data': resp['UserPoolClient']})
+        resp = cognito_idp().create_user_pool_client(**params)
+        client_index.record(params['UserPoolId'], params['ClientName'], resp['UserPoolClient']['ClientId'])
+        return {'Result': True, 'Message': "Successfully created User Pool client", 'Data': resp['UserPoolClient']}
     except Exception as e:
-        results_pipe.send({'Result': False, 'Message': "Create Failed: " + str(e), 'Data': {}})
+        return {'Result': False, 'Message': "Create Failed: " + str(e), 'Data': {}}
 
-    results_pipe.close()
-
-def update_client(params, results_pipe):
+def update_client(params, deadline):
 # -----------------------------------------------------------------------------------------------------------------
     try:
-        # Try to list existing resources with the same details.
         # We only have the client name, not the ID. We need that ID
-        # to perform an update. Don't worry about pagination - there won't be hundreds (hopefully!)
-        response = client_idp.list_user_pool_clients(UserPoolId=params['UserPoolId'], MaxResults=10)
-        for client in response['UserPoolClients']:
-            if client['ClientName'] == params['ClientName']:
-                logging.info('Found existing user pool client')                
-                client_id = client['ClientId']
-                break
+        # to perform an update, so look it up in the (cached) index of the pool's clients.
+        client_id = client_index.lookup(cognito_idp(), params['UserPoolId'], params['ClientName'], deadline)
+        if client_id:
+            logging.info('Found existing user pool client')
 
         # If we didn;t find a client ID, we're a bit stuffed.
         if client_id is None or len(client_id) <= 0 or client_id == "":
@@ -139,90 +82,189 @@ def update_client(params, results_pipe):
         # Otherwise, orsum. Update the parameters with the ID
         params.update({'ClientId': client_id})
 
+        # Don't bother with the update if the handler has already given up on us
+        deadline.check()
+
         # Update the client with the passed parameters
-        resp = client_idp.update_user_pool_client(**params)
-        results_pipe.send({'Result': True, 'Message': "Updated user pool client", 'Data': resp['UserPoolClient']})
+        resp = cognito_idp().update_user_pool_client(**params)
+        return {'Result': True, 'Message': "Updated user pool client", 'Data': resp['UserPoolClient']}
 
     except Exception as e:
-        results_pipe.send({'Result': False, 'Message': "Update Failed: " + str(e), 'Data': {}})
-
-    # Get outta here.
-    results_pipe.close()
+        # The cached ID may be stale (e.g. client removed outside of CloudFormation)
+        client_index.invalidate(params['UserPoolId'])
+        return {'Result': False, 'Message': "Update Failed: " + str(e), 'Data': {}}
 
-def delete_client(params, results_pipe):
+def delete_client(params, deadline):
 # -----------------------------------------------------------------------------------------------------------------              
     try:
-        client_idp.delete_user_pool_client(**params)
-        results_pipe.send({'Result': True, 'Message': "Deleted user pool client", 'Data': {}})
-    except ClientError as e:
-        if e.response['Error']['Code'] == "NoSuchEntity":
-            results_pipe.send({'Result': True, 'Message': "Client does not exist!", 'Data': {}})
-        else:
-            results_pipe.send({'Result': False, 'Message': "Delete Failed: " + str(e), 'Data': {}})
+        # Same as updates - Cognito wants the ID, not the name
+        client_id = client_index.lookup(cognito_idp(), params['UserPoolId'], params['ClientName'], deadline)
+        if client_id is None:
+            return {'Result': True, 'Message': "Client does not exist!", 'Data': {}}
+
+        cognito_idp().delete_user_pool_client(UserPoolId=params['UserPoolId'], ClientId=client_id)
+        client_index.forget(params['UserPoolId'], params['ClientName'])
+        return {'Result': True, 'Message': "Deleted user pool client", 'Data': {}}
     except Exception as e:
-        results_pipe.send({'Result': True, 'Message': "Delete Failed: " + str(e), 'Data': {}})
-        
-    results_pipe.close()
+        # Already gone is fine, as is anything that isn't a Cognito error
+        code = error_code(e)
+        if code in ("NoSuchEntity", "ResourceNotFoundException"):
+            client_index.invalidate(params['UserPoolId'])
+            return {'Result': True, 'Message': "Client does not exist!", 'Data': {}}
+        elif code is not None:
+            return {'Result': False, 'Message': "Delete Failed: " + str(e), 'Data': {}}
+        else:
+            return {'Result': True, 'Message': "Delete Failed: " + str(e), 'Data': {}}
 
 # -----------------------------------------------------------------------------------------------------------------    
 # DOMAIN
 # -----------------------------------------------------------------------------------------------------------------    
 
-def create_domain(params, results_pipe):
+def create_domain(params, deadline):
 # -----------------------------------------------------------------------------------------------------------------        
     try:
         print(params)
-        resp = client_idp.create_user_pool_domain(**params)
-        results_pipe.send({'Result': True, 'Message': "Created User Pool Domain", 'Data': resp})
+        resp = cognito_idp().create_user_pool_domain(**params)
+        return {'Result': True, 'Message': "Created User Pool Domain", 'Data': resp}
     except Exception as e:
-        results_pipe.send({'Result': False, 'Message': "Cannot create User Pool Domain: " + str(e), 'Data': {}})
-    
-    results_pipe.close()
+        return {'Result': False, 'Message': "Cannot create User Pool Domain: " + str(e), 'Data': {}}
 
-def update_domain(params, results_pipe):
+def update_domain(params, deadline):
 # -----------------------------------------------------------------------------------------------------------------        
     try:
-        resp = client_idp.update_user_pool_domain(**params)
-        results_pipe.send({'Result': True, 'Message': "Updated User Pool Domain: " + resp['CloudFrontDomain'], 'Data': resp})
+        resp = cognito_idp().update_user_pool_domain(**params)
+        return {'Result': True, 'Message': "Updated User Pool Domain: " + resp['CloudFrontDomain'], 'Data': resp}
     except Exception as e:
-        results_pipe.send({'Result': False, 'Message': "Cannot update User Pool Domain: " + str(e), 'Data': {}})
-    
-    results_pipe.close()
+        return {'Result': False, 'Message': "Cannot update User Pool Domain: " + str(e), 'Data': {}}
 
-def delete_domain(params, results_pipe):
+def delete_domain(params, deadline):
 # -----------------------------------------------------------------------------------------------------------------        
     try:
-        client_idp.delete_user_pool_domain(**params)
-        results_pipe.send({'Result': True, 'Message': "User Pool Domain deleted", 'Data': {}})
-    except ClientError as e:
-        if e.response['Error']['Code'] == "NoSuchEntity":
-            results_pipe.send({'Result': True, 'Message': "User Pool Domain does not exist. Skipping deletion.", 'Data': {}})
-        else:
-            results_pipe.send({'Result': False, 'Message': "Cannot delete User Pool Domain: " + str(e), 'Data': {}})
+        cognito_idp().delete_user_pool_domain(**params)
+        return {'Result': True, 'Message': "User Pool Domain deleted", 'Data': {}}
     except Exception as e:
-        results_pipe.send({'Result': True, 'Message': "Cannot delete User Pool Domain: " + str(e), 'Data': {}})
-    
-    results_pipe.close()
+        # Already gone is fine, as is anything that isn't a Cognito error
+        code = error_code(e)
+        if code == "NoSuchEntity":
+            return {'Result': True, 'Message': "User Pool Domain does not exist. Skipping deletion.", 'Data': {}}
+        elif code is not None:
+            return {'Result': False, 'Message': "Cannot delete User Pool Domain: " + str(e), 'Data': {}}
+        else:
+            return {'Result': True, 'Message': "Cannot delete User Pool Domain: " + str(e), 'Data': {}}
+
+
+# -----------------------------------------------------------------------------------------------------------------    
+# CLIENT BATCH
+# -----------------------------------------------------------------------------------------------------------------    
+
+def batch_client_worker(item, limiter, deadline):
+# -----------------------------------------------------------------------------------------------------------------
+    # item is (action, params, existing client ID or None) - see plan_client_batch
+    action, params, client_id = item
+    user_pool_id = params['UserPoolId']
+    client_name = params['ClientName']
+    client = cognito_idp()
+
+    if action == 'Delete':
+        if client_id is None:
+            return {'ClientName': client_name, 'ClientId': None, 'Status': 'NotFound'}
+        try:
+            _, attempts = call_with_backoff(limiter, lambda: client.delete_user_pool_client(UserPoolId=user_pool_id, ClientId=client_id), deadline)
+        except Exception as e:
+            if error_code(e) not in ("NoSuchEntity", "ResourceNotFoundException"):
+                raise
+            attempts = 1
+        client_index.forget(user_pool_id, client_name)
+        return {'ClientName': client_name, 'ClientId': client_id, 'Status': 'Deleted', 'Attempts': attempts}
+
+    if action == 'Update' and client_id is not None:
+        update_params = dict(params, ClientId=client_id)
+        update_params.pop('GenerateSecret', None)
+        resp, attempts = call_with_backoff(limiter, lambda: client.update_user_pool_client(**update_params), deadline)
+        return {'ClientName': client_name, 'ClientId': resp['UserPoolClient']['ClientId'], 'Status': 'Updated', 'Attempts': attempts}
+
+    # Create (or an update for a client that's been added to the list)
+    resp, attempts = call_with_backoff(limiter, lambda: client.create_user_pool_client(**params), deadline)
+    client_index.record(user_pool_id, client_name, resp['UserPoolClient']['ClientId'])
+    return {'ClientName': client_name, 'ClientId': resp['UserPoolClient']['ClientId'], 'Status': 'Created', 'Attempts': attempts}
+
+def plan_client_batch(action, params, deadline):
+# -----------------------------------------------------------------------------------------------------------------
+    # Work out what to do for each client up front, so the workers don't all race to build the index
+    if action == 'Create':
+        return [('Create', client_params, None) for client_params in params['Clients']]
+
+    # Listing the pool gets throttled like anything else (and a batch is the thing most likely to have used up the rate)
+    existing, _ = call_with_backoff(AdaptiveLimiter(1), lambda: client_index.clients(cognito_idp(), params['UserPoolId'], deadline, force=True), deadline)
+
+    if action == 'Delete':
+        return [('Delete', client_params, existing.get(client_params['ClientName'])) for client_params in params['Clients']]
+
+    # Update - anything that's dropped out of the list since last time gets deleted
+    items = [('Update', client_params, existing.get(client_params['ClientName'])) for client_params in params['Clients']]
+    current_names = set(client_params['ClientName'] for client_params in params['Clients'])
+    for client_params in params['OldClients']:
+        if client_params['ClientName'] not in current_names:
+            items.append(('Delete', client_params, existing.get(client_params['ClientName'])))
+    return items
+
+def run_client_batch(action, params, deadline):
+# -----------------------------------------------------------------------------------------------------------------
+    items = plan_client_batch(action, params, deadline)
+    results, stats = run_batch(items, batch_client_worker, deadline)
+
+    for (item_action, client_params, client_id), result in zip(items, results):
+        result.setdefault('ClientName', client_params['ClientName'])
+
+    failed = [r for r in results if r['Status'] in ('Failed', 'TimedOut')]
+    by_name = dict((r['ClientName'], r.get('ClientId')) for r in results)
+
+    data = {
+        # In the same order as the Clients property, for use with Fn::Select/Fn::Split
+        'ClientIds': ','.join(by_name.get(c['ClientName']) or '' for c in params['Clients']),
+        'Throttles': stats['Throttles'],
+        'Results': json.dumps(results),
+    }
+
+    if failed:
+        message = "{0} of {1} client operations failed: {2}".format(len(failed), len(results), "; ".join(r['ClientName'] + ": " + r.get('Message', r['Status']) for r in failed))
+        return {'Result': False, 'Message': message, 'Data': data}
+
+    return {'Result': True, 'Message': "{0} client operations completed ({1} throttled calls)".format(len(results), stats['Throttles']), 'Data': data}
+
+def create_client_batch(params, deadline):
+# -----------------------------------------------------------------------------------------------------------------
+    return run_client_batch('Create', params, deadline)
+
+def update_client_batch(params, deadline):
+# -----------------------------------------------------------------------------------------------------------------
+    return run_client_batch('Update', params, deadline)
+
+def delete_client_batch(params, deadline):
+# -----------------------------------------------------------------------------------------------------------------
+    return run_client_batch('Delete', params, deadline)
 
 
 # =================================================================================================================
-# HANDLERS
+# PARAMETERS
 # =================================================================================================================
 
+TRUTHY = ['true', '1', 't', 'y', 'yes', 'yeah', 'yup', 'aye']
+
 # User Pool Client
-def client_handler(event, context):   
-# -----------------------------------------------------------------------------------------------------------------                  
-    user_pool_id = event['ResourceProperties']['UserPoolId']
-    client_name = event['ResourceProperties']['ClientName']
-    explicit_auth_flows = event['ResourceProperties']['ExplicitAuthFlows']
-    identity_providers = event['ResourceProperties']['SupportedIdps']
-    allowed_oauth_flows_user_pool_client = str(event['ResourceProperties']['AllowedOAuthFlowsUserPoolClient']).lower() in ['true', '1', 't', 'y', 'yes', 'yeah', 'yup', 'aye']
-    allowed_oauth_flows = event['ResourceProperties']['AllowedOAuthFlows']
-    allowed_oauth_scopes = event['ResourceProperties']['AllowedOAuthScopes']
-    callback_urls = event['ResourceProperties']['CallbackURLs']
-    logout_urls = event['ResourceProperties']['LogoutURLs']
-
-    generate_secret = str(event['ResourceProperties']['GenerateSecret']).lower() in ['true', '1', 't', 'y', 'yes', 'yeah', 'yup', 'aye']
+def client_params(request_type, props):
+# -----------------------------------------------------------------------------------------------------------------
+    user_pool_id = props['UserPoolId']
+    client_name = props['ClientName']
+    explicit_auth_flows = props['ExplicitAuthFlows']
+    identity_providers = props['SupportedIdps']
+    allowed_oauth_flows_user_pool_client = str(props['AllowedOAuthFlowsUserPoolClient']).lower() in TRUTHY
+    allowed_oauth_flows = props['AllowedOAuthFlows']
+    allowed_oauth_scopes = props['AllowedOAuthScopes']
+    callback_urls = props['CallbackURLs']
+    logout_urls = props['LogoutURLs']
+
+    generate_secret = str(props['GenerateSecret']).lower() in TRUTHY
 
     # Configure common parameters here
     params = {
@@ -238,63 +280,35 @@ def client_handler(event, context):
         'LogoutURLs': logout_urls
     }
 
-    parent_end, child_end = Pipe()
+    if request_type == 'Create':
+        params.update({'GenerateSecret': generate_secret})
 
-    try:
-        if event['RequestType'] == 'Create':
-            params.update({'GenerateSecret': generate_secret})
-            p = Process(target=create_client, args=(params, child_end,))
-            p.start()
-            res = parent_end.recv()
-            p.join(timeout=180)
-            result = False if p.exitcode > 0 else res['Result']
-            message = 'Timed-out!' if p.exitcode > 0 else res['Message']
-            data = {} if p.exitcode > 0 else res['Data']
-        elif event['RequestType'] == 'Update':         
-            p = Process(target=update_client, args=(params, child_end,))
-            p.start()
-            res = parent_end.recv()
-            p.join(timeout=180)
-            result = False if p.exitcode > 0 else res['Result']
-            message = 'Timed-out!' if p.exitcode > 0 else res['Message']
-            data = {} if p.exitcode > 0 else res['Data']
-        elif event['RequestType'] == 'Delete':
-            p = Process(target=delete_client, args=(params, child_end,))
-            p.start()
-            res = parent_end.recv()
-            p.join(timeout=180)
-            result = False if p.exitcode > 0 else res['Result']
-            message = 'Timed-out!' if p.exitcode > 0 else res['Message']
-            data = {} if p.exitcode > 0 else res['Data']
-        else:
-            result = False
-            message = "Unknown operation: " + event['RequestType']
-            data = {}
-    except Exception as e:
-        result = False
-        message = "Failed to complete CloudFormation action: " + str(e)
-        data = {}
+    return params
 
-    # Provide the full response data object to allow us to grab outputs in CloudFormation
-    # Note, we should remvoe datetimes, since they're not serializable
-    responseData = data
-    responseData['Reason'] = message
-    responseData.pop('LastModifiedDate', None)
-    responseData.pop('CreationDate', None)
 
-    if result:
-        cfn_response_send(event, context, CFN_SUCCESS, responseData)
-    else:
-        cfn_response_send(event, context, CFN_FAILED, responseData)
+# User Pool Client Batch
+def client_batch_params(request_type, props, old_props=None):
+# -----------------------------------------------------------------------------------------------------------------
+    # Clients is a list of the same properties as a single UserPoolClient resource, minus the UserPoolId.
+    # Everything is built with 'Create' parameters (i.e. including GenerateSecret), since an update
+    # can end up creating clients that have been added to the list.
+    def build(props):
+        return [client_params('Create', dict(spec, UserPoolId=props['UserPoolId'])) for spec in props['Clients']]
+
+    return {
+        'UserPoolId': props['UserPoolId'],
+        'Clients': build(props),
+        'OldClients': build(old_props) if old_props else [],
+    }
 
 
 # User Pool Identity Provider
-def identity_provider_handler(event, context):   
-# -----------------------------------------------------------------------------------------------------------------                  
-    provider_xml = event['ResourceProperties']['Metadata']
-    provider_name = event['ResourceProperties']['Name']
-    provider_identifier = event['ResourceProperties']['IdpIdentifier']
-    user_pool_id = event['ResourceProperties']['UserPoolId']
+def identity_provider_params(request_type, props):
+# -----------------------------------------------------------------------------------------------------------------
+    provider_xml = props['Metadata']
+    provider_name = props['Name']
+    provider_identifier = props['IdpIdentifier']
+    user_pool_id = props['UserPoolId']
 
     params = {
         'UserPoolId': user_pool_id,
@@ -314,73 +328,25 @@ def identity_provider_handler(event, context):
         provider_identifier
     ]
 
-    parent_end, child_end = Pipe()
+    if request_type in ('Create', 'Update'):
+        params.update({'ProviderDetails': {'MetadataURL': provider_xml}})
+        params.update({'ProviderType': 'SAML'})
+        params.update({'AttributeMapping': attribute_mapping})
+        params.update({'IdpIdentifiers': idp_identifiers})
 
-    try:
-        if event['RequestType'] == 'Create':
-            params.update({'ProviderDetails': {'MetadataURL': provider_xml}})
-            params.update({'ProviderType': 'SAML'})
-            params.update({'AttributeMapping': attribute_mapping})
-            params.update({'IdpIdentifiers': idp_identifiers})
-            p = Process(target=create_provider, args=(params, child_end,))
-            p.start()
-            res = parent_end.recv()
-            p.join(timeout=180)
-            result = False if p.exitcode > 0 else res['Result']
-            message = 'Operation timed-out!' if p.exitcode > 0 else res['Message']
-            data = {} if p.exitcode > 0 else res['Data']            
-        elif event['RequestType'] == 'Update':
-            params.update({'ProviderDetails': {'MetadataURL': provider_xml}})
-            params.update({'ProviderType': 'SAML'})
-            params.update({'AttributeMapping': attribute_mapping})    
-            params.update({'IdpIdentifiers': idp_identifiers})          
-            p = Process(target=update_provider, args=(params, child_end,))
-            p.start()
-            res = parent_end.recv()
-            p.join(timeout=180)
-            result = False if p.exitcode > 0 else res['Result']
-            message = 'Operation timed-out!' if p.exitcode > 0 else res['Message']
-            data = {} if p.exitcode > 0 else res['Data']            
-        elif event['RequestType'] == 'Delete':
-            p = Process(target=delete_provider, args=(params, child_end,))
-            p.start()
-            res = parent_end.recv()
-            p.join(timeout=180)
-            result = False if p.exitcode > 0 else res['Result']
-            message = 'Operation timed-out!' if p.exitcode > 0 else res['Message']
-            data = {} if p.exitcode > 0 else res['Data']            
-        else:
-            result = False
-            message = "Unknown operation: " + event['RequestType']
-            data = {}
-    except Exception as e:
-        result = False
-        message = "Failed to complete CloudFormation action: " + str(e)
-        data = {}
-
-    # Provide the full response data object to allow us to grab outputs in CloudFormation
-    # Note, we should remvoe datetimes, since they're not serializable
-    responseData = data
-    responseData['Reason'] = message
-    responseData.pop('LastModifiedDate', None)
-    responseData.pop('CreationDate', None)
-    
-    if result:
-        cfn_response_send(event, context, CFN_SUCCESS, responseData)
-    else:
-        cfn_response_send(event, context, CFN_FAILED, responseData)                
+    return params
 
 
-# User Pool Domain Handler
-def domain_handler(event, context):            
-# -----------------------------------------------------------------------------------------------------------------                      
-    user_pool_id = event['ResourceProperties']['UserPoolId']
-    domain_name = event['ResourceProperties']['DomainName']
+# User Pool Domain
+def domain_params(request_type, props):
+# -----------------------------------------------------------------------------------------------------------------
+    user_pool_id = props['UserPoolId']
+    domain_name = props['DomainName']
 
     # Optional to help with DNS resolution etc.
     cert_arn = None
-    if hasattr(event['ResourceProperties'], 'CertArn'):
-        cert_arn = event['ResourceProperties']['CertArn']
+    if 'CertArn' in props:
+        cert_arn = props['CertArn']
 
     params = {
         'UserPoolId': user_pool_id,
@@ -391,58 +357,70 @@ def domain_handler(event, context):
         'CertificateArn': cert_arn
     }
 
-    parent_end, child_end = Pipe()
+    if request_type == 'Create' and cert_arn:
+        params.update({'CustomDomainConfig': custom_domain_config})
 
-    try:
-        if event['RequestType'] == 'Create':
-            if cert_arn:
-                params.update({'CustomDomainConfig': custom_domain_config})
-            p = Process(target=create_domain, args=(params, child_end,))
-            p.start()
-            res = parent_end.recv()
-            p.join(timeout=180)
-            result = False if p.exitcode > 0 else res['Result']
-            message = 'Operation timed-out!' if p.exitcode > 0 else res['Message']
-            data = {} if p.exitcode > 0 else res['Data']            
-        elif event['RequestType'] == 'Update':
-            # if cert_arn:
-            #     params.update({'CustomDomainConfig': custom_domain_config})
-            # p = Process(target=update_domain, args=(params, child_end,))
-            # p.start()
-            # res = parent_end.recv()
-            # p.join(timeout=180)
-            # result = False if p.exitcode > 0 else res['Result']
-            # message = 'Operation timed-out!' if p.exitcode > 0 else res['Message']
-            # data = {} if p.exitcode > 0 else res['Data']
-            result = True
-            message = 'Update Not Supported in Lambda runtime version of Boto!'            
-            data = {}            
-            # Can you believe it?
-        elif event['RequestType'] == 'Delete':
-            p = Process(target=delete_domain, args=(params, child_end,))
-            p.start()
-            res = parent_end.recv()
-            p.join(timeout=180)
-            result = False if p.exitcode > 0 else res['Result']
-            message = 'Operation timed-out!' if p.exitcode > 0 else res['Message']
-            data = {} if p.exitcode > 0 else res['Data']            
-        else:
-            result = False
-            message = "Unknown operation: " + event['RequestType']
-            data = {}
-    except Exception as e:
-        result = False
-        message = "Failed to complete CloudFormation action: " + str(e)
-        data = {}
-
-    # Provide the full response data object to allow us to grab outputs in CloudFormation
-    # Note, we should remvoe datetimes, since they're not serializable
-    responseData = data
-    responseData['Reason'] = message
-    responseData.pop('LastModifiedDate', None)
-    responseData.pop('CreationDate', None)
-    
-    if result:
-        cfn_response_send(event, context, CFN_SUCCESS, responseData)
-    else:
-        cfn_response_send(event, context, CFN_FAILED, responseData)
\ No newline at end of file
+    return params
+
+
+def skip_domain_update(params, deadline):
+# -----------------------------------------------------------------------------------------------------------------
+    # Swap this for update_domain (and pass CustomDomainConfig through in domain_params) once
+    # the Lambda runtime's boto3 supports it. Can you believe it?
+    return {'Result': True, 'Message': 'Update Not Supported in Lambda runtime version of Boto!', 'Data': {}}
+
+
+# =================================================================================================================
+# REGISTRATION
+# =================================================================================================================
+
+CLIENT_OPERATIONS = ResourceOperations('UserPoolClient', client_params,
+    create=create_client, update=update_client, delete=delete_client)
+
+IDENTITY_PROVIDER_OPERATIONS = ResourceOperations('UserPoolIdentityProvider', identity_provider_params,
+    create=create_provider, update=update_provider, delete=delete_provider)
+
+DOMAIN_OPERATIONS = ResourceOperations('UserPoolDomain', domain_params,
+    create=create_domain, update=skip_domain_update, delete=delete_domain)
+
+class ClientBatchOperations(ResourceOperations):
+# -----------------------------------------------------------------------------------------------------------------
+    # Updates need the old list too, to clean up clients that have been removed from it
+    def params_for(self, event):
+        return self.build_params(event['RequestType'], event['ResourceProperties'], event.get('OldResourceProperties'))
+
+CLIENT_BATCH_OPERATIONS = ClientBatchOperations('UserPoolClientBatch', client_batch_params,
+    create=create_client_batch, update=update_client_batch, delete=delete_client_batch)
+
+register(['Custom::UserPoolClient', 'Custom::CognitoUserPoolClient'], CLIENT_OPERATIONS)
+register(['Custom::UserPoolClientBatch'], CLIENT_BATCH_OPERATIONS)
+register(['Custom::UserPoolIdentityProvider', 'Custom::SAMLIdpManagementFunction'], IDENTITY_PROVIDER_OPERATIONS)
+register(['Custom::UserPoolDomain', 'Custom::CognitoUserPoolDomain'], DOMAIN_OPERATIONS)
+
+
+# =================================================================================================================
+# HANDLERS
+# =================================================================================================================
+
+# User Pool Client
+def client_handler(event, context):
+# -----------------------------------------------------------------------------------------------------------------
+    CLIENT_OPERATIONS.handle(event, context)
+
+
+# User Pool Client Batch
+def client_batch_handler(event, context):
+# -----------------------------------------------------------------------------------------------------------------
+    CLIENT_BATCH_OPERATIONS.handle(event, context)
+
+
+# User Pool Identity Provider
+def identity_provider_handler(event, context):
+# -----------------------------------------------------------------------------------------------------------------
+    IDENTITY_PROVIDER_OPERATIONS.handle(event, context)
+
+
+# User Pool Domain Handler
+def domain_handler(event, context):
+# -----------------------------------------------------------------------------------------------------------------
+    DOMAIN_OPERATIONS.handle(event, context)
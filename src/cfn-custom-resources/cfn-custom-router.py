@@ -0,0 +1,34 @@
+# Single entry point for all of the Cognito custom resources.
+#
+# Rather than deploying one Lambda function per custom resource (each with its own cold start),
+# point every custom resource's ServiceToken at this function. Requests are routed on the
+# event's ResourceType to the operations registered by the handler modules below - see
+# cfn_custom_registry.registered_types() for the full list.
+#
+# The individual *_handler functions still work for stacks that reference them directly.
+
+import importlib
+
+import cfn_custom_profile
+
+with cfn_custom_profile.profile_imports('cfn-custom-router'):
+    import cfn_custom_registry
+
+# The handler modules register their resource types on import. Their names aren't valid
+# identifiers, hence importlib.
+HANDLER_MODULES = [
+    'cfn-custom-manage-cognito-user-pool',
+    'cfn-custom-manage-cognito-identity-pool',
+]
+
+for module_name in HANDLER_MODULES:
+    with cfn_custom_profile.profile_imports(module_name):
+        importlib.import_module(module_name)
+
+cfn_custom_profile.report_imports()
+
+
+def router_handler(event, context):
+# -----------------------------------------------------------------------------------------------------------------
+    print("Routing {0} {1} ({2})".format(event.get('RequestType'), event.get('ResourceType'), event.get('LogicalResourceId')))
+    cfn_custom_registry.dispatch(event, context)
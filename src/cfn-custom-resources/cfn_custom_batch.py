@@ -0,0 +1,113 @@
+# Bounded, throttle-aware fan-out for custom resources that manage many things at once
+# (e.g. a whole list of user pool clients in one resource).
+#
+# Cognito's control plane APIs have fairly low request rate limits, so rather than a fixed
+# amount of concurrency we start at BATCH_WORKERS in flight and back off when Cognito tells us
+# to (TooManyRequestsException): each throttle halves the number of calls allowed in flight and
+# sleeps with jittered exponential backoff before retrying, and each run of successes lets one
+# more call back in (i.e. AIMD, the same approach TCP uses).
+
+from concurrent.futures import ThreadPoolExecutor, wait
+import random
+import threading
+import time
+
+from cfn_custom_clients import error_code
+
+# Upper bound on calls in flight for a single batch
+BATCH_WORKERS = 8
+
+MAX_ATTEMPTS = 8
+BASE_DELAY_SECONDS = 0.25
+MAX_DELAY_SECONDS = 5
+
+THROTTLE_CODES = ('TooManyRequestsException', 'ThrottlingException', 'Throttling')
+
+
+class AdaptiveLimiter(object):
+# -----------------------------------------------------------------------------------------------------------------
+
+    def __init__(self, max_in_flight=BATCH_WORKERS):
+        self.max_in_flight = max_in_flight
+        self.limit = max_in_flight
+        self.in_flight = 0
+        self.successes = 0
+        self.throttles = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, deadline):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                deadline.check()
+                self._cond.wait(timeout=min(deadline.remaining(), 0.1))
+            self.in_flight += 1
+
+    def release(self, throttled):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.throttles += 1
+                self.successes = 0
+                self.limit = max(1, self.limit // 2)
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_in_flight:
+                    self.limit += 1
+                    self.successes = 0
+            self._cond.notify_all()
+
+
+def backoff_delay(attempt):
+# -----------------------------------------------------------------------------------------------------------------
+    return random.uniform(0, min(MAX_DELAY_SECONDS, BASE_DELAY_SECONDS * (2 ** attempt)))
+
+
+def call_with_backoff(limiter, fn, deadline, max_attempts=MAX_ATTEMPTS):
+# -----------------------------------------------------------------------------------------------------------------
+    # Returns (result of fn(), number of attempts). Anything other than a throttle is raised straight away.
+    for attempt in range(max_attempts):
+        deadline.check()
+        limiter.acquire(deadline)
+
+        throttled = False
+        try:
+            return fn(), attempt + 1
+        except Exception as e:
+            if error_code(e) not in THROTTLE_CODES or attempt + 1 >= max_attempts:
+                raise
+            throttled = True
+        finally:
+            limiter.release(throttled)
+
+        time.sleep(min(backoff_delay(attempt), deadline.remaining()))
+
+
+def run_batch(items, worker, deadline, max_workers=BATCH_WORKERS):
+# -----------------------------------------------------------------------------------------------------------------
+    # Runs worker(item, limiter, deadline) for every item and returns the results in the same
+    # order as items. A worker that raises gets a 'Failed' result rather than sinking the batch;
+    # one still running when the deadline passes gets 'TimedOut'.
+    limiter = AdaptiveLimiter(max_workers)
+    results = [None] * len(items)
+
+    def run_item(index):
+        try:
+            results[index] = worker(items[index], limiter, deadline)
+        except Exception as e:
+            results[index] = {'Status': 'Failed', 'Message': str(e)}
+
+    # Deliberately not the shared executor - the batch itself is already running on it
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items))), thread_name_prefix='cfn-custom-batch')
+    try:
+        futures = [executor.submit(run_item, i) for i in range(len(items))]
+        wait(futures, timeout=deadline.remaining())
+        for future in futures:
+            future.cancel()
+    finally:
+        executor.shutdown(wait=False)
+
+    for i, result in enumerate(results):
+        if result is None:
+            results[i] = {'Status': 'TimedOut', 'Message': 'Operation timed-out!'}
+
+    return results, {'Throttles': limiter.throttles, 'FinalConcurrency': limiter.limit}
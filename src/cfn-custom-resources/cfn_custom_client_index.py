@@ -0,0 +1,101 @@
+# ClientName -> ClientId index for Cognito User Pool Clients.
+#
+# CloudFormation only hands us the client name, but Cognito wants the client ID for updates
+# and deletes. Rather than scanning list_user_pool_clients on every request (and silently
+# missing anything past the first page), we page through the full list once per user pool,
+# keep the resulting dictionary around for the lifetime of the warm Lambda container, and
+# patch it as we create/delete clients ourselves.
+
+import threading
+import time
+
+# How long an index is trusted before being rebuilt from Cognito. Clients can be changed
+# outside of CloudFormation, so don't hang on to it forever.
+CACHE_TTL_SECONDS = 300
+
+# Largest page size list_user_pool_clients allows
+PAGE_SIZE = 60
+
+
+class ClientIndex(object):
+# -----------------------------------------------------------------------------------------------------------------
+
+    def __init__(self, ttl=CACHE_TTL_SECONDS):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, client_idp, user_pool_id, client_name, deadline=None):
+        """Return the ClientId for client_name in the given pool, or None if there isn't one."""
+        clients, fresh = self._get(client_idp, user_pool_id, deadline)
+        client_id = clients.get(client_name)
+
+        # A miss against a cached index might just mean someone else created it since
+        # we last looked, so rebuild once before giving up.
+        if client_id is None and not fresh:
+            clients, fresh = self._get(client_idp, user_pool_id, deadline, force=True)
+            client_id = clients.get(client_name)
+
+        return client_id
+
+    def clients(self, client_idp, user_pool_id, deadline=None, force=False):
+        """Return a copy of the full ClientName -> ClientId dictionary for the pool."""
+        clients, fresh = self._get(client_idp, user_pool_id, deadline, force=force)
+        with self._lock:
+            return dict(clients)
+
+    def record(self, user_pool_id, client_name, client_id):
+        """Add a client we've just created to the cached index (if there is one)."""
+        with self._lock:
+            entry = self._entries.get(user_pool_id)
+            if entry is not None:
+                entry[1][client_name] = client_id
+
+    def forget(self, user_pool_id, client_name):
+        """Drop a client we've just deleted from the cached index (if there is one)."""
+        with self._lock:
+            entry = self._entries.get(user_pool_id)
+            if entry is not None:
+                entry[1].pop(client_name, None)
+
+    def invalidate(self, user_pool_id=None):
+        with self._lock:
+            if user_pool_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_pool_id, None)
+
+    def _get(self, client_idp, user_pool_id, deadline, force=False):
+        with self._lock:
+            entry = self._entries.get(user_pool_id)
+            if entry is not None and not force and (time.monotonic() - entry[0]) < self.ttl:
+                return entry[1], False
+
+        clients = build_index(client_idp, user_pool_id, deadline)
+
+        with self._lock:
+            self._entries[user_pool_id] = (time.monotonic(), clients)
+        return clients, True
+
+
+def build_index(client_idp, user_pool_id, deadline=None):
+# -----------------------------------------------------------------------------------------------------------------
+    clients = {}
+    kwargs = {'UserPoolId': user_pool_id, 'MaxResults': PAGE_SIZE}
+
+    while True:
+        if deadline is not None:
+            deadline.check()
+
+        response = client_idp.list_user_pool_clients(**kwargs)
+        for client in response['UserPoolClients']:
+            clients[client['ClientName']] = client['ClientId']
+
+        next_token = response.get('NextToken')
+        if not next_token:
+            return clients
+        kwargs['NextToken'] = next_token
+
+
+# Shared across warm invocations of the container
+client_index = ClientIndex()
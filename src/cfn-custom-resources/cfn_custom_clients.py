@@ -0,0 +1,67 @@
+# Lazily built, memoized AWS clients for the custom resource handlers.
+#
+# Importing boto3 and building a client is by far the most expensive part of a cold start,
+# and not every resource type even talks to AWS (the role mapping transform doesn't). So
+# nothing here is imported or built until a handler actually asks for a client, after which
+# the same client is reused for the lifetime of the warm container.
+
+import threading
+
+import cfn_custom_trace
+
+# Keep individual API calls well inside the handler deadline (see cfn_custom_executor)
+CONNECT_TIMEOUT_SECONDS = 5
+READ_TIMEOUT_SECONDS = 30
+MAX_ATTEMPTS = 3
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(service_name):
+# -----------------------------------------------------------------------------------------------------------------
+    client = _clients.get(service_name)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        client = _clients.get(service_name)
+        if client is None:
+            import boto3
+            from botocore.config import Config
+
+            config = Config(
+                connect_timeout=CONNECT_TIMEOUT_SECONDS,
+                read_timeout=READ_TIMEOUT_SECONDS,
+                retries={'max_attempts': MAX_ATTEMPTS}
+            )
+            client = boto3.client(service_name, config=config)
+            if cfn_custom_trace.ENABLED:
+                cfn_custom_trace.instrument_client(client)
+            _clients[service_name] = client
+    return client
+
+
+def set_client(service_name, client):
+# -----------------------------------------------------------------------------------------------------------------
+    # Swap in a different client (e.g. a stub for benchmarking). None drops the memoized one.
+    with _clients_lock:
+        if client is None:
+            _clients.pop(service_name, None)
+        else:
+            _clients[service_name] = client
+
+
+def cognito_idp():
+# -----------------------------------------------------------------------------------------------------------------
+    return get_client('cognito-idp')
+
+
+def error_code(e):
+# -----------------------------------------------------------------------------------------------------------------
+    # The error code of a botocore ClientError, or None for anything else. Saves importing
+    # botocore.exceptions just to be able to catch ClientError.
+    response = getattr(e, 'response', None)
+    if not isinstance(response, dict):
+        return None
+    return response.get('Error', {}).get('Code')
@@ -0,0 +1,107 @@
+# Shared execution layer for the Cognito custom resource handlers.
+#
+# The handlers used to fork a brand new multiprocessing.Process for every Create/Update/Delete,
+# then block on the pipe before ever getting to join(timeout=...), so a hung Cognito call
+# would happily sit there until Lambda itself killed us (and CloudFormation then waits an hour
+# for a response that never comes). Instead, we keep a small thread pool warm across invocations
+# and bound every operation by the time Lambda actually has left, minus enough headroom to
+# send the response back to CloudFormation.
+#
+# Operations are plain functions of the form operation(params, deadline) that return the
+# usual {'Result': bool, 'Message': str, 'Data': dict} dictionary.
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import threading
+import time
+
+import cfn_custom_trace
+
+# Upper bound on any single operation, regardless of how long Lambda gives us
+DEFAULT_TIMEOUT_SECONDS = 180
+
+# Time kept in reserve after an operation's deadline to PUT the response to CloudFormation
+RESPONSE_RESERVE_SECONDS = 5
+
+# The handlers only ever run one operation at a time, but a timed-out operation keeps its
+# worker thread until the underlying call returns, so leave a little room for stragglers
+MAX_WORKERS = 4
+
+TIMED_OUT_MESSAGE = 'Operation timed-out!'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class Deadline(object):
+# -----------------------------------------------------------------------------------------------------------------
+    """Absolute point in (monotonic) time by which an operation must be finished."""
+
+    def __init__(self, seconds):
+        self.seconds = max(seconds, 0)
+        self.expires_at = time.monotonic() + self.seconds
+
+    def remaining(self):
+        return max(self.expires_at - time.monotonic(), 0)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self):
+        # Long-running operations (e.g. paging through lists) call this between API calls
+        # so they give up promptly once the handler has stopped waiting for them.
+        if self.expired():
+            raise TimeoutError(TIMED_OUT_MESSAGE)
+
+
+def get_executor():
+# -----------------------------------------------------------------------------------------------------------------
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='cfn-custom')
+    return _executor
+
+
+def deadline_for(context, timeout=DEFAULT_TIMEOUT_SECONDS):
+# -----------------------------------------------------------------------------------------------------------------
+    # Outside of Lambda (e.g. benchmarks) there may not be a usable context object
+    get_remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining is None:
+        return Deadline(timeout)
+
+    remaining = (get_remaining() / 1000.0) - RESPONSE_RESERVE_SECONDS
+    return Deadline(min(timeout, remaining))
+
+
+def traced(operation, trace):
+# -----------------------------------------------------------------------------------------------------------------
+    # Splits the time from submit() to the operation starting on a worker (Queue) from the operation itself
+    submitted = time.perf_counter()
+
+    def run(params, deadline):
+        trace.add_phase('Queue', submitted)
+        with trace.phase('Operation'):
+            return operation(params, deadline)
+    return run
+
+
+def run_operation(operation, params, context, timeout=DEFAULT_TIMEOUT_SECONDS):
+# -----------------------------------------------------------------------------------------------------------------
+    deadline = deadline_for(context, timeout)
+    trace = cfn_custom_trace.active()
+    if trace.sampled:
+        operation = traced(operation, trace)
+    future = get_executor().submit(operation, params, deadline)
+
+    try:
+        return future.result(timeout=deadline.remaining())
+    except FutureTimeoutError:
+        # If the operation never got a worker this stops it from starting at all. Otherwise
+        # the call is abandoned - the deadline tells the operation to stop at its next check.
+        future.cancel()
+        trace.set('TimedOut', True)
+        return {'Result': False, 'Message': TIMED_OUT_MESSAGE, 'Data': {}}
+    except Exception as e:
+        return {'Result': False, 'Message': "Operation failed: " + str(e), 'Data': {}}
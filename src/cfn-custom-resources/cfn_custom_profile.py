@@ -0,0 +1,85 @@
+# Startup profiling for the custom resource handlers.
+#
+# Set CFN_CUSTOM_PROFILE_STARTUP=1 on the function to log, once per container:
+# - per-module import timings in the same "self | cumulative | module" layout as `python -X importtime`
+#   (for the router's handler module imports and everything they pull in), and
+# - the latency of the first call to each resource type's handler (i.e. including any lazy
+#   client construction, see cfn_custom_clients).
+#
+# When the variable isn't set none of this is installed, so it costs nothing. For functions that
+# point straight at a *_handler (rather than the router), PYTHONPROFILEIMPORTTIME=1 gets you the
+# interpreter's own import timings instead.
+
+import builtins
+import contextlib
+import json
+import os
+import sys
+import time
+
+ENABLED = os.environ.get('CFN_CUSTOM_PROFILE_STARTUP', '').lower() in ('1', 'true', 'yes')
+
+_import_timings = []
+_first_calls = {}
+
+
+@contextlib.contextmanager
+def profile_imports(label):
+# -----------------------------------------------------------------------------------------------------------------
+    if not ENABLED:
+        yield
+        return
+
+    original_import = builtins.__import__
+    # Each frame is [module name, time spent in nested imports]
+    stack = [[label, 0.0]]
+
+    def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+        if level == 0 and name in sys.modules:
+            return original_import(name, globals, locals, fromlist, level)
+
+        stack.append([name, 0.0])
+        started = time.perf_counter()
+        try:
+            return original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - started
+            frame = stack.pop()
+            stack[-1][1] += elapsed
+            _import_timings.append((len(stack), frame[0], elapsed - frame[1], elapsed))
+
+    builtins.__import__ = timed_import
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        builtins.__import__ = original_import
+        elapsed = time.perf_counter() - started
+        _import_timings.append((0, label, elapsed - stack[0][1], elapsed))
+
+
+def report_imports():
+# -----------------------------------------------------------------------------------------------------------------
+    if not ENABLED or not _import_timings:
+        return
+
+    lines = ['import time: self [us] | cumulative | imported package']
+    for depth, name, self_seconds, cumulative_seconds in _import_timings:
+        lines.append('import time: {0:>9} | {1:>10} | {2}{3}'.format(
+            int(self_seconds * 1e6), int(cumulative_seconds * 1e6), '  ' * depth, name))
+    print('\n'.join(lines))
+
+
+def record_first_call(name, started):
+# -----------------------------------------------------------------------------------------------------------------
+    # Called by the handlers after every invocation when profiling is enabled, only the first one sticks
+    if name in _first_calls:
+        return
+
+    _first_calls[name] = round((time.perf_counter() - started) * 1000, 3)
+    print(json.dumps({'StartupProfile': 'FirstCall', 'Handler': name, 'LatencyMs': _first_calls[name]}))
+
+
+def first_calls():
+# -----------------------------------------------------------------------------------------------------------------
+    return dict(_first_calls)
@@ -0,0 +1,105 @@
+# Table-driven dispatch for the Cognito custom resources.
+#
+# Every custom resource handler used to repeat the same Create/Update/Delete branching, and
+# each one was deployed as its own Lambda function (paying its own cold start). Instead each
+# resource type describes how to build its Cognito parameters and which operation to run for
+# each RequestType, and registers itself here against the CloudFormation ResourceType(s) it
+# serves. A single router function can then handle every custom resource in a stack.
+
+import time
+
+import cfn_custom_profile
+import cfn_custom_trace
+from cfn_custom_executor import run_operation
+from cfn_custom_response import CFN_SUCCESS, CFN_FAILED, cfn_response_send
+
+_registry = {}
+
+
+class ResourceOperations(object):
+# -----------------------------------------------------------------------------------------------------------------
+
+    def __init__(self, name, build_params, create=None, update=None, delete=None):
+        # build_params(request_type, resource_properties) returns the parameters for the operation.
+        # Operations are functions of the form operation(params, deadline), see cfn_custom_executor.
+        self.name = name
+        self.build_params = build_params
+        self.operations = {
+            'Create': create,
+            'Update': update,
+            'Delete': delete,
+        }
+
+    def run(self, event, context):
+        operation = self.operations.get(event['RequestType'])
+        if operation is None:
+            return {'Result': False, 'Message': "Unknown operation: " + event['RequestType'], 'Data': {}}
+
+        try:
+            with cfn_custom_trace.active().phase('Parse'):
+                params = self.params_for(event)
+            return run_operation(operation, params, context)
+        except Exception as e:
+            return {'Result': False, 'Message': "Failed to complete CloudFormation action: " + str(e), 'Data': {}}
+
+    def params_for(self, event):
+        # Override where the operation needs more of the event than the current properties
+        return self.build_params(event['RequestType'], event['ResourceProperties'])
+
+    def handle(self, event, context):
+        started = time.perf_counter()
+        trace = cfn_custom_trace.start(event)
+        res = self.run(event, context)
+        send_result(event, context, res)
+        cfn_custom_trace.finish(trace, res)
+
+        if cfn_custom_profile.ENABLED:
+            cfn_custom_profile.record_first_call(self.name, started)
+        return res
+
+
+def send_result(event, context, res):
+# -----------------------------------------------------------------------------------------------------------------
+    # Provide the full response data object to allow us to grab outputs in CloudFormation
+    # Note, we should remvoe datetimes, since they're not serializable
+    responseData = dict(res['Data'])
+    responseData['Reason'] = res['Message']
+    responseData.pop('LastModifiedDate', None)
+    responseData.pop('CreationDate', None)
+
+    trace = cfn_custom_trace.active()
+    with trace.phase('Respond'):
+        if res['Result']:
+            sent, attempts = cfn_response_send(event, context, CFN_SUCCESS, responseData)
+        else:
+            sent, attempts = cfn_response_send(event, context, CFN_FAILED, responseData)
+    trace.set('ResponseSent', sent)
+    trace.set('ResponseAttempts', len(attempts))
+    trace.set('ResponseStatuses', [a['Status'] for a in attempts])
+
+
+def register(resource_types, operations):
+# -----------------------------------------------------------------------------------------------------------------
+    for resource_type in resource_types:
+        _registry[resource_type] = operations
+
+
+def lookup(resource_type):
+# -----------------------------------------------------------------------------------------------------------------
+    return _registry.get(resource_type)
+
+
+def registered_types():
+# -----------------------------------------------------------------------------------------------------------------
+    return sorted(_registry)
+
+
+def dispatch(event, context):
+# -----------------------------------------------------------------------------------------------------------------
+    operations = lookup(event.get('ResourceType'))
+    if operations is None:
+        res = {'Result': False, 'Message': "Unknown resource type: " + str(event.get('ResourceType')), 'Data': {}}
+        send_result(event, context, res)
+        return res
+
+    return operations.handle(event, context)
@@ -0,0 +1,215 @@
+# Shared CloudFormation custom resource response sender.
+#
+# This used to be a copy of AWS's cfnresponse module pasted into each handler module, which
+# PUT the response via botocore.vendored.requests (long gone from botocore), opened a new
+# connection every time and only printed the error if the PUT failed - leaving the stack to
+# hang for an hour waiting on a response that was never delivered.
+#
+# Here we keep a small pool of keep-alive connections across warm invocations, retry with
+# jittered exponential backoff (within the time Lambda has left), make sure the body fits
+# inside CloudFormation's 4096 byte response limit before sending it, and record how long
+# each attempt took.
+#
+# See https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/cfn-lambda-function-code-cfnresponsemodule.html
+
+import http.client
+import json
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Cloudformation response values
+CFN_SUCCESS = "SUCCESS"
+CFN_FAILED = "FAILED"
+
+# CloudFormation rejects response bodies larger than this
+MAX_RESPONSE_BYTES = 4096
+MAX_PHYSICAL_ID_BYTES = 1024
+
+MAX_ATTEMPTS = 5
+BASE_DELAY_SECONDS = 0.5
+MAX_DELAY_SECONDS = 8
+REQUEST_TIMEOUT_SECONDS = 10
+
+# Idle connections kept per host
+POOL_SIZE = 2
+
+# Retrying these makes sense - anything else (e.g. 403 from an expired presigned URL) won't get better
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+class ConnectionPool(object):
+# -----------------------------------------------------------------------------------------------------------------
+
+    def __init__(self, size=POOL_SIZE, timeout=REQUEST_TIMEOUT_SECONDS):
+        self.size = size
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        key = (scheme, netloc)
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def put(self, scheme, netloc, conn):
+        key = (scheme, netloc)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+# Shared across warm invocations of the container
+pool = ConnectionPool()
+
+
+def build_response_body(event, context, responseStatus, responseData, physicalResourceId=None, noEcho=False):
+# -----------------------------------------------------------------------------------------------------------------
+    return {
+        'Status': responseStatus,
+        'Reason': 'See the details in CloudWatch Log Stream: ' + context.log_stream_name,
+        'PhysicalResourceId': physicalResourceId or context.log_stream_name,
+        'StackId': event['StackId'],
+        'RequestId': event['RequestId'],
+        'LogicalResourceId': event['LogicalResourceId'],
+        'NoEcho': noEcho,
+        'Data': responseData or {},
+    }
+
+
+def fit_response_body(responseBody, limit=MAX_RESPONSE_BYTES):
+# -----------------------------------------------------------------------------------------------------------------
+    # Returns the encoded body and the list of Data keys dropped to get it under the limit.
+    # The largest values go first, since they're the most likely culprits (and the least
+    # likely to be referenced with Fn::GetAtt). Everything outside of Data is required.
+    # boto3 responses put in Data carry datetimes, so anything json can't encode goes as str()
+    body = json.dumps(responseBody, default=str).encode('utf-8')
+    if len(body) <= limit:
+        return body, []
+
+    data = dict(responseBody['Data'])
+    trimmed = []
+    by_size = sorted(data, key=lambda k: len(json.dumps(data[k], default=str)), reverse=True)
+
+    for key in by_size:
+        data.pop(key)
+        trimmed.append(key)
+        body = json.dumps(dict(responseBody, Data=data), default=str).encode('utf-8')
+        if len(body) <= limit:
+            return body, trimmed
+
+    raise ValueError('Response body is {0} bytes even with no Data (limit is {1})'.format(len(body), limit))
+
+
+def backoff_delay(attempt):
+# -----------------------------------------------------------------------------------------------------------------
+    # "Full jitter" - anywhere between nothing and the exponential ceiling
+    return random.uniform(0, min(MAX_DELAY_SECONDS, BASE_DELAY_SECONDS * (2 ** attempt)))
+
+
+def time_left(context):
+# -----------------------------------------------------------------------------------------------------------------
+    get_remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining is None:
+        return None
+    return get_remaining() / 1000.0
+
+
+def put_response(responseUrl, body, context=None, max_attempts=MAX_ATTEMPTS):
+# -----------------------------------------------------------------------------------------------------------------
+    url = urlsplit(responseUrl)
+    target = url.path + ('?' + url.query if url.query else '')
+    headers = {
+        'content-type': '',
+        'content-length': str(len(body))
+    }
+
+    attempts = []
+    for attempt in range(max_attempts):
+        conn = pool.get(url.scheme, url.netloc)
+        started = time.monotonic()
+        status, error = None, None
+
+        try:
+            conn.request('PUT', target, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+            if response.will_close:
+                conn.close()
+            else:
+                pool.put(url.scheme, url.netloc, conn)
+        except Exception as e:
+            conn.close()
+            error = str(e)
+
+        attempts.append({
+            'Attempt': attempt + 1,
+            'Status': status,
+            'Error': error,
+            'LatencyMs': round((time.monotonic() - started) * 1000, 1),
+        })
+
+        if status is not None and 200 <= status < 300:
+            return True, attempts
+        if status is not None and status not in RETRYABLE_STATUSES:
+            return False, attempts
+        if attempt + 1 >= max_attempts:
+            break
+
+        # Don't sleep past the point where Lambda would kill us mid-request anyway
+        delay = backoff_delay(attempt)
+        remaining = time_left(context)
+        if remaining is not None and remaining < delay + REQUEST_TIMEOUT_SECONDS:
+            break
+        time.sleep(delay)
+
+    return False, attempts
+
+
+def cfn_response_send(event, context, responseStatus, responseData, physicalResourceId=None, noEcho=False):
+# -----------------------------------------------------------------------------------------------------------------
+    responseUrl = event['ResponseURL']
+
+    print(responseUrl)
+
+    responseBody = build_response_body(event, context, responseStatus, responseData, physicalResourceId, noEcho)
+    try:
+        body, trimmed = fit_response_body(responseBody)
+    except (TypeError, ValueError) as e:
+        # CloudFormation still has to hear back, or the stack waits on us until it times out
+        # (CloudFormation won't take a physical ID over 1KB anyway, so that's the one other thing to drop)
+        print("Response body could not be built ({0}), sending FAILED with no Data".format(e))
+        if physicalResourceId and len(physicalResourceId) > MAX_PHYSICAL_ID_BYTES:
+            physicalResourceId = None
+        responseBody = build_response_body(event, context, CFN_FAILED, {}, physicalResourceId, noEcho)
+        responseBody['Reason'] = 'Response could not be built: {0:.500}'.format(str(e))
+        body, trimmed = fit_response_body(responseBody)
+    if trimmed:
+        print("Response too large, dropped Data keys: " + ", ".join(trimmed))
+
+    print("Response body:\n" + body.decode('utf-8'))
+
+    sent, attempts = put_response(responseUrl, body, context)
+    print("Response attempts: " + json.dumps(attempts))
+    if not sent:
+        print("send(..) failed after {0} attempt(s)".format(len(attempts)))
+
+    return sent, attempts
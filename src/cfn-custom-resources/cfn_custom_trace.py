@@ -0,0 +1,240 @@
+# Per-invocation latency tracing for the custom resource handlers.
+#
+# When a stack deployment stalls, the logs only show the response URL and body, not where the
+# time went. With CFN_CUSTOM_TRACE_SAMPLE_RATE set (0..1, the share of invocations to trace),
+# each sampled invocation logs one record at the end with the time spent in each phase:
+#
+#   Parse      building the Cognito parameters from ResourceProperties
+#   Queue      waiting for a worker on the shared executor (what used to be spawning a Process)
+#   Operation  the operation itself, including every Cognito call it makes
+#   Respond    fitting and PUTting the response to CloudFormation, over however many attempts
+#
+# along with every Cognito API call made meanwhile (latency, attempts, throttled attempts and
+# error code, picked up from botocore's event hooks, so that includes botocore's own retries
+# as well as cfn_custom_batch's), keyed by LogicalResourceId and RequestType. By default the
+# record is CloudWatch Embedded Metric Format, so the phases turn into metrics under
+# CFN_CUSTOM_TRACE_NAMESPACE; CFN_CUSTOM_TRACE_FORMAT=json logs it without the metric directive.
+#
+# With no sample rate none of the hooks are installed and an invocation that isn't sampled only
+# costs a random(). Lambda runs one invocation at a time per container, so the trace of the
+# invocation in progress is simply module state - the one exception being the Cognito calls of
+# an operation that timed out and is still running, which land in the next invocation's trace.
+
+import contextlib
+import json
+import os
+import random
+import threading
+import time
+
+
+def _sample_rate():
+# -----------------------------------------------------------------------------------------------------------------
+    try:
+        return min(max(float(os.environ.get('CFN_CUSTOM_TRACE_SAMPLE_RATE', '0')), 0.0), 1.0)
+    except ValueError:
+        return 0.0
+
+
+SAMPLE_RATE = _sample_rate()
+ENABLED = SAMPLE_RATE > 0
+
+NAMESPACE = os.environ.get('CFN_CUSTOM_TRACE_NAMESPACE', 'BirdBanding/CustomResources')
+EMF = os.environ.get('CFN_CUSTOM_TRACE_FORMAT', 'emf').lower() != 'json'
+
+PHASES = ('Parse', 'Queue', 'Operation', 'Respond')
+
+# Same as cfn_custom_batch.THROTTLE_CODES (not imported from there, to keep this stdlib only)
+THROTTLE_CODES = ('TooManyRequestsException', 'ThrottlingException', 'Throttling')
+
+_active = None
+
+
+class Trace(object):
+# -----------------------------------------------------------------------------------------------------------------
+
+    sampled = True
+
+    def __init__(self, event):
+        self.started = time.perf_counter()
+        self.timestamp = time.time()
+        self.event = event
+        self.phases = {}
+        self.calls = []
+        self.properties = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, started)
+
+    def add_phase(self, name, started):
+        # Phases can repeat (e.g. Respond for an unknown resource type), so they accumulate
+        elapsed = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def add_call(self, operation, latency_ms, attempts, throttles, error=None):
+        with self._lock:
+            self.calls.append({'Operation': operation, 'LatencyMs': round(latency_ms, 1), 'Attempts': attempts,
+                               'Throttles': throttles, 'Error': error})
+
+    def set(self, name, value):
+        self.properties[name] = value
+
+    def record(self, result=None):
+        with self._lock:
+            calls = list(self.calls)
+            phases = dict(self.phases)
+
+        metrics = [('TotalMs', (time.perf_counter() - self.started) * 1000, 'Milliseconds')]
+        metrics.extend((name + 'Ms', phases.get(name, 0.0), 'Milliseconds') for name in PHASES)
+        metrics.extend([
+            ('CognitoCalls', len(calls), 'Count'),
+            ('CognitoMs', sum(c['LatencyMs'] for c in calls), 'Milliseconds'),
+            ('CognitoRetries', sum(c['Attempts'] - 1 for c in calls), 'Count'),
+            ('Throttles', sum(c['Throttles'] for c in calls), 'Count'),
+        ])
+
+        record = {
+            'Trace': 'CustomResource',
+            'LogicalResourceId': self.event.get('LogicalResourceId'),
+            'RequestType': self.event.get('RequestType'),
+            'ResourceType': self.event.get('ResourceType'),
+            'StackId': self.event.get('StackId'),
+            'RequestId': self.event.get('RequestId'),
+            'Result': None if result is None else bool(result.get('Result')),
+            'CognitoCallDetail': calls,
+        }
+        record.update(self.properties)
+        record.update((name, round(value, 1) if unit == 'Milliseconds' else value) for name, value, unit in metrics)
+
+        if EMF:
+            record['_aws'] = {
+                'Timestamp': int(self.timestamp * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [['RequestType'], ['LogicalResourceId', 'RequestType']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, _, unit in metrics],
+                }],
+            }
+        return record
+
+
+class NullTrace(Trace):
+# -----------------------------------------------------------------------------------------------------------------
+    # Stands in for invocations that aren't sampled, so callers never need to check
+
+    sampled = False
+
+    def __init__(self):
+        pass
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        yield
+
+    def add_phase(self, name, started):
+        pass
+
+    def add_call(self, operation, latency_ms, attempts, throttles, error=None):
+        pass
+
+    def set(self, name, value):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+def start(event):
+# -----------------------------------------------------------------------------------------------------------------
+    global _active
+
+    if not ENABLED or random.random() >= SAMPLE_RATE:
+        _active = None
+        return NULL_TRACE
+
+    _active = Trace(event)
+    return _active
+
+
+def active():
+# -----------------------------------------------------------------------------------------------------------------
+    return _active or NULL_TRACE
+
+
+def finish(trace, result=None):
+# -----------------------------------------------------------------------------------------------------------------
+    global _active
+
+    if not trace.sampled:
+        return None
+    if _active is trace:
+        _active = None
+
+    record = trace.record(result)
+    print(json.dumps(record, default=str))
+    return record
+
+
+# -----------------------------------------------------------------------------------------------------------------
+# BOTOCORE HOOKS
+# -----------------------------------------------------------------------------------------------------------------
+
+# Per-call state lives in botocore's request context, which the same call's before-call,
+# needs-retry (once per attempt) and after-call events all share
+_CONTEXT_KEY = 'cfn_custom_trace'
+
+
+def _before_call(model=None, context=None, **kwargs):
+# -----------------------------------------------------------------------------------------------------------------
+    if _active is not None and context is not None:
+        context[_CONTEXT_KEY] = {'Trace': _active, 'Operation': getattr(model, 'name', None),
+                                 'Started': time.perf_counter(), 'Attempts': 0, 'Throttles': 0}
+
+
+def _needs_retry(response=None, request_dict=None, **kwargs):
+# -----------------------------------------------------------------------------------------------------------------
+    state = ((request_dict or {}).get('context') or {}).get(_CONTEXT_KEY)
+    if state is not None:
+        state['Attempts'] += 1
+        if response is not None and response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+            state['Throttles'] += 1
+    # Returning None leaves the retry decision to botocore
+
+
+def _finish_call(context, error):
+# -----------------------------------------------------------------------------------------------------------------
+    state = (context or {}).pop(_CONTEXT_KEY, None)
+    if state is not None:
+        state['Trace'].add_call(state['Operation'], (time.perf_counter() - state['Started']) * 1000,
+                                max(state['Attempts'], 1), state['Throttles'], error)
+
+
+def _after_call(parsed=None, context=None, **kwargs):
+# -----------------------------------------------------------------------------------------------------------------
+    _finish_call(context, (parsed or {}).get('Error', {}).get('Code'))
+
+
+def _after_call_error(exception=None, context=None, **kwargs):
+# -----------------------------------------------------------------------------------------------------------------
+    _finish_call(context, type(exception).__name__)
+
+
+def instrument_client(client):
+# -----------------------------------------------------------------------------------------------------------------
+    # Called by cfn_custom_clients for every client it builds when tracing is enabled
+    events = getattr(getattr(client, 'meta', None), 'events', None)
+    if events is None:
+        return client
+
+    events.register('before-call', _before_call)
+    events.register('needs-retry', _needs_retry)
+    events.register('after-call', _after_call)
+    events.register('after-call-error', _after_call_error)
+    return client
@@ -0,0 +1,10 @@
+# The handler modules aren't a package (Lambda loads them from the top of the deployment
+# package), so make them importable the same way here.
+#
+# Usage (from src/cfn-custom-resources, stdlib + pytest only):
+#   python3 -m pytest tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,26 @@
+# Custom::UserPoolClientBatch against bench/batch_clients.py's stubbed Cognito, which throttles
+# once requests go over a token-bucket rate: every client has to be created exactly once, every
+# result has to be Created, Updated or Deleted, and Cognito has to have throttled (or the
+# limiter wasn't tested at all).
+
+import cfn_custom_batch
+import cfn_custom_clients
+import cfn_custom_response
+from bench import batch_clients
+
+
+def test_batch_under_throttling(monkeypatch):
+# -----------------------------------------------------------------------------------------------------------------
+    # A burst well under the batch's workers, so the first round of calls is bound to be throttled
+    monkeypatch.setattr(cfn_custom_batch, 'BASE_DELAY_SECONDS', 0.05)
+    monkeypatch.setattr(cfn_custom_response, 'put_response', lambda url, body, context=None: (True, []))
+
+    try:
+        report, problems = batch_clients.run(clients=12, rate=50, burst=2, api_latency_ms=10)
+    finally:
+        cfn_custom_clients.set_client('cognito-idp', None)
+
+    assert problems == []
+    assert report['batch_create']['created_once']
+    assert report['batch_create']['throttles'] > 0
+    assert report['batch_delete']['remaining_clients'] == 0
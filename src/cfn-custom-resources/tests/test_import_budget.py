@@ -0,0 +1,19 @@
+# The cold-start import budget (bench/import_budget.py and bench/import_budget.json) as a
+# test: each handler module is imported in a fresh interpreter, best of the configured runs,
+# and fails if it's over budget or loads a module that should only ever be loaded lazily.
+
+import pytest
+
+from bench import import_budget
+
+CONFIG = import_budget.load_config()
+
+
+@pytest.mark.parametrize('module', sorted(CONFIG['BudgetsMs']))
+def test_import_within_budget(module):
+# -----------------------------------------------------------------------------------------------------------------
+    elapsed, loaded = import_budget.measure(module, CONFIG.get('Runs', 5))
+
+    assert import_budget.forbidden_modules(loaded, CONFIG) == []
+    assert elapsed <= CONFIG['BudgetsMs'][module], '{0} took {1:.1f} ms to import (budget {2} ms)'.format(
+        module, elapsed, CONFIG['BudgetsMs'][module])
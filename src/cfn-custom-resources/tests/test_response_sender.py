@@ -0,0 +1,156 @@
+# cfn_custom_response against a local HTTP server standing in for the presigned S3 response
+# URL (the same stand-in bench/response_sender.py times). Each test says which status codes
+# the server answers with, in order, and checks what was PUT and over how many connections.
+
+import datetime
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import cfn_custom_response
+
+
+class StandInS3(BaseHTTPRequestHandler):
+# -----------------------------------------------------------------------------------------------------------------
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['content-length']))
+        server = self.server
+        with server.lock:
+            server.connections.add(self.client_address)
+            server.bodies.append(body)
+            status = server.statuses.pop(0) if server.statuses else 200
+
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StubContext(object):
+# -----------------------------------------------------------------------------------------------------------------
+    log_stream_name = 'test-stream'
+
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+
+@pytest.fixture
+def stand_in(monkeypatch):
+# -----------------------------------------------------------------------------------------------------------------
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInS3)
+    server.lock = threading.Lock()
+    server.connections, server.bodies, server.statuses = set(), [], []
+    server.url = 'http://127.0.0.1:{0}/bucket/key?X-Amz-Signature=stub'.format(server.server_address[1])
+    threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+
+    # Keep the backoff short, and don't hand connections from one test's server to the next
+    monkeypatch.setattr(cfn_custom_response, 'BASE_DELAY_SECONDS', 0.001)
+    cfn_custom_response.pool.clear()
+    yield server
+    cfn_custom_response.pool.clear()
+    server.shutdown()
+    server.server_close()
+
+
+def make_event(url, request_id='req-1'):
+# -----------------------------------------------------------------------------------------------------------------
+    return {'ResponseURL': url, 'StackId': 'stack', 'RequestId': request_id, 'LogicalResourceId': 'Test'}
+
+
+def test_retries_after_503(stand_in):
+# -----------------------------------------------------------------------------------------------------------------
+    stand_in.statuses = [503, 503]
+
+    sent, attempts = cfn_custom_response.put_response(stand_in.url, b'{}', StubContext())
+
+    assert sent
+    assert [a['Status'] for a in attempts] == [503, 503, 200]
+    assert len(stand_in.bodies) == 3
+
+
+def test_no_retry_on_403(stand_in):
+# -----------------------------------------------------------------------------------------------------------------
+    stand_in.statuses = [403]
+
+    sent, attempts = cfn_custom_response.put_response(stand_in.url, b'{}', StubContext())
+
+    assert not sent
+    assert [a['Status'] for a in attempts] == [403]
+    assert len(stand_in.bodies) == 1
+
+
+def test_gives_up_after_max_attempts(stand_in):
+# -----------------------------------------------------------------------------------------------------------------
+    stand_in.statuses = [503] * 10
+
+    sent, attempts = cfn_custom_response.put_response(stand_in.url, b'{}', StubContext(), max_attempts=3)
+
+    assert not sent
+    assert len(attempts) == 3
+    assert len(stand_in.bodies) == 3
+
+
+def test_trims_body_to_limit(stand_in):
+# -----------------------------------------------------------------------------------------------------------------
+    data = {'ClientId': 'abc', 'Big': 'x' * 6000}
+
+    sent, _ = cfn_custom_response.cfn_response_send(make_event(stand_in.url), StubContext(),
+                                                    cfn_custom_response.CFN_SUCCESS, data)
+
+    assert sent
+    body = stand_in.bodies[-1]
+    assert len(body) <= cfn_custom_response.MAX_RESPONSE_BYTES
+    response = json.loads(body)
+    assert response['Status'] == cfn_custom_response.CFN_SUCCESS
+    assert response['Data'] == {'ClientId': 'abc'}
+
+
+def test_reuses_connection(stand_in):
+# -----------------------------------------------------------------------------------------------------------------
+    stand_in.statuses = [503]
+
+    for i in range(5):
+        sent, _ = cfn_custom_response.cfn_response_send(make_event(stand_in.url, 'req-{0}'.format(i)), StubContext(),
+                                                        cfn_custom_response.CFN_SUCCESS, {'ClientId': 'abc'})
+        assert sent
+
+    assert len(stand_in.bodies) == 6
+    assert len(stand_in.connections) == 1
+
+
+def test_serialises_datetimes(stand_in):
+# -----------------------------------------------------------------------------------------------------------------
+    # e.g. resp['IdentityProvider'] from create_identity_provider
+    created = datetime.datetime(2021, 3, 4, 5, 6, 7, tzinfo=datetime.timezone.utc)
+    data = {'ProviderName': 'idp', 'CreationDate': created}
+
+    sent, _ = cfn_custom_response.cfn_response_send(make_event(stand_in.url), StubContext(),
+                                                    cfn_custom_response.CFN_SUCCESS, data)
+
+    assert sent
+    response = json.loads(stand_in.bodies[-1])
+    assert response['Status'] == cfn_custom_response.CFN_SUCCESS
+    assert response['Data'] == {'ProviderName': 'idp', 'CreationDate': str(created)}
+
+
+def test_sends_failed_when_body_cannot_fit(stand_in):
+# -----------------------------------------------------------------------------------------------------------------
+    # Too big with no Data at all, so the only thing left is to tell CloudFormation it failed
+    physical_id = 'p' * 5000
+
+    sent, _ = cfn_custom_response.cfn_response_send(make_event(stand_in.url), StubContext(),
+                                                    cfn_custom_response.CFN_SUCCESS, {'ClientId': 'abc'}, physical_id)
+
+    assert sent
+    body = stand_in.bodies[-1]
+    assert len(body) <= cfn_custom_response.MAX_RESPONSE_BYTES
+    response = json.loads(body)
+    assert response['Status'] == cfn_custom_response.CFN_FAILED
+    assert response['Data'] == {}
+    assert response['RequestId'] == 'req-1'
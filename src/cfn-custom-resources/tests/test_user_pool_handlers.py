@@ -0,0 +1,50 @@
+# The user pool handlers against bench/replay_stack.py's stubbed Cognito, which answers with
+# the response shapes the real API uses.
+
+import importlib
+
+import pytest
+
+import cfn_custom_clients
+from bench.replay_stack import StubCognitoIdp
+
+user_pool = importlib.import_module('cfn-custom-manage-cognito-user-pool')
+
+PROVIDER_PROPS = {'UserPoolId': 'stub-pool', 'Name': 'ExampleAD', 'IdpIdentifier': 'example',
+                  'Metadata': 'https://example.com/metadata.xml'}
+
+
+@pytest.fixture
+def cognito():
+# -----------------------------------------------------------------------------------------------------------------
+    stub = StubCognitoIdp(0)
+    cfn_custom_clients.set_client('cognito-idp', stub)
+    yield stub
+    cfn_custom_clients.set_client('cognito-idp', None)
+
+
+def test_update_provider_reads_identifiers_from_provider(cognito):
+# -----------------------------------------------------------------------------------------------------------------
+    user_pool.create_provider(user_pool.identity_provider_params('Create', PROVIDER_PROPS), None)
+
+    res = user_pool.update_provider(user_pool.identity_provider_params('Update', PROVIDER_PROPS), None)
+
+    assert res['Result'], res['Message']
+    assert res['Message'] == 'Updated SAML Idp: example'
+    assert res['Data']['IdpIdentifiers'] == ['example']
+
+
+def test_domain_params_passes_cert_arn():
+# -----------------------------------------------------------------------------------------------------------------
+    props = {'UserPoolId': 'stub-pool', 'DomainName': 'auth.example.com', 'CertArn': 'arn:aws:acm:cert'}
+
+    params = user_pool.domain_params('Create', props)
+
+    assert params['CustomDomainConfig'] == {'CertificateArn': 'arn:aws:acm:cert'}
+
+
+def test_domain_params_without_cert_arn():
+# -----------------------------------------------------------------------------------------------------------------
+    params = user_pool.domain_params('Create', {'UserPoolId': 'stub-pool', 'DomainName': 'bench'})
+
+    assert 'CustomDomainConfig' not in params
@@ -0,0 +1,8 @@
+# Benchmarks for the database side of birdbanding, run against a scratch PostgreSQL loaded
+# with synthetic data (see synthetic_data.py). Run from src/db-tools so the db_* modules
+# resolve, e.g.
+#
+#   python3 -m bench.search_pagination --dsn "host=localhost dbname=birdbanding_bench" --create-schema
+#
+# Every benchmark prints (and optionally writes) a JSON document with the same shape, so two
+# runs can be diffed with --compare.
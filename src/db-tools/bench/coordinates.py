@@ -0,0 +1,177 @@
+# Benchmark: NZTM / NZMG -> WGS84 conversion with db_coordinates.py against PostGIS.
+#
+# Random points across New Zealand's grid extents (plus the test coordinates from the SQL
+# function comments) are converted three ways:
+#
+#   - per row: SELECT * FROM ro_nztm_to_wgs84(e, n) / ro_nzmg_to_wgs84(e, n), one call per point,
+#     as the upload path does today (only --per-row-points of them, it is slow)
+#   - set based: one ST_Transform query over unnest()ed arrays of every point
+#   - NumPy: db_coordinates.nztm_to_wgs84 / nzmg_to_wgs84
+#
+# The NumPy results are checked against the set based PostGIS ones (and the per row ones for the
+# points they cover); every point has to agree to within --tolerance-m (default a millimetre).
+# Only needs the schema's functions and spatial_ref_sys, not synthetic data.
+#
+#   python3 -m bench.coordinates --dsn "dbname=birdbanding_bench" --points 200000
+
+import argparse
+import time
+
+import numpy as np
+
+import db_coordinates
+from db_pool import ConnectionPool
+
+from bench import results
+
+POINTS = 100000
+PER_ROW_POINTS = 2000
+REPEATS = 3
+TOLERANCE_M = 0.001
+
+# Rough easting/northing extents of mainland New Zealand in each grid
+EXTENTS = {
+    db_coordinates.NZTM_SRID: ((1090000.0, 2090000.0), (4740000.0, 6200000.0)),
+    db_coordinates.NZMG_SRID: ((2000000.0, 3020000.0), (5300000.0, 6800000.0)),
+}
+
+PER_ROW_FUNCTIONS = {
+    db_coordinates.NZTM_SRID: 'ro_nztm_to_wgs84',
+    db_coordinates.NZMG_SRID: 'ro_nzmg_to_wgs84',
+}
+
+SET_BASED_SQL = '''
+    SELECT ST_Y(p), ST_X(p)
+    FROM (
+        SELECT ordinality, ST_Transform(ST_SetSRID(ST_MakePoint(e, n), %(srid)s), 4326) AS p
+        FROM unnest(%(eastings)s::float8[], %(northings)s::float8[]) WITH ORDINALITY AS t (e, n, ordinality)
+    ) AS transformed
+    ORDER BY ordinality
+'''
+
+
+def make_points(srid, count, seed):
+# -----------------------------------------------------------------------------------------------------------------
+    rng = np.random.default_rng(seed)
+    (e0, e1), (n0, n1) = EXTENTS[srid]
+    tests = [(e, n) for s, e, n, _, _ in db_coordinates.TEST_POINTS if s == srid]
+    eastings = np.concatenate([[e for e, _ in tests], rng.uniform(e0, e1, count)])
+    northings = np.concatenate([[n for _, n in tests], rng.uniform(n0, n1, count)])
+    return eastings, northings
+
+
+def postgis_set_based(pool, srid, eastings, northings):
+# -----------------------------------------------------------------------------------------------------------------
+    with pool.cursor() as cur:
+        cur.execute(SET_BASED_SQL, {'srid': srid, 'eastings': eastings.tolist(), 'northings': northings.tolist()})
+        rows = np.array(cur.fetchall(), dtype=np.float64)
+    return rows[:, 0], rows[:, 1]
+
+
+def postgis_per_row(pool, srid, eastings, northings):
+# -----------------------------------------------------------------------------------------------------------------
+    query = 'SELECT latitude::float8, longitude::float8 FROM {0}(%s, %s)'.format(PER_ROW_FUNCTIONS[srid])
+    latitudes = []
+    longitudes = []
+    with pool.cursor() as cur:
+        for easting, northing in zip(eastings.tolist(), northings.tolist()):
+            cur.execute(query, (easting, northing))
+            latitude, longitude = cur.fetchone()
+            latitudes.append(latitude)
+            longitudes.append(longitude)
+    return np.array(latitudes), np.array(longitudes)
+
+
+def agreement(latitude, longitude, expected_latitude, expected_longitude, tolerance_m):
+# -----------------------------------------------------------------------------------------------------------------
+    error = db_coordinates.error_metres(latitude, longitude, expected_latitude, expected_longitude)
+    return {
+        'MaxErrorM': float(np.max(error)),
+        'MeanErrorM': float(np.mean(error)),
+        'OverTolerance': int(np.count_nonzero(~(error <= tolerance_m))),
+    }
+
+
+def rows_per_second(latency, rows):
+# -----------------------------------------------------------------------------------------------------------------
+    return round(rows / (latency['median_ms'] / 1000), 1) if latency['median_ms'] else None
+
+
+def run(pool, points=POINTS, per_row_points=PER_ROW_POINTS, repeats=REPEATS, tolerance_m=TOLERANCE_M, seed=1):
+# -----------------------------------------------------------------------------------------------------------------
+    metrics = {}
+    detail = {'ToleranceM': tolerance_m, 'Grids': {}}
+
+    # The embedded expectations (PROJ's answers) first, so a bad build of the module fails fast
+    detail['TestPoints'] = []
+    for srid, easting, northing, latitude, longitude in db_coordinates.TEST_POINTS:
+        got_latitude, got_longitude = db_coordinates.to_wgs84(srid, [easting], [northing])
+        detail['TestPoints'].append(dict(
+            {'Srid': srid, 'Easting': easting, 'Northing': northing},
+            **agreement(got_latitude, got_longitude, [latitude], [longitude], tolerance_m)))
+
+    for srid in sorted(EXTENTS):
+        eastings, northings = make_points(srid, points, seed + srid)
+        count = len(eastings)
+
+        numpy_latency, (latitude, longitude) = results.timed(
+            lambda: db_coordinates.to_wgs84(srid, eastings, northings), repeats)
+        set_latency, (set_latitude, set_longitude) = results.timed(
+            lambda: postgis_set_based(pool, srid, eastings, northings), repeats)
+
+        sample = slice(0, min(per_row_points, count))
+        started = time.perf_counter()
+        row_latitude, row_longitude = postgis_per_row(pool, srid, eastings[sample], northings[sample])
+        per_row_ms = (time.perf_counter() - started) * 1000
+        per_row_count = len(row_latitude)
+
+        grid = {
+            'Points': count,
+            'NumPy': dict(numpy_latency, rows_per_second=rows_per_second(numpy_latency, count)),
+            'SetBased': dict(set_latency, rows_per_second=rows_per_second(set_latency, count)),
+            'PerRow': {'Points': per_row_count, 'total_ms': round(per_row_ms, 3),
+                       'rows_per_second': round(per_row_count / (per_row_ms / 1000), 1) if per_row_ms else None},
+            'VsSetBased': agreement(latitude, longitude, set_latitude, set_longitude, tolerance_m),
+            'VsPerRow': agreement(latitude[sample], longitude[sample], row_latitude, row_longitude, tolerance_m),
+        }
+        detail['Grids'][srid] = grid
+
+        name = str(srid)
+        metrics[name + '.numpy.median_ms'] = numpy_latency['median_ms']
+        metrics[name + '.set_based.median_ms'] = set_latency['median_ms']
+        metrics[name + '.per_row.us_per_point'] = round(per_row_ms * 1000 / per_row_count, 3) if per_row_count else 0
+        metrics[name + '.numpy.max_error_mm'] = round(grid['VsSetBased']['MaxErrorM'] * 1000, 6)
+
+    detail['AllAgree'] = (all(p['OverTolerance'] == 0 for p in detail['TestPoints']) and
+                          all(g[k]['OverTolerance'] == 0 for g in detail['Grids'].values()
+                              for k in ('VsSetBased', 'VsPerRow')))
+    return metrics, detail
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default=None, help='libpq connection string (default: $BIRDBANDING_DB_DSN / PG* env vars)')
+    parser.add_argument('--points', type=int, default=POINTS, help='Random points per grid')
+    parser.add_argument('--per-row-points', type=int, default=PER_ROW_POINTS,
+                        help='How many of them to also convert one call at a time')
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--tolerance-m', type=float, default=TOLERANCE_M)
+    parser.add_argument('--seed', type=int, default=1)
+    results.add_arguments(parser)
+    args = parser.parse_args()
+
+    parameters = {'Points': args.points, 'PerRowPoints': args.per_row_points, 'Repeats': args.repeats,
+                  'ToleranceM': args.tolerance_m, 'Seed': args.seed}
+
+    with ConnectionPool(args.dsn, max_connections=1) as pool:
+        document = {'Benchmark': 'coordinates', 'Metadata': results.run_metadata(pool, parameters)}
+        document['Metrics'], document['Detail'] = run(pool, args.points, args.per_row_points, args.repeats,
+                                                      args.tolerance_m, args.seed)
+
+    exit_code = results.emit(document, args.output, args.compare)
+    return exit_code or (0 if document['Detail']['AllAgree'] else 1)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
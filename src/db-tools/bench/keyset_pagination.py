@@ -0,0 +1,128 @@
+# Benchmark: keyset pagination over the base tables (db_keyset_pagination.py) against the
+# search_events_sort_* materialized views it replaces.
+#
+# For every sort order, the first page and a deep page are fetched both ways, for an admin and
+# for a bander, and the admin pages are checked to hold the same entries in the same order (the
+# views are refreshed first, so both sides see the same data). The views' refresh time is part
+# of what the matview path costs, so search_pagination.py is the place to look for that.
+#
+#   python3 -m bench.keyset_pagination --dsn "dbname=birdbanding_bench" --skip-generate --output keyset.json
+
+import argparse
+
+from db_keyset_pagination import SORT_KEYS, KeysetPaginator
+from db_matview_refresh import SUCCEEDED, refresh_matviews, select_matviews
+from db_pool import ConnectionPool
+
+from bench import results, synthetic_data
+from bench.search_pagination import ADMIN_PAGE, BANDER_PAGE, DEEP_FRACTION, PAGE_SIZE, REPEATS, pick_bander
+
+
+def entry_sequence(rows, mark_keyed):
+# -----------------------------------------------------------------------------------------------------------------
+    """The entries a page's rows belong to, in order (what one pagination_idx covers in the views)."""
+    sequence = []
+    for row in rows:
+        entry = (row['id'], row['mark_prefix_number'], row['mark_short_number']) if mark_keyed else row['id']
+        if not sequence or sequence[-1] != entry:
+            sequence.append(entry)
+    return sequence
+
+
+def matview_page(pool, view, audience, after, page_size, bander_id, project_ids):
+# -----------------------------------------------------------------------------------------------------------------
+    query = (ADMIN_PAGE if audience == 'admin' else BANDER_PAGE).format(view=view)
+    params = {'after': after, 'page_size': page_size, 'bander_id': bander_id, 'project_ids': project_ids}
+
+    def fetch_page():
+        with pool.cursor() as cur:
+            cur.execute(query, params)
+            columns = [c[0] for c in cur.description]
+            return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+    return fetch_page
+
+
+def keyset_page(paginator, sort, audience, cursor, page_size, bander_id, project_ids):
+# -----------------------------------------------------------------------------------------------------------------
+    def fetch_page():
+        if audience == 'admin':
+            return paginator.page(sort, cursor, page_size)[0]
+        return paginator.page(sort, cursor, page_size, bander_id=bander_id, project_ids=project_ids)[0]
+
+    return fetch_page
+
+
+def run(pool, sorts=None, page_size=PAGE_SIZE, repeats=REPEATS, deep_fraction=DEEP_FRACTION):
+# -----------------------------------------------------------------------------------------------------------------
+    sorts = sorts or sorted(SORT_KEYS)
+    views = ['bander_birds_matview'] + [SORT_KEYS[s].matview for s in sorts]
+    refreshed, refresh_ms = refresh_matviews(pool, select_matviews(views), concurrent=False)
+    if any(r['Status'] != SUCCEEDED for r in refreshed):
+        raise RuntimeError('Refreshing the views failed: {0}'.format(refreshed))
+
+    paginator = KeysetPaginator(pool)
+    bander_id, project_ids = pick_bander(pool)
+    metrics = {}
+    detail = {'RefreshMs': refresh_ms, 'Bander': {'Id': bander_id, 'Projects': project_ids}, 'Sorts': {}}
+
+    for sort in sorts:
+        sort_key = SORT_KEYS[sort]
+        with pool.cursor() as cur:
+            cur.execute('SELECT max(pagination_idx) FROM {0}'.format(sort_key.matview))
+            deep = int((cur.fetchone()[0] or 0) * deep_fraction)
+
+        pages = {}
+        for page, after in (('first_page', 0), ('deep_page', deep)):
+            for audience in ('admin', 'bander'):
+                scope = {} if audience == 'admin' else {'bander_id': bander_id, 'project_ids': project_ids}
+                cursor = paginator.cursor_at(sort, after, **scope)
+                matview_latency, matview_rows = results.timed(
+                    matview_page(pool, sort_key.matview, audience, after, page_size, bander_id, project_ids), repeats)
+                keyset_latency, keyset_rows = results.timed(
+                    keyset_page(paginator, sort, audience, cursor, page_size, bander_id, project_ids), repeats)
+
+                name = '{0}.{1}.{2}'.format(sort, page, audience)
+                outcome = {'After': after, 'Matview': dict(matview_latency, rows=len(matview_rows)),
+                           'Keyset': dict(keyset_latency, rows=len(keyset_rows))}
+                if audience == 'admin':
+                    # The bander pages aren't comparable: the views filter rows, keyset filters whole entries
+                    outcome['SameEntries'] = (entry_sequence(matview_rows, sort_key.mark_keyed) ==
+                                              entry_sequence(keyset_rows, sort_key.mark_keyed))
+                pages[name] = outcome
+                results.flatten(name + '.matview', {'median_ms': matview_latency['median_ms']}, metrics)
+                results.flatten(name + '.keyset', {'median_ms': keyset_latency['median_ms'],
+                                                   'p95_ms': keyset_latency['p95_ms']}, metrics)
+        detail['Sorts'][sort] = pages
+
+    detail['AllSameEntries'] = all(p.get('SameEntries', True) for s in detail['Sorts'].values() for p in s.values())
+    return metrics, detail
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default=None, help='libpq connection string (default: $BIRDBANDING_DB_DSN / PG* env vars)')
+    synthetic_data.add_arguments(parser)
+    parser.add_argument('--sorts', nargs='+', choices=sorted(SORT_KEYS), help='Just these sort orders')
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--deep-fraction', type=float, default=DEEP_FRACTION)
+    results.add_arguments(parser)
+    args = parser.parse_args()
+
+    parameters = dict(synthetic_data.parameters(args), PageSize=args.page_size, Repeats=args.repeats,
+                      DeepFraction=args.deep_fraction)
+
+    with ConnectionPool(args.dsn, max_connections=4) as pool:
+        document = {'Benchmark': 'keyset_pagination', 'Metadata': results.run_metadata(pool, parameters)}
+        synthetic_data.prepare(pool, args, document)
+        document['Metrics'], document['Detail'] = run(pool, args.sorts, args.page_size, args.repeats,
+                                                      args.deep_fraction)
+
+    exit_code = results.emit(document, args.output, args.compare)
+    return exit_code or (0 if document['Detail']['AllSameEntries'] else 1)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,156 @@
+# Benchmark: validating band uploads with the in-memory mark range index (db_mark_index.py)
+# against the SQL functions it replaces.
+#
+# For the busiest prefixes, an upload of --upload-size short numbers is made up of a run that
+# overlaps bands already in use and a run just past the last one, then checked both ways:
+#
+#   - uniqueness: ro_are_marks_unique(prefix, range_array) vs MarkRangeIndex.existing()
+#   - last number: ro_get_last_short_number(prefix) vs MarkRangeIndex.last_short_number()
+#   - range free: a count over mark vs MarkRangeIndex.is_range_free()
+#
+# and the answers are checked to agree. It also times the initial load and, after inserting a
+# batch of marks under a throwaway prefix (deleted again afterwards), an incremental refresh.
+#
+#   python3 -m bench.mark_index --dsn "dbname=birdbanding_bench" --skip-generate --upload-size 50000
+
+import argparse
+import random
+import time
+
+from db_mark_index import MarkRangeIndex
+from db_pool import ConnectionPool
+
+from bench import results, synthetic_data
+
+UPLOAD_SIZE = 20000
+PREFIX_COUNT = 3
+REPEATS = 5
+REFRESH_MARKS = 1000
+BENCH_PREFIX = 'zz-bench'
+
+RANGE_USED_SQL = '''
+    SELECT count(*) FROM mark
+    WHERE prefix_number = %s AND NULLIF(regexp_replace(short_number, '\\D', '', 'g'), '')::bigint BETWEEN %s AND %s
+'''
+
+
+def busiest_prefixes(pool, count):
+# -----------------------------------------------------------------------------------------------------------------
+    with pool.cursor() as cur:
+        cur.execute('SELECT prefix_number FROM mark GROUP BY prefix_number ORDER BY count(*) DESC, prefix_number LIMIT %s',
+                    (count,))
+        return [r[0] for r in cur.fetchall()]
+
+
+def make_upload(index, prefix, size, rng):
+# -----------------------------------------------------------------------------------------------------------------
+    """Half overlapping what's already used, half fresh numbers after the last one."""
+    last = index.last_short_number(prefix) or 0
+    overlapping = size // 2
+    start = rng.randint(1, max(1, last - overlapping))
+    numbers = list(range(start, start + overlapping)) + list(range(last + 1, last + 1 + size - overlapping))
+    return [str(n) for n in numbers]
+
+
+def measure_refresh(pool, index, marks):
+# -----------------------------------------------------------------------------------------------------------------
+    with pool.cursor() as cur:
+        cur.execute('''
+            INSERT INTO mark (prefix_number, short_number)
+            SELECT %s, n::text FROM generate_series(1, %s) AS n
+        ''', (BENCH_PREFIX, marks))
+    try:
+        started = time.perf_counter()
+        added = index.refresh(pool)
+        refresh_ms = round((time.perf_counter() - started) * 1000, 3)
+    finally:
+        with pool.cursor() as cur:
+            cur.execute('DELETE FROM mark WHERE prefix_number = %s', (BENCH_PREFIX,))
+    return {'refresh_ms': refresh_ms, 'Added': added, 'Correct': added == marks}
+
+
+def run(pool, upload_size=UPLOAD_SIZE, prefix_count=PREFIX_COUNT, repeats=REPEATS, refresh_marks=REFRESH_MARKS,
+        seed=1):
+# -----------------------------------------------------------------------------------------------------------------
+    rng = random.Random(seed)
+    index = MarkRangeIndex()
+    load_latency, _ = results.timed(lambda: index.load(pool), 1)
+    metrics = {'load_ms': load_latency['median_ms']}
+    detail = {'Index': index.stats(), 'Prefixes': {}}
+
+    for prefix in busiest_prefixes(pool, prefix_count):
+        upload = make_upload(index, prefix, upload_size, rng)
+        first, last = int(upload[0]), int(upload[-1])
+
+        with pool.cursor() as cur:
+            def sql_existing():
+                cur.execute('SELECT short_number FROM ro_are_marks_unique(%s, %s)', (prefix, upload))
+                return sorted(r[0] for r in cur.fetchall())
+
+            def sql_last():
+                cur.execute('SELECT ro_get_last_short_number(%s)', (prefix,))
+                return cur.fetchone()[0]
+
+            def sql_range_free():
+                cur.execute(RANGE_USED_SQL, (prefix, first, last))
+                return cur.fetchone()[0] == 0
+
+            sql_timings = {}
+            sql_answers = {}
+            for name, fn in (('unique', sql_existing), ('last_number', sql_last), ('range_free', sql_range_free)):
+                sql_timings[name], sql_answers[name] = results.timed(fn, repeats)
+
+        index_timings = {}
+        index_answers = {}
+        for name, fn in (('unique', lambda: sorted(index.existing(prefix, upload))),
+                         ('last_number', lambda: index.last_short_number(prefix)),
+                         ('range_free', lambda: index.is_range_free(prefix, first, last))):
+            index_timings[name], index_answers[name] = results.timed(fn, repeats)
+
+        agrees = dict((name, sql_answers[name] == index_answers[name]) for name in sql_answers)
+        detail['Prefixes'][prefix] = {
+            'Upload': {'Size': len(upload), 'First': first, 'Last': last, 'AlreadyUsed': len(sql_answers['unique'])},
+            'Sql': sql_timings, 'Index': index_timings, 'Agrees': agrees,
+        }
+        for name in sql_timings:
+            metrics['{0}.{1}.sql.median_ms'.format(prefix, name)] = sql_timings[name]['median_ms']
+            metrics['{0}.{1}.index.median_ms'.format(prefix, name)] = index_timings[name]['median_ms']
+
+    if refresh_marks:
+        detail['Refresh'] = measure_refresh(pool, index, refresh_marks)
+        metrics['refresh_ms'] = detail['Refresh']['refresh_ms']
+
+    metrics['index_bytes'] = detail['Index']['Bytes']
+    detail['AllAgree'] = (all(all(p['Agrees'].values()) for p in detail['Prefixes'].values()) and
+                          detail.get('Refresh', {}).get('Correct', True))
+    return metrics, detail
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default=None, help='libpq connection string (default: $BIRDBANDING_DB_DSN / PG* env vars)')
+    synthetic_data.add_arguments(parser)
+    parser.add_argument('--upload-size', type=int, default=UPLOAD_SIZE)
+    parser.add_argument('--prefixes', type=int, default=PREFIX_COUNT, help='How many of the busiest prefixes to test')
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--refresh-marks', type=int, default=REFRESH_MARKS,
+                        help='Marks to insert (and delete again) to time a refresh; 0 to skip')
+    results.add_arguments(parser)
+    args = parser.parse_args()
+
+    parameters = dict(synthetic_data.parameters(args), UploadSize=args.upload_size, Prefixes=args.prefixes,
+                      Repeats=args.repeats, RefreshMarks=args.refresh_marks)
+
+    with ConnectionPool(args.dsn, max_connections=2) as pool:
+        document = {'Benchmark': 'mark_index', 'Metadata': results.run_metadata(pool, parameters)}
+        synthetic_data.prepare(pool, args, document)
+        document['Metrics'], document['Detail'] = run(pool, args.upload_size, args.prefixes, args.repeats,
+                                                      args.refresh_marks, args.seed)
+
+    exit_code = results.emit(document, args.output, args.compare)
+    return exit_code or (0 if document['Detail']['AllAgree'] else 1)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,218 @@
+# Benchmark: band combination searches through advanced_search_mark_configuration
+# (db_mark_search.py) against the same searches through vw_advanced_search_events, which unnests
+# agg_mc for every row of advanced_search_events.
+#
+# advanced_search_events is refreshed and advanced_search_events_incremental (with its mark
+# configurations) rebuilt, both timed, so the two sides search the same events. Then --samples
+# events with at least three mark configurations are picked (deterministically, by --seed), and
+# from each one's own bands, for each scenario:
+#
+#   - one_colour: one of its colour bands (side, position, colour)
+#   - two_colours: two of its colour bands
+#   - colours_and_text: those, plus its metal band by exact text
+#   - text_exact: just the metal band's text
+#   - text_prefix: the first few characters of that text, as a prefix search
+#
+# each search is run both ways (--repeats times, after a warm-up), and both have to return the
+# same page of events. The plan of the indexed search is kept for the first sample, so a
+# regression can be traced to a plan change.
+#
+#   python3 -m bench.mark_search --dsn "dbname=birdbanding_bench" --create-schema --events 1000000 \
+#       --output results/mark_search_1m.json
+
+import argparse
+import time
+
+from db_mark_search import EVENT_COLUMNS, TABLE, build_query, mark_conditions, validate
+from db_matview_refresh import SUCCEEDED, refresh_matviews, select_matviews
+from db_pool import ConnectionPool
+from db_search_events_incremental import rebuild
+
+from bench import results, synthetic_data
+from bench.search_pagination import plan_summary
+
+SAMPLES = 5
+REPEATS = 3
+LIMIT = 100
+PREFIX_LENGTH = 4
+
+SCENARIOS = ('one_colour', 'two_colours', 'colours_and_text', 'text_exact', 'text_prefix')
+
+# The same search the way it has to be written against vw_advanced_search_events: one view row
+# per band, joined on the event (a different agg_mc entry for each band)
+EXPLODED_QUERY = '''
+    SELECT {columns} FROM advanced_search_events AS ase
+    WHERE ase.id IN (
+      SELECT v0.id FROM vw_advanced_search_events AS v0
+      {joins}
+      WHERE {conditions}
+    )
+    ORDER BY ase.event_timestamp DESC, ase.id
+    LIMIT %s'''
+
+
+def exploded_query(criteria, limit=LIMIT):
+# -----------------------------------------------------------------------------------------------------------------
+    joins, conditions, params = [], [], []
+    for n, mark in enumerate(criteria):
+        alias = 'v{0}'.format(n)
+        if n:
+            joins.append('INNER JOIN vw_advanced_search_events AS {0} ON {0}.id = v0.id'.format(alias))
+
+        def column(field, alias=alias):
+            value = "({0}.obj->>'{1}')".format(alias, field)
+            return value + '::integer' if field == 'location_idx' else value
+
+        mark_sql, mark_params = mark_conditions(mark, column)
+        conditions.extend(mark_sql)
+        params.extend(mark_params)
+        for earlier in range(n):
+            conditions.append('{0}.obj <> v{1}.obj'.format(alias, earlier))
+
+    query = EXPLODED_QUERY.format(columns=', '.join('ase.' + c for c in EVENT_COLUMNS), joins='\n      '.join(joins),
+                                  conditions='\n        AND '.join(conditions))
+    return query, params + [limit]
+
+
+def prepare_tables(pool):
+# -----------------------------------------------------------------------------------------------------------------
+    refreshed, refresh_ms = refresh_matviews(pool, select_matviews(['advanced_search_events']), concurrent=False)
+    if any(r['Status'] != SUCCEEDED for r in refreshed):
+        raise RuntimeError('Refreshing advanced_search_events failed: {0}'.format(refreshed))
+    rebuilt = rebuild(pool)
+
+    with pool.cursor() as cur:
+        cur.execute('''
+            SELECT pg_relation_size(%(table)s::regclass), pg_indexes_size(%(table)s::regclass),
+                   pg_total_relation_size('advanced_search_events'::regclass)''', {'table': TABLE})
+        table_bytes, index_bytes, matview_bytes = cur.fetchone()
+    return {'RefreshMs': refresh_ms, 'Rebuild': rebuilt, 'TableBytes': table_bytes, 'IndexBytes': index_bytes,
+            'MatviewTotalBytes': matview_bytes}
+
+
+def sample_marks(pool, samples, seed):
+# -----------------------------------------------------------------------------------------------------------------
+    """[(event id, its colour bands, its metal band or None)] for events with at least three mark configurations."""
+    with pool.cursor() as cur:
+        cur.execute('''
+            SELECT event_id::text FROM {0}
+            GROUP BY event_id HAVING count(*) >= 3
+            ORDER BY md5(event_id::text || %s) LIMIT %s'''.format(TABLE), (str(seed), samples))
+        event_ids = [row[0] for row in cur.fetchall()]
+
+        picked = []
+        for event_id in event_ids:
+            cur.execute('''
+                SELECT side::text, position::text, colour::text, mark_material::text, alphanumeric_text FROM {0}
+                WHERE event_id = %s ORDER BY mark_configuration_id'''.format(TABLE), (event_id,))
+            marks = cur.fetchall()
+            colours = [{'side': m[0], 'position': m[1], 'colour': m[2]} for m in marks if m[2] and m[0] and m[1]]
+            metal = next(({'mark_material': m[3], 'alphanumeric_text': m[4]} for m in marks
+                          if m[3] == 'METAL' and m[4]), None)
+            picked.append((event_id, colours, metal))
+    return picked
+
+
+def scenario_criteria(name, colours, metal):
+# -----------------------------------------------------------------------------------------------------------------
+    """The bands to search for, or None when the sampled event doesn't have what the scenario needs."""
+    if name == 'one_colour':
+        return colours[:1] or None
+    if name == 'two_colours':
+        return colours[:2] if len(colours) >= 2 else None
+    if metal is None:
+        return None
+    if name == 'colours_and_text':
+        return colours[:2] + [metal] if len(colours) >= 2 else None
+    if name == 'text_exact':
+        return [metal]
+    return [{'alphanumeric_text': metal['alphanumeric_text'][:PREFIX_LENGTH] + '*'}]
+
+
+def measure(cur, query, params, repeats):
+# -----------------------------------------------------------------------------------------------------------------
+    """(each repeat's duration in ms, the event ids found). Durations are pooled over the samples, so not summarised here."""
+    def fetch():
+        cur.execute(query, params)
+        return [row[0] for row in cur.fetchall()]
+
+    fetch()  # Warm the cache so every repeat measures the same thing
+    durations = []
+    for _ in range(max(1, repeats)):
+        started = time.perf_counter()
+        event_ids = fetch()
+        durations.append((time.perf_counter() - started) * 1000)
+    return durations, event_ids
+
+
+def run(pool, samples=SAMPLES, repeats=REPEATS, limit=LIMIT, seed=1):
+# -----------------------------------------------------------------------------------------------------------------
+    """Measure already generated data. Returns (metrics, detail)."""
+    detail = {'Tables': prepare_tables(pool), 'Scenarios': {}}
+    metrics = {'refresh_matview_ms': detail['Tables']['RefreshMs'],
+               'rebuild_incremental_ms': detail['Tables']['Rebuild']['DurationMs'],
+               'mark_table_bytes': detail['Tables']['TableBytes'],
+               'mark_index_bytes': detail['Tables']['IndexBytes']}
+
+    picked = sample_marks(pool, samples, seed)
+    if not picked:
+        raise RuntimeError('No events with three or more mark configurations - generate some data first')
+
+    with pool.cursor() as cur:
+        for name in SCENARIOS:
+            durations = {'indexed': [], 'exploded': []}
+            outcome = {'Searches': [], 'Plan': None}
+            for event_id, colours, metal in picked:
+                criteria = scenario_criteria(name, colours, metal)
+                if criteria is None:
+                    continue
+                criteria = validate(criteria)
+                indexed_query, indexed_params = build_query(criteria, limit)
+                indexed, indexed_ids = measure(cur, indexed_query, indexed_params, repeats)
+                exploded, exploded_ids = measure(cur, *exploded_query(criteria, limit), repeats=repeats)
+                durations['indexed'].extend(indexed)
+                durations['exploded'].extend(exploded)
+                outcome['Searches'].append({'Criteria': criteria, 'Events': len(indexed_ids),
+                                            'FoundSampled': event_id in indexed_ids or len(indexed_ids) == limit,
+                                            'Same': indexed_ids == exploded_ids})
+                if outcome['Plan'] is None:
+                    outcome['Plan'] = plan_summary(cur, indexed_query, indexed_params)
+
+            if not outcome['Searches']:
+                outcome['Skipped'] = 'No sampled event has the marks for this scenario'
+                detail['Scenarios'][name] = outcome
+                continue
+            for method, measured in durations.items():
+                outcome[method.capitalize()] = results.summarise(measured)
+                metrics['{0}.{1}.median_ms'.format(name, method)] = outcome[method.capitalize()]['median_ms']
+            outcome['AllSame'] = all(s['Same'] and s['FoundSampled'] for s in outcome['Searches'])
+            detail['Scenarios'][name] = outcome
+
+    detail['AllAgree'] = all(s.get('AllSame', True) for s in detail['Scenarios'].values())
+    return metrics, detail
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default=None, help='libpq connection string (default: $BIRDBANDING_DB_DSN / PG* env vars)')
+    synthetic_data.add_arguments(parser)
+    parser.add_argument('--samples', type=int, default=SAMPLES, help='Events whose bands are searched for')
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--limit', type=int, default=LIMIT, help='Events per search')
+    results.add_arguments(parser)
+    args = parser.parse_args()
+
+    parameters = dict(synthetic_data.parameters(args), Samples=args.samples, Repeats=args.repeats, Limit=args.limit)
+
+    with ConnectionPool(args.dsn, max_connections=2) as pool:
+        document = {'Benchmark': 'mark_search', 'Metadata': results.run_metadata(pool, parameters)}
+        synthetic_data.prepare(pool, args, document)
+        document['Metrics'], document['Detail'] = run(pool, args.samples, args.repeats, args.limit, args.seed)
+
+    exit_code = results.emit(document, args.output, args.compare)
+    return exit_code or (0 if document['Detail']['AllAgree'] else 1)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
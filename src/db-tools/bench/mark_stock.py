@@ -0,0 +1,220 @@
+# Benchmark: keeping mark_stock_aggregation_rollup up to date through a bulk transfer of bands,
+# with the rw_update_*_stock functions (as the API does today) against the incremental
+# MarkStockEngine (db_mark_stock.py).
+#
+# --transfer-size marks under a throwaway prefix are issued to a stand-in banding office and that
+# prefix's rollup rows are brought in line with a recompute (verify with repair); a read-only
+# verify of the whole table is timed as the full recompute cost. Then, for each scenario and
+# repeat, in a transaction that is rolled back afterwards:
+#
+#   - office_to_bander: the whole lot goes from the office to bander A
+#   - bander_to_bander: after A has received them, the top half goes on to bander B (so A loses
+#     its highest band, the one case the engine goes back to the base tables for)
+#
+# the transfer is written (a TRANSFER event, new current mark_allocation / mark_state rows), the
+# rollup is updated one way or the other (timed), and the banders' rows are read back. Both ways
+# have to leave the same rows, and the engine's have to pass verify() for the prefix.
+#
+#   python3 -m bench.mark_stock --dsn "dbname=birdbanding_bench" --skip-generate --transfer-size 20000
+
+import argparse
+import time
+import uuid
+
+from db_mark_stock import TABLE, MarkStockEngine
+from db_pool import ConnectionPool
+
+from bench import results, synthetic_data
+
+TRANSFER_SIZE = 10000
+REPEATS = 5
+BENCH_PREFIX = 'zz-stock'
+
+TRANSFER_EVENT_SQL = '''
+    INSERT INTO event (id, event_type, event_state, event_banding_scheme, event_timestamp, event_owner_id,
+                       event_reporter_id, event_provider_id, transfer_recipient_id, mark_count)
+    VALUES (%(event_id)s, %(event_type)s, 'VALID', 'NZ_NON_GAMEBIRD', now(), %(from_id)s, %(from_id)s, %(from_id)s,
+            %(to_id)s, %(marks)s)
+'''
+
+# Each transfer is one more allocation / state per mark, and the latest is the current one
+TRANSFER_MARKS_SQL = '''
+    UPDATE mark_allocation SET is_current = FALSE WHERE mark_id = ANY(%(mark_ids)s::uuid[]) AND is_current = TRUE;
+    INSERT INTO mark_allocation (event_id, mark_id, bander_id, allocation_idx, is_current)
+    SELECT %(event_id)s, mark_id, %(to_id)s, %(idx)s, TRUE FROM unnest(%(mark_ids)s::uuid[]) AS mark_id;
+    UPDATE mark_state SET is_current = FALSE WHERE mark_id = ANY(%(mark_ids)s::uuid[]) AND is_current = TRUE;
+    INSERT INTO mark_state (event_id, mark_id, state, state_idx, is_current)
+    SELECT %(event_id)s, mark_id, %(state)s, %(idx)s, TRUE FROM unnest(%(mark_ids)s::uuid[]) AS mark_id;
+'''
+
+
+def transfer(cur, mark_ids, from_id, to_id, idx, event_type='TRANSFER', state='ALLOCATED'):
+# -----------------------------------------------------------------------------------------------------------------
+    params = {'event_id': str(uuid.uuid4()), 'event_type': event_type, 'from_id': from_id, 'to_id': to_id,
+              'marks': len(mark_ids), 'mark_ids': mark_ids, 'idx': idx, 'state': state}
+    cur.execute(TRANSFER_EVENT_SQL, params)
+    cur.execute(TRANSFER_MARKS_SQL, params)
+    return params['event_id']
+
+
+def pick_banders(pool):
+# -----------------------------------------------------------------------------------------------------------------
+    with pool.cursor() as cur:
+        cur.execute('SELECT id::text FROM bander ORDER BY id LIMIT 3')
+        banders = [row[0] for row in cur.fetchall()]
+    if len(banders) < 3:
+        raise RuntimeError('Need at least 3 banders (generate some synthetic data first)')
+    return banders
+
+
+def issue_marks(pool, office_id, banders, size):
+# -----------------------------------------------------------------------------------------------------------------
+    """The throwaway marks, in the office's stock, with a rollup row for each bander. Returns their ids by short number."""
+    with pool.cursor(autocommit=False) as cur:
+        cur.execute('''
+            INSERT INTO mark (prefix_number, short_number)
+            SELECT %s, n::text FROM generate_series(1, %s) AS n
+            RETURNING id::text, short_number''', (BENCH_PREFIX, size))
+        mark_ids = [row[0] for row in sorted(cur.fetchall(), key=lambda r: int(r[1]))]
+        transfer(cur, mark_ids, office_id, office_id, 0, event_type='NEW_MARK', state='NEW')
+        # The rw_update_*_stock functions only update rows that are already there
+        cur.execute('''
+            INSERT INTO {0} (bander_id, prefix_number, number_of_bands, last_short_number)
+            SELECT bander_id, %s, 0, '-' FROM unnest(%s::uuid[]) AS bander_id'''.format(TABLE), (BENCH_PREFIX, banders))
+    return mark_ids
+
+
+def remove_marks(pool):
+# -----------------------------------------------------------------------------------------------------------------
+    with pool.cursor(autocommit=False) as cur:
+        cur.execute('SELECT id FROM mark WHERE prefix_number = %s', (BENCH_PREFIX,))
+        mark_ids = [row[0] for row in cur.fetchall()]
+        cur.execute('SELECT DISTINCT event_id FROM mark_allocation WHERE mark_id = ANY(%s::uuid[])', (mark_ids,))
+        event_ids = [row[0] for row in cur.fetchall()]
+        cur.execute('DELETE FROM mark_state WHERE mark_id = ANY(%s::uuid[])', (mark_ids,))
+        cur.execute('DELETE FROM mark_allocation WHERE mark_id = ANY(%s::uuid[])', (mark_ids,))
+        cur.execute('DELETE FROM mark WHERE id = ANY(%s::uuid[])', (mark_ids,))
+        cur.execute('DELETE FROM event WHERE id = ANY(%s::uuid[])', (event_ids,))
+        cur.execute('DELETE FROM {0} WHERE prefix_number = %s'.format(TABLE), (BENCH_PREFIX,))
+
+
+def rollup_rows(cur):
+# -----------------------------------------------------------------------------------------------------------------
+    cur.execute('SELECT bander_id::text, number_of_bands, last_short_number FROM {0} WHERE prefix_number = %s ORDER BY 1'
+                .format(TABLE), (BENCH_PREFIX,))
+    return cur.fetchall()
+
+
+def scenarios(mark_ids, office_id, bander_a, bander_b):
+# -----------------------------------------------------------------------------------------------------------------
+    """name -> (setup transfers, measured transfer, (offices, banders) for the legacy functions to update)"""
+    top_half = mark_ids[len(mark_ids) // 2:]
+    return {
+        'office_to_bander': ([], (mark_ids, office_id, bander_a, 1), ([office_id], [bander_a])),
+        'bander_to_bander': ([(mark_ids, office_id, bander_a, 1)], (top_half, bander_a, bander_b, 2),
+                             ([], [bander_a, bander_b])),
+    }
+
+
+def legacy_update(cur, offices, banders):
+# -----------------------------------------------------------------------------------------------------------------
+    if offices:
+        cur.execute('SELECT rw_update_banding_office_stock(%s, %s)', (offices, [BENCH_PREFIX]))
+    if banders:
+        cur.execute('SELECT rw_update_bander_stock(%s, %s)', (banders, [BENCH_PREFIX]))
+
+
+def run_scenario(pool, engine, setup, measured, legacy_banders, method):
+# -----------------------------------------------------------------------------------------------------------------
+    """One rolled back transfer; returns (duration in ms, rollup rows after, verify report or None)."""
+    with pool.connection(autocommit=False) as conn:
+        try:
+            with conn.cursor() as cur:
+                for mark_ids, from_id, to_id, idx in setup:
+                    before = engine.snapshot(cur, mark_ids)
+                    transfer(cur, mark_ids, from_id, to_id, idx)
+                    engine.apply_since(cur, before)
+
+                mark_ids, from_id, to_id, idx = measured
+                if method == 'engine':
+                    started = time.perf_counter()
+                    before = engine.snapshot(cur, mark_ids)
+                    snapshot_ms = (time.perf_counter() - started) * 1000
+                    transfer(cur, mark_ids, from_id, to_id, idx)
+                    started = time.perf_counter()
+                    engine.apply_since(cur, before)
+                    duration = snapshot_ms + (time.perf_counter() - started) * 1000
+                    verified = engine.verify(cur, [BENCH_PREFIX])
+                else:
+                    transfer(cur, mark_ids, from_id, to_id, idx)
+                    started = time.perf_counter()
+                    legacy_update(cur, *legacy_banders)
+                    duration = (time.perf_counter() - started) * 1000
+                    verified = None
+                rows = rollup_rows(cur)
+        finally:
+            conn.rollback()
+    return duration, rows, verified
+
+
+def run(pool, transfer_size=TRANSFER_SIZE, repeats=REPEATS):
+# -----------------------------------------------------------------------------------------------------------------
+    office_id, bander_a, bander_b = pick_banders(pool)
+    engine = MarkStockEngine(office_id)
+    remove_marks(pool)          # Leftovers from an interrupted run
+    mark_ids = issue_marks(pool, office_id, [office_id, bander_a, bander_b], transfer_size)
+    metrics = {}
+    detail = {'Banders': {'Office': office_id, 'A': bander_a, 'B': bander_b}, 'Scenarios': {}}
+    try:
+        # The whole table is only timed (read only); just the bench prefix's rows are put right
+        with pool.cursor() as cur:
+            detail['FullRecompute'] = engine.verify(cur, limit=0)
+        metrics['full_recompute_ms'] = detail['FullRecompute']['DurationMs']
+        with pool.cursor(autocommit=False) as cur:
+            detail['PrefixRepair'] = engine.verify(cur, [BENCH_PREFIX], repair=True, limit=0)
+
+        for name, (setup, measured, legacy_banders) in scenarios(mark_ids, office_id, bander_a, bander_b).items():
+            outcome = {'Marks': len(measured[0])}
+            rows = {}
+            for method in ('legacy', 'engine'):
+                durations = []
+                for _ in range(max(1, repeats)):
+                    duration, rows[method], verified = run_scenario(pool, engine, setup, measured, legacy_banders, method)
+                    durations.append(duration)
+                outcome[method.capitalize()] = results.summarise(durations)
+                if verified is not None:
+                    outcome['EngineConsistent'] = verified['Consistent']
+                metrics['{0}.{1}.median_ms'.format(name, method)] = outcome[method.capitalize()]['median_ms']
+            outcome['Rows'] = rows['engine']
+            outcome['SameRows'] = rows['legacy'] == rows['engine']
+            detail['Scenarios'][name] = outcome
+    finally:
+        remove_marks(pool)
+
+    detail['AllAgree'] = all(s['SameRows'] and s['EngineConsistent'] for s in detail['Scenarios'].values())
+    return metrics, detail
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default=None, help='libpq connection string (default: $BIRDBANDING_DB_DSN / PG* env vars)')
+    synthetic_data.add_arguments(parser)
+    parser.add_argument('--transfer-size', type=int, default=TRANSFER_SIZE, help='Bands per transfer')
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    results.add_arguments(parser)
+    args = parser.parse_args()
+
+    parameters = dict(synthetic_data.parameters(args), TransferSize=args.transfer_size, Repeats=args.repeats)
+
+    with ConnectionPool(args.dsn, max_connections=2) as pool:
+        document = {'Benchmark': 'mark_stock', 'Metadata': results.run_metadata(pool, parameters)}
+        synthetic_data.prepare(pool, args, document)
+        document['Metrics'], document['Detail'] = run(pool, args.transfer_size, args.repeats)
+
+    exit_code = results.emit(document, args.output, args.compare)
+    return exit_code or (0 if document['Detail']['AllAgree'] else 1)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
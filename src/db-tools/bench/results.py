@@ -0,0 +1,130 @@
+# Shared shape for benchmark results.
+#
+# Every benchmark produces
+#
+#   {
+#     "Benchmark": "search_pagination",
+#     "Metadata": {"StartedAt": ..., "GitCommit": ..., "ServerVersion": ..., "Parameters": {...}},
+#     "Metrics": {"search_events_sort_timestamp.first_page.admin.median_ms": 1.234, ...},
+#     ... benchmark specific detail ...
+#   }
+#
+# Metrics is flat and every metric is "lower is better" (a latency, a duration or a size), so
+# two documents can be compared key by key without knowing which benchmark wrote them.
+
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+
+# A metric has regressed when it is this much worse than the previous run...
+REGRESSION_THRESHOLD = 0.2
+# ...and the difference is big enough not to be noise (in the metric's own unit)
+REGRESSION_MIN_DELTA = 0.5
+
+
+def git_commit():
+# -----------------------------------------------------------------------------------------------------------------
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_metadata(pool, parameters):
+# -----------------------------------------------------------------------------------------------------------------
+    with pool.cursor() as cur:
+        cur.execute('SHOW server_version')
+        server_version = cur.fetchone()[0]
+    return {
+        'StartedAt': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'GitCommit': git_commit(),
+        'ServerVersion': server_version,
+        'Python': platform.python_version(),
+        'Host': platform.node(),
+        'Parameters': parameters,
+    }
+
+
+def timed(fn, repeats):
+# -----------------------------------------------------------------------------------------------------------------
+    """Run fn() `repeats` times; returns (latency summary in ms, result of the last call)."""
+    durations = []
+    result = None
+    for _ in range(max(1, repeats)):
+        started = time.perf_counter()
+        result = fn()
+        durations.append((time.perf_counter() - started) * 1000)
+    return summarise(durations), result
+
+
+def summarise(durations_ms):
+# -----------------------------------------------------------------------------------------------------------------
+    ordered = sorted(durations_ms)
+    return {
+        'min_ms': round(ordered[0], 3),
+        'median_ms': round(statistics.median(ordered), 3),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))], 3),
+        'max_ms': round(ordered[-1], 3),
+    }
+
+
+def flatten(prefix, values, metrics):
+# -----------------------------------------------------------------------------------------------------------------
+    for name, value in values.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics['{0}.{1}'.format(prefix, name)] = value
+
+
+def compare(current, previous, threshold=REGRESSION_THRESHOLD, min_delta=REGRESSION_MIN_DELTA):
+# -----------------------------------------------------------------------------------------------------------------
+    """Metric by metric comparison of two results documents; regressions are listed first."""
+    old = previous.get('Metrics', {})
+    new = current.get('Metrics', {})
+    changes = []
+    for name in sorted(set(old) & set(new)):
+        before, after = old[name], new[name]
+        change = {'Metric': name, 'Previous': before, 'Current': after,
+                  'Ratio': round(after / before, 3) if before else None}
+        change['Regressed'] = after - before > min_delta and (not before or after > before * (1 + threshold))
+        change['Improved'] = before - after > min_delta and before > after * (1 + threshold)
+        changes.append(change)
+    changes.sort(key=lambda c: (not c['Regressed'], not c['Improved'], c['Metric']))
+    return {
+        'PreviousStartedAt': previous.get('Metadata', {}).get('StartedAt'),
+        'PreviousGitCommit': previous.get('Metadata', {}).get('GitCommit'),
+        'Regressions': sum(1 for c in changes if c['Regressed']),
+        'Improvements': sum(1 for c in changes if c['Improved']),
+        'OnlyInPrevious': sorted(set(old) - set(new)),
+        'OnlyInCurrent': sorted(set(new) - set(old)),
+        'Changes': changes,
+    }
+
+
+def load(path):
+# -----------------------------------------------------------------------------------------------------------------
+    with open(path) as f:
+        return json.load(f)
+
+
+def add_arguments(parser):
+# -----------------------------------------------------------------------------------------------------------------
+    parser.add_argument('--output', help='Also write the results to this file')
+    parser.add_argument('--compare', metavar='PREVIOUS', help='Results file from an earlier run to compare against')
+
+
+def emit(document, output=None, previous=None):
+# -----------------------------------------------------------------------------------------------------------------
+    """Print the results (with a comparison against `previous` if given), optionally saving them to `output`."""
+    if previous:
+        document['Comparison'] = compare(document, load(previous))
+    text = json.dumps(document, indent=2, default=str)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+    return 1 if document.get('Comparison', {}).get('Regressions') else 0
@@ -0,0 +1,218 @@
+# Benchmark: search_events_sort_* pagination and materialized view refresh cost.
+#
+# The search pages read one of the search_events_sort_* views a page at a time by
+# pagination_idx (a dense_rank() over the sort key), optionally restricted to what a bander may
+# see via the wide *_bander_access_id indexes. This measures, for each sort view:
+#
+#   - first page and deep page latency, both unrestricted (admin) and for a bander, with the
+#     plan's node types and buffer counts so a regression can be traced to a plan change
+#   - how long the view takes to refresh, both plain and CONCURRENTLY
+#   - the size of the view and of each of its indexes
+#
+# against synthetic data (bench/synthetic_data.py) at a configurable scale. Typical use, on a
+# scratch database:
+#
+#   python3 -m bench.search_pagination --dsn "dbname=birdbanding_bench" --create-schema --events 500000 \
+#       --output results/500k.json
+#   ... change something ...
+#   python3 -m bench.search_pagination --dsn "dbname=birdbanding_bench" --skip-generate --compare results/500k.json
+#
+# The exit code is 1 when --compare finds a regression.
+
+import argparse
+import json
+
+from db_matview_refresh import MATVIEWS, SUCCEEDED, refresh_matviews
+from db_pool import ConnectionPool
+
+from bench import results, synthetic_data
+
+SORT_VIEWS = [m.name for m in MATVIEWS if m.name.startswith('search_events_sort_')]
+
+PAGE_SIZE = 100
+REPEATS = 5
+# How far into the result set the "deep" page starts
+DEEP_FRACTION = 0.9
+
+# A page of whole events for an admin (who sees everything)
+ADMIN_PAGE = '''
+    SELECT * FROM {view}
+    WHERE pagination_idx > %(after)s AND pagination_idx <= %(after)s + %(page_size)s
+    ORDER BY pagination_idx
+'''
+
+# A page for a bander: what they reported, provided or own, their projects' events, anything
+# out of moratorium, and the later history of birds they banded
+BANDER_PAGE = '''
+    SELECT * FROM {view}
+    WHERE pagination_idx > %(after)s
+      AND (event_reporter_id = %(bander_id)s OR event_provider_id = %(bander_id)s OR event_owner_id = %(bander_id)s
+           OR project_id = ANY(%(project_ids)s::uuid[]) OR default_moratorium_expiry < now()
+           OR previous_bander = %(bander_id)s)
+    ORDER BY pagination_idx
+    LIMIT %(page_size)s
+'''
+
+BASE_TABLES = ['bird', 'mark', 'event', 'mark_state', 'mark_configuration', 'characteristic_measurement']
+
+
+def pick_bander(pool):
+# -----------------------------------------------------------------------------------------------------------------
+    """The median bander by events reported (a typical, not the busiest, user) and their projects."""
+    with pool.cursor() as cur:
+        cur.execute('''
+            SELECT event_reporter_id::text FROM event
+            GROUP BY event_reporter_id
+            ORDER BY count(*), event_reporter_id
+            OFFSET (SELECT count(DISTINCT event_reporter_id) / 2 FROM event) LIMIT 1
+        ''')
+        row = cur.fetchone()
+        if row is None:
+            raise ValueError('No events - generate some data first')
+        bander_id = row[0]
+        cur.execute('SELECT project_id::text FROM project_bander_membership WHERE bander_id = %s AND NOT is_deleted '
+                    'ORDER BY project_id', (bander_id,))
+        return bander_id, [r[0] for r in cur.fetchall()]
+
+
+def plan_summary(cur, query, params):
+# -----------------------------------------------------------------------------------------------------------------
+    cur.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query, params)
+    explained = cur.fetchone()[0]
+    if isinstance(explained, str):
+        explained = json.loads(explained)
+    plan = explained[0]['Plan']
+
+    node_types = []
+    pending = [plan]
+    while pending:
+        node = pending.pop()
+        label = node['Node Type']
+        if node.get('Index Name'):
+            label += ' using ' + node['Index Name']
+        node_types.append(label)
+        pending.extend(reversed(node.get('Plans', [])))
+
+    return {
+        'Nodes': node_types,
+        'SharedHitBlocks': plan.get('Shared Hit Blocks', 0),
+        'SharedReadBlocks': plan.get('Shared Read Blocks', 0),
+        'ExecutionMs': explained[0].get('Execution Time'),
+    }
+
+
+def measure_page(pool, query, params, repeats):
+# -----------------------------------------------------------------------------------------------------------------
+    with pool.cursor() as cur:
+        def fetch_page():
+            cur.execute(query, params)
+            return len(cur.fetchall())
+
+        fetch_page()  # Warm the cache so every repeat measures the same thing
+        latency, rows = results.timed(fetch_page, repeats)
+        latency['rows'] = rows
+        return latency, plan_summary(cur, query, params)
+
+
+def view_sizes(pool, view):
+# -----------------------------------------------------------------------------------------------------------------
+    with pool.cursor() as cur:
+        cur.execute('SELECT count(*), max(pagination_idx), pg_relation_size(%s::regclass) FROM {0}'.format(view),
+                    (view,))
+        rows, max_idx, table_bytes = cur.fetchone()
+        cur.execute('''
+            SELECT indexrelname, pg_relation_size(indexrelid) FROM pg_stat_user_indexes
+            WHERE relname = %s ORDER BY indexrelname
+        ''', (view,))
+        indexes = dict(cur.fetchall())
+    return {'Rows': rows, 'MaxPaginationIdx': max_idx or 0, 'TableBytes': table_bytes,
+            'IndexBytes': sum(indexes.values()), 'Indexes': indexes}
+
+
+def measure_refresh(pool):
+# -----------------------------------------------------------------------------------------------------------------
+    # One view at a time so each duration is the view's own cost, not its share of a parallel run.
+    # The plain refresh goes first: it also populates views created WITH NO DATA.
+    refreshes = {}
+    for concurrent in (False, True):
+        refreshed, total_ms = refresh_matviews(pool, workers=1, concurrent=concurrent)
+        failed = [r for r in refreshed if r['Status'] != SUCCEEDED]
+        if failed:
+            raise RuntimeError('Refresh failed: {0}'.format(json.dumps(failed)))
+        for r in refreshed:
+            refreshes.setdefault(r['Matview'], {})['concurrent_ms' if concurrent else 'non_concurrent_ms'] = r['DurationMs']
+        refreshes.setdefault('all', {})['concurrent_ms' if concurrent else 'non_concurrent_ms'] = total_ms
+    return refreshes
+
+
+def table_rows(pool):
+# -----------------------------------------------------------------------------------------------------------------
+    with pool.cursor() as cur:
+        counts = {}
+        for table in BASE_TABLES:
+            cur.execute('SELECT count(*) FROM {0}'.format(table))
+            counts[table] = cur.fetchone()[0]
+        return counts
+
+
+def run(pool, views=None, page_size=PAGE_SIZE, repeats=REPEATS, deep_fraction=DEEP_FRACTION):
+# -----------------------------------------------------------------------------------------------------------------
+    """Measure already generated data. Returns (metrics, detail)."""
+    metrics = {}
+    detail = {'TableRows': table_rows(pool)}
+
+    detail['Refresh'] = measure_refresh(pool)
+    for view, durations in detail['Refresh'].items():
+        results.flatten('refresh.' + view, durations, metrics)
+
+    with pool.cursor() as cur:
+        cur.execute('ANALYZE')
+
+    bander_id, project_ids = pick_bander(pool)
+    detail['Bander'] = {'Id': bander_id, 'Projects': project_ids}
+
+    detail['Views'] = {}
+    for view in views or SORT_VIEWS:
+        sizes = view_sizes(pool, view)
+        pages = {}
+        for page, after in (('first_page', 0), ('deep_page', int(sizes['MaxPaginationIdx'] * deep_fraction))):
+            params = {'after': after, 'page_size': page_size, 'bander_id': bander_id, 'project_ids': project_ids}
+            for audience, query in (('admin', ADMIN_PAGE), ('bander', BANDER_PAGE)):
+                latency, plan = measure_page(pool, query.format(view=view), params, repeats)
+                pages['{0}.{1}'.format(page, audience)] = dict(latency, After=after, Plan=plan)
+                results.flatten('{0}.{1}.{2}'.format(view, page, audience),
+                                dict((k, v) for k, v in latency.items() if k.endswith('_ms')), metrics)
+
+        metrics[view + '.table_bytes'] = sizes['TableBytes']
+        metrics[view + '.index_bytes'] = sizes['IndexBytes']
+        detail['Views'][view] = {'Sizes': sizes, 'Pages': pages}
+
+    return metrics, detail
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default=None, help='libpq connection string (default: $BIRDBANDING_DB_DSN / PG* env vars)')
+    synthetic_data.add_arguments(parser)
+    parser.add_argument('--views', nargs='+', choices=SORT_VIEWS, help='Just these sort views')
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--deep-fraction', type=float, default=DEEP_FRACTION)
+    results.add_arguments(parser)
+    args = parser.parse_args()
+
+    parameters = dict(synthetic_data.parameters(args), PageSize=args.page_size, Repeats=args.repeats,
+                      DeepFraction=args.deep_fraction)
+
+    with ConnectionPool(args.dsn, max_connections=2) as pool:
+        document = {'Benchmark': 'search_pagination', 'Metadata': results.run_metadata(pool, parameters)}
+        synthetic_data.prepare(pool, args, document)
+        document['Metrics'], document['Detail'] = run(pool, args.views, args.page_size, args.repeats,
+                                                      args.deep_fraction)
+
+    return results.emit(document, args.output, args.compare)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,378 @@
+# Synthetic birdbanding data for benchmarking.
+#
+# create_schema() runs sql/1..5 against a scratch database one statement at a time. The
+# scripts are written for the Aurora cluster, so the handful of statements that only make
+# sense there (GRANTs to the IAM users, OWNER TO rds_superuser, the aws_s3 extension, ...)
+# are allowed to fail and are reported as skipped; anything else failing stops the run.
+#
+# generate() then fills the tables the search views read with data shaped like production:
+#
+#   - a few dozen species in groups, with a long tail (most birds are a few common species)
+#   - banders, projects coordinated by banders, banders belonging to a few projects each
+#   - marks issued to banders in batches of up to 100 (a NEW_MARK event, mark_state NEW and a
+#     mark_allocation per mark), most of which then go on a bird and some stay in stock
+#   - per bird: a FIRST_MARKING_IN_HAND event attaching its metal band (plus a couple of
+#     colour bands as mark_configuration rows), then a geometric number of resightings,
+#     each with an out status characteristic_measurement (characteristic 43, which the
+#     search views join on) and sometimes a weight
+#
+# Everything is derived from a seeded random.Random, so the same scale and seed always
+# produce the same rows (UUIDs included), and rows go in with COPY, one transaction per
+# block of birds.
+#
+#   scale = Scale.from_events(100000)
+#   create_schema(pool)
+#   counts = generate(pool, scale, seed=1)
+
+import bisect
+import csv
+import datetime
+import io
+import itertools
+import math
+import os
+import random
+import time
+import uuid
+
+import psycopg2
+
+from db_sql import ENVIRONMENT_SPECIFIC, SCHEMA_SCRIPTS, SQL_DIR, split_statements, strip_comments
+
+DEFAULT_EVENTS = 100000
+
+# Birds generated (and committed) together - bounds memory at the larger scales
+BLOCK_BIRDS = 5000
+
+# Marks issued per NEW_MARK event
+STOCK_BATCH_MARKS = 100
+
+# The characteristic the search views join on (the bird's out status)
+OUT_STATUS_CHARACTERISTIC_ID = 43
+WEIGHT_CHARACTERISTIC_ID = 1
+
+PREFIXES = ['a', 'b', 'c', 'cp', 'd', 'dp', 'e', 'h', 'k', 'l', 'r', 'z', 'ap', 'ka']
+COLOURS = ['RED', 'ORANGE', 'YELLOW', 'WHITE', 'BLACK', 'BLUE', 'GREEN', 'PINK', 'LIME_GREEN', 'LIGHT_BLUE']
+RESIGHTING_TYPES = ['SIGHTING_BY_PERSON', 'SIGHTING_BY_PERSON', 'IN_HAND', 'RECORDED_BY_TECHNOLOGY']
+LOCATIONS = ['Farewell Spit', 'Kapiti Island', 'Miranda', 'Otago Peninsula', 'Kaikoura', 'Tiritiri Matangi',
+             'Stewart Island', 'Lake Ellesmere', 'Firth of Thames', 'Chatham Islands', 'Manawatu Estuary']
+
+FIRST_EVENT = datetime.datetime(1990, 1, 1, tzinfo=datetime.timezone.utc)
+LAST_EVENT = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class SchemaError(Exception):
+# -----------------------------------------------------------------------------------------------------------------
+    pass
+
+
+class Scale(object):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    How much data to generate. from_events() derives realistic proportions from a target
+    event count (the number actually generated is close to, not exactly, that target).
+    """
+
+    def __init__(self, birds, banders, projects, species=60, species_groups=8, stock_marks_per_bird=0.25,
+                 mean_resightings=2.5, colour_bands_per_bird=1.5):
+        self.birds = birds
+        self.banders = banders
+        self.projects = projects
+        self.species = species
+        self.species_groups = species_groups
+        self.stock_marks_per_bird = stock_marks_per_bird
+        self.mean_resightings = mean_resightings
+        self.colour_bands_per_bird = colour_bands_per_bird
+
+    @classmethod
+    def from_events(cls, events):
+        # One marking plus mean_resightings sightings per bird, plus the odd stock event
+        birds = max(10, int(events / 3.5))
+        return cls(birds=birds, banders=max(10, events // 1000), projects=max(3, events // 5000))
+
+    def describe(self):
+        return dict(self.__dict__)
+
+
+class _Tables(object):
+# -----------------------------------------------------------------------------------------------------------------
+    """Rows waiting to be COPYed, in foreign key order."""
+
+    COLUMNS = [
+        ('species_group', ['id', 'name']),
+        ('species', ['id', 'species_code_nznbbs', 'scientific_name_nznbbs', 'common_name_nznbbs',
+                     'english_name_nznbbs', 'is_gamebird']),
+        ('species_group_membership', ['group_id', 'species_id']),
+        ('characteristic', ['id', 'ss_source_name_', 'name', 'display', 'datatype', 'unit']),
+        ('bander', ['id', 'username', 'person_name', 'nznbbs_certification_number', 'bander_state', 'is_hidden']),
+        ('project', ['id', 'name', 'project_state', 'coordinator_id', 'default_moratorium_expiry', 'is_doc_project']),
+        ('project_bander_membership', ['project_id', 'bander_id']),
+        ('bird', ['id', 'species_id', 'friendly_name']),
+        ('mark', ['id', 'prefix_number', 'short_number']),
+        ('event', ['id', 'event_type', 'event_state', 'event_banding_scheme', 'event_timestamp',
+                   'event_timestamp_accuracy', 'event_owner_id', 'event_reporter_id', 'event_provider_id',
+                   'event_bird_situation', 'bird_id', 'project_id', 'latitude', 'longitude',
+                   'user_coordinate_system', 'location_description', 'mark_count']),
+        ('mark_state', ['event_id', 'mark_id', 'state', 'state_idx', 'is_current']),
+        ('mark_allocation', ['event_id', 'mark_id', 'bander_id', 'allocation_idx', 'is_current']),
+        ('mark_configuration', ['event_id', 'mark_id', 'mark_type', 'mark_material', 'colour', 'alphanumeric_text',
+                                'side', 'position', 'location_idx']),
+        ('characteristic_measurement', ['event_id', 'characteristic_id', 'value']),
+    ]
+
+    def __init__(self):
+        self.rows = dict((table, []) for table, _ in self.COLUMNS)
+
+    def add(self, table, *row):
+        self.rows[table].append(row)
+
+    def copy(self, conn, counts):
+        with conn.cursor() as cur:
+            for table, columns in self.COLUMNS:
+                rows = self.rows[table]
+                if not rows:
+                    continue
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(rows)
+                buffer.seek(0)
+                cur.copy_expert('COPY {0} ({1}) FROM STDIN WITH (FORMAT csv)'.format(table, ', '.join(columns)), buffer)
+                counts[table] = counts.get(table, 0) + len(rows)
+                del rows[:]
+
+
+def create_schema(pool, sql_dir=SQL_DIR, scripts=SCHEMA_SCRIPTS):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    Run the schema scripts into an empty database. Returns the environment specific statements
+    that failed and were skipped; raises SchemaError for any other failure.
+    """
+    skipped = []
+    with pool.connection(autocommit=True) as conn:
+        for script in scripts:
+            with open(os.path.join(sql_dir, script)) as f:
+                statements = split_statements(f.read())
+            for line_number, statement in statements:
+                with conn.cursor() as cur:
+                    try:
+                        cur.execute(statement)
+                    except psycopg2.Error as e:
+                        message = str(e).strip().splitlines()[0]
+                        if not ENVIRONMENT_SPECIFIC.match(strip_comments(statement)):
+                            raise SchemaError('{0}:{1}: {2}'.format(script, line_number, message))
+                        skipped.append({'Script': script, 'Line': line_number, 'Message': message})
+    return skipped
+
+
+def _uuid(rng):
+# -----------------------------------------------------------------------------------------------------------------
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def _timestamp(rng, start, end):
+# -----------------------------------------------------------------------------------------------------------------
+    return start + datetime.timedelta(seconds=rng.uniform(0, (end - start).total_seconds()))
+
+
+def _geometric(rng, mean):
+# -----------------------------------------------------------------------------------------------------------------
+    # Number of failures before a success with P(success) = 1 / (1 + mean)
+    if mean <= 0:
+        return 0
+    return int(math.log(1.0 - rng.random()) / math.log(mean / (1.0 + mean)))
+
+
+def _reference_data(rng, scale, tables):
+# -----------------------------------------------------------------------------------------------------------------
+    for group_id in range(1, scale.species_groups + 1):
+        tables.add('species_group', group_id, 'Species group {0}'.format(group_id))
+
+    for species_id in range(1, scale.species + 1):
+        tables.add('species', species_id, species_id, 'Synthetica avis {0:03d}'.format(species_id),
+                   'Synthetic bird {0:03d}'.format(species_id), 'Synthetic bird {0:03d}'.format(species_id),
+                   species_id % 10 == 0)
+        tables.add('species_group_membership', 1 + species_id % scale.species_groups, species_id)
+
+    tables.add('characteristic', WEIGHT_CHARACTERISTIC_ID, 'weight', 'weight', 'Weight', 'NUMERIC', 'g')
+    tables.add('characteristic', OUT_STATUS_CHARACTERISTIC_ID, 'outStatusCode', 'outStatusCode', 'Out status',
+               'TEXT', None)
+
+    banders = [_uuid(rng) for _ in range(scale.banders)]
+    for n, bander_id in enumerate(banders):
+        tables.add('bander', bander_id, 'bander{0:05d}'.format(n), 'Synthetic Bander {0:05d}'.format(n),
+                   str(1000 + n), 'ACTIVE' if rng.random() < 0.9 else 'INACTIVE', False)
+
+    projects = []
+    for n in range(scale.projects):
+        project_id = _uuid(rng)
+        coordinator = rng.choice(banders)
+        moratorium = _timestamp(rng, LAST_EVENT - datetime.timedelta(days=3 * 365),
+                                LAST_EVENT + datetime.timedelta(days=3 * 365)) if rng.random() < 0.5 else None
+        tables.add('project', project_id, 'Project {0} {1:04d}'.format(rng.choice(LOCATIONS), n), 'ACTIVE',
+                   coordinator, moratorium, rng.random() < 0.3)
+        projects.append({'id': project_id, 'coordinator': coordinator, 'members': {coordinator}})
+
+    for bander_id in banders:
+        for project in rng.sample(projects, min(len(projects), 1 + _geometric(rng, 1.0))):
+            project['members'].add(bander_id)
+    for project in projects:
+        project['members'] = sorted(project['members'])
+        for bander_id in project['members']:
+            tables.add('project_bander_membership', project['id'], bander_id)
+
+    return banders, projects
+
+
+class _MarkSequence(object):
+# -----------------------------------------------------------------------------------------------------------------
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.next_short_number = dict((prefix, 1) for prefix in PREFIXES)
+
+    def take(self):
+        prefix = self.rng.choice(PREFIXES)
+        short_number = self.next_short_number[prefix]
+        self.next_short_number[prefix] += 1
+        return _uuid(self.rng), prefix, str(short_number)
+
+
+class _StockBatch(object):
+# -----------------------------------------------------------------------------------------------------------------
+    """Marks issued to one bander on a project by a single NEW_MARK event, ahead of their first use."""
+
+    def __init__(self, rng, project):
+        self.event_id = _uuid(rng)
+        self.project = project
+        self.bander_id = rng.choice(project['members'])
+        self.marks = []           # (mark_id, prefix, short_number, is_current NEW state)
+        self.first_use = None
+
+    def add(self, mark, used_at=None):
+        self.marks.append(mark + (used_at is None,))
+        if used_at is not None and (self.first_use is None or used_at < self.first_use):
+            self.first_use = used_at
+
+    def issue(self, rng, tables):
+        issued = (self.first_use or LAST_EVENT) - datetime.timedelta(days=rng.randint(7, 365))
+        tables.add('event', self.event_id, 'NEW_MARK', 'VALID', 'NZ_NON_GAMEBIRD', issued, 'D',
+                   self.project['coordinator'], self.bander_id, self.bander_id, None, None, self.project['id'],
+                   None, None, None, None, len(self.marks))
+        for mark_id, prefix, short_number, unused in self.marks:
+            tables.add('mark', mark_id, prefix, short_number)
+            tables.add('mark_allocation', self.event_id, mark_id, self.bander_id, 0, True)
+            tables.add('mark_state', self.event_id, mark_id, 'NEW', 0, unused)
+
+
+def _bird_events(rng, scale, tables, projects, species_weights, marks, batches):
+# -----------------------------------------------------------------------------------------------------------------
+    project = rng.choice(projects)
+    batch = batches.get(project['id'])
+    if batch is None or len(batch.marks) >= STOCK_BATCH_MARKS:
+        if batch is not None:
+            batch.issue(rng, tables)
+        batch = batches[project['id']] = _StockBatch(rng, project)
+    bird_id = _uuid(rng)
+    species_id = 1 + bisect.bisect(species_weights, rng.random() * species_weights[-1])
+    tables.add('bird', bird_id, min(species_id, scale.species), None)
+
+    latitude = rng.uniform(-47.0, -34.5)
+    longitude = rng.uniform(166.5, 178.5)
+    location = rng.choice(LOCATIONS)
+    marked_at = _timestamp(rng, FIRST_EVENT, LAST_EVENT)
+
+    band = marks.take()
+    batch.add(band, used_at=marked_at)
+    for _ in range(_geometric(rng, scale.stock_marks_per_bird)):
+        batch.add(marks.take())
+
+    colour_bands = [rng.choice(COLOURS) for _ in range(_geometric(rng, scale.colour_bands_per_bird))]
+    timestamps = [marked_at]
+    for _ in range(_geometric(rng, scale.mean_resightings)):
+        timestamps.append(min(LAST_EVENT, timestamps[-1] + datetime.timedelta(days=rng.expovariate(1 / 400.0))))
+    dies = rng.random() < 0.05
+
+    for n, event_timestamp in enumerate(timestamps):
+        event_id = _uuid(rng)
+        reporter = batch.bander_id if n == 0 else rng.choice(project['members'])
+        event_type = 'FIRST_MARKING_IN_HAND' if n == 0 else rng.choice(RESIGHTING_TYPES)
+        tables.add('event', event_id, event_type, 'VALID', 'NZ_NON_GAMEBIRD', event_timestamp, 'D',
+                   project['coordinator'], reporter, reporter, 'WILD', bird_id, project['id'],
+                   round(latitude + rng.gauss(0, 0.05), 6), round(longitude + rng.gauss(0, 0.05), 6), 'WGS84',
+                   location, 1 + len(colour_bands))
+
+        last = n == len(timestamps) - 1
+        tables.add('mark_state', event_id, band[0], 'ATTACHED', n + 1, last)
+        # The metal band's text is its band number, as stamped on it
+        tables.add('mark_configuration', event_id, band[0], 'LEG_BAND', 'METAL', None, '{0}-{1}'.format(band[1], band[2]),
+                   'RIGHT', 'TARSUS', 0)
+        for location_idx, colour in enumerate(colour_bands):
+            tables.add('mark_configuration', event_id, None, 'LEG_BAND', 'DARVIC', colour, None,
+                       'LEFT', 'TIBIA' if location_idx % 2 else 'TARSUS', location_idx)
+
+        tables.add('characteristic_measurement', event_id, OUT_STATUS_CHARACTERISTIC_ID,
+                   'DEAD_RECENT' if dies and last else 'ALIVE')
+        if event_type != 'SIGHTING_BY_PERSON' and rng.random() < 0.5:
+            tables.add('characteristic_measurement', event_id, WEIGHT_CHARACTERISTIC_ID,
+                       str(round(rng.lognormvariate(5, 0.6), 1)))
+
+
+def generate(pool, scale, seed=1, block_birds=BLOCK_BIRDS):
+# -----------------------------------------------------------------------------------------------------------------
+    """Fill the (empty) tables; returns the number of rows written to each table and how long it took."""
+    rng = random.Random(seed)
+    tables = _Tables()
+    counts = {}
+    started = time.perf_counter()
+
+    with pool.connection(autocommit=False) as conn:
+        _, projects = _reference_data(rng, scale, tables)
+        tables.copy(conn, counts)
+
+    # A long tail: species n is picked in proportion to 1 / n
+    species_weights = list(itertools.accumulate(1.0 / n for n in range(1, scale.species + 1)))
+    marks = _MarkSequence(rng)
+    remaining = scale.birds
+    while remaining > 0:
+        block = min(block_birds, remaining)
+        batches = {}
+        for _ in range(block):
+            _bird_events(rng, scale, tables, projects, species_weights, marks, batches)
+        for project_id in sorted(batches):
+            batches[project_id].issue(rng, tables)
+        with pool.connection(autocommit=False) as conn:
+            tables.copy(conn, counts)
+        remaining -= block
+
+    with pool.connection(autocommit=True) as conn:
+        with conn.cursor() as cur:
+            # Explicit ids were given for these, so move the identity sequences past them
+            for table in ('species', 'species_group', 'characteristic'):
+                cur.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), (SELECT max(id) FROM {0}))".format(table),
+                            (table,))
+            cur.execute('ANALYZE')
+
+    return {'Rows': counts, 'DurationMs': round((time.perf_counter() - started) * 1000, 3)}
+
+
+def add_arguments(parser):
+# -----------------------------------------------------------------------------------------------------------------
+    """The data set-up options every benchmark takes."""
+    parser.add_argument('--create-schema', action='store_true', help='Run sql/1..5 first (the database must be empty)')
+    parser.add_argument('--skip-generate', action='store_true', help='Benchmark the data already in the database')
+    parser.add_argument('--events', type=int, default=DEFAULT_EVENTS, help='Approximate number of events to generate')
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def parameters(args):
+# -----------------------------------------------------------------------------------------------------------------
+    return {'Events': args.events, 'Seed': args.seed, 'Scale': Scale.from_events(args.events).describe(),
+            'Generated': not args.skip_generate}
+
+
+def prepare(pool, args, document):
+# -----------------------------------------------------------------------------------------------------------------
+    """Create the schema and/or generate data as asked, noting what was done in the results document."""
+    if args.create_schema:
+        document['SchemaSkipped'] = create_schema(pool)
+    if not args.skip_generate:
+        document['Generated'] = generate(pool, Scale.from_events(args.events), seed=args.seed)
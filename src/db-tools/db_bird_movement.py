@@ -0,0 +1,378 @@
+# Batch maintenance of bird_movement_summary (sql/4_create_materialized_views.sql): per bird, the
+# travel timeline, cumulative and total distance, first-to-last and most recent location deltas,
+# and out status history that ro_bird_travel_timeline, ro_bird_location_delta_first_to_last,
+# ro_bird_location_delta_most_recent and ro_bird_status_summary work out on every bird page load
+# (an ST_Distance per event, over a lag() window, four queries per bird).
+#
+# Birds are recomputed a chunk at a time: their events are read ordered by bird and time, and
+# every distance in the chunk comes from one vectorised geodesic call over the latitude/longitude
+# columns (db_coordinates.geodesic_distance, WGS84 as ST_Distance on geography), with per-bird
+# totals, first/last located events and the two most recent events picked out with array
+# operations rather than per-bird queries.
+#
+# Which birds to recompute comes from search_event_change, as for advanced_search_events_incremental
+# (db_search_events_incremental.py, whose change log, watermark and gap handling this shares):
+# triggers on event log the bird_id of every inserted, updated or deleted event (and the bird an
+# event was moved off), and out status changes arrive as characteristic_measurement event_ids.
+# record_action is left to the data platform sync.
+#
+# Events are ordered by event_timestamp, then row_creation_timestamp_ and id, so ties that the
+# SQL functions leave to chance always come out the same way.
+#
+# Usage (from src/db-tools):
+#   python3 db_bird_movement.py rebuild                 # every bird, sets the watermark
+#   python3 db_bird_movement.py sync                    # birds changed since the watermark
+#   python3 db_bird_movement.py check [--sample 1000] [--repair]
+
+import argparse
+import csv
+import io
+import json
+import random
+import time
+
+import numpy as np
+
+from db_coordinates import geodesic_distance
+from db_pool import ConnectionPool
+from db_search_events_incremental import (BATCH_ACTIONS, current_position, fetch_actions, next_gaps, read_watermark,
+                                          write_watermark)
+
+TABLE = 'bird_movement_summary'
+
+OUT_STATUS_CHARACTERISTIC_ID = 43
+
+# search_event_change rows (db_table, db_table_identifier_name) that name a bird, and an event whose out status may
+# have changed. Everything else in there is for advanced_search_events_incremental
+BIRD_KEY = ('event', 'bird_id')
+STATUS_EVENT_KEY = ('characteristic_measurement', 'event_id')
+
+# Birds recomputed per chunk (and so per geodesic call)
+RECOMPUTE_CHUNK = 2000
+REBUILD_CHUNK = 20000
+
+# How close (metres) distances have to be to count as the same in check()
+TOLERANCE_M = 0.001
+
+COLUMNS = ['bird_id', 'event_count', 'located_event_count', 'first_event_timestamp', 'last_event_timestamp',
+           'total_distance', 'delta_first_to_last', 'delta_most_recent', 'latest_out_status_code',
+           'latest_out_status_timestamp', 'travel_timeline', 'status_summary']
+
+EVENTS_SQL = '''
+    SELECT e.bird_id::text, e.id::text, e.event_timestamp,
+           extract(epoch FROM e.event_timestamp)::float8, extract(epoch FROM e.row_creation_timestamp_)::float8,
+           e.latitude::float8, e.longitude::float8
+    FROM event AS e
+    WHERE e.bird_id = ANY(%s::uuid[])
+    ORDER BY e.bird_id, e.event_timestamp, e.row_creation_timestamp_, e.id
+'''
+
+STATUSES_SQL = '''
+    SELECT e.bird_id::text, e.id::text, e.event_timestamp, cm.value
+    FROM event AS e
+    INNER JOIN characteristic_measurement AS cm ON cm.event_id = e.id AND cm.characteristic_id = %s
+    WHERE e.bird_id = ANY(%s::uuid[])
+    ORDER BY e.bird_id, e.event_timestamp, e.row_creation_timestamp_, e.id, cm.id
+'''
+
+# PostGIS's own distances for the same timeline, for check()
+REFERENCE_DISTANCES_SQL = '''
+    SELECT e.id::text,
+           ST_Distance(e.location, lag(e.location) OVER (
+             PARTITION BY e.bird_id ORDER BY e.event_timestamp, e.row_creation_timestamp_, e.id))
+    FROM event AS e
+    WHERE e.bird_id = ANY(%s::uuid[])
+'''
+
+
+def _float_or_none(value):
+# -----------------------------------------------------------------------------------------------------------------
+    return None if np.isnan(value) else float(value)
+
+
+def summarise(event_rows, status_rows):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    Summary rows (in COLUMNS order) for the birds in event_rows, which must be EVENTS_SQL rows
+    (ordered by bird, then time); status_rows are the matching STATUSES_SQL rows.
+    """
+    if not event_rows:
+        return []
+
+    birds = np.array([r[0] for r in event_rows], dtype=object)
+    event_epoch = np.array([r[3] for r in event_rows], dtype=np.float64)
+    created_epoch = np.array([r[4] for r in event_rows], dtype=np.float64)
+    latitude = np.array([r[5] for r in event_rows], dtype=np.float64)      # None -> NaN
+    longitude = np.array([r[6] for r in event_rows], dtype=np.float64)
+    count = len(event_rows)
+
+    new_bird = np.ones(count, dtype=bool)
+    new_bird[1:] = birds[1:] != birds[:-1]
+    starts = np.flatnonzero(new_bird)
+    ends = np.append(starts[1:], count) - 1
+    event_counts = ends - starts + 1
+
+    # Distance from each event's predecessor (NaN for a bird's first event, or either end unlocated)
+    distance = np.full(count, np.nan)
+    distance[1:] = geodesic_distance(latitude[:-1], longitude[:-1], latitude[1:], longitude[1:])
+    distance[new_bird] = np.nan
+    steps = np.where(np.isnan(distance), 0.0, distance)
+    cumulative = np.cumsum(steps)
+    cumulative -= np.repeat(cumulative[starts], event_counts)
+    total_distance = cumulative[ends]
+
+    # First and last located events of each bird
+    located = ~np.isnan(latitude) & ~np.isnan(longitude)
+    bird_index = np.repeat(np.arange(len(starts)), event_counts)
+    located_counts = np.bincount(bird_index[located], minlength=len(starts))
+    located_rows = np.flatnonzero(located)
+    located_birds = bird_index[located_rows]
+    first_of_bird = np.ones(len(located_rows), dtype=bool)
+    first_of_bird[1:] = located_birds[1:] != located_birds[:-1]
+    last_of_bird = np.ones(len(located_rows), dtype=bool)
+    last_of_bird[:-1] = first_of_bird[1:]
+    first_located = np.full(len(starts), -1)
+    last_located = np.full(len(starts), -1)
+    first_located[located_birds[first_of_bird]] = located_rows[first_of_bird]
+    last_located[located_birds[last_of_bird]] = located_rows[last_of_bird]
+
+    delta_first_to_last = np.full(len(starts), np.nan)
+    apart = (first_located >= 0) & (first_located != last_located)
+    delta_first_to_last[apart] = geodesic_distance(latitude[first_located[apart]], longitude[first_located[apart]],
+                                                   latitude[last_located[apart]], longitude[last_located[apart]])
+
+    # Between the two most recent events - which the SQL can't tell apart (so gives NULL) if they tie exactly
+    delta_most_recent = np.full(len(starts), np.nan)
+    pairs = event_counts >= 2
+    tied = (event_epoch[ends] == event_epoch[ends - 1]) & (created_epoch[ends] == created_epoch[ends - 1])
+    delta_most_recent[pairs & ~tied] = distance[ends[pairs & ~tied]]
+
+    statuses = {}
+    for row in status_rows:
+        statuses.setdefault(row[0], []).append(row)
+
+    summaries = []
+    for b, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        timeline = [{'id': event_rows[i][1], 'event_timestamp': event_rows[i][2].isoformat(),
+                     'distance': _float_or_none(distance[i]), 'cumulative_distance': float(cumulative[i])}
+                    for i in range(start, end + 1)]
+        bird_statuses = statuses.get(birds[start], [])
+        status_summary = [{'id': event_id, 'event_timestamp': event_timestamp.isoformat(), 'out_status_code': value}
+                          for _, event_id, event_timestamp, value in bird_statuses]
+        latest = bird_statuses[-1] if bird_statuses else (None, None, None, None)
+        summaries.append((
+            birds[start], int(event_counts[b]), int(located_counts[b]),
+            event_rows[start][2], event_rows[end][2], float(total_distance[b]),
+            _float_or_none(delta_first_to_last[b]), _float_or_none(delta_most_recent[b]),
+            latest[3], latest[2],
+            json.dumps(timeline), json.dumps(status_summary),
+        ))
+    return summaries
+
+
+def compute_birds(cur, bird_ids):
+# -----------------------------------------------------------------------------------------------------------------
+    cur.execute(EVENTS_SQL, (bird_ids,))
+    event_rows = cur.fetchall()
+    cur.execute(STATUSES_SQL, (OUT_STATUS_CHARACTERISTIC_ID, bird_ids))
+    return summarise(event_rows, cur.fetchall())
+
+
+def write_summaries(cur, summaries):
+# -----------------------------------------------------------------------------------------------------------------
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(summaries)      # None -> empty -> NULL
+    buffer.seek(0)
+    cur.copy_expert('COPY {0} ({1}) FROM STDIN WITH (FORMAT csv)'.format(TABLE, ', '.join(COLUMNS)), buffer)
+
+
+def recompute_birds(cur, bird_ids, chunk_size=RECOMPUTE_CHUNK):
+# -----------------------------------------------------------------------------------------------------------------
+    # Birds with no events left just don't come back
+    bird_ids = sorted(bird_ids)
+    removed, written = 0, 0
+    for i in range(0, len(bird_ids), chunk_size):
+        chunk = bird_ids[i:i + chunk_size]
+        cur.execute('DELETE FROM {0} WHERE bird_id = ANY(%s::uuid[])'.format(TABLE), (chunk,))
+        removed += cur.rowcount
+        summaries = compute_birds(cur, chunk)
+        write_summaries(cur, summaries)
+        written += len(summaries)
+    return removed, written
+
+
+def affected_birds(cur, actions):
+# -----------------------------------------------------------------------------------------------------------------
+    bird_ids = set()
+    event_ids = set()
+    ignored = 0
+    for _, table, identifier_name, value in actions:
+        if (table, identifier_name) == BIRD_KEY:
+            bird_ids.add(value)
+        elif (table, identifier_name) == STATUS_EVENT_KEY:
+            event_ids.add(value)
+        else:
+            ignored += 1
+
+    # (Deleted events' birds are already logged by the event trigger)
+    if event_ids:
+        cur.execute('SELECT DISTINCT bird_id::text FROM event WHERE id = ANY(%s::uuid[]) AND bird_id IS NOT NULL',
+                    (sorted(event_ids),))
+        bird_ids.update(row[0] for row in cur.fetchall())
+    return bird_ids, ignored
+
+
+def sync(pool, batch_actions=BATCH_ACTIONS):
+# -----------------------------------------------------------------------------------------------------------------
+    """Recompute the birds named in search_event_change since the watermark, one transaction per batch."""
+    summary = {'Batches': 0, 'Actions': 0, 'Ignored': 0, 'Birds': 0, 'Written': 0, 'Removed': 0,
+               'Watermark': None, 'PendingGaps': None}
+    started = time.perf_counter()
+    gaps_read = False
+    while True:
+        with pool.cursor(autocommit=False) as cur:
+            # Gaps get one look per run: only the first batch re-reads them, later ones carry them over
+            last_id, gaps = read_watermark(cur, TABLE)
+            actions, new_ids = fetch_actions(cur, last_id, [] if gaps_read else gaps, batch_actions)
+            if not actions and (gaps_read or not gaps):
+                break
+
+            bird_ids, ignored = affected_birds(cur, actions)
+            removed, written = recompute_birds(cur, bird_ids)
+
+            new_gaps = next_gaps(gaps, last_id, new_ids, set(a[0] for a in actions), time.time())
+            write_watermark(cur, new_ids[-1] if new_ids else last_id, new_gaps, TABLE)
+
+        summary['Batches'] += 1
+        summary['Actions'] += len(actions)
+        summary['Ignored'] += ignored
+        summary['Birds'] += len(bird_ids)
+        summary['Written'] += written
+        summary['Removed'] += removed
+        summary.update(Watermark=new_ids[-1] if new_ids else last_id, PendingGaps=len(new_gaps))
+        gaps_read = True
+
+        if len(new_ids) < batch_actions:
+            break
+
+    summary['DurationMs'] = round((time.perf_counter() - started) * 1000, 3)
+    return summary
+
+
+def rebuild(pool, chunk_size=REBUILD_CHUNK):
+# -----------------------------------------------------------------------------------------------------------------
+    """Recompute every bird and start the watermark from the current end of search_event_change."""
+    started = time.perf_counter()
+    with pool.cursor(autocommit=False) as cur:
+        cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        last_id, gaps = current_position(cur)
+        cur.execute('SELECT DISTINCT bird_id::text FROM event WHERE bird_id IS NOT NULL')
+        bird_ids = [row[0] for row in cur.fetchall()]
+
+        cur.execute('TRUNCATE {0}'.format(TABLE))
+        _, written = recompute_birds(cur, bird_ids, chunk_size)
+        write_watermark(cur, last_id, gaps, TABLE)
+    with pool.cursor() as cur:
+        cur.execute('ANALYZE {0}'.format(TABLE))
+    return {'Birds': written, 'Watermark': last_id, 'PendingGaps': len(gaps),
+            'DurationMs': round((time.perf_counter() - started) * 1000, 3)}
+
+
+def _same(stored, computed):
+# -----------------------------------------------------------------------------------------------------------------
+    for column, a, b in zip(COLUMNS, stored, computed):
+        if column in ('travel_timeline', 'status_summary'):
+            if a != json.loads(b):
+                return False
+        elif isinstance(a, float) or isinstance(b, float):
+            if (a is None) != (b is None) or (a is not None and abs(a - b) > TOLERANCE_M):
+                return False
+        elif a != b:
+            return False
+    return True
+
+
+def check(pool, sample=None, repair=False, limit=100):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    Compare the table with a fresh recompute (of every bird, or a random sample), and the
+    sampled/checked birds' distances with PostGIS's ST_Distance. Optionally recompute the birds that differ.
+    """
+    started = time.perf_counter()
+    with pool.cursor(autocommit=False) as cur:
+        cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        cur.execute('SELECT DISTINCT bird_id::text FROM event WHERE bird_id IS NOT NULL ORDER BY 1')
+        bird_ids = [row[0] for row in cur.fetchall()]
+        if sample:
+            bird_ids = sorted(random.sample(bird_ids, min(sample, len(bird_ids))))
+            extra = []
+        else:
+            cur.execute('''
+                SELECT s.bird_id::text FROM {0} AS s
+                WHERE NOT EXISTS (SELECT 1 FROM event AS e WHERE e.bird_id = s.bird_id)'''.format(TABLE))
+            extra = [row[0] for row in cur.fetchall()]
+
+        differences = [(bird_id, 'Extra') for bird_id in extra]
+        max_error = 0.0
+        for i in range(0, len(bird_ids), REBUILD_CHUNK):
+            chunk = bird_ids[i:i + REBUILD_CHUNK]
+            computed = dict((row[0], row) for row in compute_birds(cur, chunk))
+            cur.execute('SELECT {0} FROM {1} WHERE bird_id = ANY(%s::uuid[])'.format(
+                ', '.join('bird_id::text' if c == 'bird_id' else c for c in COLUMNS), TABLE), (chunk,))
+            stored = dict((row[0], row) for row in cur.fetchall())
+            for bird_id in chunk:
+                if bird_id not in stored:
+                    differences.append((bird_id, 'Missing'))
+                elif not _same(stored[bird_id], computed[bird_id]):
+                    differences.append((bird_id, 'Different'))
+
+            cur.execute(REFERENCE_DISTANCES_SQL, (chunk,))
+            reference = dict(cur.fetchall())
+            for row in computed.values():
+                for entry in json.loads(row[COLUMNS.index('travel_timeline')]):
+                    expected = reference.get(entry['id'])
+                    if (expected is None) != (entry['distance'] is None):
+                        max_error = float('inf')
+                    elif expected is not None:
+                        max_error = max(max_error, abs(expected - entry['distance']))
+
+    report = {'Birds': len(bird_ids), 'Sampled': bool(sample), 'Differences': len(differences),
+              'MaxDistanceErrorM': max_error, 'DistancesAgree': max_error <= TOLERANCE_M}
+    report['Consistent'] = not differences and report['DistancesAgree']
+    for kind in ('Missing', 'Extra', 'Different'):
+        report[kind] = len([d for d in differences if d[1] == kind])
+    report['Sample'] = [{'BirdId': d[0], 'Problem': d[1]} for d in differences[:limit]]
+
+    if repair and differences:
+        with pool.cursor(autocommit=False) as cur:
+            removed, written = recompute_birds(cur, [d[0] for d in differences])
+        report['Repaired'] = {'Removed': removed, 'Written': written}
+
+    report['DurationMs'] = round((time.perf_counter() - started) * 1000, 3)
+    return report
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=('sync', 'rebuild', 'check'))
+    parser.add_argument('--dsn', default=None, help='libpq connection string (default: $BIRDBANDING_DB_DSN / PG* env vars)')
+    parser.add_argument('--batch-actions', type=int, default=BATCH_ACTIONS)
+    parser.add_argument('--sample', type=int, help='check: just this many random birds')
+    parser.add_argument('--repair', action='store_true', help='check: recompute any birds that differ')
+    args = parser.parse_args()
+
+    with ConnectionPool(args.dsn, max_connections=1) as pool:
+        if args.command == 'sync':
+            result = sync(pool, args.batch_actions)
+        elif args.command == 'rebuild':
+            result = rebuild(pool)
+        else:
+            result = check(pool, args.sample, args.repair)
+
+    print(json.dumps(result, indent=2, default=str))
+    return 1 if args.command == 'check' and not result['Consistent'] and not args.repair else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
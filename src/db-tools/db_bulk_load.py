@@ -0,0 +1,329 @@
+# Parallel bulk load of an environment export (db_export.py, or rw_export_environment's plain
+# csv_backups/<timestamp>/<table>.csv layout) into a database with the sql/ scripts applied.
+#
+# rw_import_query loads one CSV at a time through aws_s3.table_import_from_s3 with every index
+# and trigger live, so restoring an environment takes hours. This streams COPY ... FROM STDIN
+# over several connections instead: tables are loaded parents-first (by their foreign keys),
+# each as soon as everything it references has loaded, with the chunks of a table loading in
+# parallel. Optionally:
+#
+#   --defer-indexes     drop the secondary indexes (not the ones backing PK/unique/exclusion
+#                       constraints) before loading and rebuild them in parallel afterwards.
+#                       Definitions are kept in --state-file until they're back, so a crashed
+#                       load can finish with --restore-indexes.
+#   --disable-triggers  turn off the user triggers (update_row_modified_timestamp,
+#                       update_location_geography, the search_event_change ones) while loading.
+#                       Foreign keys are still checked. Note update_row_modified_timestamp
+#                       otherwise overwrites every exported row_creation_timestamp_ with now().
+#
+# Identity sequences are moved past the loaded ids and the tables ANALYZEd at the end. Row counts
+# (and checksums, where there's a manifest) are checked against the export.
+#
+# Usage (from src/db-tools):
+#   python3 db_bulk_load.py --source ./backups --export-dir csv_backups/2021_01_01_00_00_00/
+#                           [--workers 4] [--truncate] [--defer-indexes] [--disable-triggers]
+#   python3 db_bulk_load.py --restore-indexes [--state-file bulk_load_state.json]
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import csv
+import hashlib
+import json
+import os
+import threading
+import time
+
+from db_export import MANIFEST, quote_ident
+from db_pool import ConnectionPool
+from db_storage import open_store
+
+LOAD_WORKERS = 4
+
+# PostGIS fills this in itself when the extension is created
+SKIP_TABLES = ('spatial_ref_sys',)
+
+STATE_FILE = 'bulk_load_state.json'
+
+COPY_OPTIONS = 'FORMAT csv, HEADER'
+
+MAINTENANCE_WORK_MEM = '512MB'
+
+HEADER_READ_BYTES = 64 * 1024
+
+
+class HashingReader(object):
+# -----------------------------------------------------------------------------------------------------------------
+    # What COPY ... FROM STDIN reads from: the export file, hashed on the way through
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.digest = hashlib.sha256()
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.digest.update(data)
+        self.bytes += len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.stream.readline(size)
+        self.digest.update(data)
+        self.bytes += len(data)
+        return data
+
+
+def read_export(store, export_dir):
+# -----------------------------------------------------------------------------------------------------------------
+    # {table: {'Columns': [...] or None, 'Chunks': [{'File', 'Rows', 'Sha256'}...]}}
+    export_dir = export_dir.rstrip('/') + '/'
+    if store.exists(export_dir + MANIFEST):
+        manifest = json.loads(store.get_bytes(export_dir + MANIFEST).decode('utf-8'))
+        if not manifest.get('Complete'):
+            raise ValueError('Export {0} did not complete, resume it with db_export.py first'.format(export_dir))
+        return dict((table, {'Columns': plan['Columns'], 'Chunks': plan['Chunks']})
+                    for table, plan in manifest['Tables'].items())
+
+    # rw_export_environment layout: just <table>.csv, columns from the header row
+    tables = {}
+    for key in store.list(export_dir):
+        name = key[len(export_dir):]
+        if '/' in name or not name.endswith('.csv'):
+            continue
+        tables[name[:-len('.csv')]] = {'Columns': None, 'Chunks': [{'File': name}]}
+    return tables
+
+
+def header_columns(store, key):
+# -----------------------------------------------------------------------------------------------------------------
+    stream = store.open(key)
+    try:
+        head = b''
+        while b'\n' not in head:
+            block = stream.read(HEADER_READ_BYTES)
+            if not block:
+                break
+            head += block
+    finally:
+        stream.close()
+    return next(csv.reader([head.split(b'\n', 1)[0].decode('utf-8').rstrip('\r')]))
+
+
+def foreign_key_parents(cur, tables):
+# -----------------------------------------------------------------------------------------------------------------
+    cur.execute('''
+        SELECT c.conrelid::regclass::text, c.confrelid::regclass::text
+        FROM pg_constraint AS c
+        WHERE c.contype = 'f' AND c.conrelid::regclass::text = ANY(%s) AND c.confrelid::regclass::text = ANY(%s)''',
+                (list(tables), list(tables)))
+    parents = dict((table, set()) for table in tables)
+    for child, parent in cur.fetchall():
+        if child != parent:
+            parents[child].add(parent)
+    return parents
+
+
+def secondary_indexes(cur, tables):
+# -----------------------------------------------------------------------------------------------------------------
+    # Indexes that no constraint depends on - safe to drop and rebuild
+    cur.execute('''
+        SELECT i.indrelid::regclass::text, c.relname, pg_get_indexdef(i.indexrelid)
+        FROM pg_index AS i
+        INNER JOIN pg_class AS c ON c.oid = i.indexrelid
+        WHERE i.indrelid::regclass::text = ANY(%s)
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint AS con WHERE con.conindid = i.indexrelid)
+        ORDER BY 1, 2''', (list(tables),))
+    return [{'Table': t, 'Name': n, 'Definition': d} for t, n, d in cur.fetchall()]
+
+
+def save_state(state_file, state):
+# -----------------------------------------------------------------------------------------------------------------
+    partial = state_file + '.partial'
+    with open(partial, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(partial, state_file)
+
+
+def rebuild_indexes(pool, indexes, workers):
+# -----------------------------------------------------------------------------------------------------------------
+    def build(index):
+        started = time.perf_counter()
+        with pool.cursor() as cur:
+            cur.execute('SET maintenance_work_mem = %s', (MAINTENANCE_WORK_MEM,))
+            cur.execute(index['Definition'].replace('CREATE INDEX ', 'CREATE INDEX IF NOT EXISTS ', 1)
+                        .replace('CREATE UNIQUE INDEX ', 'CREATE UNIQUE INDEX IF NOT EXISTS ', 1))
+        return {'Index': index['Name'], 'Table': index['Table'], 'DurationMs': round((time.perf_counter() - started) * 1000, 3)}
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='bulk-load-index') as executor:
+        return list(executor.map(build, indexes))
+
+
+class BulkLoader(object):
+# -----------------------------------------------------------------------------------------------------------------
+
+    def __init__(self, pool, store, export_dir, workers=LOAD_WORKERS, state_file=STATE_FILE):
+        self.pool = pool
+        self.store = store
+        self.export_dir = export_dir.rstrip('/') + '/'
+        self.workers = workers
+        self.state_file = state_file
+        self._lock = threading.Lock()
+        self.table_stats = {}
+
+    def load(self, tables=None, truncate=False, defer_indexes=False, disable_triggers=False):
+        started = time.perf_counter()
+        export = read_export(self.store, self.export_dir)
+        wanted = [t for t in sorted(export) if (t in tables if tables else t not in SKIP_TABLES)]
+
+        with self.pool.cursor() as cur:
+            parents = foreign_key_parents(cur, wanted)
+            deferred = secondary_indexes(cur, wanted) if defer_indexes else []
+
+        report = {'Tables': {}, 'Indexes': [], 'Problems': []}
+
+        if deferred:
+            save_state(self.state_file, {'DeferredIndexes': deferred})
+        try:
+            with self.pool.cursor() as cur:
+                if truncate:
+                    cur.execute('TRUNCATE {0} CASCADE'.format(', '.join(quote_ident(t) for t in wanted)))
+                for index in deferred:
+                    cur.execute('DROP INDEX IF EXISTS {0}'.format(quote_ident(index['Name'])))
+                if disable_triggers:
+                    for table in wanted:
+                        cur.execute('ALTER TABLE {0} DISABLE TRIGGER USER'.format(quote_ident(table)))
+            try:
+                self.load_tables(export, wanted, parents)
+            finally:
+                if disable_triggers:
+                    with self.pool.cursor() as cur:
+                        for table in wanted:
+                            cur.execute('ALTER TABLE {0} ENABLE TRIGGER USER'.format(quote_ident(table)))
+        finally:
+            if deferred:
+                report['Indexes'] = rebuild_indexes(self.pool, deferred, self.workers)
+                os.unlink(self.state_file)
+
+        with self.pool.cursor() as cur:
+            for table in wanted:
+                reset_identity_sequences(cur, table)
+                cur.execute('ANALYZE {0}'.format(quote_ident(table)))
+
+        for table in wanted:
+            stats = self.table_stats.get(table, {})
+            seconds = stats.get('Seconds') or 0
+            report['Tables'][table] = {
+                'Rows': stats.get('Rows'),
+                'Seconds': round(seconds, 3),
+                'RowsPerSecond': round(stats['Rows'] / seconds, 1) if seconds and stats.get('Rows') else None,
+                'Bytes': stats.get('Bytes'),
+            }
+            report['Problems'].extend(stats.get('Problems', []))
+
+        report['Seconds'] = round(time.perf_counter() - started, 3)
+        return report
+
+    def load_tables(self, export, tables, parents):
+        # Same idea as db_matview_refresh: start each table's chunks as soon as its parents have loaded
+        waiting_on = dict((t, set(parents[t])) for t in tables)
+        chunks_left = {}
+        running = {}
+        executor = ThreadPoolExecutor(max_workers=max(1, self.workers), thread_name_prefix='bulk-load')
+        try:
+            while waiting_on or running:
+                for table in sorted(t for t, deps in waiting_on.items() if not deps):
+                    del waiting_on[table]
+                    columns = export[table]['Columns'] or header_columns(self.store, self.export_dir + export[table]['Chunks'][0]['File'])
+                    chunks = export[table]['Chunks']
+                    chunks_left[table] = len(chunks)
+                    self.table_stats[table] = {'Rows': 0, 'Bytes': 0, 'Started': time.perf_counter(), 'Problems': []}
+                    for chunk in chunks:
+                        running[executor.submit(self.load_chunk, table, columns, chunk)] = table
+
+                if not running:
+                    raise RuntimeError('Foreign key cycle between: {0}'.format(', '.join(sorted(waiting_on))))
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    table = running.pop(future)
+                    future.result()
+                    chunks_left[table] -= 1
+                    if chunks_left[table] == 0:
+                        stats = self.table_stats[table]
+                        stats['Seconds'] = time.perf_counter() - stats['Started']
+                        for deps in waiting_on.values():
+                            deps.discard(table)
+        finally:
+            for future in running:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def load_chunk(self, table, columns, chunk):
+        stream = self.store.open(self.export_dir + chunk['File'])
+        try:
+            reader = HashingReader(stream)
+            with self.pool.cursor() as cur:
+                cur.copy_expert('COPY {0} ({1}) FROM STDIN WITH ({2})'.format(
+                    quote_ident(table), ', '.join(quote_ident(c) for c in columns), COPY_OPTIONS), reader)
+                rows = cur.rowcount
+        finally:
+            stream.close()
+
+        problems = []
+        if chunk.get('Rows') is not None and rows >= 0 and rows != chunk['Rows']:
+            problems.append('{0}: loaded {1} rows, export has {2}'.format(chunk['File'], rows, chunk['Rows']))
+        if chunk.get('Sha256') and reader.digest.hexdigest() != chunk['Sha256']:
+            problems.append('{0}: checksum does not match the manifest'.format(chunk['File']))
+
+        with self._lock:
+            stats = self.table_stats[table]
+            stats['Rows'] += max(rows, 0)
+            stats['Bytes'] += reader.bytes
+            stats['Problems'].extend(problems)
+
+
+def reset_identity_sequences(cur, table):
+# -----------------------------------------------------------------------------------------------------------------
+    # Loaded rows bring their own ids, which doesn't move the identity/serial sequences on
+    cur.execute('''
+        SELECT a.attname, pg_get_serial_sequence(%s, a.attname)
+        FROM pg_attribute AS a
+        WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+          AND pg_get_serial_sequence(%s, a.attname) IS NOT NULL''', (table, table, table))
+    for column, sequence in cur.fetchall():
+        cur.execute('SELECT setval(%s, COALESCE((SELECT MAX({0}) FROM {1}), 0) + 1, false)'.format(
+            quote_ident(column), quote_ident(table)), (sequence,))
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default=None, help='libpq connection string (default: $BIRDBANDING_DB_DSN / PG* env vars)')
+    parser.add_argument('--source', help='s3://bucket/prefix or a local directory holding the export')
+    parser.add_argument('--export-dir', help='e.g. csv_backups/2021_01_01_00_00_00/')
+    parser.add_argument('--workers', type=int, default=LOAD_WORKERS)
+    parser.add_argument('--tables', nargs='+', default=None)
+    parser.add_argument('--truncate', action='store_true', help='Empty the tables (CASCADE) before loading')
+    parser.add_argument('--defer-indexes', action='store_true')
+    parser.add_argument('--disable-triggers', action='store_true')
+    parser.add_argument('--state-file', default=STATE_FILE)
+    parser.add_argument('--restore-indexes', action='store_true', help='Rebuild indexes left dropped by a failed load, then exit')
+    args = parser.parse_args()
+
+    with ConnectionPool(args.dsn, max_connections=args.workers) as pool:
+        if args.restore_indexes:
+            with open(args.state_file) as f:
+                result = {'Indexes': rebuild_indexes(pool, json.load(f)['DeferredIndexes'], args.workers)}
+            os.unlink(args.state_file)
+        else:
+            if not args.source or not args.export_dir:
+                parser.error('--source and --export-dir are required')
+            loader = BulkLoader(pool, open_store(args.source), args.export_dir, args.workers, args.state_file)
+            result = loader.load(args.tables, args.truncate, args.defer_indexes, args.disable_triggers)
+
+    print(json.dumps(result, indent=2))
+    return 1 if result.get('Problems') else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
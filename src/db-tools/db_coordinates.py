@@ -0,0 +1,315 @@
+# Vectorised NZTM2000 / NZMG -> WGS84 conversion for upload ingestion.
+#
+# ro_nztm_to_wgs84 / ro_nzmg_to_wgs84 (sql/3_create_functions.sql) convert one point per call
+# and run ST_Transform twice per point, so a spreadsheet of NZTM or NZMG coordinates costs a
+# round trip and two transforms per row. This does the same conversions over whole NumPy
+# arrays, following what PROJ (and so ST_Transform) does for each SRID:
+#
+#   2193  NZGD2000 / New Zealand Transverse Mercator 2000 - inverse transverse Mercator on
+#         GRS80 (Kruger series to n^6, as PROJ's default tmerc), NZGD2000 taken as WGS84
+#   27200 NZGD49 / New Zealand Map Grid, with the proj4text set in sql/1_create_prereqs.sql -
+#         PROJ's inverse nzmg (complex polynomial, Newton iteration) on International 1924,
+#         then the +towgs84 7 parameter (position vector) Helmert shift to WGS84
+#
+# Agreement with PostGIS is checked (to well under a millimetre) by bench/coordinates.py; the
+# test coordinates from the SQL function comments are below with the values PROJ gives them.
+#
+# geodesic_distance() is the vectorised counterpart of ST_Distance between two geography points
+# (on the WGS84 spheroid), for the bird movement summary (db_bird_movement.py).
+#
+#   latitude, longitude = nztm_to_wgs84(eastings, northings)
+#   latitude, longitude = user_coordinates_to_wgs84(['NZTM', 'NZMG', 'WGS84'], eastings, northings)
+#   metres = geodesic_distance(latitudes1, longitudes1, latitudes2, longitudes2)
+
+import numpy as np
+
+NZTM_SRID = 2193
+NZMG_SRID = 27200
+
+# (srid, easting, northing, latitude, longitude) - the test coordinates in the ro_*_to_wgs84 comments
+TEST_POINTS = [
+    (NZTM_SRID, 1753950.0, 5441393.0, -41.16419009065875, 174.83504444644004),
+    (NZMG_SRID, 2664116.0, 6003034.0, -41.1648290321227, 174.83676710874542),
+]
+
+# GRS80
+GRS80_A = 6378137.0
+GRS80_F = 1 / 298.257222101
+
+# NZTM2000
+NZTM_LON0 = np.radians(173.0)
+NZTM_K0 = 0.9996
+NZTM_FALSE_EASTING = 1600000.0
+NZTM_FALSE_NORTHING = 10000000.0
+
+# International 1924 and NZMG
+INTL_A = 6378388.0
+INTL_F = 1 / 297.0
+NZMG_LAT0 = np.radians(-41.0)
+NZMG_LON0 = np.radians(173.0)
+NZMG_FALSE_EASTING = 2510000.0
+NZMG_FALSE_NORTHING = 6023150.0
+NZMG_TOWGS84 = (59.47, -5.04, 187.44, 0.47, -0.1, 1.024, -4.5993)
+
+# PROJ's NZMG coefficients
+NZMG_BF = np.array([
+    0.7557853228 + 0.0j,
+    0.249204646 + 0.003371507j,
+    -0.001541739 + 0.041058560j,
+    -0.10162907 + 0.01727609j,
+    -0.26623489 - 0.36249218j,
+    -0.6870983 - 1.1651967j,
+])
+NZMG_TPHI = np.array([1.5627014243, 0.5185406398, -0.03333098, -0.1052906, -0.0368594, 0.007317,
+                      0.01220, 0.00394, -0.0013])
+NZMG_ITERATIONS = 20
+NZMG_EPSILON = 1e-10
+SEC5_TO_RAD = 0.4848136811095359935899141023    # 10^5 arc seconds in radians
+
+# WGS84
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+
+ARCSEC_TO_RAD = np.pi / (180 * 3600)
+
+# Vincenty's inverse converges in a handful of iterations for anything but near-antipodal points
+VINCENTY_ITERATIONS = 50
+VINCENTY_EPSILON = 1e-12
+
+
+def _kruger_beta(n):
+# -----------------------------------------------------------------------------------------------------------------
+    """Inverse transverse Mercator series coefficients beta_1..beta_6 (Karney 2011, eq. 36)."""
+    n2, n3, n4, n5, n6 = n ** 2, n ** 3, n ** 4, n ** 5, n ** 6
+    return np.array([
+        n / 2 - 2 * n2 / 3 + 37 * n3 / 96 - n4 / 360 - 81 * n5 / 512 + 96199 * n6 / 604800,
+        n2 / 48 + n3 / 15 - 437 * n4 / 1440 + 46 * n5 / 105 - 1118711 * n6 / 3870720,
+        17 * n3 / 480 - 37 * n4 / 840 - 209 * n5 / 4480 + 5569 * n6 / 90720,
+        4397 * n4 / 161280 - 11 * n5 / 504 - 830251 * n6 / 7257600,
+        4583 * n5 / 161280 - 108847 * n6 / 3991680,
+        20648693 * n6 / 638668800,
+    ])
+
+
+_GRS80_N = GRS80_F / (2 - GRS80_F)
+_GRS80_E = np.sqrt(GRS80_F * (2 - GRS80_F))
+_GRS80_RECTIFYING_RADIUS = GRS80_A / (1 + _GRS80_N) * (1 + _GRS80_N ** 2 / 4 + _GRS80_N ** 4 / 64 + _GRS80_N ** 6 / 256)
+_GRS80_BETA = _kruger_beta(_GRS80_N)
+
+
+def _wrap_longitude(longitude):
+# -----------------------------------------------------------------------------------------------------------------
+    # Into [-180, 180) degrees, as PROJ does - the Chathams side of NZTM crosses the antimeridian
+    return (longitude + 180.0) % 360.0 - 180.0
+
+
+def _as_arrays(easting, northing):
+# -----------------------------------------------------------------------------------------------------------------
+    easting = np.asarray(easting, dtype=np.float64)
+    northing = np.asarray(northing, dtype=np.float64)
+    if easting.shape != northing.shape:
+        raise ValueError('easting and northing must be the same shape')
+    return easting, northing
+
+
+def _latitude_from_conformal(tau_prime, e):
+# -----------------------------------------------------------------------------------------------------------------
+    """Geodetic from conformal latitude, both as tangents (Karney 2011, eqs. 19-21, Newton's method)."""
+    e2m = 1 - e * e
+    tau = tau_prime / e2m
+    for _ in range(5):
+        tau1 = np.hypot(1.0, tau)
+        sigma = np.sinh(e * np.arctanh(e * tau / tau1))
+        tau_prime_i = tau * np.hypot(1.0, sigma) - sigma * tau1
+        tau = tau + (tau_prime - tau_prime_i) / np.hypot(1.0, tau_prime_i) * (1 + e2m * tau * tau) / (e2m * tau1)
+    return tau
+
+
+def nztm_to_wgs84(easting, northing):
+# -----------------------------------------------------------------------------------------------------------------
+    """NZTM2000 (EPSG:2193) easting/northing arrays in metres -> (latitude, longitude) arrays in degrees."""
+    easting, northing = _as_arrays(easting, northing)
+    scale = NZTM_K0 * _GRS80_RECTIFYING_RADIUS
+    xi = (northing - NZTM_FALSE_NORTHING) / scale
+    eta = (easting - NZTM_FALSE_EASTING) / scale
+
+    xi_prime = xi.copy()
+    eta_prime = eta.copy()
+    for j, beta in enumerate(_GRS80_BETA, start=1):
+        xi_prime -= beta * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+        eta_prime -= beta * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+
+    # Conformal latitude, as a tangent, then geodetic latitude
+    tau_prime = np.sin(xi_prime) / np.hypot(np.sinh(eta_prime), np.cos(xi_prime))
+    latitude = np.arctan(_latitude_from_conformal(tau_prime, _GRS80_E))
+    longitude = NZTM_LON0 + np.arctan2(np.sinh(eta_prime), np.cos(xi_prime))
+    return np.degrees(latitude), _wrap_longitude(np.degrees(longitude))
+
+
+def _nzmg_to_nzgd49(easting, northing):
+# -----------------------------------------------------------------------------------------------------------------
+    """Inverse NZMG to NZGD49 (latitude, longitude) in radians, as PROJ's nzmg does it."""
+    target = ((northing - NZMG_FALSE_NORTHING) + 1j * (easting - NZMG_FALSE_EASTING)) / INTL_A
+    powers = np.arange(1, len(NZMG_BF) + 1)
+
+    z = target.copy()
+    active = np.ones(z.shape, dtype=bool)
+    for _ in range(NZMG_ITERATIONS):
+        if not active.any():
+            break
+        za = z[active]
+        # f(z) = sum bf[k] z^(k+1), f'(z) = sum (k+1) bf[k] z^k
+        zp = za[..., np.newaxis] ** (powers - 1)
+        f = (zp * za[..., np.newaxis]) @ NZMG_BF - target[active]
+        fp = zp @ (NZMG_BF * powers)
+        dz = -f / fp
+        z[active] = za + dz
+        still = np.abs(dz.real) + np.abs(dz.imag) > NZMG_EPSILON
+        active[np.flatnonzero(active)[~still]] = False
+
+    if active.any():
+        # PROJ gives up on these too (HUGE_VAL); make them obviously unusable
+        z[active] = np.nan
+
+    psi = z.real
+    latitude = NZMG_LAT0 + psi * np.polyval(NZMG_TPHI[::-1], psi) * SEC5_TO_RAD
+    longitude = NZMG_LON0 + z.imag
+    return latitude, longitude
+
+
+def _geodetic_to_geocentric(latitude, longitude, a, f):
+# -----------------------------------------------------------------------------------------------------------------
+    e2 = f * (2 - f)
+    sin_lat = np.sin(latitude)
+    n = a / np.sqrt(1 - e2 * sin_lat * sin_lat)
+    return (n * np.cos(latitude) * np.cos(longitude), n * np.cos(latitude) * np.sin(longitude),
+            n * (1 - e2) * sin_lat)
+
+
+def _geocentric_to_geodetic(x, y, z, a, f):
+# -----------------------------------------------------------------------------------------------------------------
+    # Bowring's closed form, as PROJ's cart
+    b = a * (1 - f)
+    e2 = f * (2 - f)
+    e2s = e2 / (1 - e2)
+    p = np.hypot(x, y)
+    theta = np.arctan2(z * a, p * b)
+    c = np.cos(theta)
+    s = np.sin(theta)
+    return np.arctan2(z + e2s * b * s ** 3, p - e2 * a * c ** 3), np.arctan2(y, x)
+
+
+def _helmert_position_vector(x, y, z, params):
+# -----------------------------------------------------------------------------------------------------------------
+    tx, ty, tz, rx, ry, rz, ppm = params
+    rx, ry, rz = rx * ARCSEC_TO_RAD, ry * ARCSEC_TO_RAD, rz * ARCSEC_TO_RAD
+    m = 1 + ppm * 1e-6
+    return (m * (x - rz * y + ry * z) + tx,
+            m * (rz * x + y - rx * z) + ty,
+            m * (-ry * x + rx * y + z) + tz)
+
+
+def nzmg_to_wgs84(easting, northing):
+# -----------------------------------------------------------------------------------------------------------------
+    """NZMG (EPSG:27200) easting/northing arrays in metres -> (latitude, longitude) arrays in degrees."""
+    easting, northing = _as_arrays(easting, northing)
+    latitude, longitude = _nzmg_to_nzgd49(easting, northing)
+    x, y, z = _geodetic_to_geocentric(latitude, longitude, INTL_A, INTL_F)
+    x, y, z = _helmert_position_vector(x, y, z, NZMG_TOWGS84)
+    latitude, longitude = _geocentric_to_geodetic(x, y, z, WGS84_A, WGS84_F)
+    return np.degrees(latitude), _wrap_longitude(np.degrees(longitude))
+
+
+CONVERTERS = {
+    NZTM_SRID: nztm_to_wgs84,
+    NZMG_SRID: nzmg_to_wgs84,
+}
+
+# enum_event_user_coordinate_system
+COORDINATE_SYSTEM_SRIDS = {
+    'NZTM': NZTM_SRID,
+    'NZMG': NZMG_SRID,
+}
+
+
+def to_wgs84(srid, easting, northing):
+# -----------------------------------------------------------------------------------------------------------------
+    try:
+        converter = CONVERTERS[srid]
+    except KeyError:
+        raise ValueError('Unsupported SRID: {0} (one of {1})'.format(srid, ', '.join(map(str, sorted(CONVERTERS)))))
+    return converter(easting, northing)
+
+
+def user_coordinates_to_wgs84(coordinate_systems, easting, northing):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    Rows of an upload, each in its own user_coordinate_system: NZTM and NZMG rows are converted
+    (one vectorised pass per system), WGS84 rows are taken as easting=longitude,
+    northing=latitude, and anything else (including no coordinates) comes back as NaN.
+    """
+    easting, northing = _as_arrays(easting, northing)
+    systems = np.asarray(coordinate_systems, dtype=object)
+    latitude = np.full(easting.shape, np.nan)
+    longitude = np.full(easting.shape, np.nan)
+
+    wgs84 = systems == 'WGS84'
+    latitude[wgs84] = northing[wgs84]
+    longitude[wgs84] = easting[wgs84]
+    for system, srid in COORDINATE_SYSTEM_SRIDS.items():
+        rows = (systems == system) & np.isfinite(easting) & np.isfinite(northing)
+        if rows.any():
+            latitude[rows], longitude[rows] = to_wgs84(srid, easting[rows], northing[rows])
+    return latitude, longitude
+
+
+def error_metres(latitude, longitude, expected_latitude, expected_longitude):
+# -----------------------------------------------------------------------------------------------------------------
+    """Approximate ground distance between two sets of WGS84 points (fine at the millimetre scale)."""
+    lat = np.radians(np.asarray(expected_latitude, dtype=np.float64))
+    d_lat = np.radians(np.asarray(latitude, dtype=np.float64)) - lat
+    d_lon = np.radians(np.asarray(longitude, dtype=np.float64) - np.asarray(expected_longitude, dtype=np.float64))
+    return WGS84_A * np.hypot(d_lat, d_lon * np.cos(lat))
+
+
+def geodesic_distance(latitude1, longitude1, latitude2, longitude2, a=WGS84_A, f=WGS84_F):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    Distance in metres along the spheroid between two sets of points in degrees (Vincenty's
+    inverse formula, vectorised). NaN wherever either point is missing; near-antipodal pairs,
+    which never converge, are left at the last iteration.
+    """
+    b = a * (1 - f)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        phi1 = np.radians(np.asarray(latitude1, dtype=np.float64))
+        phi2 = np.radians(np.asarray(latitude2, dtype=np.float64))
+        big_l = np.radians(np.asarray(longitude2, dtype=np.float64) - np.asarray(longitude1, dtype=np.float64))
+        u1 = np.arctan((1 - f) * np.tan(phi1))
+        u2 = np.arctan((1 - f) * np.tan(phi2))
+        sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+        sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+
+        lam = big_l.copy()
+        for _ in range(VINCENTY_ITERATIONS):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha * sin_alpha
+            # Both points on the equator: cos^2(alpha) is 0 and the term drops out
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha)
+            c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            previous = lam
+            lam = big_l + (1 - c) * f * sin_alpha * (
+                sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m * cos_2sigma_m)))
+            if not (np.abs(lam - previous) > VINCENTY_EPSILON).any():
+                break
+
+        u_sq = cos2_alpha * (a * a - b * b) / (b * b)
+        big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+        big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+        delta_sigma = big_b * sin_sigma * (cos_2sigma_m + big_b / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m * cos_2sigma_m) -
+            big_b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma * sin_sigma) * (-3 + 4 * cos_2sigma_m * cos_2sigma_m)))
+        return b * big_a * (sigma - delta_sigma)
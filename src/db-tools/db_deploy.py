@@ -0,0 +1,715 @@
+# Checksum-driven deploy of the sql/ scripts.
+#
+# Deploying used to mean running 1_create_prereqs.sql .. 5_create_views.sql in full, which drops
+# and rebuilds every materialized view (advanced_search_events and the search_events_sort_*
+# views included) and builds every index one after another, holding locks all the while, even
+# when one function changed. This splits the scripts into objects instead - each CREATE, with
+# the DROPs in front of it - and hashes each object's definition. A statement that isn't a
+# CREATE belongs to the object it names (ALTER TABLE x, DELETE FROM incremental_refresh_watermark
+# WHERE name = 'x') and runs where it appears in the script; one that names nothing the scripts
+# define goes with its script's 'setup', and one that names nothing at all with the CREATE before
+# it. Checksums of what was deployed are kept in schema_object_checksum, so a deploy only runs the
+# objects that are missing or whose definition changed, plus:
+#
+#   - the views / materialized views that depend on them in the database (found through
+#     pg_depend, since DROP without CASCADE fails on them and CREATE OR REPLACE can't change
+#     a view's columns), which are dropped up front, dependents first, and recreated in order
+#   - the indexes and triggers on any relation that's rebuilt, and anything the rebuilt
+#     objects' DROPs take with them
+#   - each script's GRANTs, whenever anything at all was created (they're ON ALL TABLES)
+#
+# Everything but the indexes runs in one transaction, so a failure leaves the database as it
+# was. It is not invisible to readers, though: the views and materialized views being rebuilt
+# are dropped at the start of it, and DROP takes an ACCESS EXCLUSIVE lock, so anything reading
+# them (advanced_search_events included, when it's rebuilt) blocks until the transaction commits,
+# i.e. for the whole definitions phase. Indexes are then built on --workers connections:
+# CONCURRENTLY on relations that were already there (and so are in use), plainly on the ones
+# just created.
+#
+# Tables and types hold data, so a changed one (a new ALTER TABLE attached to it included) is
+# reported as HoldsData and the deploy refused unless --allow-destructive. What rebuilding one
+# then does depends on its script: if the script DROPs it (DROP TABLE ... CASCADE) it is recreated
+# empty, and since the CASCADE also drops the foreign keys that point at it, so are the tables
+# that reference it (found through pg_constraint; one the scripts don't define stops the deploy as
+# ForeignKeyDependents). If the script only has CREATE TABLE IF NOT EXISTS, the CREATE is a no-op:
+# the rows stay, the statements attached to it rerun, and changes to its columns are not applied -
+# those need an ALTER TABLE of their own. A view that something outside the scripts depends on
+# also stops the deploy.
+#
+# Statements that only make sense on Aurora (roles, aws_s3, ...) are skipped where the database
+# rejects them, as in bench/synthetic_data.py.
+#
+# A database that was deployed the old way has no checksums yet: --baseline records the current
+# scripts' checksums for every object that exists (i.e. trusts that they match) without running
+# anything. --dry-run doesn't change the database at all, schema_object_checksum included.
+#
+# Usage (from src/db-tools):
+#   python3 db_deploy.py [--dsn "host=localhost dbname=birdbanding"] [--workers 4] [--dry-run]
+#                        [--baseline] [--allow-destructive] [--sql-dir ../../sql]
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import re
+import time
+
+import psycopg2
+
+from db_pool import ConnectionPool
+from db_sql import ENVIRONMENT_SPECIFIC, SCHEMA_SCRIPTS, SQL_DIR, split_statements, strip_comments
+
+INDEX_WORKERS = 4
+MAINTENANCE_WORK_MEM = '512MB'
+
+CHECKSUM_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS schema_object_checksum (
+        object_key      text PRIMARY KEY,
+        checksum        text NOT NULL,
+        script          text NOT NULL,
+        deployed_at     timestamp with time zone NOT NULL DEFAULT now(),
+        duration_ms     numeric
+    )
+'''
+
+RECORD_CHECKSUM_SQL = '''
+    INSERT INTO schema_object_checksum (object_key, checksum, script, deployed_at, duration_ms)
+    VALUES (%s, %s, %s, now(), %s)
+    ON CONFLICT (object_key) DO UPDATE
+    SET checksum = EXCLUDED.checksum, script = EXCLUDED.script, deployed_at = EXCLUDED.deployed_at,
+        duration_ms = EXCLUDED.duration_ms
+'''
+
+# Actions
+SKIP = 'Skip'
+CREATE = 'Create'
+REBUILD = 'Rebuild'
+BASELINE = 'Baseline'
+BLOCKED = 'Blocked'
+
+# What rebuilding a table / type does to it (reported with a HoldsData problem)
+DROP_AND_RECREATE = 'DropAndRecreate'       # Its script DROPs it first: recreated empty
+RERUN_STATEMENTS = 'RerunStatements'        # Only CREATE ... IF NOT EXISTS: rows kept, what's attached to it reruns
+
+# Everything else is just its definition and can be dropped and recreated; these hold data
+STATEFUL_KINDS = ('table', 'type')
+RELATION_KINDS = ('table', 'view', 'materialized view')
+
+_NAME = r'(?P<name>"[^"]+"|[\w.$]+)'
+_OWNER = r'(?P<owner>"[^"]+"|[\w.$]+)'
+
+CREATE_PATTERNS = [(kind, re.compile(pattern, re.IGNORECASE | re.DOTALL)) for kind, pattern in [
+    ('index', r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:CONCURRENTLY\s+)?(?:IF\s+NOT\s+EXISTS\s+)?' + _NAME +
+              r'\s+ON\s+(?:ONLY\s+)?' + _OWNER),
+    ('materialized view', r'CREATE\s+MATERIALIZED\s+VIEW\s+(?:IF\s+NOT\s+EXISTS\s+)?' + _NAME),
+    ('view', r'CREATE\s+(?:OR\s+REPLACE\s+)?(?:TEMP(?:ORARY)?\s+)?(?:RECURSIVE\s+)?VIEW\s+' + _NAME),
+    ('table', r'CREATE\s+(?:UNLOGGED\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?' + _NAME),
+    ('function', r'CREATE\s+(?:OR\s+REPLACE\s+)?(?:FUNCTION|PROCEDURE)\s+' + _NAME + r'\s*(?P<args>\(.*)'),
+    ('aggregate', r'CREATE\s+(?:OR\s+REPLACE\s+)?AGGREGATE\s+' + _NAME + r'\s*(?P<args>\(.*)'),
+    ('trigger', r'CREATE\s+(?:OR\s+REPLACE\s+)?(?:CONSTRAINT\s+)?TRIGGER\s+' + _NAME + r'\s.*?\bON\s+' + _OWNER),
+    ('type', r'CREATE\s+TYPE\s+' + _NAME),
+    ('extension', r'CREATE\s+EXTENSION\s+(?:IF\s+NOT\s+EXISTS\s+)?' + _NAME),
+    ('role', r'CREATE\s+(?:USER|ROLE)\s+' + _NAME),
+]]
+
+DROP_PATTERN = re.compile(r'DROP\s+(?P<kind>MATERIALIZED\s+VIEW|VIEW|TABLE|FUNCTION|PROCEDURE|AGGREGATE|TYPE|'
+                          r'TRIGGER|INDEX)\s+(?:CONCURRENTLY\s+)?(?:IF\s+EXISTS\s+)?' + _NAME +
+                          r'(?:\s+ON\s+' + _OWNER + r')?', re.IGNORECASE | re.DOTALL)
+
+GRANT_PATTERN = re.compile(r'(GRANT|REVOKE)\b', re.IGNORECASE)
+
+# What a statement that isn't a CREATE / DROP names: the object it alters or writes to, or the
+# table a registry row (incremental_refresh_watermark's) is about
+ALTER_PATTERN = re.compile(r'ALTER\s+(?P<kind>TABLE|MATERIALIZED\s+VIEW|VIEW|INDEX|SCHEMA|TYPE)\s+'
+                           r'(?:IF\s+EXISTS\s+)?(?:ONLY\s+)?' + _NAME, re.IGNORECASE | re.DOTALL)
+DML_PATTERN = re.compile(r'(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM|TRUNCATE(?:\s+TABLE)?)\s+(?:ONLY\s+)?' + _NAME,
+                         re.IGNORECASE | re.DOTALL)
+NAMED_ROW_PATTERN = re.compile(r"\bWHERE\s+name\s*=\s*'(?P<name>[^']+)'", re.IGNORECASE)
+
+CREATE_INDEX_PREFIX = re.compile(r'^(\s*CREATE\s+(?:UNIQUE\s+)?INDEX)\s+(?!CONCURRENTLY\b)', re.IGNORECASE)
+
+
+class DeployError(Exception):
+# -----------------------------------------------------------------------------------------------------------------
+    pass
+
+
+class SqlObject(object):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    One object defined by the scripts. It may be defined more than once (a later script
+    redefining a view), in which case every definition is part of it and runs, in order.
+    Each definition is (prelude, statements): the DROPs before its CREATE, then the CREATE
+    and whatever follows it up to the next object.
+    """
+
+    def __init__(self, key, kind, name, owner=None):
+        self.key = key
+        self.kind = kind
+        self.name = name
+        self.owner = owner
+        self.definitions = []
+        self.script = None
+
+    def add_definition(self, script, prelude, statements):
+        self.script = script
+        self.definitions.append((prelude, statements))
+
+    @property
+    def checksum(self):
+        # The preludes are left out: they drop what has to make way, which isn't part of the definition
+        digest = hashlib.sha256()
+        for _, statements in self.definitions:
+            for _, statement in statements:
+                digest.update(normalise(statement).encode('utf-8'))
+                digest.update(b';')
+        return digest.hexdigest()
+
+    def drops_itself(self):
+        """Whether rebuilding this runs a DROP of it (a table that's only CREATE ... IF NOT EXISTS keeps its rows)."""
+        return any(kind == self.kind and name == self.name for kind, name, _ in self.drop_targets())
+
+    def drop_targets(self):
+        """(kind, name, owner) of everything the preludes drop."""
+        targets = []
+        for prelude, _ in self.definitions:
+            for _, statement in prelude:
+                match = DROP_PATTERN.match(normalise(statement))
+                if match:
+                    targets.append((' '.join(match.group('kind').lower().split()), identifier(match.group('name')),
+                                    identifier(match.group('owner')) if match.group('owner') else None))
+        return targets
+
+
+def normalise(statement):
+# -----------------------------------------------------------------------------------------------------------------
+    """The statement without comments, with runs of whitespace collapsed (inside bodies too, which is harmless for a hash)."""
+    return ' '.join(strip_comments(statement).split())
+
+
+def identifier(name):
+# -----------------------------------------------------------------------------------------------------------------
+    name = name.strip().strip('"')
+    if name.lower().startswith('public.'):
+        name = name[len('public.'):]
+    return name.strip('"') if '"' in name else name.lower()
+
+
+def _arguments(text):
+# -----------------------------------------------------------------------------------------------------------------
+    # The balanced (...) at the start of text, normalised - functions are keyed on their arguments
+    depth = 0
+    for i, c in enumerate(text):
+        depth += {'(': 1, ')': -1}.get(c, 0)
+        if depth == 0:
+            return ' '.join(text[:i + 1].lower().split())
+    return ' '.join(text.lower().split())
+
+
+def object_key(kind, name, owner=None, args=None):
+# -----------------------------------------------------------------------------------------------------------------
+    if kind in ('function', 'aggregate'):
+        return '{0}:{1}{2}'.format(kind, name, args or '()')
+    if kind == 'trigger':
+        return '{0}:{1} on {2}'.format(kind, name, owner)
+    return '{0}:{1}'.format(kind, name)
+
+
+def classify(statement):
+# -----------------------------------------------------------------------------------------------------------------
+    """('create', SqlObject prototype) / ('drop', None) / ('grant', None) / ('other', None)"""
+    code = normalise(statement)
+    for kind, pattern in CREATE_PATTERNS:
+        match = pattern.match(code)
+        if match:
+            name = identifier(match.group('name'))
+            groups = match.groupdict()
+            owner = identifier(groups['owner']) if groups.get('owner') else None
+            args = _arguments(groups['args']) if groups.get('args') else None
+            return 'create', SqlObject(object_key(kind, name, owner, args), kind, name, owner)
+    if DROP_PATTERN.match(code):
+        return 'drop', None
+    if GRANT_PATTERN.match(code):
+        return 'grant', None
+    return 'other', None
+
+
+def statement_target(statement):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    (kind, name) of what a statement other than a CREATE / DROP names, kind being 'relation' for
+    a table, view or materialized view, or None when it names nothing (a SELECT, say).
+    """
+    code = normalise(statement)
+    match = ALTER_PATTERN.match(code)
+    if match:
+        kind = ' '.join(match.group('kind').lower().split())
+        return ('relation' if kind in RELATION_KINDS else kind), identifier(match.group('name'))
+    match = DML_PATTERN.match(code)
+    if match:
+        named = NAMED_ROW_PATTERN.search(code)
+        return 'relation', identifier(named.group('name') if named else match.group('name'))
+    return None
+
+
+def resolve_target(target, objects):
+# -----------------------------------------------------------------------------------------------------------------
+    """The key of the object the scripts define for a statement_target(), or None if they don't define it."""
+    kind, name = target
+    if kind == 'relation':
+        keys = [object_key(k, name) for k in RELATION_KINDS]
+    elif kind in ('index', 'type'):
+        keys = [object_key(kind, name)]
+    else:
+        keys = []
+    return next((key for key in keys if key in objects), None)
+
+
+def parse_scripts(sql_dir=SQL_DIR, scripts=SCHEMA_SCRIPTS):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    Returns (objects, order): objects is key -> SqlObject, order is [(object key, definition index)]
+    in the order the definitions run. A statement naming an object the scripts define (see
+    statement_target) is another definition of that object, in its place in the script. Each
+    script's GRANT / REVOKE statements are collected into a 'grants:<script>' object that runs at
+    the end of the script, and the statements that belong to no object (anything before the
+    script's first CREATE, or naming something it doesn't define, like spatial_ref_sys) into
+    'setup:<script>'.
+    """
+    objects = {}
+    order = []
+
+    def add(obj, script, prelude, statements):
+        existing = objects.setdefault(obj.key, obj)
+        existing.add_definition(script, prelude, statements)
+        order.append((existing.key, len(existing.definitions) - 1))
+        return existing
+
+    for script in scripts:
+        with open(os.path.join(sql_dir, script)) as f:
+            statements = split_statements(f.read())
+
+        setup = SqlObject('setup:' + script, 'setup', script)
+        grants, pending_drops = [], []
+        current = None          # The object whose CREATE came last
+        for line_number, statement in statements:
+            category, obj = classify(statement)
+            if category == 'grant':
+                grants.append((line_number, statement))
+            elif category == 'drop' or (category == 'other' and pending_drops):
+                # Anything between DROPs and the next CREATE goes with the DROPs, in front of it
+                pending_drops.append((line_number, statement))
+            elif category == 'create':
+                current = add(obj, script, pending_drops, [(line_number, statement)])
+                pending_drops = []
+            else:
+                target = statement_target(statement)
+                if target is None and current is not None:
+                    # Indexes are built apart from everything else, so what follows one goes with its relation
+                    key = current.key if current.kind != 'index' else resolve_target(('relation', current.owner), objects)
+                else:
+                    key = resolve_target(target, objects) if target is not None else None
+                if key is None:
+                    add(setup, script, [], [(line_number, statement)])
+                elif current is not None and key == current.key:
+                    current.definitions[-1][1].append((line_number, statement))
+                else:
+                    add(objects[key], script, [], [(line_number, statement)])
+
+        if pending_drops:
+            add(SqlObject('cleanup:' + script, 'cleanup', script), script, [], pending_drops)
+        if grants:
+            add(SqlObject('grants:' + script, 'grants', script), script, [], grants)
+
+    check_attachments(objects)
+    return objects, order
+
+
+def check_attachments(objects):
+# -----------------------------------------------------------------------------------------------------------------
+    """Raises DeployError for a statement that names a different object than the one it runs as part of."""
+    misplaced = []
+    for obj in objects.values():
+        for prelude, statements in obj.definitions:
+            trailing = statements[1:] if classify(statements[0][1])[0] == 'create' else statements
+            if obj.kind == 'index' and trailing:
+                misplaced.extend((obj.key, line_number, 'runs in the index workers') for line_number, _ in trailing)
+                continue
+            for line_number, statement in trailing:
+                target = statement_target(statement)
+                if target is None:
+                    continue
+                key = resolve_target(target, objects)
+                if obj.kind in ('setup', 'cleanup', 'grants') and key is None:
+                    continue
+                if key != obj.key:
+                    misplaced.append((obj.key, line_number, 'names ' + (key or '{0} {1}'.format(*target))))
+    if misplaced:
+        raise DeployError('Statements attached to the wrong object: ' + ', '.join(
+            '{0} line {1} ({2})'.format(*m) for m in misplaced))
+
+
+class Catalog(object):
+# -----------------------------------------------------------------------------------------------------------------
+    """What exists in the database's public schema, and which views depend on what."""
+
+    def __init__(self, cur):
+        cur.execute('''
+            SELECT c.relname, c.relkind::text, coalesce(i.indisvalid, TRUE)
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            LEFT JOIN pg_index i ON i.indexrelid = c.oid
+            WHERE n.nspname = 'public' ''')
+        self.relations = dict((name, (kind, valid)) for name, kind, valid in cur.fetchall())
+        cur.execute('''
+            SELECT p.proname FROM pg_proc p JOIN pg_namespace n ON n.oid = p.pronamespace WHERE n.nspname = 'public' ''')
+        self.functions = set(row[0] for row in cur.fetchall())
+        cur.execute('''
+            SELECT t.typname FROM pg_type t JOIN pg_namespace n ON n.oid = t.typnamespace
+            WHERE n.nspname = 'public' AND t.typtype IN ('e', 'c', 'd', 'b', 'r') ''')
+        self.types = set(row[0] for row in cur.fetchall())
+        cur.execute('SELECT t.tgname, c.relname FROM pg_trigger t JOIN pg_class c ON c.oid = t.tgrelid WHERE NOT t.tgisinternal')
+        self.triggers = set(cur.fetchall())
+        cur.execute('SELECT extname FROM pg_extension')
+        self.extensions = set(row[0] for row in cur.fetchall())
+        cur.execute('SELECT rolname FROM pg_roles')
+        self.roles = set(row[0] for row in cur.fetchall())
+
+        # Views / materialized views, and the relations and functions their rules reference
+        cur.execute('''
+            SELECT DISTINCT dependent.relname, referenced.relname
+            FROM pg_depend d
+            JOIN pg_rewrite r ON r.oid = d.objid
+            JOIN pg_class dependent ON dependent.oid = r.ev_class
+            JOIN pg_class referenced ON referenced.oid = d.refobjid
+            JOIN pg_namespace n ON n.oid = dependent.relnamespace
+            WHERE d.classid = 'pg_rewrite'::regclass AND d.refclassid = 'pg_class'::regclass
+              AND dependent.oid <> referenced.oid AND n.nspname = 'public'
+            UNION
+            SELECT DISTINCT dependent.relname, p.proname
+            FROM pg_depend d
+            JOIN pg_rewrite r ON r.oid = d.objid
+            JOIN pg_class dependent ON dependent.oid = r.ev_class
+            JOIN pg_proc p ON p.oid = d.refobjid
+            JOIN pg_namespace n ON n.oid = dependent.relnamespace
+            WHERE d.classid = 'pg_rewrite'::regclass AND d.refclassid = 'pg_proc'::regclass AND n.nspname = 'public' ''')
+        self.dependents = {}
+        for dependent, referenced in cur.fetchall():
+            self.dependents.setdefault(referenced, set()).add(dependent)
+
+        # Tables with foreign keys to another table, which DROP TABLE ... CASCADE drops along with it
+        cur.execute('''
+            SELECT DISTINCT referencing.relname, referenced.relname
+            FROM pg_constraint con
+            JOIN pg_class referencing ON referencing.oid = con.conrelid
+            JOIN pg_class referenced ON referenced.oid = con.confrelid
+            JOIN pg_namespace n ON n.oid = referencing.relnamespace
+            WHERE con.contype = 'f' AND con.conrelid <> con.confrelid AND n.nspname = 'public' ''')
+        self.referencing = {}
+        for referencing, referenced in cur.fetchall():
+            self.referencing.setdefault(referenced, set()).add(referencing)
+
+    def exists(self, obj):
+        if obj.kind in ('table', 'view', 'materialized view', 'index'):
+            return obj.name in self.relations
+        if obj.kind in ('function', 'aggregate'):
+            return obj.name in self.functions
+        if obj.kind == 'type':
+            return obj.name in self.types
+        if obj.kind == 'trigger':
+            return (obj.name, obj.owner) in self.triggers
+        if obj.kind == 'extension':
+            return obj.name in self.extensions
+        if obj.kind == 'role':
+            return obj.name in self.roles
+        return False        # setup / cleanup / grants only have a checksum
+
+    def invalid_index(self, name):
+        kind, valid = self.relations.get(name, (None, True))
+        return kind == 'i' and not valid
+
+    def relkind(self, name):
+        return self.relations.get(name, (None, True))[0]
+
+
+def read_checksums(cur):
+# -----------------------------------------------------------------------------------------------------------------
+    # Nothing recorded yet if the table isn't there - it's created when there's something to record
+    cur.execute("SELECT to_regclass('schema_object_checksum') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return {}
+    cur.execute('SELECT object_key, checksum FROM schema_object_checksum')
+    return dict(cur.fetchall())
+
+
+class PlannedObject(object):
+# -----------------------------------------------------------------------------------------------------------------
+
+    def __init__(self, obj, action, reason):
+        self.obj = obj
+        self.action = action
+        self.reason = reason
+        self.existed = False
+        self.duration_ms = 0.0
+
+    def summary(self):
+        return {'Object': self.obj.key, 'Script': self.obj.script, 'Action': self.action, 'Reason': self.reason,
+                'DurationMs': round(self.duration_ms, 3)}
+
+
+def plan(objects, catalog, checksums, baseline=False, allow_destructive=False):
+# -----------------------------------------------------------------------------------------------------------------
+    """key -> PlannedObject, and the problems (blocked objects, unmanaged dependents) that stop the deploy."""
+    planned = {}
+    for key, obj in objects.items():
+        exists = catalog.exists(obj)
+        stored = checksums.get(key)
+        # setup / cleanup / grants have nothing to look for in the catalog, only their checksum
+        has_catalog_entry = obj.kind not in ('setup', 'cleanup', 'grants')
+        if stored == obj.checksum and (exists or not has_catalog_entry):
+            entry = PlannedObject(obj, SKIP, None)
+        elif has_catalog_entry and not exists:
+            entry = PlannedObject(obj, CREATE, 'Missing')
+        else:
+            entry = PlannedObject(obj, BASELINE if baseline else REBUILD, 'NotRecorded' if stored is None else 'Changed')
+        entry.existed = exists
+        planned[key] = entry
+
+    if baseline:
+        return planned, []
+
+    by_relation = dict((o.name, o.key) for o in objects.values() if o.kind in RELATION_KINDS)
+    by_function = {}
+    for o in objects.values():
+        if o.kind in ('function', 'aggregate'):
+            by_function.setdefault(o.name, []).append(o.key)
+    by_owner = {}
+    for o in objects.values():
+        if o.owner:
+            by_owner.setdefault(o.owner, []).append(o.key)
+
+    problems = []
+    queue = [key for key, entry in planned.items() if entry.action in (CREATE, REBUILD)]
+    while queue:
+        key = queue.pop()
+        obj = planned[key].obj
+        affected = []
+
+        if planned[key].action == REBUILD and obj.kind in RELATION_KINDS + ('function', 'aggregate'):
+            for dependent in sorted(catalog.dependents.get(obj.name, ())):
+                if dependent in by_relation:
+                    affected.append((by_relation[dependent], 'DependsOn ' + key))
+                else:
+                    problems.append({'Object': key, 'Problem': 'UnmanagedDependent', 'Dependent': dependent})
+        if planned[key].action == REBUILD and obj.kind == 'table' and obj.drops_itself():
+            # Their foreign keys go with the DROP ... CASCADE, and only recreating them puts the keys back
+            for referencing in sorted(catalog.referencing.get(obj.name, ())):
+                if referencing in by_relation:
+                    affected.append((by_relation[referencing], 'References ' + key))
+                else:
+                    problems.append({'Object': key, 'Problem': 'ForeignKeyDependents', 'Dependent': referencing})
+        if obj.kind in RELATION_KINDS:
+            affected.extend((owned, 'On ' + key) for owned in by_owner.get(obj.name, ()))
+        for kind, name, owner in obj.drop_targets():
+            if kind in ('function', 'procedure', 'aggregate'):
+                targets = by_function.get(name, [])
+            elif kind == 'trigger':
+                targets = [object_key(kind, name, owner)]
+            else:
+                targets = [object_key(kind, name)]
+            affected.extend((target, 'DroppedBy ' + key) for target in targets if target in planned and target != key)
+
+        for target, reason in affected:
+            entry = planned[target]
+            if entry.action == SKIP:
+                entry.action, entry.reason = (REBUILD if entry.existed else CREATE), reason
+                queue.append(target)
+
+    # Anything at all created means new relations to grant on
+    if any(e.action in (CREATE, REBUILD) for e in planned.values()):
+        for entry in planned.values():
+            if entry.obj.kind == 'grants' and entry.action == SKIP:
+                entry.action, entry.reason = REBUILD, 'NewObjects'
+
+    for entry in planned.values():
+        if entry.action == REBUILD and entry.obj.kind in STATEFUL_KINDS and not allow_destructive:
+            entry.action = BLOCKED
+            problems.append({'Object': entry.obj.key, 'Problem': 'HoldsData', 'Reason': entry.reason,
+                             'Effect': DROP_AND_RECREATE if entry.obj.drops_itself() else RERUN_STATEMENTS})
+
+    return planned, problems
+
+
+def drop_order(planned, catalog):
+# -----------------------------------------------------------------------------------------------------------------
+    """The existing views / materialized views being rebuilt, each after everything that depends on it."""
+    remaining = dict((e.obj.name, e) for e in planned.values()
+                     if e.action == REBUILD and e.existed and e.obj.kind in ('view', 'materialized view'))
+    ordered = []
+    while remaining:
+        ready = sorted(n for n in remaining if not (catalog.dependents.get(n, set()) & set(remaining)))
+        if not ready:
+            raise DeployError('Circular view dependencies between ' + ', '.join(sorted(remaining)))
+        ordered.extend(remaining.pop(n) for n in ready)
+    return ordered
+
+
+def execute_statement(cur, statement, skipped, script, line_number):
+# -----------------------------------------------------------------------------------------------------------------
+    """Runs statement, letting the environment specific ones fail (under a savepoint) into skipped."""
+    if not ENVIRONMENT_SPECIFIC.match(strip_comments(statement)):
+        cur.execute(statement)
+        return
+    cur.execute('SAVEPOINT deploy_statement')
+    try:
+        cur.execute(statement)
+    except psycopg2.Error as e:
+        cur.execute('ROLLBACK TO SAVEPOINT deploy_statement')
+        skipped.append({'Script': script, 'Line': line_number, 'Message': str(e).strip().splitlines()[0]})
+    cur.execute('RELEASE SAVEPOINT deploy_statement')
+
+
+def run_definitions(cur, order, planned, catalog, skipped):
+# -----------------------------------------------------------------------------------------------------------------
+    """Everything except the indexes, in script order, inside the caller's transaction."""
+    for entry in drop_order(planned, catalog):
+        started = time.perf_counter()
+        kind = 'MATERIALIZED VIEW' if catalog.relkind(entry.obj.name) == 'm' else 'VIEW'
+        cur.execute('DROP {0} IF EXISTS "{1}"'.format(kind, entry.obj.name))
+        entry.duration_ms += (time.perf_counter() - started) * 1000
+
+    for key, index in order:
+        entry = planned[key]
+        if entry.action not in (CREATE, REBUILD) or entry.obj.kind == 'index':
+            continue
+        prelude, statements = entry.obj.definitions[index]
+        started = time.perf_counter()
+        for line_number, statement in prelude + statements:
+            # CREATE USER / ROLE isn't IF NOT EXISTS - for an existing one only what follows it reruns
+            if entry.obj.kind == 'role' and entry.existed and (line_number, statement) == statements[0]:
+                continue
+            try:
+                execute_statement(cur, statement, skipped, entry.obj.script, line_number)
+            except psycopg2.Error as e:
+                raise DeployError('{0}:{1}: {2}: {3}'.format(entry.obj.script, line_number, key,
+                                                            str(e).strip().splitlines()[0]))
+        entry.duration_ms += (time.perf_counter() - started) * 1000
+
+
+def build_indexes(pool, planned, workers=INDEX_WORKERS):
+# -----------------------------------------------------------------------------------------------------------------
+    """(Re)builds the planned indexes on several connections, recording each checksum as it completes."""
+    fresh = set(e.obj.name for e in planned.values()
+                if e.action in (CREATE, REBUILD) and e.obj.kind in RELATION_KINDS)
+    entries = [e for e in planned.values() if e.obj.kind == 'index' and e.action in (CREATE, REBUILD)]
+
+    def build(entry):
+        obj = entry.obj
+        # Readers are using relations that were already there, so those don't get locked against writes
+        concurrently = obj.owner not in fresh
+        # Just the CREATE INDEX: check_attachments() keeps anything else out of an index's definition
+        statement = strip_comments(obj.definitions[-1][1][0][1]).strip()
+        if concurrently:
+            statement = CREATE_INDEX_PREFIX.sub(r'\1 CONCURRENTLY ', statement, count=1)
+        started = time.perf_counter()
+        with pool.cursor() as cur:
+            cur.execute('SET maintenance_work_mem = %s', (MAINTENANCE_WORK_MEM,))
+            # Also clears away what's left of a failed CONCURRENTLY build (an INVALID index IF NOT EXISTS would keep)
+            cur.execute('DROP INDEX {0}IF EXISTS "{1}"'.format('CONCURRENTLY ' if concurrently else '', obj.name))
+            cur.execute(statement)
+            entry.duration_ms = (time.perf_counter() - started) * 1000
+            cur.execute(RECORD_CHECKSUM_SQL, (obj.key, obj.checksum, obj.script, round(entry.duration_ms, 3)))
+        return entry
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='deploy-index') as executor:
+        futures = [(e, executor.submit(build, e)) for e in entries]
+    failures = []
+    for entry, future in futures:
+        try:
+            future.result()
+        except psycopg2.Error as e:
+            failures.append({'Object': entry.obj.key, 'Message': str(e).strip().splitlines()[0]})
+    return failures
+
+
+def deploy(pool, sql_dir=SQL_DIR, scripts=SCHEMA_SCRIPTS, workers=INDEX_WORKERS, dry_run=False, baseline=False,
+           allow_destructive=False):
+# -----------------------------------------------------------------------------------------------------------------
+    started = time.perf_counter()
+    objects, order = parse_scripts(sql_dir, scripts)
+    skipped, failures = [], []
+    definitions_ms = indexes_ms = 0.0
+
+    with pool.cursor(autocommit=False) as cur:
+        checksums = read_checksums(cur)
+        catalog = Catalog(cur)
+        planned, problems = plan(objects, catalog, checksums, baseline=baseline, allow_destructive=allow_destructive)
+
+        # Invalid leftovers of an interrupted CONCURRENTLY build count as missing
+        for entry in planned.values():
+            if entry.obj.kind == 'index' and entry.action == SKIP and catalog.invalid_index(entry.obj.name):
+                entry.action, entry.reason = REBUILD, 'Invalid'
+
+        deploying = not dry_run and not baseline and not problems
+        if deploying:
+            definitions_started = time.perf_counter()
+            run_definitions(cur, order, planned, catalog, skipped)
+            definitions_ms = (time.perf_counter() - definitions_started) * 1000
+        if deploying or (baseline and not dry_run):
+            cur.execute(CHECKSUM_TABLE_SQL)
+            for entry in planned.values():
+                if entry.action == BASELINE or (entry.action in (CREATE, REBUILD) and entry.obj.kind != 'index'):
+                    cur.execute(RECORD_CHECKSUM_SQL, (entry.obj.key, entry.obj.checksum, entry.obj.script,
+                                                      round(entry.duration_ms, 3) if entry.action != BASELINE else None))
+
+    if deploying:
+        indexes_started = time.perf_counter()
+        failures = build_indexes(pool, planned, workers)
+        indexes_ms = (time.perf_counter() - indexes_started) * 1000
+
+    counts = {}
+    for entry in planned.values():
+        counts[entry.action] = counts.get(entry.action, 0) + 1
+    return {
+        'DryRun': dry_run,
+        'Baseline': baseline,
+        'Deployed': deploying,
+        'Plan': counts,
+        'Problems': problems,
+        'Objects': [planned[key].summary() for key in objects if planned[key].action != SKIP],
+        'SkippedStatements': skipped,
+        'IndexFailures': failures,
+        'DefinitionsMs': round(definitions_ms, 3),
+        'IndexesMs': round(indexes_ms, 3),
+        'TotalMs': round((time.perf_counter() - started) * 1000, 3),
+    }
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default=None, help='libpq connection string (default: $BIRDBANDING_DB_DSN / PG* env vars)')
+    parser.add_argument('--sql-dir', default=SQL_DIR)
+    parser.add_argument('--scripts', nargs='+', default=SCHEMA_SCRIPTS)
+    parser.add_argument('--workers', type=int, default=INDEX_WORKERS, help='Connections building indexes')
+    parser.add_argument('--dry-run', action='store_true', help='Print the plan without changing anything')
+    parser.add_argument('--baseline', action='store_true',
+                        help='Record the checksums of the objects that exist, without running anything')
+    parser.add_argument('--allow-destructive', action='store_true',
+                        help='Rebuild changed tables and types anyway. One whose script DROPs it is dropped (CASCADE) '
+                             'and recreated empty, along with the tables that reference it; a CREATE ... IF NOT EXISTS '
+                             'one keeps its rows and only reruns the statements attached to it (e.g. ALTER TABLE), so '
+                             'changed columns in its CREATE are not applied'),
+    args = parser.parse_args()
+
+    with ConnectionPool(args.dsn, max_connections=max(1, args.workers)) as pool:
+        result = deploy(pool, args.sql_dir, args.scripts, workers=args.workers, dry_run=args.dry_run,
+                        baseline=args.baseline, allow_destructive=args.allow_destructive)
+
+    print(json.dumps(result, indent=2))
+    return 0 if not result['Problems'] and not result['IndexFailures'] else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
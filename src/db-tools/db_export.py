@@ -0,0 +1,319 @@
+# Parallel, chunked, resumable export of an environment's tables to CSV.
+#
+# rw_export_environment (sql/3_create_functions.sql) runs aws_s3.query_export_to_s3 for each of
+# 26 tables in turn, a single SELECT * each, and any error throws the whole backup away. This
+# streams each table with COPY ... TO STDOUT instead, several tables at once, and splits the big
+# tables (event, mark_state, characteristic_measurement, ...) into ranges of an indexed integer
+# key so they export in parallel too.
+#
+# Every chunk is written whole to the store (S3, or a local directory standing in for it) and
+# recorded in manifest.json with its row count and SHA-256. Re-running against the same export
+# directory picks up from the chunks that already finished. All chunks of one run read the same
+# exported snapshot, so a run that isn't resumed is a consistent point-in-time copy.
+#
+# Files are CSV with a header row, in the same csv_backups/<timestamp>/<table>.csv layout as
+# rw_export_environment; chunked tables are <table>.<nnnnn>.csv.
+#
+# Usage (from src/db-tools):
+#   python3 db_export.py --dest ./backups [--export-dir csv_backups/2021_01_01_00_00_00/]
+#                        [--workers 4] [--chunk-rows 250000] [--tables event mark_state ...]
+#   python3 db_export.py --dest s3://bucket/prefix ...
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import datetime
+import hashlib
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+
+from db_pool import ConnectionPool
+from db_storage import open_store
+
+EXPORT_TABLES = [
+    'bander', 'bander_certifications', 'bander_downloads', 'bander_uploads',
+    'bird', 'certification_media', 'characteristic', 'characteristic_measurement',
+    'cms_attachment', 'cms_content', 'event', 'event_media', 'mark', 'mark_allocation',
+    'mark_configuration', 'mark_state', 'project', 'project_bander_invitations',
+    'project_bander_membership', 'project_notices', 'public_event', 'public_event_media',
+    'spatial_ref_sys', 'species', 'species_group', 'species_group_membership',
+]
+
+EXPORT_WORKERS = 4
+
+# Tables estimated (pg_class.reltuples) at more rows than this are split into chunks of about this size
+CHUNK_ROWS = 250000
+
+# Tries per chunk before it's left for the next run to pick up
+CHUNK_ATTEMPTS = 2
+
+MANIFEST = 'manifest.json'
+MANIFEST_VERSION = 1
+
+COPY_OPTIONS = 'FORMAT csv, HEADER, FORCE_QUOTE *'
+
+DONE = 'Done'
+PENDING = 'Pending'
+FAILED = 'Failed'
+
+
+class HashingWriter(object):
+# -----------------------------------------------------------------------------------------------------------------
+    # What COPY ... TO STDOUT writes into: a temporary file, hashed and sized on the way through
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+        self.bytes = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.digest.update(data)
+        self.bytes += len(data)
+        self.f.write(data)
+
+
+def default_export_dir():
+# -----------------------------------------------------------------------------------------------------------------
+    # Same naming as rw_export_environment (NZ local time)
+    try:
+        import zoneinfo
+        now = datetime.datetime.now(zoneinfo.ZoneInfo('Pacific/Auckland'))
+    except Exception:
+        now = datetime.datetime.now()
+    return 'csv_backups/{0}/'.format(now.strftime('%Y_%m_%d_%H_%M_%S'))
+
+
+def quote_ident(name):
+# -----------------------------------------------------------------------------------------------------------------
+    return '"{0}"'.format(name.replace('"', '""'))
+
+
+def chunk_key(cur, table):
+# -----------------------------------------------------------------------------------------------------------------
+    # A NOT NULL integer column with a unique index of its own, so each key range is an index range scan
+    cur.execute('''
+        SELECT a.attname
+        FROM pg_index AS i
+        INNER JOIN pg_attribute AS a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+        WHERE i.indrelid = %s::regclass AND i.indisunique AND i.indnatts = 1 AND i.indpred IS NULL AND a.attnotnull
+          AND a.atttypid IN ('int2'::regtype, 'int4'::regtype, 'int8'::regtype)
+        ORDER BY i.indisprimary DESC, a.attname
+        LIMIT 1''', (table,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def plan_table(cur, table, chunk_rows):
+# -----------------------------------------------------------------------------------------------------------------
+    cur.execute('SELECT GREATEST(reltuples, 0)::bigint FROM pg_class WHERE oid = %s::regclass', (table,))
+    estimated_rows = cur.fetchone()[0]
+    cur.execute('''SELECT column_name FROM information_schema.columns
+                   WHERE table_schema = current_schema() AND table_name = %s ORDER BY ordinal_position''', (table,))
+    columns = [row[0] for row in cur.fetchall()]
+
+    key = chunk_key(cur, table) if estimated_rows > chunk_rows else None
+    ranges = [(None, None)]
+    if key:
+        cur.execute('SELECT MIN({0}), MAX({0}) FROM {1}'.format(quote_ident(key), quote_ident(table)))
+        low, high = cur.fetchone()
+        if low is not None:
+            count = int(math.ceil(estimated_rows / float(chunk_rows)))
+            step = max(1, int(math.ceil((high - low + 1) / float(count))))
+            bounds = list(range(low, high + 1, step))[1:]
+            # Open-ended at both ends, so rows outside [low, high] (e.g. added before a resume) aren't missed
+            ranges = list(zip([None] + bounds, bounds + [None]))
+
+    chunks = []
+    for index, (from_key, to_key) in enumerate(ranges):
+        name = '{0}.csv'.format(table) if len(ranges) == 1 else '{0}.{1:05d}.csv'.format(table, index + 1)
+        chunks.append({'File': name, 'From': from_key, 'To': to_key, 'Status': PENDING})
+
+    return {'EstimatedRows': estimated_rows, 'Columns': columns, 'ChunkKey': key if len(ranges) > 1 else None, 'Chunks': chunks}
+
+
+def chunk_query(table, table_plan, chunk):
+# -----------------------------------------------------------------------------------------------------------------
+    query = 'SELECT * FROM {0}'.format(quote_ident(table))
+    conditions = []
+    if table_plan['ChunkKey']:
+        key = quote_ident(table_plan['ChunkKey'])
+        if chunk['From'] is not None:
+            conditions.append('{0} >= {1:d}'.format(key, chunk['From']))
+        if chunk['To'] is not None:
+            conditions.append('{0} < {1:d}'.format(key, chunk['To']))
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    return query
+
+
+class Exporter(object):
+# -----------------------------------------------------------------------------------------------------------------
+
+    def __init__(self, pool, store, export_dir, workers=EXPORT_WORKERS, chunk_rows=CHUNK_ROWS):
+        self.pool = pool
+        self.store = store
+        self.export_dir = export_dir.rstrip('/') + '/'
+        self.workers = workers
+        self.chunk_rows = chunk_rows
+        self.manifest = None
+        self._lock = threading.Lock()
+
+    def key(self, name):
+        return self.export_dir + name
+
+    def load_manifest(self):
+        if not self.store.exists(self.key(MANIFEST)):
+            return None
+        return json.loads(self.store.get_bytes(self.key(MANIFEST)).decode('utf-8'))
+
+    def save_manifest(self):
+        # Callers hold self._lock
+        self.store.put_bytes(self.key(MANIFEST), json.dumps(self.manifest, indent=2, sort_keys=True).encode('utf-8'))
+
+    def plan(self, tables):
+        manifest = self.load_manifest()
+        if manifest is not None:
+            # Resuming: keep the existing chunk boundaries, just redo whatever didn't finish
+            # (or whose file has gone missing since)
+            for table_plan in manifest['Tables'].values():
+                for chunk in table_plan['Chunks']:
+                    if chunk['Status'] == DONE and not self.store.exists(self.key(chunk['File'])):
+                        chunk['Status'] = PENDING
+                    elif chunk['Status'] != DONE:
+                        chunk['Status'] = PENDING
+            self.manifest = manifest
+            return
+
+        with self.pool.cursor() as cur:
+            self.manifest = {
+                'Version': MANIFEST_VERSION,
+                'Format': 'csv',
+                'CopyOptions': COPY_OPTIONS,
+                'StartedAt': datetime.datetime.utcnow().isoformat() + 'Z',
+                'Snapshots': [],
+                'Tables': dict((table, plan_table(cur, table, self.chunk_rows)) for table in tables),
+            }
+        with self._lock:
+            self.save_manifest()
+
+    def run(self, tables=None):
+        started = time.perf_counter()
+        self.plan(tables or EXPORT_TABLES)
+
+        # Biggest tables first, so they aren't the long tail
+        work = []
+        for table, table_plan in sorted(self.manifest['Tables'].items(), key=lambda t: -t[1]['EstimatedRows']):
+            work.extend((table, chunk) for chunk in table_plan['Chunks'] if chunk['Status'] != DONE)
+
+        # Hold a snapshot open for the workers to share while they run
+        with self.pool.connection(autocommit=False) as snapshot_conn:
+            with snapshot_conn.cursor() as cur:
+                cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+                cur.execute('SELECT pg_export_snapshot()')
+                snapshot = cur.fetchone()[0]
+            with self._lock:
+                self.manifest['Snapshots'].append(snapshot)
+                self.save_manifest()
+
+            executor = ThreadPoolExecutor(max_workers=max(1, self.workers), thread_name_prefix='export')
+            try:
+                futures = [executor.submit(self.export_chunk, table, chunk, snapshot) for table, chunk in work]
+                for future in as_completed(futures):
+                    future.result()
+            finally:
+                executor.shutdown(wait=True)
+            snapshot_conn.rollback()
+
+        return self.summary(time.perf_counter() - started)
+
+    def export_chunk(self, table, chunk, snapshot):
+        table_plan = self.manifest['Tables'][table]
+        query = chunk_query(table, table_plan, chunk)
+        for attempt in range(CHUNK_ATTEMPTS):
+            started = time.perf_counter()
+            handle, filename = tempfile.mkstemp(suffix='.csv')
+            try:
+                with os.fdopen(handle, 'wb') as f:
+                    writer = HashingWriter(f)
+                    with self.pool.connection(autocommit=False) as conn:
+                        with conn.cursor() as cur:
+                            cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+                            cur.execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+                            cur.copy_expert('COPY ({0}) TO STDOUT WITH ({1})'.format(query, COPY_OPTIONS), writer)
+                            rows = cur.rowcount
+                            if rows is None or rows < 0:
+                                cur.execute('SELECT COUNT(*) FROM ({0}) AS chunk'.format(query))
+                                rows = cur.fetchone()[0]
+                        conn.rollback()
+                self.store.put_file(self.key(chunk['File']), filename)
+            except Exception as e:
+                with self._lock:
+                    chunk.update(Status=FAILED, Message=str(e).strip(), Attempts=attempt + 1)
+                    self.save_manifest()
+                continue
+            finally:
+                os.unlink(filename)
+
+            with self._lock:
+                chunk.update(Status=DONE, Rows=rows, Bytes=writer.bytes, Sha256=writer.digest.hexdigest(),
+                             Snapshot=snapshot, DurationMs=round((time.perf_counter() - started) * 1000, 3),
+                             Attempts=attempt + 1)
+                chunk.pop('Message', None)
+                self.save_manifest()
+            return
+
+    def summary(self, seconds):
+        with self._lock:
+            tables = {}
+            for table, table_plan in self.manifest['Tables'].items():
+                done = [c for c in table_plan['Chunks'] if c['Status'] == DONE]
+                table_plan['Rows'] = sum(c['Rows'] for c in done) if len(done) == len(table_plan['Chunks']) else None
+                tables[table] = {'Chunks': len(table_plan['Chunks']), 'Done': len(done), 'Rows': table_plan['Rows']}
+
+            failed = [{'Table': t, 'File': c['File'], 'Message': c.get('Message')}
+                      for t, p in self.manifest['Tables'].items() for c in p['Chunks'] if c['Status'] != DONE]
+            self.manifest['Complete'] = not failed
+            self.manifest['Consistent'] = not failed and len(set(
+                c['Snapshot'] for p in self.manifest['Tables'].values() for c in p['Chunks'])) == 1
+            if not failed:
+                self.manifest['FinishedAt'] = datetime.datetime.utcnow().isoformat() + 'Z'
+            self.save_manifest()
+
+            return {
+                'ExportDir': '{0}/{1}'.format(self.store, self.export_dir),
+                'Complete': self.manifest['Complete'],
+                'Consistent': self.manifest['Consistent'],
+                'Seconds': round(seconds, 3),
+                'Tables': tables,
+                'Failed': failed,
+            }
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default=None, help='libpq connection string (default: $BIRDBANDING_DB_DSN / PG* env vars)')
+    parser.add_argument('--dest', required=True, help='s3://bucket/prefix or a local directory')
+    parser.add_argument('--export-dir', default=None, help='Export to (or resume) this directory under --dest')
+    parser.add_argument('--workers', type=int, default=EXPORT_WORKERS)
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--tables', nargs='+', default=None)
+    args = parser.parse_args()
+
+    store = open_store(args.dest)
+    # One extra connection holds the shared snapshot
+    with ConnectionPool(args.dsn, max_connections=args.workers + 1) as pool:
+        exporter = Exporter(pool, store, args.export_dir or default_export_dir(), args.workers, args.chunk_rows)
+        result = exporter.run(args.tables)
+
+    print(json.dumps(result, indent=2))
+    return 0 if result['Complete'] else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
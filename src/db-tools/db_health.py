@@ -0,0 +1,381 @@
+# Periodic database health and hot-path metrics, as CloudWatch Embedded Metric Format (EMF).
+#
+# 6_maintenance.sql is a one-off look at pg_stat_user_tables. This samples the cumulative
+# statistics views every --interval seconds and reports what changed in between:
+#
+#   - pg_stat_user_tables (tables and materialized views): scans, tuple churn, (auto)vacuum and
+#     (auto)analyze runs, plus live / dead tuples and size as they stand
+#   - pg_stat_user_indexes: scans per index, e.g. whether the idx_search_event_sort_* indexes
+#     are earning their keep
+#   - pg_stat_user_functions: calls and time per function (ro_*, and the rw_refresh_* functions,
+#     which gives the matview refresh durations). Needs track_functions = 'pl' (or 'all' to
+#     include SQL functions) in the cluster parameter group, otherwise the view is empty
+#   - pg_stat_statements, when the extension is installed and preloaded: the --top statements
+#     by time spent in the interval
+#
+# Counters that went backwards (pg_stat_reset(), pg_stat_statements_reset(), an evicted
+# statement) are counted from zero. Each interval also flags
+#
+#   - unused indexes: no scans since the statistics were last reset, not backing a unique /
+#     primary key / exclusion constraint, and at least --unused-index-min-bytes big
+#   - tables needing a vacuum: more dead tuples than the autovacuum trigger point (so
+#     autovacuum is behind), or a dead-tuple ratio over --dead-ratio
+#
+# Every record is one JSON line on stdout (or appended to --output), which CloudWatch Logs
+# turns into metrics under --namespace when shipped from a Lambda / the CloudWatch agent. The
+# first sample is only a baseline, so nothing is written until the second.
+#
+# Usage (from src/db-tools, against the Aurora cluster or a local PostgreSQL):
+#   python3 db_health.py [--dsn "host=localhost dbname=birdbanding"] [--interval 60] [--count 10]
+#                        [--output health.log] [--namespace BirdBanding/Database] [--top 20]
+
+import argparse
+import json
+import sys
+import time
+
+import psycopg2
+
+from db_pool import ConnectionPool
+
+NAMESPACE = 'BirdBanding/Database'
+INTERVAL_SECONDS = 60
+TOP_STATEMENTS = 20
+QUERY_TEXT_CHARS = 500
+
+# Flag tables whose dead tuples are this share of all their tuples (and at least DEAD_TUPLES_MIN)
+DEAD_RATIO = 0.2
+DEAD_TUPLES_MIN = 1000
+UNUSED_INDEX_MIN_BYTES = 1024 * 1024
+
+SETTINGS_SQL = '''
+    SELECT name, setting FROM pg_settings
+    WHERE name IN ('autovacuum_vacuum_threshold', 'autovacuum_vacuum_scale_factor', 'track_functions', 'track_counts')
+'''
+
+STATS_RESET_SQL = 'SELECT current_database(), stats_reset FROM pg_stat_database WHERE datname = current_database()'
+
+TABLES_SQL = '''
+    SELECT s.relid, s.schemaname, s.relname, c.relkind::text AS relkind, c.reloptions,
+           s.seq_scan, s.seq_tup_read, coalesce(s.idx_scan, 0) AS idx_scan, coalesce(s.idx_tup_fetch, 0) AS idx_tup_fetch,
+           s.n_tup_ins, s.n_tup_upd, s.n_tup_hot_upd, s.n_tup_del,
+           s.vacuum_count, s.autovacuum_count, s.analyze_count, s.autoanalyze_count,
+           s.n_live_tup, s.n_dead_tup, s.n_mod_since_analyze,
+           extract(epoch FROM now() - greatest(s.last_vacuum, s.last_autovacuum))::float8 AS seconds_since_vacuum,
+           pg_total_relation_size(s.relid) AS total_bytes
+    FROM pg_stat_user_tables s
+    JOIN pg_class c ON c.oid = s.relid
+'''
+
+INDEXES_SQL = '''
+    SELECT s.indexrelid, s.schemaname, s.relname, s.indexrelname,
+           s.idx_scan, s.idx_tup_read, s.idx_tup_fetch,
+           pg_relation_size(s.indexrelid) AS index_bytes,
+           i.indisunique OR i.indisprimary OR i.indisexclusion AS enforces_constraint
+    FROM pg_stat_user_indexes s
+    JOIN pg_index i ON i.indexrelid = s.indexrelid
+'''
+
+FUNCTIONS_SQL = 'SELECT funcid, schemaname, funcname, calls, total_time, self_time FROM pg_stat_user_functions'
+
+STATEMENTS_AVAILABLE_SQL = "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements')"
+
+# total_time became total_exec_time in PostgreSQL 13; the sample reads whichever is there
+STATEMENTS_SQL = '''
+    SELECT s.userid, s.queryid, s.query, s.calls, s.{0} AS total_time, s.rows, s.shared_blks_hit, s.shared_blks_read
+    FROM pg_stat_statements s
+    WHERE s.dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+'''
+
+TABLE_COUNTERS = ('seq_scan', 'seq_tup_read', 'idx_scan', 'idx_tup_fetch', 'n_tup_ins', 'n_tup_upd', 'n_tup_hot_upd',
+                  'n_tup_del', 'vacuum_count', 'autovacuum_count', 'analyze_count', 'autoanalyze_count')
+INDEX_COUNTERS = ('idx_scan', 'idx_tup_read', 'idx_tup_fetch')
+FUNCTION_COUNTERS = ('calls', 'total_time', 'self_time')
+STATEMENT_COUNTERS = ('calls', 'total_time', 'rows', 'shared_blks_hit', 'shared_blks_read')
+
+RELKINDS = {'r': 'Table', 'm': 'MaterializedView', 'p': 'PartitionedTable'}
+
+
+class Sample(object):
+# -----------------------------------------------------------------------------------------------------------------
+    """One reading of the statistics views; tables / indexes / functions / statements are keyed by oid (or query)."""
+
+    def __init__(self, taken_at, database, stats_reset, settings, tables, indexes, functions, statements,
+                 statements_error=None):
+        self.taken_at = taken_at
+        self.database = database
+        self.stats_reset = stats_reset
+        self.settings = settings
+        self.tables = tables
+        self.indexes = indexes
+        self.functions = functions
+        self.statements = statements            # None when pg_stat_statements can't be read
+        self.statements_error = statements_error
+
+
+def _rows_by_key(cur, key):
+# -----------------------------------------------------------------------------------------------------------------
+    columns = [d[0] for d in cur.description]
+    rows = {}
+    for values in cur.fetchall():
+        row = dict(zip(columns, values))
+        rows[key(row)] = row
+    return rows
+
+
+def _read_statements(cur):
+# -----------------------------------------------------------------------------------------------------------------
+    """pg_stat_statements rows, or (None, why not) - it needs both the extension and shared_preload_libraries."""
+    cur.execute(STATEMENTS_AVAILABLE_SQL)
+    if not cur.fetchone()[0]:
+        return None, 'pg_stat_statements extension is not installed'
+    try:
+        cur.execute('SELECT * FROM pg_stat_statements LIMIT 0')
+        columns = [d[0] for d in cur.description]
+        cur.execute(STATEMENTS_SQL.format('total_exec_time' if 'total_exec_time' in columns else 'total_time'))
+    except psycopg2.Error as e:
+        cur.connection.rollback()
+        return None, str(e).strip()
+    return _rows_by_key(cur, lambda r: (r['userid'], r['queryid'])), None
+
+
+def take_sample(cur):
+# -----------------------------------------------------------------------------------------------------------------
+    taken_at = time.time()
+    cur.execute(SETTINGS_SQL)
+    settings = dict(cur.fetchall())
+    cur.execute(STATS_RESET_SQL)
+    database, stats_reset = cur.fetchone()
+    cur.execute(TABLES_SQL)
+    tables = _rows_by_key(cur, lambda r: r['relid'])
+    cur.execute(INDEXES_SQL)
+    indexes = _rows_by_key(cur, lambda r: r['indexrelid'])
+    cur.execute(FUNCTIONS_SQL)
+    functions = _rows_by_key(cur, lambda r: r['funcid'])
+    statements, statements_error = _read_statements(cur)
+    return Sample(taken_at, database, stats_reset, settings, tables, indexes, functions, statements, statements_error)
+
+
+def counter_deltas(previous, current, counters):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    key -> {counter: increase} for every key in current. Anything new since the previous sample,
+    or whose counters went backwards (a reset / eviction), counts from zero.
+    """
+    deltas = {}
+    for key, row in current.items():
+        before = previous.get(key)
+        if before is not None and all((row[c] or 0) >= (before[c] or 0) for c in counters):
+            deltas[key] = dict((c, (row[c] or 0) - (before[c] or 0)) for c in counters)
+        else:
+            deltas[key] = dict((c, row[c] or 0) for c in counters)
+    return deltas
+
+
+def _table_name(row):
+# -----------------------------------------------------------------------------------------------------------------
+    return row['relname'] if row['schemaname'] == 'public' else '{0}.{1}'.format(row['schemaname'], row['relname'])
+
+
+def _reloption(row, name, default):
+# -----------------------------------------------------------------------------------------------------------------
+    for option in row['reloptions'] or ():
+        key, _, value = option.partition('=')
+        if key == name:
+            return float(value)
+    return default
+
+
+def tables_needing_vacuum(sample, dead_ratio=DEAD_RATIO, dead_tuples_min=DEAD_TUPLES_MIN):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    Tables with more dead tuples than would trigger autovacuum (per-table reloptions win over the
+    server settings, as they do for autovacuum itself), or with a high share of dead tuples.
+    """
+    base_threshold = float(sample.settings.get('autovacuum_vacuum_threshold', 50))
+    scale_factor = float(sample.settings.get('autovacuum_vacuum_scale_factor', 0.2))
+    flagged = []
+    for row in sample.tables.values():
+        live, dead = row['n_live_tup'] or 0, row['n_dead_tup'] or 0
+        trigger = (_reloption(row, 'autovacuum_vacuum_threshold', base_threshold)
+                   + _reloption(row, 'autovacuum_vacuum_scale_factor', scale_factor) * live)
+        ratio = float(dead) / (live + dead) if live + dead else 0.0
+        reasons = []
+        if dead > trigger:
+            reasons.append('AutovacuumBehind')
+        if dead >= dead_tuples_min and ratio > dead_ratio:
+            reasons.append('HighDeadRatio')
+        if reasons:
+            flagged.append({'Table': _table_name(row), 'DeadTuples': dead, 'LiveTuples': live,
+                            'DeadRatio': round(ratio, 4), 'AutovacuumTrigger': int(trigger),
+                            'SecondsSinceVacuum': row['seconds_since_vacuum'], 'Reasons': reasons})
+    return sorted(flagged, key=lambda f: -f['DeadTuples'])
+
+
+def unused_indexes(sample, min_bytes=UNUSED_INDEX_MIN_BYTES):
+# -----------------------------------------------------------------------------------------------------------------
+    """Indexes never scanned since the statistics were reset, leaving out those that back a constraint."""
+    flagged = [{'Table': _table_name(row), 'Index': row['indexrelname'], 'IndexBytes': row['index_bytes']}
+               for row in sample.indexes.values()
+               if not row['idx_scan'] and not row['enforces_constraint'] and row['index_bytes'] >= min_bytes]
+    return sorted(flagged, key=lambda f: -f['IndexBytes'])
+
+
+def emf_record(namespace, timestamp, dimensions, metrics, properties=None):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    One EMF log event. dimensions is {name: value} (a single dimension set), metrics a list of
+    (name, value, unit); properties are logged alongside but not turned into metrics.
+    """
+    record = {
+        '_aws': {
+            'Timestamp': int(timestamp * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, _, unit in metrics],
+            }],
+        },
+    }
+    record.update(properties or {})
+    record.update(dimensions)
+    record.update((name, value) for name, value, _ in metrics)
+    return record
+
+
+def interval_records(previous, current, namespace=NAMESPACE, top=TOP_STATEMENTS, dead_ratio=DEAD_RATIO,
+                     unused_index_min_bytes=UNUSED_INDEX_MIN_BYTES):
+# -----------------------------------------------------------------------------------------------------------------
+    """The EMF records for what changed between two samples, ending with a per-database summary."""
+    ts = current.taken_at
+    interval = current.taken_at - previous.taken_at
+    database = {'Database': current.database}
+    if current.stats_reset != previous.stats_reset:
+        previous = Sample(previous.taken_at, previous.database, previous.stats_reset, previous.settings, {}, {}, {}, {})
+    records = []
+
+    for key, delta in counter_deltas(previous.tables, current.tables, TABLE_COUNTERS).items():
+        row = current.tables[key]
+        live, dead = row['n_live_tup'] or 0, row['n_dead_tup'] or 0
+        records.append(emf_record(namespace, ts, dict(database, Table=_table_name(row)), [
+            ('SeqScans', delta['seq_scan'], 'Count'),
+            ('SeqTuplesRead', delta['seq_tup_read'], 'Count'),
+            ('IndexScans', delta['idx_scan'], 'Count'),
+            ('IndexTuplesFetched', delta['idx_tup_fetch'], 'Count'),
+            ('Inserts', delta['n_tup_ins'], 'Count'),
+            ('Updates', delta['n_tup_upd'], 'Count'),
+            ('HotUpdates', delta['n_tup_hot_upd'], 'Count'),
+            ('Deletes', delta['n_tup_del'], 'Count'),
+            ('Vacuums', delta['vacuum_count'] + delta['autovacuum_count'], 'Count'),
+            ('Analyzes', delta['analyze_count'] + delta['autoanalyze_count'], 'Count'),
+            ('LiveTuples', live, 'Count'),
+            ('DeadTuples', dead, 'Count'),
+            ('DeadTupleRatio', round(float(dead) / (live + dead), 4) if live + dead else 0.0, 'None'),
+            ('TotalBytes', row['total_bytes'], 'Bytes'),
+        ], {'Kind': RELKINDS.get(row['relkind'], row['relkind']), 'ModifiedSinceAnalyze': row['n_mod_since_analyze'],
+            'SecondsSinceVacuum': row['seconds_since_vacuum']}))
+
+    for key, delta in counter_deltas(previous.indexes, current.indexes, INDEX_COUNTERS).items():
+        row = current.indexes[key]
+        records.append(emf_record(namespace, ts, dict(database, Table=_table_name(row), Index=row['indexrelname']), [
+            ('IndexScans', delta['idx_scan'], 'Count'),
+            ('IndexTuplesRead', delta['idx_tup_read'], 'Count'),
+            ('IndexTuplesFetched', delta['idx_tup_fetch'], 'Count'),
+            ('IndexBytes', row['index_bytes'], 'Bytes'),
+        ], {'ScansSinceReset': row['idx_scan']}))
+
+    for key, delta in counter_deltas(previous.functions, current.functions, FUNCTION_COUNTERS).items():
+        if not delta['calls']:
+            continue
+        row = current.functions[key]
+        records.append(emf_record(namespace, ts, dict(database, Function=row['funcname']), [
+            ('Calls', delta['calls'], 'Count'),
+            ('TotalTimeMs', round(delta['total_time'], 3), 'Milliseconds'),
+            ('SelfTimeMs', round(delta['self_time'], 3), 'Milliseconds'),
+            ('MeanTimeMs', round(delta['total_time'] / delta['calls'], 3), 'Milliseconds'),
+        ]))
+
+    if current.statements is not None:
+        deltas = counter_deltas(previous.statements or {}, current.statements, STATEMENT_COUNTERS)
+        busiest = sorted((k for k, d in deltas.items() if d['calls']), key=lambda k: -deltas[k]['total_time'])[:top]
+        for rank, key in enumerate(busiest, 1):
+            delta, row = deltas[key], current.statements[key]
+            records.append(emf_record(namespace, ts, dict(database, StatementRank=str(rank)), [
+                ('Calls', delta['calls'], 'Count'),
+                ('TotalTimeMs', round(delta['total_time'], 3), 'Milliseconds'),
+                ('MeanTimeMs', round(delta['total_time'] / delta['calls'], 3), 'Milliseconds'),
+                ('Rows', delta['rows'], 'Count'),
+                ('SharedBlocksHit', delta['shared_blks_hit'], 'Count'),
+                ('SharedBlocksRead', delta['shared_blks_read'], 'Count'),
+            ], {'QueryId': str(row['queryid']), 'Query': (row['query'] or '')[:QUERY_TEXT_CHARS]}))
+
+    vacuum = tables_needing_vacuum(current, dead_ratio=dead_ratio)
+    unused = unused_indexes(current, min_bytes=unused_index_min_bytes)
+    records.append(emf_record(namespace, ts, database, [
+        ('IntervalSeconds', round(interval, 3), 'Seconds'),
+        ('TablesNeedingVacuum', len(vacuum), 'Count'),
+        ('UnusedIndexes', len(unused), 'Count'),
+        ('UnusedIndexBytes', sum(u['IndexBytes'] for u in unused), 'Bytes'),
+    ], {
+        'TablesNeedingVacuumDetail': vacuum,
+        'UnusedIndexesDetail': unused,
+        'StatsReset': current.stats_reset.isoformat() if current.stats_reset else None,
+        'TrackFunctions': current.settings.get('track_functions'),
+        'TrackCounts': current.settings.get('track_counts'),
+        'StatementsUnavailable': current.statements_error,
+    }))
+    return records
+
+
+def collect(pool, write, interval=INTERVAL_SECONDS, count=0, **options):
+# -----------------------------------------------------------------------------------------------------------------
+    """Sample every interval seconds and write() each interval's records; count=0 runs until interrupted."""
+    with pool.cursor() as cur:
+        previous = take_sample(cur)
+    next_at = time.monotonic()
+    emitted = 0
+    while not count or emitted < count:
+        next_at += interval
+        time.sleep(max(0.0, next_at - time.monotonic()))
+        with pool.cursor() as cur:
+            current = take_sample(cur)
+        write(interval_records(previous, current, **options))
+        previous = current
+        emitted += 1
+    return emitted
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default=None, help='libpq connection string (default: $BIRDBANDING_DB_DSN / PG* env vars)')
+    parser.add_argument('--interval', type=float, default=INTERVAL_SECONDS, help='Seconds between samples')
+    parser.add_argument('--count', type=int, default=0, help='Stop after this many intervals (default: run until interrupted)')
+    parser.add_argument('--output', default=None, help='Append the EMF lines to this file instead of stdout')
+    parser.add_argument('--namespace', default=NAMESPACE)
+    parser.add_argument('--top', type=int, default=TOP_STATEMENTS, help='pg_stat_statements entries to report per interval')
+    parser.add_argument('--dead-ratio', type=float, default=DEAD_RATIO)
+    parser.add_argument('--unused-index-min-bytes', type=int, default=UNUSED_INDEX_MIN_BYTES)
+    args = parser.parse_args()
+
+    out = open(args.output, 'a') if args.output else sys.stdout
+
+    def write(records):
+        for record in records:
+            out.write(json.dumps(record, default=str) + '\n')
+        out.flush()
+
+    try:
+        with ConnectionPool(args.dsn, max_connections=1) as pool:
+            collect(pool, write, interval=args.interval, count=args.count, namespace=args.namespace, top=args.top,
+                    dead_ratio=args.dead_ratio, unused_index_min_bytes=args.unused_index_min_bytes)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,350 @@
+# Keyset pagination of search events straight from the base tables.
+#
+# Each search sort order currently has its own search_events_sort_* materialized view, stamped
+# with a dense_rank() pagination_idx, and new events don't show up until that (large) view is
+# refreshed. This pages the same rows - same columns, same order, same row per event x mark
+# state x out status x previous bander - from event and friends instead:
+#
+#   - a page is the next N sort entries after the cursor, where an entry is what the views
+#     give one pagination_idx: (sort key..., event id)
+#   - "after the cursor" is a row comparison on the sort key, which walks the existing btree
+#     indexes (idx_event_timestamp, idx_row_creation_timestamp, idx_mark_prefix_num_short_num,
+#     idx_mark_short_num, idx_project_name, idx_species_common_name_nznbbs) from the cursor
+#     onwards, so a page deep in the results costs about the same as the first one
+#   - events with nothing to sort on (no mark, project or species - the views sort these
+#     last) are a second phase paged by event id
+#   - cursors are opaque tokens: base64 JSON of the last entry's key, tied to the sort and
+#     filters they were issued for
+#
+# The project and species sorts can only walk the index as far as the project/species; events
+# within one are then sorted by id, so their page cost grows with the size of that group (the
+# largest project), not with how deep the page is.
+#
+#   paginator = KeysetPaginator(ConnectionPool())
+#   rows, cursor = paginator.page('prefix_number', page_size=50, bander_id='...', project_ids=[...])
+#   rows, cursor = paginator.page('prefix_number', cursor=cursor, page_size=50, bander_id='...', project_ids=[...])
+#
+# Usage (from src/db-tools):
+#   python3 db_keyset_pagination.py [--dsn ...] --sort timestamp [--cursor TOKEN] [--page-size 100]
+#                                   [--bander-id UUID [--project-id UUID ...]] [--filter event_type=IN_HAND ...]
+
+import argparse
+import base64
+import datetime
+import hashlib
+import json
+
+from db_pool import ConnectionPool
+
+CURSOR_VERSION = 1
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Same exclusions as the search_events_sort_* views
+EXCLUDED_EVENT_TYPES = ('NEW_MARK', 'LOST', 'FOUND', 'PRACTICE', 'OTHER', 'TRANSFER')
+
+# Event columns that can be filtered on (equality)
+FILTER_COLUMNS = ('event_type', 'event_state', 'event_banding_scheme', 'event_bird_situation', 'bird_id',
+                  'project_id', 'event_reporter_id', 'event_provider_id', 'event_owner_id')
+
+PHASE_KEYED = 0      # Entries with a sort key, in key order
+PHASE_UNKEYED = 1    # Then entries without one, in event id order
+
+
+class InvalidCursor(ValueError):
+# -----------------------------------------------------------------------------------------------------------------
+    pass
+
+
+class SortKey(object):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    One sort order. columns are the (expression, type) of the key, before the event id that
+    breaks ties; source joins whatever the key comes from onto `e` (event); unkeyed picks
+    out the events with no key (None when every event has one). mark_keyed sorts have one
+    entry per mark on the event, so an entry's rows are only those for that mark.
+    """
+
+    def __init__(self, name, columns, source, unkeyed, matview, mark_keyed=False):
+        self.name = name
+        self.columns = columns
+        self.source = source
+        self.unkeyed = unkeyed
+        self.matview = matview
+        self.mark_keyed = mark_keyed
+
+
+SORT_KEYS = dict((s.name, s) for s in [
+    SortKey('timestamp', [('e.event_timestamp', 'timestamptz')],
+            'event AS e', None, 'search_events_sort_timestamp'),
+    SortKey('row_creation_timestamp', [('e.row_creation_timestamp_', 'timestamptz')],
+            'event AS e', None, 'search_events_sort_row_creation_timestamp'),
+    SortKey('prefix_number', [('k_m.prefix_number', 'text'), ('k_m.short_number', 'text')],
+            'mark AS k_m JOIN mark_state AS k_ms ON k_ms.mark_id = k_m.id JOIN event AS e ON e.id = k_ms.event_id',
+            'NOT EXISTS (SELECT 1 FROM mark_state AS k_ms WHERE k_ms.event_id = e.id)',
+            'search_events_sort_prefix_number', mark_keyed=True),
+    SortKey('short_number', [('k_m.short_number', 'text'), ('k_m.prefix_number', 'text')],
+            'mark AS k_m JOIN mark_state AS k_ms ON k_ms.mark_id = k_m.id JOIN event AS e ON e.id = k_ms.event_id',
+            'NOT EXISTS (SELECT 1 FROM mark_state AS k_ms WHERE k_ms.event_id = e.id)',
+            'search_events_sort_short_number', mark_keyed=True),
+    SortKey('project_name', [('k_p.name', 'text')],
+            'project AS k_p JOIN event AS e ON e.project_id = k_p.id',
+            'e.project_id IS NULL',
+            'search_events_sort_project_name'),
+    SortKey('species_common_name', [('k_s.common_name_nznbbs', 'text')],
+            'species AS k_s JOIN bird AS k_b ON k_b.species_id = k_s.id JOIN event AS e ON e.bird_id = k_b.id',
+            'NOT EXISTS (SELECT 1 FROM bird AS k_b WHERE k_b.id = e.bird_id AND k_b.species_id IS NOT NULL)',
+            'search_events_sort_species_common_name'),
+])
+
+# The rows for a page of entries, as the search_events_sort_* views have them (less pagination_idx)
+PAGE_ROWS = '''
+SELECT
+    e.id AS id, e.event_type,
+    e.event_banding_scheme, e.event_reporter_id, e.event_provider_id, e.event_owner_id,
+    e.event_timestamp, e.event_bird_situation,
+    b.id AS bird_id,
+    s.id AS species_id,
+    sg.id AS species_group_id,
+    ms.id AS mark_state_id, ms.state AS mark_state_state,
+    m.prefix_number AS mark_prefix_number, m.short_number AS mark_short_number,
+    cm.id AS characteristic_measurement_id, cm.characteristic_id AS characteristic_id,
+    cm.value AS characteristic_measurement_value,
+    p.id AS project_id, p.default_moratorium_expiry,
+    bb.bander_id AS previous_bander,
+    {entry_keys}
+FROM entries
+  JOIN event AS e ON e.id = entries.entry_event_id
+  LEFT JOIN bird AS b ON b.id = e.bird_id
+  LEFT JOIN species AS s ON s.id = b.species_id
+  LEFT JOIN species_group_membership AS sgm ON sgm.species_id = s.id
+  LEFT JOIN species_group AS sg ON sgm.group_id = sg.id
+  LEFT JOIN (mark_state AS ms JOIN mark AS m ON m.id = ms.mark_id) ON ms.event_id = e.id {mark_condition}
+  LEFT JOIN characteristic_measurement AS cm ON cm.event_id = e.id AND cm.characteristic_id = 43
+  LEFT JOIN project AS p ON p.id = e.project_id
+  LEFT JOIN LATERAL (
+    -- bander_birds_matview, for just this bird
+    SELECT DISTINCT x.bander_id
+    FROM event AS pe, unnest(ARRAY[pe.event_reporter_id, pe.event_provider_id, pe.event_owner_id]) AS x(bander_id)
+    WHERE pe.bird_id = b.id
+  ) AS bb ON TRUE
+ORDER BY entries.entry_idx, ms.id, cm.id, bb.bander_id
+'''
+
+# What a bander may see: events they reported/provided/own, their projects' events, anything out
+# of moratorium, and everything about birds they've had an event with
+BANDER_ACCESS = '''(
+    e.event_reporter_id = %(bander_id)s OR e.event_provider_id = %(bander_id)s OR e.event_owner_id = %(bander_id)s
+    OR e.project_id = ANY(%(project_ids)s::uuid[])
+    OR EXISTS (SELECT 1 FROM project AS a_p WHERE a_p.id = e.project_id AND a_p.default_moratorium_expiry < now())
+    OR EXISTS (SELECT 1 FROM event AS a_e WHERE a_e.bird_id = e.bird_id
+               AND %(bander_id)s IN (a_e.event_reporter_id, a_e.event_provider_id, a_e.event_owner_id))
+)'''
+
+
+def _fingerprint(sort, filters, bander_id, project_ids):
+# -----------------------------------------------------------------------------------------------------------------
+    scope = json.dumps([sort, sorted(filters.items()), bander_id, sorted(project_ids)], default=str)
+    return hashlib.sha1(scope.encode()).hexdigest()[:12]
+
+
+def encode_cursor(sort, phase, key, scope):
+# -----------------------------------------------------------------------------------------------------------------
+    values = [v.isoformat() if isinstance(v, datetime.datetime) else None if v is None else str(v) for v in key]
+    payload = json.dumps({'v': CURSOR_VERSION, 's': sort, 'p': phase, 'k': values, 'f': scope}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, sort, scope):
+# -----------------------------------------------------------------------------------------------------------------
+    """Returns (phase, key values) for a cursor issued for this sort and these filters."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode())
+        version, cursor_sort, phase, key, cursor_scope = (payload['v'], payload['s'], payload['p'], payload['k'],
+                                                          payload['f'])
+    except (ValueError, KeyError, TypeError):
+        raise InvalidCursor('Malformed pagination cursor')
+    if version != CURSOR_VERSION or cursor_sort != sort or cursor_scope != scope:
+        raise InvalidCursor('Pagination cursor was issued for a different search')
+    expected = len(SORT_KEYS[sort].columns) + 1 if phase == PHASE_KEYED else 1
+    if phase not in (PHASE_KEYED, PHASE_UNKEYED) or not isinstance(key, list) or len(key) != expected:
+        raise InvalidCursor('Malformed pagination cursor')
+    return phase, key
+
+
+def build_entries_query(sort_key, phase, after, limit, filters, bander_id, project_ids):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    SQL and parameters for the next `limit` entries of one phase after key `after` (None for the
+    start of the phase). Entries are (key_0, ..., event id, entry_idx).
+    """
+    params = {'limit': limit}
+    where = ['e.event_type NOT IN ({0})'.format(', '.join("'{0}'".format(t) for t in EXCLUDED_EVENT_TYPES))]
+
+    for n, (column, value) in enumerate(sorted(filters.items())):
+        if column not in FILTER_COLUMNS:
+            raise ValueError('Cannot filter on {0}'.format(column))
+        params['filter_{0}'.format(n)] = value
+        where.append('e.{0} = %(filter_{1})s'.format(column, n))
+
+    if bander_id is not None:
+        params.update(bander_id=bander_id, project_ids=list(project_ids))
+        where.append(BANDER_ACCESS)
+
+    if phase == PHASE_KEYED:
+        keys = [expression for expression, _ in sort_key.columns] + ['e.id']
+        source = sort_key.source
+        if after is not None:
+            casts = [cast for _, cast in sort_key.columns] + ['uuid']
+            bounds = []
+            for n, (value, cast) in enumerate(zip(after, casts)):
+                params['after_{0}'.format(n)] = value
+                bounds.append('%(after_{0})s::{1}'.format(n, cast))
+            # The leading column on its own is what lets the planner start the index scan at the cursor
+            where.append('{0} >= {1}'.format(keys[0], bounds[0]))
+            where.append('({0}) > ({1})'.format(', '.join(keys), ', '.join(bounds)))
+    else:
+        keys = ['e.id']
+        source = 'event AS e'
+        where.append(sort_key.unkeyed)
+        if after is not None:
+            params['after_0'] = after[0]
+            where.append('e.id > %(after_0)s::uuid')
+
+    # mark keyed sorts can meet the same mark twice on one event (two mark_state rows)
+    distinct = 'DISTINCT ' if sort_key.mark_keyed and phase == PHASE_KEYED else ''
+    selected = ', '.join('{0} AS entry_key_{1}'.format(k, n) for n, k in enumerate(keys[:-1]))
+    sql = '''
+        SELECT {distinct}{selected}{comma}e.id AS entry_event_id
+        FROM {source}
+        WHERE {where}
+        ORDER BY {order}
+        LIMIT %(limit)s
+    '''.format(distinct=distinct, selected=selected, comma=', ' if selected else '', source=source,
+               where='\n          AND '.join(where), order=', '.join(keys))
+    return sql, params
+
+
+def build_page_query(sort_key, phase, after, limit, filters, bander_id, project_ids):
+# -----------------------------------------------------------------------------------------------------------------
+    entries_sql, params = build_entries_query(sort_key, phase, after, limit, filters, bander_id, project_ids)
+    key_count = len(sort_key.columns) if phase == PHASE_KEYED else 0
+    entry_keys = ', '.join(['entries.entry_key_{0}'.format(n) for n in range(key_count)] + ['entries.entry_idx'])
+    mark_condition = ''
+    if sort_key.mark_keyed and phase == PHASE_KEYED:
+        # Only the mark this entry is for (the mark columns are in key order)
+        mark_columns = [expression.split('.')[1] for expression, _ in sort_key.columns]
+        mark_condition = ' '.join('AND m.{0} = entries.entry_key_{1}'.format(c, n) for n, c in enumerate(mark_columns))
+    order = ', '.join(['entry_key_{0}'.format(n) for n in range(key_count)] + ['entry_event_id'])
+    sql = 'WITH entries AS (SELECT *, row_number() OVER (ORDER BY {0}) AS entry_idx FROM ({1}) AS ordered)\n'.format(
+        order, entries_sql)
+    return sql + PAGE_ROWS.format(entry_keys=entry_keys, mark_condition=mark_condition), params
+
+
+class KeysetPaginator(object):
+# -----------------------------------------------------------------------------------------------------------------
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def page(self, sort='timestamp', cursor=None, page_size=PAGE_SIZE, filters=None, bander_id=None, project_ids=()):
+        """
+        The next page_size entries (all of their rows) after cursor, or from the start with no
+        cursor. Returns (rows as dicts, cursor for the next page or None at the end).
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError('Unknown sort: {0} (one of {1})'.format(sort, ', '.join(sorted(SORT_KEYS))))
+        if not 0 < page_size <= MAX_PAGE_SIZE:
+            raise ValueError('page_size must be between 1 and {0}'.format(MAX_PAGE_SIZE))
+        filters = dict(filters or {})
+        scope = _fingerprint(sort, filters, bander_id, project_ids)
+        phase, after = decode_cursor(cursor, sort, scope) if cursor else (PHASE_KEYED, None)
+        sort_key = SORT_KEYS[sort]
+
+        entries = []
+        with self.pool.cursor() as cur:
+            while True:
+                # One extra entry tells us whether there's a next page
+                wanted = page_size + 1 - len(entries)
+                sql, params = build_page_query(sort_key, phase, after, wanted, filters, bander_id, project_ids)
+                cur.execute(sql, params)
+                columns = [c[0] for c in cur.description]
+                found = _group_entries(columns, cur.fetchall(), phase)
+                entries.extend(found)
+                if len(entries) > page_size or phase == PHASE_UNKEYED or sort_key.unkeyed is None:
+                    break
+                phase, after = PHASE_UNKEYED, None
+
+        next_cursor = None
+        if len(entries) > page_size:
+            entries = entries[:page_size]
+            last_phase, last_key, _ = entries[-1]
+            next_cursor = encode_cursor(sort, last_phase, last_key, scope)
+        return [row for _, _, rows in entries for row in rows], next_cursor
+
+    def cursor_at(self, sort, offset, filters=None, bander_id=None, project_ids=()):
+        """
+        A cursor positioned after the first `offset` entries - for benchmarks and tests, it
+        OFFSETs through everything before it.
+        """
+        filters = dict(filters or {})
+        sort_key = SORT_KEYS[sort]
+        if offset <= 0:
+            return None
+        phases = (PHASE_KEYED,) if sort_key.unkeyed is None else (PHASE_KEYED, PHASE_UNKEYED)
+        with self.pool.cursor() as cur:
+            for phase in phases:
+                sql, params = build_entries_query(sort_key, phase, None, 1, filters, bander_id, project_ids)
+                cur.execute('SELECT * FROM ({0}) AS q'.format(sql.replace('LIMIT %(limit)s', 'LIMIT 1 OFFSET %(offset)s')),
+                            dict(params, offset=max(0, offset - 1)))
+                row = cur.fetchone()
+                if row is not None:
+                    return encode_cursor(sort, phase, list(row), _fingerprint(sort, filters, bander_id, project_ids))
+                cur.execute('SELECT count(*) FROM ({0}) AS q'.format(sql.replace('LIMIT %(limit)s', '')), params)
+                offset -= cur.fetchone()[0]
+        return None
+
+
+def _group_entries(columns, rows, phase):
+# -----------------------------------------------------------------------------------------------------------------
+    """[(phase, entry key, [row dicts])] in entry order; the entry_* bookkeeping columns are dropped."""
+    key_indexes = [i for i, c in enumerate(columns) if c.startswith('entry_key_')]
+    idx_index = columns.index('entry_idx')
+    id_index = columns.index('id')
+    visible = [(i, c) for i, c in enumerate(columns) if not c.startswith('entry_')]
+
+    entries = []
+    current = None
+    for row in rows:
+        if current is None or row[idx_index] != current:
+            current = row[idx_index]
+            entries.append((phase, [row[i] for i in key_indexes] + [row[id_index]], []))
+        entries[-1][2].append(dict((c, row[i]) for i, c in visible))
+    return entries
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default=None, help='libpq connection string (default: $BIRDBANDING_DB_DSN / PG* env vars)')
+    parser.add_argument('--sort', choices=sorted(SORT_KEYS), default='timestamp')
+    parser.add_argument('--cursor', default=None, help='Cursor returned with the previous page')
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    parser.add_argument('--bander-id', default=None, help='Only what this bander may see')
+    parser.add_argument('--project-id', dest='project_ids', action='append', default=[],
+                        help="The bander's projects (repeatable)")
+    parser.add_argument('--filter', dest='filters', action='append', default=[], metavar='COLUMN=VALUE',
+                        help='Equality filter on one of: ' + ', '.join(FILTER_COLUMNS))
+    args = parser.parse_args()
+
+    filters = dict(f.split('=', 1) for f in args.filters)
+    with ConnectionPool(args.dsn, max_connections=1) as pool:
+        rows, next_cursor = KeysetPaginator(pool).page(args.sort, args.cursor, args.page_size, filters,
+                                                        args.bander_id, args.project_ids)
+
+    print(json.dumps({'Rows': rows, 'NextCursor': next_cursor}, indent=2, default=str))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,312 @@
+# In-memory index of the short numbers already used under each mark prefix, for validating
+# bulk band uploads.
+#
+# Validating an upload currently means, per prefix, shipping every short number in the upload
+# to ro_are_marks_unique(prefix, range_array) and running ro_get_last_short_number(prefix),
+# which regexp_replace()s every mark of the prefix. Bands come in long consecutive runs, so the
+# short numbers of a prefix compress to a handful of intervals:
+#
+#   - numeric short numbers (digits only, no leading zero - the vast majority) are kept as
+#     sorted, non-overlapping [start, end] intervals in two array('q')s, so membership, "is
+#     this range free", gaps and the last number are a binary search away
+#   - anything else ("0123", "12a") is kept verbatim in a set, so uniqueness still matches
+#     ro_are_marks_unique's exact text comparison, and its digits still count towards the
+#     last number as they do in ro_get_last_short_number
+#
+# Marks are only ever added in bulk, so after the initial load the index catches up by reading
+# mark rows past the highest row_creation_idx it has seen. row_creation_idx is handed out at
+# insert time, not commit time, so each refresh re-reads a trailing window of rows; adding a
+# number that's already there is a no-op. Deleted marks need a reload().
+#
+#   index = MarkRangeIndex()
+#   index.load(pool)
+#   index.existing('cp', ['1001', '1002'])      # those already used, like ro_are_marks_unique
+#   index.is_range_free('cp', 5000, 5999)
+#   index.refresh(pool)                         # pick up marks added since
+
+import argparse
+from array import array
+from bisect import bisect_left, bisect_right
+import json
+import re
+import threading
+import time
+
+from db_pool import ConnectionPool
+
+# How far behind the high-water mark each refresh re-reads (see above)
+REFRESH_OVERLAP_ROWS = 10000
+LOAD_FETCH_ROWS = 50000
+
+NON_DIGITS = re.compile(r'\D')
+
+# Largest value an array('q') holds; anything bigger is treated as irregular
+MAX_INTERVAL_VALUE = 2 ** 63 - 1
+
+
+def numeric_value(short_number):
+# -----------------------------------------------------------------------------------------------------------------
+    """The short number's digits as an integer, as ro_get_last_short_number reads it (None if it has none)."""
+    digits = NON_DIGITS.sub('', short_number)
+    return int(digits) if digits else None
+
+
+def _canonical_int(short_number):
+# -----------------------------------------------------------------------------------------------------------------
+    # Only numbers that round-trip exactly can live in the intervals - "0123" is a different mark to "123"
+    if short_number.isdigit() and short_number.isascii() and (short_number == '0' or short_number[0] != '0'):
+        value = int(short_number)
+        if value <= MAX_INTERVAL_VALUE:
+            return value
+    return None
+
+
+class ShortNumberSet(object):
+# -----------------------------------------------------------------------------------------------------------------
+    """The short numbers used under one prefix."""
+
+    def __init__(self):
+        self.starts = array('q')
+        self.ends = array('q')
+        self.irregular = set()
+        self.irregular_max = None
+        self.count = 0
+
+    @classmethod
+    def from_short_numbers(cls, short_numbers):
+        numbers = cls()
+        values = []
+        for short_number in short_numbers:
+            value = _canonical_int(short_number)
+            if value is None:
+                numbers._add_irregular(short_number)
+            else:
+                values.append(value)
+        values.sort()
+        for value in values:
+            if numbers.ends and value <= numbers.ends[-1] + 1:
+                if value > numbers.ends[-1]:
+                    numbers.ends[-1] = value
+                    numbers.count += 1
+            else:
+                numbers.starts.append(value)
+                numbers.ends.append(value)
+                numbers.count += 1
+        return numbers
+
+    def _add_irregular(self, short_number):
+        if short_number in self.irregular:
+            return False
+        self.irregular.add(short_number)
+        self.count += 1
+        value = numeric_value(short_number)
+        if value is not None and (self.irregular_max is None or value > self.irregular_max):
+            self.irregular_max = value
+        return True
+
+    def add(self, short_number):
+        """Returns True if the short number wasn't already there."""
+        value = _canonical_int(short_number)
+        if value is None:
+            return self._add_irregular(short_number)
+
+        i = bisect_right(self.starts, value) - 1
+        if i >= 0 and self.ends[i] >= value:
+            return False
+        joins_left = i >= 0 and self.ends[i] == value - 1
+        joins_right = i + 1 < len(self.starts) and self.starts[i + 1] == value + 1
+        if joins_left and joins_right:
+            self.ends[i] = self.ends[i + 1]
+            del self.starts[i + 1]
+            del self.ends[i + 1]
+        elif joins_left:
+            self.ends[i] = value
+        elif joins_right:
+            self.starts[i + 1] = value
+        else:
+            self.starts.insert(i + 1, value)
+            self.ends.insert(i + 1, value)
+        self.count += 1
+        return True
+
+    def _contains_int(self, value):
+        i = bisect_right(self.starts, value) - 1
+        return i >= 0 and self.ends[i] >= value
+
+    def contains(self, short_number):
+        value = _canonical_int(short_number)
+        return self._contains_int(value) if value is not None else short_number in self.irregular
+
+    def last_number(self):
+        candidates = [v for v in (self.ends[-1] if self.ends else None, self.irregular_max) if v is not None]
+        return max(candidates) if candidates else None
+
+    def is_range_free(self, first, last):
+        """True if no numeric short number in [first, last] is used (irregular ones count by their digits)."""
+        i = bisect_right(self.starts, last) - 1
+        if i >= 0 and self.ends[i] >= first:
+            return False
+        return not any(v is not None and first <= v <= last for v in map(numeric_value, self.irregular))
+
+    def used_in(self, first, last):
+        """[(start, end)] of the used intervals overlapping [first, last], clipped to it."""
+        used = []
+        for i in range(max(0, bisect_right(self.starts, first) - 1), bisect_left(self.starts, last + 1)):
+            if self.ends[i] >= first:
+                used.append((max(first, self.starts[i]), min(last, self.ends[i])))
+        return used
+
+    def gaps(self, first=None, last=None):
+        """[(start, end)] of the unused numbers between first and last (default: the used range)."""
+        if not self.starts:
+            return [] if first is None or last is None else [(first, last)]
+        first = self.starts[0] if first is None else first
+        last = self.ends[-1] if last is None else last
+        gaps = []
+        cursor = first
+        for start, end in self.used_in(first, last):
+            if start > cursor:
+                gaps.append((cursor, start - 1))
+            cursor = end + 1
+        if cursor <= last:
+            gaps.append((cursor, last))
+        return gaps
+
+    def nbytes(self):
+        return (self.starts.itemsize * len(self.starts) + self.ends.itemsize * len(self.ends) +
+                sum(len(s) for s in self.irregular))
+
+
+class MarkRangeIndex(object):
+# -----------------------------------------------------------------------------------------------------------------
+
+    def __init__(self, refresh_overlap_rows=REFRESH_OVERLAP_ROWS):
+        self.refresh_overlap_rows = refresh_overlap_rows
+        self.prefixes = {}
+        self.high_water = 0          # Highest mark.row_creation_idx read so far
+        self.loaded_at = None
+        self._lock = threading.Lock()
+
+    def load(self, pool):
+        """(Re)build the whole index from the mark table."""
+        by_prefix = {}
+        high_water = 0
+        with pool.connection(autocommit=False) as conn:
+            # Server side cursor, so the marks stream rather than landing in memory all at once
+            with conn.cursor(name='mark_range_index_load') as cur:
+                cur.itersize = LOAD_FETCH_ROWS
+                cur.execute('SELECT prefix_number, short_number, row_creation_idx FROM mark')
+                for prefix_number, short_number, row_creation_idx in cur:
+                    by_prefix.setdefault(prefix_number, []).append(short_number)
+                    if row_creation_idx > high_water:
+                        high_water = row_creation_idx
+
+        prefixes = dict((prefix, ShortNumberSet.from_short_numbers(numbers)) for prefix, numbers in by_prefix.items())
+        with self._lock:
+            self.prefixes = prefixes
+            self.high_water = high_water
+            self.loaded_at = time.time()
+
+    def refresh(self, pool):
+        """Add marks created since the last load/refresh. Returns how many new short numbers were added."""
+        with pool.cursor() as cur:
+            cur.execute('''
+                SELECT prefix_number, short_number, row_creation_idx FROM mark
+                WHERE row_creation_idx > %s ORDER BY row_creation_idx
+            ''', (max(0, self.high_water - self.refresh_overlap_rows),))
+            rows = cur.fetchall()
+        return self.add_marks(rows)
+
+    def add_marks(self, rows):
+        """Add (prefix_number, short_number, row_creation_idx) rows, e.g. as just inserted by an upload."""
+        added = 0
+        with self._lock:
+            for prefix_number, short_number, row_creation_idx in rows:
+                numbers = self.prefixes.get(prefix_number)
+                if numbers is None:
+                    numbers = self.prefixes[prefix_number] = ShortNumberSet()
+                added += numbers.add(short_number)
+                if row_creation_idx is not None and row_creation_idx > self.high_water:
+                    self.high_water = row_creation_idx
+        return added
+
+    def _numbers(self, prefix_number):
+        return self.prefixes.get(prefix_number) or ShortNumberSet()
+
+    def exists(self, prefix_number, short_number):
+        return self._numbers(prefix_number).contains(short_number)
+
+    def existing(self, prefix_number, short_numbers):
+        """The short numbers already used under the prefix (ro_are_marks_unique), in the order given."""
+        numbers = self._numbers(prefix_number)
+        return [s for s in short_numbers if numbers.contains(s)]
+
+    def last_short_number(self, prefix_number):
+        """Highest short number used under the prefix (ro_get_last_short_number), None if there are none."""
+        return self._numbers(prefix_number).last_number()
+
+    def is_range_free(self, prefix_number, first, last):
+        return self._numbers(prefix_number).is_range_free(first, last)
+
+    def used_in(self, prefix_number, first, last):
+        return self._numbers(prefix_number).used_in(first, last)
+
+    def gaps(self, prefix_number, first=None, last=None):
+        return self._numbers(prefix_number).gaps(first, last)
+
+    def is_supported_prefix(self, prefix_number):
+        return prefix_number in self.prefixes
+
+    def validate_range(self, prefix_number, first, last):
+        """Everything an upload of bands first..last under the prefix needs to know, in one call."""
+        numbers = self._numbers(prefix_number)
+        clashes = numbers.used_in(first, last)
+        return {
+            'PrefixNumber': prefix_number,
+            'First': first,
+            'Last': last,
+            'KnownPrefix': prefix_number in self.prefixes,
+            'RangeFree': numbers.is_range_free(first, last),
+            'AlreadyUsed': clashes,
+            'AlreadyUsedCount': sum(end - start + 1 for start, end in clashes),
+            'LastShortNumber': numbers.last_number(),
+        }
+
+    def stats(self):
+        with self._lock:
+            return {
+                'Prefixes': len(self.prefixes),
+                'ShortNumbers': sum(n.count for n in self.prefixes.values()),
+                'Intervals': sum(len(n.starts) for n in self.prefixes.values()),
+                'IrregularShortNumbers': sum(len(n.irregular) for n in self.prefixes.values()),
+                'Bytes': sum(n.nbytes() for n in self.prefixes.values()),
+                'HighWater': self.high_water,
+            }
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default=None, help='libpq connection string (default: $BIRDBANDING_DB_DSN / PG* env vars)')
+    parser.add_argument('--prefix', help='Validate a range under this prefix')
+    parser.add_argument('--first', type=int)
+    parser.add_argument('--last', type=int)
+    args = parser.parse_args()
+
+    index = MarkRangeIndex()
+    with ConnectionPool(args.dsn, max_connections=1) as pool:
+        started = time.perf_counter()
+        index.load(pool)
+        output = {'LoadMs': round((time.perf_counter() - started) * 1000, 3), 'Index': index.stats()}
+
+    if args.prefix:
+        first = args.first if args.first is not None else (index.last_short_number(args.prefix) or 0) + 1
+        last = args.last if args.last is not None else first
+        output['Validation'] = index.validate_range(args.prefix, first, last)
+
+    print(json.dumps(output, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
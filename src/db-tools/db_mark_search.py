@@ -0,0 +1,329 @@
+# Mark combination searches over advanced_search_mark_configuration.
+#
+# A resighting is usually reported as the bands seen on the bird ("left tibia red over white,
+# right tarsus metal 'a-1234'"), and finding the events that match means finding events with a
+# mark configuration matching each band. vw_advanced_search_events does that by unnesting agg_mc
+# for every row of advanced_search_events, whatever the search. Here each mark configuration of
+# each searchable event is a row of advanced_search_mark_configuration (kept up to date with
+# advanced_search_events_incremental by db_search_events_incremental.py), indexed on colour,
+# material and text, so:
+#
+#   - each band in the combination is one alias of that table, restricted by its own conditions,
+#     and the aliases are joined on event_id - the planner starts from the most selective band's
+#     index and checks the others against idx_asmc_event_id
+#   - each band has to be matched by a different mark configuration, so "red, red" needs two
+#     red bands
+#   - alphanumeric_text is matched lowercased (as in agg_mc), exactly or, ending in '*', as a
+#     prefix (idx_asmc_alphanumeric_text is text_pattern_ops for that)
+#   - the matching events come back from advanced_search_events_incremental, newest first
+#
+# Both tables are only as fresh as the last `db_search_events_incremental.py sync`, which nothing
+# here runs: it has to be scheduled like the advanced_search_events refresh it replaces (and a
+# `rebuild` run once before the first search, or they're empty). So search() also returns how far
+# behind they are, from the sync's watermark in incremental_refresh_watermark: the changes logged
+# in search_event_change that it hasn't applied yet, and how long the oldest has been waiting.
+#
+# A combination is either a list of dictionaries of mark_configuration columns or text:
+# bands are separated by ',', ';' or 'and', and 'over' separates bands on the same leg (a band
+# after 'over' with no side or position of its own takes the previous band's). Order on a leg
+# isn't matched, as location_idx isn't recorded consistently enough to rely on.
+#
+#   parse_combination("left tibia red over white, right tarsus metal 'a-12*'")
+#   -> [{'side': 'LEFT', 'position': 'TIBIA', 'colour': 'RED'},
+#       {'side': 'LEFT', 'position': 'TIBIA', 'colour': 'WHITE'},
+#       {'side': 'RIGHT', 'position': 'TARSUS', 'mark_material': 'METAL', 'alphanumeric_text': 'a-12*'}]
+#   rows, fresh = search(cur, "left tibia red over white", limit=50, filters={'species_code_nznbbs': 'SIPO'})
+#   -> fresh == {'Watermark': 81234, 'SyncedAt': ..., 'PendingChanges': 0, 'PendingGaps': 0, 'StaleSeconds': 0.0}
+#
+# Usage (from src/db-tools):
+#   python3 db_mark_search.py [--dsn ...] "left tibia red over white" [--limit 100] [--filter event_type=IN_HAND ...]
+#                             [--max-stale-seconds 600]   # exit status 1 if the oldest unapplied change is older
+
+import argparse
+import json
+import re
+import time
+
+from db_pool import ConnectionPool
+from db_search_events_incremental import CHANGE_TABLE, MARKS_TABLE as TABLE, TABLE as EVENTS_TABLE, WatermarkMissing
+
+LIMIT = 100
+MAX_LIMIT = 1000
+MAX_MARKS = 8
+
+# Unapplied changes counted at most (a sync that's stopped running could leave millions)
+MAX_PENDING_COUNT = 10000
+
+FRESHNESS_SQL = '''
+    SELECT w.last_change_id, w.row_update_timestamp_, jsonb_array_length(w.pending_gaps),
+           (SELECT count(*) FROM (SELECT 1 FROM {changes} AS c WHERE c.id > w.last_change_id LIMIT %s) AS pending),
+           (SELECT extract(epoch FROM now() - c.row_creation_timestamp_)::float8 FROM {changes} AS c
+            WHERE c.id > w.last_change_id ORDER BY c.id LIMIT 1)
+    FROM incremental_refresh_watermark AS w
+    WHERE w.name = %s'''.format(changes=CHANGE_TABLE)
+
+# The enum values (sql/1_create_prereqs.sql) of the columns a band can be described by
+VOCABULARY = {
+    'side': ('LEFT', 'RIGHT'),
+    'position': ('TIBIA', 'TARSUS'),
+    'mark_type': ('LEG_BAND', 'LEG_TRANSPONDER', 'INSERTED_TRANSPONDER', 'WEB', 'JESS', 'GPS', 'TDR', 'GLS', 'FLIPPER',
+                  'WING', 'TRANSMITTER', 'OTHER'),
+    'mark_material': ('METAL', 'ACETATE', 'ACRYLIC', 'DARVIC', 'CELLULOID', 'PLASTIC_UNSPECIFIED', 'OTHER'),
+    'mark_form': ('BUTT', 'BUTT_HALF_METAL', 'WRAPAROUND_1', 'WRAPAROUND_1_5', 'WRAPAROUND_1_75', 'WRAPAROUND_2',
+                  'WRAPAROUND_UNKNOWN', 'SPIRAL', 'FLAG', 'OTHER'),
+    'mark_fixing': ('GLUE', 'THF', 'SUPERGLUE', 'PIPE_CEMENT', 'SELLEYS_PLASTIC_FIX_2_STEP', 'SOLDER', 'DOUBLE_SIDED_TAPE',
+                    'SOLVENT', 'OTHER'),
+    'colour': ('BLACK', 'WHITE', 'GREY', 'RED', 'ORANGE', 'PALE_ORANGE', 'FLUORESCENT_ORANGE', 'YELLOW', 'PALE_PINK',
+               'PINK', 'FLUORESCENT_PINK', 'CRIMSON_PINK', 'FLUORESCENT_PURPLE', 'LIGHT_PURPLE', 'PURPLE', 'PALE_BLUE',
+               'FLUORESCENT_BLUE', 'LIGHT_BLUE', 'BLUE', 'DARK_BLUE', 'FLUORESCENT_GREEN', 'LIME_GREEN', 'PALE_GREEN',
+               'GREEN', 'DARK_GREEN', 'BROWN', 'BLUE_STRIPED_PINK', 'GREEN_STRIPED_PURPLE', 'RED_STRIPED_WHITE',
+               'PINK_STRIPED_WHITE', 'BLUE_STRIPED_YELLOW', 'OTHER'),
+}
+VOCABULARY['text_colour'] = VOCABULARY['colour']
+
+# Every column a band can be matched on
+FIELDS = ('side', 'position', 'location_idx', 'mark_type', 'mark_material', 'mark_form', 'mark_fixing', 'colour',
+          'text_colour', 'alphanumeric_text')
+
+# Words of a text combination, to the column they set. 'other' is ambiguous, so it isn't one.
+WORDS = {}
+for _field in ('side', 'position', 'mark_type', 'mark_material', 'mark_form', 'colour'):
+    WORDS.update((value.lower(), _field) for value in VOCABULARY[_field] if value != 'OTHER')
+WORDS['band'] = 'mark_type'
+
+ALIASES = {'band': 'LEG_BAND'}
+SEPARATORS = (',', ';', 'and')
+SAME_LEG = 'over'
+# Longest enum value in words (e.g. green striped purple)
+MAX_WORDS = 3
+
+# Event columns that can be filtered on (equality)
+FILTER_COLUMNS = ('event_type', 'event_banding_scheme', 'event_bird_situation', 'bird_id', 'species_id',
+                  'species_code_nznbbs', 'project_id', 'event_reporter_id', 'event_provider_id', 'event_owner_id')
+
+# What comes back for each matching event
+EVENT_COLUMNS = ('id', 'event_timestamp', 'event_type', 'bird_id', 'friendly_name', 'species_code_nznbbs',
+                 'common_name_nznbbs', 'project_name', 'location_description', 'latitude', 'longitude', 'agg_mc')
+
+TOKEN_PATTERN = re.compile(r"'[^']*'|\"[^\"]*\"|[,;]|[^\s,;'\"]+")
+
+
+class InvalidCombination(ValueError):
+# -----------------------------------------------------------------------------------------------------------------
+    pass
+
+
+def parse_combination(text):
+# -----------------------------------------------------------------------------------------------------------------
+    """A text description of the bands on a bird as a list of criteria dictionaries."""
+    marks = []
+    current = {}
+    same_leg = False
+    words = TOKEN_PATTERN.findall(text)
+    i = 0
+
+    def finish(next_same_leg):
+        if not current:
+            raise InvalidCombination('Empty band description in: {0}'.format(text))
+        if same_leg and marks and 'side' not in current and 'position' not in current:
+            for field in ('side', 'position'):
+                if field in marks[-1]:
+                    current[field] = marks[-1][field]
+        marks.append(dict(current))
+        current.clear()
+        return next_same_leg
+
+    def set_field(field, value):
+        if field in current:
+            raise InvalidCombination('Two values for {0} in one band: {1}, {2}'.format(field, current[field], value))
+        current[field] = value
+
+    while i < len(words):
+        word = words[i]
+        lowered = word.lower()
+        if word[0] in '\'"':
+            set_field('alphanumeric_text', word[1:-1])
+            # 'ab' in white
+            if i + 2 < len(words) and words[i + 1].lower() == 'in' and WORDS.get(words[i + 2].lower()) == 'colour':
+                set_field('text_colour', words[i + 2].upper())
+                i += 2
+        elif lowered in SEPARATORS or lowered == SAME_LEG:
+            same_leg = finish(lowered == SAME_LEG)
+        else:
+            # Longest run of words that's a value, so 'light blue' isn't 'light' and then 'blue'
+            for n in range(min(MAX_WORDS, len(words) - i), 0, -1):
+                value = '_'.join(w.lower() for w in words[i:i + n])
+                if value in WORDS:
+                    set_field(WORDS[value], ALIASES.get(value, value.upper()))
+                    i += n - 1
+                    break
+            else:
+                raise InvalidCombination('Unrecognised word in band description: {0}'.format(word))
+        i += 1
+
+    finish(False)
+    return marks
+
+
+def validate(criteria):
+# -----------------------------------------------------------------------------------------------------------------
+    """Criteria with the enum values uppercased and the text lowercased; raises InvalidCombination."""
+    if not criteria:
+        raise InvalidCombination('No bands to search for')
+    if len(criteria) > MAX_MARKS:
+        raise InvalidCombination('At most {0} bands can be searched for at once'.format(MAX_MARKS))
+
+    validated = []
+    for criterion in criteria:
+        unknown = sorted(set(criterion) - set(FIELDS))
+        if unknown:
+            raise InvalidCombination('Unknown mark configuration field(s): {0}'.format(', '.join(unknown)))
+        mark = {}
+        for field, value in criterion.items():
+            if value is None:
+                continue
+            if field == 'alphanumeric_text':
+                value = str(value).lower()
+                if not value.rstrip('*') or '*' in value[:-1]:
+                    raise InvalidCombination('Text to match must be a value, optionally ending in *: {0}'.format(value))
+            elif field == 'location_idx':
+                value = int(value)
+            else:
+                value = str(value).upper()
+                if value not in VOCABULARY[field]:
+                    raise InvalidCombination('Not a {0}: {1}'.format(field, value))
+            mark[field] = value
+        if not mark:
+            raise InvalidCombination('Every band needs something to match on')
+        validated.append(mark)
+    return validated
+
+
+def _like_prefix(text):
+# -----------------------------------------------------------------------------------------------------------------
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def mark_conditions(mark, column):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    SQL conditions (and their parameters) matching one validated band. column(field) is the SQL
+    for that field's value, so the same conditions can be applied to agg_mc entries.
+    """
+    conditions, params = [], []
+    for field in FIELDS:
+        if field not in mark:
+            continue
+        value = mark[field]
+        if field == 'alphanumeric_text' and value.endswith('*'):
+            conditions.append('{0} LIKE %s'.format(column(field)))
+            params.append(_like_prefix(value[:-1]))
+        else:
+            conditions.append('{0} = %s'.format(column(field)))
+            params.append(value)
+    return conditions, params
+
+
+def build_query(criteria, limit=LIMIT, filters=None, columns=EVENT_COLUMNS):
+# -----------------------------------------------------------------------------------------------------------------
+    """(sql, params) for the events matching every (validated) band, newest first."""
+    filters = filters or {}
+    unknown = sorted(set(filters) - set(FILTER_COLUMNS))
+    if unknown:
+        raise InvalidCombination('Cannot filter on: {0}'.format(', '.join(unknown)))
+
+    joins, conditions, params = [], [], []
+    for n, mark in enumerate(criteria):
+        alias = 'm{0}'.format(n)
+        if n:
+            joins.append('INNER JOIN {0} AS {1} ON {1}.event_id = m0.event_id'.format(TABLE, alias))
+        mark_sql, mark_params = mark_conditions(mark, lambda field, alias=alias: '{0}.{1}'.format(alias, field))
+        conditions.extend(mark_sql)
+        params.extend(mark_params)
+        # A different mark configuration for each band
+        for earlier in range(n):
+            conditions.append('{0}.mark_configuration_id <> m{1}.mark_configuration_id'.format(alias, earlier))
+
+    event_conditions = []
+    for column in sorted(filters):
+        event_conditions.append('AND ase.{0} = %s'.format(column))
+        params.append(filters[column])
+
+    query = '''
+        SELECT {columns} FROM {events} AS ase
+        WHERE ase.id IN (
+          SELECT m0.event_id FROM {table} AS m0
+          {joins}
+          WHERE {conditions}
+        ) {event_conditions}
+        ORDER BY ase.event_timestamp DESC, ase.id
+        LIMIT %s'''.format(columns=', '.join('ase.' + c for c in columns), events=EVENTS_TABLE, table=TABLE,
+                           joins='\n          '.join(joins), conditions='\n            AND '.join(conditions),
+                           event_conditions=' '.join(event_conditions))
+    params.append(max(1, min(int(limit), MAX_LIMIT)))
+    return query, params
+
+
+def freshness(cur):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    How far the searched tables are behind the database, from the sync's watermark. Raises
+    WatermarkMissing when they've never been rebuilt (and so have nothing in them). PendingChanges
+    stops counting at MAX_PENDING_COUNT; PendingGaps are changes from transactions that hadn't
+    committed when the sync last ran, which it looks at again next time.
+    """
+    cur.execute(FRESHNESS_SQL, (MAX_PENDING_COUNT, EVENTS_TABLE))
+    row = cur.fetchone()
+    if row is None:
+        raise WatermarkMissing('No watermark for {0}, run db_search_events_incremental.py rebuild first'.format(EVENTS_TABLE))
+    watermark, synced_at, gaps, pending, oldest_seconds = row
+    return {'Watermark': watermark, 'SyncedAt': synced_at.isoformat(), 'PendingChanges': pending, 'PendingGaps': gaps,
+            'StaleSeconds': round(oldest_seconds or 0.0, 3)}
+
+
+def search(cur, combination, limit=LIMIT, filters=None, columns=EVENT_COLUMNS):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    (events whose mark configurations match every band of the combination (text or criteria), as
+    dictionaries, how fresh they are - see freshness()).
+    """
+    criteria = parse_combination(combination) if isinstance(combination, str) else combination
+    query, params = build_query(validate(criteria), limit, filters, columns)
+    fresh = freshness(cur)
+    cur.execute(query, params)
+    names = [d[0] for d in cur.description]
+    return [dict(zip(names, row)) for row in cur.fetchall()], fresh
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('combination', help="e.g. \"left tibia red over white, right tarsus metal 'a-12*'\"")
+    parser.add_argument('--dsn', default=None, help='libpq connection string (default: $BIRDBANDING_DB_DSN / PG* env vars)')
+    parser.add_argument('--limit', type=int, default=LIMIT)
+    parser.add_argument('--filter', dest='filters', action='append', default=[], metavar='COLUMN=VALUE',
+                        help='Equality filter on one of: ' + ', '.join(FILTER_COLUMNS))
+    parser.add_argument('--max-stale-seconds', type=float, default=None,
+                        help='Exit with status 1 if a change has been waiting for the sync longer than this')
+    args = parser.parse_args()
+
+    try:
+        criteria = validate(parse_combination(args.combination))
+    except InvalidCombination as e:
+        parser.error(str(e))
+
+    filters = dict(f.split('=', 1) for f in args.filters)
+    with ConnectionPool(args.dsn, max_connections=1) as pool:
+        with pool.cursor() as cur:
+            started = time.perf_counter()
+            rows, fresh = search(cur, criteria, args.limit, filters)
+            duration_ms = round((time.perf_counter() - started) * 1000, 3)
+
+    stale = args.max_stale_seconds is not None and fresh['StaleSeconds'] > args.max_stale_seconds
+    print(json.dumps({'Criteria': criteria, 'Events': rows, 'Freshness': dict(fresh, Stale=stale),
+                      'DurationMs': duration_ms}, indent=2, default=str))
+    return 1 if stale else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
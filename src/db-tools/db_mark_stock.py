@@ -0,0 +1,294 @@
+# Incremental maintenance of mark_stock_aggregation_rollup (number_of_bands / last_short_number
+# per bander and prefix).
+#
+# rw_update_banding_office_stock, rw_update_bander_stock and rw_update_bander_stock_by_prefix
+# reset the affected (bander, prefix) groups and recount them from mark_allocation, mark_state
+# and mark, re-reading every mark of the prefix for its highest short number, on every transfer
+# or allocation. Instead, a batch of marks is snapshotted (who holds each in stock) before it is
+# written and diffed afterwards, and the differences go to the rollup as signed deltas in one
+# set-based statement:
+#
+#   - number_of_bands moves by the net +1/-1 of the batch for each group
+#   - last_short_number only goes up with the marks coming in, except for the rare group that
+#     lost its highest mark, which alone is recounted from the base tables
+#   - the banding office's rows follow the prefix's highest short number, whoever holds the
+#     marks, and keep it with no stock; everyone else's are '-' when they run out
+#
+# A mark is "in stock" with whoever its current mark_allocation is with while its current
+# mark_state is NEW, ALLOCATED or RETURNED, so apply changes once is_current is up to date
+# (after rw_update_latest_mark_allocation_and_state), in the same transaction. verify() checks
+# the whole rollup (or some prefixes) against a full recompute and can repair it, which also
+# covers anything done outside the engine (deleted marks, manual fixes).
+#
+#   engine = MarkStockEngine(banding_office_id)
+#   before = engine.snapshot(cur, mark_ids)
+#   ... write the transfer, update is_current ...
+#   engine.apply_since(cur, before)
+#
+#   python3 db_mark_stock.py verify --banding-office-id <uuid> [--prefix cp ...] [--repair]
+
+import argparse
+import json
+import time
+
+from db_pool import ConnectionPool
+
+TABLE = 'mark_stock_aggregation_rollup'
+
+IN_STOCK_STATES = ('NEW', 'ALLOCATED', 'RETURNED')
+
+_IN_STOCK = "({0})".format(', '.join("'{0}'".format(s) for s in IN_STOCK_STATES))
+_SHORT_NUMBER_VALUE = "NULLIF(regexp_replace({0}, '\\D', '', 'g'), '')::bigint"
+
+HOLDERS_SQL = '''
+    SELECT m.id::text, m.prefix_number, m.short_number,
+           CASE WHEN ms.state IN {in_stock} THEN ma.bander_id::text END
+    FROM mark AS m
+    LEFT JOIN mark_allocation AS ma ON ma.mark_id = m.id AND ma.is_current = TRUE
+    LEFT JOIN mark_state AS ms ON ms.mark_id = m.id AND ms.is_current = TRUE
+    WHERE m.id = ANY(%s::uuid[])
+'''.format(in_stock=_IN_STOCK)
+
+APPLY_SQL = '''
+    WITH change AS (
+      SELECT c.bander_id, c.prefix_number, c.delta, {value} AS short_value
+      FROM unnest(%(bander_ids)s::uuid[], %(prefix_numbers)s::text[], %(short_numbers)s::text[], %(deltas)s::integer[])
+        AS c (bander_id, prefix_number, short_number, delta)
+      UNION ALL
+      -- The banding office's last short number is the prefix's highest, whoever holds the marks
+      SELECT %(office)s::uuid, c.prefix_number, 0, {value}
+      FROM unnest(%(prefix_numbers)s::text[], %(short_numbers)s::text[]) AS c (prefix_number, short_number)
+      WHERE %(office)s::uuid IS NOT NULL
+    ),
+    delta AS (
+      SELECT bander_id, prefix_number, sum(delta)::integer AS delta,
+             COALESCE(bander_id = %(office)s::uuid, FALSE) AS is_office,
+             max(short_value) FILTER (WHERE delta > 0 OR bander_id = %(office)s::uuid) AS max_added,
+             max(short_value) FILTER (WHERE delta < 0) AS max_removed
+      FROM change
+      GROUP BY bander_id, prefix_number
+    ),
+    target AS (
+      SELECT d.*, r.id AS rollup_id, COALESCE(r.number_of_bands, 0) + d.delta AS number_of_bands,
+             {last_value} AS last_value
+      FROM delta AS d
+      LEFT JOIN LATERAL (
+        SELECT id, number_of_bands, last_short_number FROM {table}
+        WHERE bander_id = d.bander_id AND prefix_number = d.prefix_number
+        ORDER BY id LIMIT 1
+      ) AS r ON TRUE
+    ),
+    -- Only groups that may have given away their highest mark go back to the base tables
+    recounted AS (
+      SELECT t.bander_id, t.prefix_number, max({mark_value}) AS max_value
+      FROM target AS t
+      INNER JOIN mark_allocation AS ma ON ma.bander_id = t.bander_id AND ma.is_current = TRUE
+      INNER JOIN mark AS m ON m.id = ma.mark_id AND m.prefix_number = t.prefix_number
+      INNER JOIN mark_state AS ms ON ms.mark_id = ma.mark_id AND ms.is_current = TRUE AND ms.state IN {in_stock}
+      WHERE NOT t.is_office AND t.number_of_bands > 0
+        AND t.max_removed >= t.last_value AND (t.max_added IS NULL OR t.max_added < t.max_removed)
+      GROUP BY t.bander_id, t.prefix_number
+    ),
+    resolved AS (
+      SELECT t.bander_id, t.prefix_number, t.rollup_id, t.number_of_bands < 0 AS went_negative,
+             GREATEST(t.number_of_bands, 0) AS number_of_bands,
+             CASE
+               WHEN t.is_office THEN COALESCE(lpad_upto(GREATEST(t.last_value, t.max_added)::text, 4, '0'), '-')
+               WHEN t.number_of_bands <= 0 THEN '-'
+               WHEN rc.max_value IS NOT NULL THEN lpad_upto(rc.max_value::text, 4, '0')
+               ELSE COALESCE(lpad_upto(GREATEST(t.last_value, t.max_added)::text, 4, '0'), '-')
+             END AS last_short_number
+      FROM target AS t
+      LEFT JOIN recounted AS rc ON rc.bander_id = t.bander_id AND rc.prefix_number = t.prefix_number
+    ),
+    updated AS (
+      UPDATE {table} AS r
+      SET number_of_bands = s.number_of_bands, last_short_number = s.last_short_number
+      FROM resolved AS s
+      WHERE r.id = s.rollup_id
+        AND (r.number_of_bands, r.last_short_number) IS DISTINCT FROM (s.number_of_bands, s.last_short_number)
+      RETURNING r.id
+    ),
+    inserted AS (
+      INSERT INTO {table} (bander_id, prefix_number, number_of_bands, last_short_number)
+      SELECT bander_id, prefix_number, number_of_bands, last_short_number
+      FROM resolved
+      WHERE rollup_id IS NULL AND number_of_bands > 0
+      RETURNING id
+    )
+    SELECT (SELECT count(*) FROM delta), (SELECT count(*) FROM updated), (SELECT count(*) FROM inserted),
+           (SELECT count(*) FROM recounted), (SELECT count(*) FROM resolved WHERE went_negative)
+'''.format(table=TABLE, in_stock=_IN_STOCK, value=_SHORT_NUMBER_VALUE.format('c.short_number'),
+           last_value=_SHORT_NUMBER_VALUE.format('r.last_short_number'),
+           mark_value=_SHORT_NUMBER_VALUE.format('m.short_number'))
+
+# What the rw_update_*_stock functions would leave in every (bander, prefix) group, against what's there
+VERIFY_SQL = '''
+    WITH stock AS (
+      SELECT ma.bander_id, m.prefix_number, count(ma.mark_id)::integer AS number_of_bands, max({mark_value}) AS max_value
+      FROM mark_allocation AS ma
+      INNER JOIN mark_state AS ms ON ms.mark_id = ma.mark_id
+      INNER JOIN mark AS m ON m.id = ma.mark_id
+      WHERE ma.is_current = TRUE AND ms.is_current = TRUE AND ms.state IN {in_stock}
+        AND (%(prefix_numbers)s::text[] IS NULL OR m.prefix_number = ANY(%(prefix_numbers)s::text[]))
+      GROUP BY ma.bander_id, m.prefix_number
+    ),
+    prefix_max AS (
+      SELECT prefix_number, max({mark_value}) AS max_value
+      FROM mark AS m
+      WHERE %(prefix_numbers)s::text[] IS NULL OR m.prefix_number = ANY(%(prefix_numbers)s::text[])
+      GROUP BY prefix_number
+    ),
+    rollup AS (
+      SELECT r.id, r.bander_id, r.prefix_number, r.number_of_bands, r.last_short_number,
+             row_number() OVER (PARTITION BY r.bander_id, r.prefix_number ORDER BY r.id) AS n
+      FROM {table} AS r
+      WHERE %(prefix_numbers)s::text[] IS NULL OR r.prefix_number = ANY(%(prefix_numbers)s::text[])
+    ),
+    compared AS (
+      SELECT COALESCE(s.bander_id, r.bander_id) AS bander_id, COALESCE(s.prefix_number, r.prefix_number) AS prefix_number,
+             r.id AS rollup_id, r.n, r.number_of_bands AS actual_count, r.last_short_number AS actual_last,
+             COALESCE(s.number_of_bands, 0) AS expected_count,
+             CASE
+               WHEN COALESCE(COALESCE(s.bander_id, r.bander_id) = %(office)s::uuid, FALSE)
+                 THEN COALESCE(lpad_upto(pm.max_value::text, 4, '0'), '-')
+               WHEN s.number_of_bands IS NULL THEN '-'
+               ELSE COALESCE(lpad_upto(s.max_value::text, 4, '0'), '-')
+             END AS expected_last
+      FROM stock AS s
+      FULL OUTER JOIN rollup AS r ON r.bander_id = s.bander_id AND r.prefix_number = s.prefix_number
+      LEFT JOIN prefix_max AS pm ON pm.prefix_number = COALESCE(s.prefix_number, r.prefix_number)
+    )
+    SELECT bander_id::text, prefix_number, rollup_id, actual_count, actual_last, expected_count, expected_last,
+           CASE WHEN rollup_id IS NULL THEN 'Missing' WHEN n > 1 THEN 'Duplicate' ELSE 'Different' END
+    FROM compared
+    WHERE rollup_id IS NULL OR n > 1 OR actual_count <> expected_count OR actual_last <> expected_last
+    ORDER BY prefix_number, bander_id
+'''.format(table=TABLE, in_stock=_IN_STOCK, mark_value=_SHORT_NUMBER_VALUE.format('m.short_number'))
+
+
+class StockChange(object):
+# -----------------------------------------------------------------------------------------------------------------
+    """One mark going into (+1) or out of (-1) a bander's stock."""
+
+    def __init__(self, bander_id, prefix_number, short_number, delta):
+        self.bander_id = bander_id
+        self.prefix_number = prefix_number
+        self.short_number = short_number
+        self.delta = delta
+
+
+def stock_holders(cur, mark_ids):
+# -----------------------------------------------------------------------------------------------------------------
+    """{mark_id: (prefix_number, short_number, bander_id holding it in stock or None)}; deleted marks are left out."""
+    cur.execute(HOLDERS_SQL, (list(mark_ids),))
+    return dict((row[0], row[1:]) for row in cur.fetchall())
+
+
+def stock_changes(before, after):
+# -----------------------------------------------------------------------------------------------------------------
+    """The StockChanges that take the rollup from the `before` stock_holders() to the `after` ones."""
+    changes = []
+    for mark_id in set(before) | set(after):
+        was, now = before.get(mark_id), after.get(mark_id)
+        if was == now:
+            continue
+        if was is not None and was[2] is not None:
+            changes.append(StockChange(was[2], was[0], was[1], -1))
+        if now is not None and now[2] is not None:
+            changes.append(StockChange(now[2], now[0], now[1], 1))
+    return changes
+
+
+class MarkStockEngine(object):
+# -----------------------------------------------------------------------------------------------------------------
+
+    def __init__(self, banding_office_id=None):
+        self.banding_office_id = banding_office_id
+
+    def snapshot(self, cur, mark_ids):
+        return stock_holders(cur, mark_ids)
+
+    def apply(self, cur, changes):
+        """Apply StockChanges to the rollup in one statement. Returns a summary dictionary."""
+        started = time.perf_counter()
+        summary = {'Changes': len(changes), 'Groups': 0, 'Updated': 0, 'Inserted': 0, 'Recounted': 0, 'WentNegative': 0}
+        if changes:
+            cur.execute(APPLY_SQL, {
+                'bander_ids': [c.bander_id for c in changes],
+                'prefix_numbers': [c.prefix_number for c in changes],
+                'short_numbers': [c.short_number for c in changes],
+                'deltas': [c.delta for c in changes],
+                'office': self.banding_office_id,
+            })
+            groups, updated, inserted, recounted, went_negative = cur.fetchone()
+            # Anything that went negative means the rollup was already out of step - verify(repair=True) fixes it
+            summary.update(Groups=groups, Updated=updated, Inserted=inserted, Recounted=recounted,
+                           WentNegative=went_negative)
+        summary['DurationMs'] = round((time.perf_counter() - started) * 1000, 3)
+        return summary
+
+    def apply_since(self, cur, before):
+        """Apply whatever has changed for the marks in a snapshot() taken before writing them."""
+        return self.apply(cur, stock_changes(before, stock_holders(cur, before)))
+
+    def verify(self, cur, prefix_numbers=None, repair=False, limit=100):
+        """Compare the rollup (for some prefixes, or all) with a full recompute, optionally fixing it to match."""
+        started = time.perf_counter()
+        cur.execute(VERIFY_SQL, {'prefix_numbers': list(prefix_numbers) if prefix_numbers else None,
+                                 'office': self.banding_office_id})
+        differences = cur.fetchall()
+
+        report = {'Differences': len(differences), 'Consistent': not differences}
+        for kind in ('Missing', 'Duplicate', 'Different'):
+            report[kind] = len([d for d in differences if d[7] == kind])
+        report['Sample'] = [{'BanderId': d[0], 'PrefixNumber': d[1], 'Problem': d[7],
+                             'Actual': {'NumberOfBands': d[3], 'LastShortNumber': d[4]},
+                             'Expected': {'NumberOfBands': d[5], 'LastShortNumber': d[6]}} for d in differences[:limit]]
+        if repair and differences:
+            report['Repaired'] = self._repair(cur, differences)
+        report['DurationMs'] = round((time.perf_counter() - started) * 1000, 3)
+        return report
+
+    def _repair(self, cur, differences):
+        duplicates = [d[2] for d in differences if d[7] == 'Duplicate']
+        different = [d for d in differences if d[7] == 'Different']
+        missing = [d for d in differences if d[7] == 'Missing']
+        if duplicates:
+            cur.execute('DELETE FROM {0} WHERE id = ANY(%s::integer[])'.format(TABLE), (duplicates,))
+        if different:
+            cur.execute('''
+                UPDATE {0} AS r SET number_of_bands = d.number_of_bands, last_short_number = d.last_short_number
+                FROM unnest(%s::integer[], %s::integer[], %s::text[]) AS d (id, number_of_bands, last_short_number)
+                WHERE r.id = d.id'''.format(TABLE), ([d[2] for d in different], [d[5] for d in different],
+                                                   [d[6] for d in different]))
+        if missing:
+            cur.execute('''
+                INSERT INTO {0} (bander_id, prefix_number, number_of_bands, last_short_number)
+                SELECT * FROM unnest(%s::uuid[], %s::text[], %s::integer[], %s::text[])'''.format(TABLE),
+                        ([d[0] for d in missing], [d[1] for d in missing], [d[5] for d in missing],
+                         [d[6] for d in missing]))
+        return {'Deleted': len(duplicates), 'Updated': len(different), 'Inserted': len(missing)}
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=('verify',))
+    parser.add_argument('--dsn', default=None, help='libpq connection string (default: $BIRDBANDING_DB_DSN / PG* env vars)')
+    parser.add_argument('--banding-office-id', help='Bander id of the banding office (its rows track the prefix maximum)')
+    parser.add_argument('--prefix', dest='prefix_numbers', action='append', help='Just this prefix (repeatable)')
+    parser.add_argument('--repair', action='store_true', help='Bring the rollup in line with the recompute')
+    args = parser.parse_args()
+
+    engine = MarkStockEngine(args.banding_office_id)
+    with ConnectionPool(args.dsn, max_connections=1) as pool:
+        with pool.cursor(autocommit=False) as cur:
+            result = engine.verify(cur, args.prefix_numbers, repair=args.repair)
+
+    print(json.dumps(result, indent=2))
+    return 0 if result['Consistent'] or args.repair else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,206 @@
+# Dependency-aware, parallel refresh of the materialized views in sql/4_create_materialized_views.sql.
+#
+# The views were being refreshed one rw_refresh_*_matview() call at a time, in whatever order
+# the caller happened to list them. Most of them only read base tables and can be refreshed side
+# by side, but the search_events_sort_* views LEFT JOIN bander_birds_matview and so must wait for
+# it. This builds that dependency graph, refreshes every view as soon as the views it reads are
+# done (over a small connection pool), and records how long each refresh took.
+#
+# REFRESH ... CONCURRENTLY errors on a view that has never been populated (e.g. straight after
+# it was created WITH NO DATA, or on a fresh restore), so those go through the _non_conc
+# variant of the refresh function instead. Every rw_refresh_* function waits on the view's
+# advisory lock (ro_matview_lock_key), so this never overlaps a refresh of the same view
+# started elsewhere, e.g. by db_refresh_coordinator.
+#
+# Usage (from src/db-tools, against any PostgreSQL the sql/ scripts have been run on):
+#   python3 db_matview_refresh.py [--dsn "host=localhost dbname=birdbanding"] [--workers 4]
+#                                 [--only search_events_sort_timestamp ...] [--non-concurrent] [--plan]
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import json
+import time
+
+import psycopg2
+import psycopg2.errorcodes
+
+from db_pool import ConnectionPool
+
+REFRESH_WORKERS = 4
+
+# SQLSTATE raised by REFRESH ... CONCURRENTLY against an unpopulated view
+NOT_POPULATED_SQLSTATE = psycopg2.errorcodes.OBJECT_NOT_IN_PREREQUISITE_STATE
+
+SUCCEEDED = 'Succeeded'
+FAILED = 'Failed'
+SKIPPED = 'Skipped'
+
+
+class Matview(object):
+# -----------------------------------------------------------------------------------------------------------------
+
+    def __init__(self, name, refresh_function, depends_on=()):
+        self.name = name
+        self.refresh_function = refresh_function
+        self.depends_on = tuple(depends_on)
+
+    def function_for(self, concurrent):
+        return self.refresh_function if concurrent else self.refresh_function + '_non_conc'
+
+
+def _sort_view(key):
+# -----------------------------------------------------------------------------------------------------------------
+    # Note: the sort views' refresh functions say "event", the views themselves say "events"
+    return Matview('search_events_sort_' + key, 'rw_refresh_search_event_sort_' + key + '_matview',
+                   depends_on=('bander_birds_matview',))
+
+
+MATVIEWS = [
+    Matview('bander_birds_matview', 'rw_refresh_bander_birds_matview'),
+    Matview('advanced_search_events', 'rw_refresh_advanced_search_events_matview'),
+    _sort_view('timestamp'),
+    _sort_view('prefix_number'),
+    _sort_view('short_number'),
+    _sort_view('project_name'),
+    _sort_view('species_common_name'),
+    _sort_view('row_creation_timestamp'),
+    Matview('project_event_counts_matview', 'rw_refresh_project_event_counts_matview'),
+    Matview('mark_pagination_sort_band_number_matview', 'rw_refresh_mark_pagination_sort_band_number_matview'),
+    Matview('mark_latest_matview', 'rw_refresh_mark_latest_matview'),
+]
+
+MATVIEWS_BY_NAME = dict((m.name, m) for m in MATVIEWS)
+
+
+def select_matviews(names=None):
+# -----------------------------------------------------------------------------------------------------------------
+    # Dependencies on views that weren't selected are dropped - they're taken to be fresh enough already
+    if not names:
+        return list(MATVIEWS)
+
+    unknown = sorted(set(names) - set(MATVIEWS_BY_NAME))
+    if unknown:
+        raise ValueError('Unknown materialized view(s): {0}'.format(', '.join(unknown)))
+
+    selected = set(names)
+    return [Matview(m.name, m.refresh_function, [d for d in m.depends_on if d in selected])
+            for m in MATVIEWS if m.name in selected]
+
+
+def refresh_levels(matviews):
+# -----------------------------------------------------------------------------------------------------------------
+    # Topological layers of the graph: everything in a layer can be refreshed at the same time.
+    # Only used to describe the plan, the scheduler itself starts each view as soon as it can.
+    remaining = dict((m.name, set(m.depends_on)) for m in matviews)
+    levels = []
+    while remaining:
+        ready = sorted(name for name, deps in remaining.items() if not deps)
+        if not ready:
+            raise ValueError('Materialized view dependency cycle between: {0}'.format(', '.join(sorted(remaining))))
+        levels.append(ready)
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return levels
+
+
+def populated_matviews(pool):
+# -----------------------------------------------------------------------------------------------------------------
+    with pool.cursor() as cur:
+        cur.execute('SELECT matviewname, ispopulated FROM pg_matviews WHERE schemaname = current_schema()')
+        return dict(cur.fetchall())
+
+
+def refresh_one(pool, matview, concurrent):
+# -----------------------------------------------------------------------------------------------------------------
+    result = {'Matview': matview.name, 'Concurrent': concurrent, 'FellBack': False}
+    started = time.perf_counter()
+    try:
+        with pool.cursor() as cur:
+            try:
+                cur.execute('SELECT {0}()'.format(matview.function_for(concurrent)))
+            except psycopg2.Error as e:
+                # Lost a race with something that emptied the view after we checked pg_matviews
+                if not concurrent or e.pgcode != NOT_POPULATED_SQLSTATE:
+                    raise
+                result.update(Concurrent=False, FellBack=True)
+                cur.execute('SELECT {0}()'.format(matview.function_for(False)))
+        result['Status'] = SUCCEEDED
+    except Exception as e:
+        result.update(Status=FAILED, Message=str(e).strip())
+    result['DurationMs'] = round((time.perf_counter() - started) * 1000, 3)
+    return result
+
+
+def refresh_matviews(pool, matviews=None, workers=REFRESH_WORKERS, concurrent=True):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    Refresh matviews (default: all of them) respecting dependencies, up to `workers` at a time.
+    Returns (per-view results in completion order, total wall time in ms). A view whose
+    dependency failed is not refreshed and is reported as Skipped.
+    """
+    matviews = list(MATVIEWS if matviews is None else matviews)
+    refresh_levels(matviews)  # Fails fast on a cycle
+
+    populated = populated_matviews(pool) if concurrent else {}
+    waiting_on = dict((m.name, set(m.depends_on)) for m in matviews)
+    by_name = dict((m.name, m) for m in matviews)
+    results = []
+    running = {}
+
+    started = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='matview-refresh')
+    try:
+        while waiting_on or running:
+            for name in sorted(n for n, deps in waiting_on.items() if not deps):
+                del waiting_on[name]
+                matview = by_name[name]
+                use_concurrent = concurrent and populated.get(name, True)
+                running[executor.submit(refresh_one, pool, matview, use_concurrent)] = name
+
+            if not running:
+                # Everything left is waiting on a failure
+                for name in sorted(waiting_on):
+                    results.append({'Matview': name, 'Status': SKIPPED,
+                                    'Message': 'Dependency failed: ' + ', '.join(sorted(by_name[name].depends_on))})
+                break
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                result = future.result()
+                results.append(result)
+                if result['Status'] == SUCCEEDED:
+                    for deps in waiting_on.values():
+                        deps.discard(name)
+    finally:
+        executor.shutdown(wait=True)
+
+    return results, round((time.perf_counter() - started) * 1000, 3)
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default=None, help='libpq connection string (default: $BIRDBANDING_DB_DSN / PG* env vars)')
+    parser.add_argument('--workers', type=int, default=REFRESH_WORKERS)
+    parser.add_argument('--only', nargs='+', metavar='MATVIEW', help='Refresh just these views')
+    parser.add_argument('--non-concurrent', action='store_true', help='Always use the _non_conc refresh functions')
+    parser.add_argument('--plan', action='store_true', help='Print the refresh order and exit without connecting')
+    args = parser.parse_args()
+
+    matviews = select_matviews(args.only)
+    if args.plan:
+        print(json.dumps({'Levels': refresh_levels(matviews)}, indent=2))
+        return 0
+
+    with ConnectionPool(args.dsn, max_connections=max(1, args.workers)) as pool:
+        results, total_ms = refresh_matviews(pool, matviews, workers=args.workers, concurrent=not args.non_concurrent)
+
+    print(json.dumps({'TotalMs': total_ms, 'Refreshes': results}, indent=2))
+    return 0 if all(r['Status'] == SUCCEEDED for r in results) else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
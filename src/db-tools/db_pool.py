@@ -0,0 +1,83 @@
+# Small thread-safe PostgreSQL connection pool shared by the database maintenance tools.
+#
+# Connection details come from a libpq connection string (--dsn / BIRDBANDING_DB_DSN) or, when
+# that's empty, the usual libpq environment variables (PGHOST, PGPORT, PGDATABASE, PGUSER,
+# PGPASSWORD), so the same tools run unchanged against a local PostgreSQL or the Aurora cluster
+# through the bastion.
+
+import contextlib
+import os
+
+import psycopg2
+import psycopg2.pool
+
+DSN_ENV_VAR = 'BIRDBANDING_DB_DSN'
+
+APPLICATION_NAME = 'birdbanding-db-tools'
+
+
+def default_dsn(dsn=None):
+# -----------------------------------------------------------------------------------------------------------------
+    if dsn:
+        return dsn
+    return os.environ.get(DSN_ENV_VAR, '')
+
+
+class ConnectionPool(object):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    Wraps psycopg2's ThreadedConnectionPool so callers can just do
+
+        with pool.connection() as conn:
+            ...
+
+    Connections are autocommit unless asked otherwise (maintenance work like REFRESH / COPY /
+    CREATE INDEX CONCURRENTLY manages its own transactions), and any connection that comes back
+    broken is thrown away rather than handed to the next caller.
+    """
+
+    def __init__(self, dsn=None, max_connections=4, min_connections=1, autocommit=True, statement_timeout_ms=None):
+        self.dsn = default_dsn(dsn)
+        self.max_connections = max_connections
+        self.autocommit = autocommit
+        self.statement_timeout_ms = statement_timeout_ms
+        self._pool = psycopg2.pool.ThreadedConnectionPool(min(min_connections, max_connections), max_connections,
+                                                          dsn=self.dsn, application_name=APPLICATION_NAME)
+
+    @contextlib.contextmanager
+    def connection(self, autocommit=None):
+        conn = self._pool.getconn()
+        broken = False
+        try:
+            conn.autocommit = self.autocommit if autocommit is None else autocommit
+            if self.statement_timeout_ms is not None:
+                with conn.cursor() as cur:
+                    cur.execute('SET statement_timeout = %s', (int(self.statement_timeout_ms),))
+            yield conn
+            if not conn.autocommit:
+                conn.commit()
+        except Exception:
+            try:
+                if not conn.closed:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+            raise
+        finally:
+            broken = broken or bool(conn.closed)
+            self._pool.putconn(conn, close=broken)
+
+    @contextlib.contextmanager
+    def cursor(self, autocommit=None):
+        with self.connection(autocommit=autocommit) as conn:
+            with conn.cursor() as cur:
+                yield cur
+
+    def close(self):
+        self._pool.closeall()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,165 @@
+# Coalescing materialized view refresh requests.
+#
+# Every upload/edit wants "the search views refreshed", but a refresh of the bigger views takes
+# far longer than the gap between requests, so refreshing once per request just queues up
+# duplicate work (and rw_refresh_* now serialise on a per-view advisory lock anyway, see
+# ro_matview_lock_key in 3_create_functions.sql). Instead, callers signal that a view is stale:
+#
+#   - if nothing is refreshing it, a refresh starts straight away
+#   - if a refresh is already running, the view is marked dirty, and however many more signals
+#     arrive before that refresh finishes, exactly one follow-up refresh runs after it
+#     (the running refresh may have read the tables before the change being signalled)
+#
+# Refreshes go through rw_try_refresh_matview, so a refresh already running in another process
+# (the API, db_matview_refresh.py) is waited out rather than duplicated.
+#
+#   coordinator = RefreshCoordinator(ConnectionPool(max_connections=2))
+#   coordinator.request('advanced_search_events')
+#   coordinator.queue_depth('advanced_search_events'), coordinator.last_refresh_age('advanced_search_events')
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from db_matview_refresh import MATVIEWS_BY_NAME
+
+COORDINATOR_WORKERS = 2
+
+# How long to wait before trying again when another process holds the view's refresh lock
+LOCK_RETRY_SECONDS = 1.0
+
+
+class MatviewState(object):
+# -----------------------------------------------------------------------------------------------------------------
+
+    def __init__(self, name):
+        self.name = name
+        self.running = False
+        self.dirty = False
+        self.pending_requests = 0     # Signals received that no started refresh has covered yet
+        self.requests = 0
+        self.refreshes = 0
+        self.failures = 0
+        self.lock_waits = 0
+        self.last_refreshed = None    # time.monotonic() at the end of the last successful refresh
+        self.last_duration_ms = None
+        self.last_error = None
+
+    def snapshot(self, now):
+        return {
+            'Matview': self.name,
+            'Running': self.running,
+            'QueueDepth': self.pending_requests,
+            'Requests': self.requests,
+            'Refreshes': self.refreshes,
+            'Failures': self.failures,
+            'LockWaits': self.lock_waits,
+            'LastRefreshAgeSeconds': None if self.last_refreshed is None else round(now - self.last_refreshed, 3),
+            'LastDurationMs': self.last_duration_ms,
+            'LastError': self.last_error,
+        }
+
+
+class RefreshCoordinator(object):
+# -----------------------------------------------------------------------------------------------------------------
+
+    def __init__(self, pool, workers=COORDINATOR_WORKERS, concurrent=True, lock_retry_seconds=LOCK_RETRY_SECONDS):
+        self.pool = pool
+        self.concurrent = concurrent
+        self.lock_retry_seconds = lock_retry_seconds
+        self._states = dict((name, MatviewState(name)) for name in MATVIEWS_BY_NAME)
+        self._cond = threading.Condition()
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='matview-coordinator')
+
+    def request(self, *names):
+        """Signal that the given views are stale. Never blocks on the refresh itself."""
+        for name in names:
+            state = self._state(name)
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError('RefreshCoordinator is closed')
+                state.requests += 1
+                state.pending_requests += 1
+                state.dirty = True
+                if state.running:
+                    continue
+                state.running = True
+            self._executor.submit(self._refresh_loop, state)
+
+    def queue_depth(self, name=None):
+        """Number of refresh requests not yet covered by a started refresh (for one view, or all of them)."""
+        with self._cond:
+            if name is not None:
+                return self._state(name).pending_requests
+            return sum(s.pending_requests for s in self._states.values())
+
+    def last_refresh_age(self, name):
+        """Seconds since the view last finished refreshing through this coordinator, or None if it hasn't."""
+        with self._cond:
+            last_refreshed = self._state(name).last_refreshed
+        return None if last_refreshed is None else time.monotonic() - last_refreshed
+
+    def status(self):
+        now = time.monotonic()
+        with self._cond:
+            return [self._states[name].snapshot(now) for name in sorted(self._states)]
+
+    def wait_idle(self, timeout=None):
+        """Block until nothing is running or dirty. Returns False if the timeout ran out first."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not any(s.running for s in self._states.values()), timeout=timeout)
+
+    def close(self, wait=True):
+        with self._cond:
+            self._closed = True
+        self._executor.shutdown(wait=wait)
+
+    def _state(self, name):
+        try:
+            return self._states[name]
+        except KeyError:
+            raise ValueError('Unknown materialized view: {0}'.format(name))
+
+    def _refresh_loop(self, state):
+        while True:
+            with self._cond:
+                if not state.dirty or self._closed:
+                    state.running = False
+                    self._cond.notify_all()
+                    return
+                # Everything signalled up to now is covered by the refresh we're about to start
+                state.dirty = False
+                covered = state.pending_requests
+
+            started = time.perf_counter()
+            try:
+                refreshed = self._try_refresh(state.name)
+            except Exception as e:
+                with self._cond:
+                    state.failures += 1
+                    state.last_error = str(e).strip()
+                    # Leave the requests queued; the next signal will try again
+                    state.running = False
+                    self._cond.notify_all()
+                return
+
+            with self._cond:
+                if refreshed:
+                    state.refreshes += 1
+                    state.pending_requests -= covered
+                    state.last_refreshed = time.monotonic()
+                    state.last_duration_ms = round((time.perf_counter() - started) * 1000, 3)
+                    state.last_error = None
+                else:
+                    # Someone else is refreshing it, but may have started before our changes
+                    # were committed - go round again once they're done
+                    state.lock_waits += 1
+                    state.dirty = True
+            if not refreshed:
+                time.sleep(self.lock_retry_seconds)
+
+    def _try_refresh(self, name):
+        with self.pool.cursor() as cur:
+            cur.execute('SELECT rw_try_refresh_matview(%s, %s)', (name, self.concurrent))
+            return cur.fetchone()[0]
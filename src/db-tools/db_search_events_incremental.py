@@ -0,0 +1,338 @@
+# Incremental maintenance of advanced_search_events_incremental, the table equivalent of the
+# advanced_search_events matview (both are vw_advanced_search_events_source, see
+# sql/4_create_materialized_views.sql).
+#
+# Refreshing the matview recomputes every event after every upload. Instead, triggers log the
+# events touched by each change in search_event_change, and sync() reads search_event_change from
+# where it last got to, works out which event rows that affects (fanning bird/project/bander/species/
+# species group changes out to their events), and recomputes just those: delete + re-insert from the source
+# view, in the same transaction as moving the watermark on.
+#
+# search_event_change ids are handed out when a row is inserted but only become visible when its
+# transaction commits, so a long upload can commit ids *below* ones we've already read. Those
+# skipped ids are kept as "pending gaps" on the watermark and re-read on later runs until they
+# turn up or are old enough (GAP_RETENTION_SECONDS) that their transaction must have rolled back.
+#
+# The events' mark configurations are kept one row each in advanced_search_mark_configuration,
+# recomputed along with their events, for the indexed mark searches in db_mark_search.py.
+#
+# check() diffs both tables against a full recompute (and can repair the differences).
+#
+# Usage (from src/db-tools):
+#   python3 db_search_events_incremental.py rebuild     # full load, sets the watermark
+#   python3 db_search_events_incremental.py sync        # apply search_event_change since the watermark
+#   python3 db_search_events_incremental.py check [--repair]
+
+import argparse
+import json
+import time
+
+from psycopg2.extras import Json
+
+from db_pool import ConnectionPool
+
+TABLE = 'advanced_search_events_incremental'
+SOURCE_VIEW = 'vw_advanced_search_events_source'
+MARKS_TABLE = 'advanced_search_mark_configuration'
+MARKS_SOURCE_VIEW = 'vw_advanced_search_mark_configuration_source'
+
+# Written by the triggers in sql/4_create_materialized_views.sql (not record_action, which is the data platform's)
+CHANGE_TABLE = 'search_event_change'
+
+# search_event_change rows read per transaction
+BATCH_ACTIONS = 5000
+
+# Event rows recomputed per statement
+RECOMPUTE_CHUNK = 1000
+
+# Long enough for any transaction that could write search_event_change to have finished (API Lambdas are capped at 15 minutes)
+GAP_RETENTION_SECONDS = 30 * 60
+
+# Changes to rows of these tables identify the event(s) they belong to directly
+EVENT_KEYS = {
+    ('event', 'id'),
+    ('mark_configuration', 'event_id'),
+    ('characteristic_measurement', 'event_id'),
+}
+
+SPECIES_EVENTS = '''
+        SELECT e.id FROM event AS e INNER JOIN bird AS b ON b.id = e.bird_id
+        WHERE b.species_id = ANY(%s::integer[])'''
+
+# Changes to rows of these tables affect every event that refers to them, by (table, identifier logged)
+FAN_OUT_QUERIES = {
+    ('bird', 'id'): 'SELECT id FROM event WHERE bird_id = ANY(%s::uuid[])',
+    ('project', 'id'): 'SELECT id FROM event WHERE project_id = ANY(%s::uuid[])',
+    ('bander', 'id'): '''
+        SELECT id FROM event WHERE event_reporter_id = ANY(%(ids)s::uuid[])
+        UNION SELECT id FROM event WHERE event_provider_id = ANY(%(ids)s::uuid[])
+        UNION SELECT id FROM event WHERE event_owner_id = ANY(%(ids)s::uuid[])''',
+    ('species', 'id'): SPECIES_EVENTS,
+    # A species joining or leaving a group adds or removes its events' rows (the source view inner joins groups)
+    ('species_group_membership', 'species_id'): SPECIES_EVENTS,
+    ('species_group', 'id'): '''
+        SELECT e.id FROM event AS e
+        INNER JOIN bird AS b ON b.id = e.bird_id
+        INNER JOIN species_group_membership AS sgm ON sgm.species_id = b.species_id
+        WHERE sgm.group_id = ANY(%s::integer[])''',
+}
+
+# Row contents for comparison, with agg_mc sorted (jsonb_agg's order isn't stable between runs)
+NORMALISED_ROW = '''md5((to_jsonb({alias}) - 'agg_mc'
+    || jsonb_build_object('agg_mc', (SELECT jsonb_agg(mc ORDER BY mc::text) FROM jsonb_array_elements({alias}.agg_mc) AS mc)))::text)'''
+
+# Mark configurations of the events that are in the table (those of unsearchable event types aren't)
+INSERT_MARKS = '''
+    INSERT INTO {marks} SELECT s.* FROM {source} AS s
+    INNER JOIN {table} AS t ON t.id = s.event_id'''.format(marks=MARKS_TABLE, source=MARKS_SOURCE_VIEW, table=TABLE)
+
+
+class WatermarkMissing(Exception):
+# -----------------------------------------------------------------------------------------------------------------
+    pass
+
+
+def read_watermark(cur, name=TABLE):
+# -----------------------------------------------------------------------------------------------------------------
+    # Row lock doubles as the guard against two syncs running at once
+    cur.execute('SELECT last_change_id, pending_gaps FROM incremental_refresh_watermark WHERE name = %s FOR UPDATE NOWAIT',
+                (name,))
+    row = cur.fetchone()
+    if row is None:
+        raise WatermarkMissing('No watermark for {0}, run a rebuild first'.format(name))
+    return row[0], [tuple(g) for g in row[1]]
+
+
+def write_watermark(cur, last_id, gaps, name=TABLE):
+# -----------------------------------------------------------------------------------------------------------------
+    cur.execute('''
+        INSERT INTO incremental_refresh_watermark (name, last_change_id, pending_gaps, row_update_timestamp_)
+        VALUES (%s, %s, %s, now())
+        ON CONFLICT (name) DO UPDATE
+        SET last_change_id = EXCLUDED.last_change_id, pending_gaps = EXCLUDED.pending_gaps,
+            row_update_timestamp_ = EXCLUDED.row_update_timestamp_''', (name, last_id, Json([list(g) for g in gaps])))
+
+
+def fetch_actions(cur, last_id, gaps, limit=BATCH_ACTIONS):
+# -----------------------------------------------------------------------------------------------------------------
+    # Anything that has turned up in the gaps (one range scan each), then the next batch past the watermark
+    actions = []
+    if gaps:
+        cur.execute('''
+            SELECT c.id, c.db_table, c.db_table_identifier_name, c.db_table_identifier_value
+            FROM unnest(%s::bigint[], %s::bigint[]) AS g(from_id, to_id)
+            INNER JOIN LATERAL (
+              SELECT * FROM {0} WHERE id BETWEEN g.from_id AND g.to_id
+            ) AS c ON TRUE'''.format(CHANGE_TABLE), ([g[0] for g in gaps], [g[1] for g in gaps]))
+        actions.extend(cur.fetchall())
+
+    cur.execute('''
+        SELECT id, db_table, db_table_identifier_name, db_table_identifier_value
+        FROM {0} WHERE id > %s ORDER BY id LIMIT %s'''.format(CHANGE_TABLE), (last_id, limit))
+    new_actions = cur.fetchall()
+    actions.extend(new_actions)
+    return actions, [a[0] for a in new_actions]
+
+
+def next_gaps(gaps, last_id, new_ids, seen_ids, now):
+# -----------------------------------------------------------------------------------------------------------------
+    # Old gaps minus whatever filled them, plus any holes among the newly read ids
+    remaining = []
+    for from_id, to_id, first_seen in gaps:
+        if now - first_seen > GAP_RETENTION_SECONDS:
+            continue
+        start = from_id
+        for seen in sorted(i for i in seen_ids if from_id <= i <= to_id):
+            if seen > start:
+                remaining.append((start, seen - 1, first_seen))
+            start = seen + 1
+        if start <= to_id:
+            remaining.append((start, to_id, first_seen))
+
+    previous = last_id
+    for action_id in new_ids:
+        if action_id > previous + 1:
+            remaining.append((previous + 1, action_id - 1, now))
+        previous = action_id
+    return remaining
+
+
+def affected_events(cur, actions):
+# -----------------------------------------------------------------------------------------------------------------
+    event_ids = set()
+    fan_out = {}
+    ignored = 0
+    for _, table, identifier_name, value in actions:
+        if (table, identifier_name) in EVENT_KEYS:
+            event_ids.add(value)
+        elif (table, identifier_name) in FAN_OUT_QUERIES:
+            fan_out.setdefault((table, identifier_name), set()).add(value)
+        else:
+            ignored += 1
+
+    for key, ids in sorted(fan_out.items()):
+        query = FAN_OUT_QUERIES[key]
+        ids = sorted(ids)
+        cur.execute(query, {'ids': ids} if '%(ids)s' in query else (ids,))
+        event_ids.update(str(row[0]) for row in cur.fetchall())
+
+    return event_ids, ignored
+
+
+def recompute_events(cur, event_ids):
+# -----------------------------------------------------------------------------------------------------------------
+    # Deleted (or no longer searchable) events just don't come back from the source view
+    event_ids = sorted(event_ids)
+    removed, upserted = 0, 0
+    for i in range(0, len(event_ids), RECOMPUTE_CHUNK):
+        chunk = event_ids[i:i + RECOMPUTE_CHUNK]
+        cur.execute('DELETE FROM {0} WHERE id = ANY(%s::uuid[])'.format(TABLE), (chunk,))
+        removed += cur.rowcount
+        cur.execute('INSERT INTO {0} SELECT * FROM {1} WHERE id = ANY(%s::uuid[])'.format(TABLE, SOURCE_VIEW), (chunk,))
+        upserted += cur.rowcount
+        cur.execute('DELETE FROM {0} WHERE event_id = ANY(%s::uuid[])'.format(MARKS_TABLE), (chunk,))
+        cur.execute(INSERT_MARKS + ' WHERE s.event_id = ANY(%s::uuid[])', (chunk,))
+    return removed, upserted
+
+
+def sync(pool, batch_actions=BATCH_ACTIONS):
+# -----------------------------------------------------------------------------------------------------------------
+    """Apply search_event_change since the watermark, one transaction per batch. Returns a summary dictionary."""
+    summary = {'Batches': 0, 'Actions': 0, 'Ignored': 0, 'Events': 0, 'Upserted': 0, 'Removed': 0,
+               'Watermark': None, 'PendingGaps': None}
+    started = time.perf_counter()
+    gaps_read = False
+    while True:
+        with pool.cursor(autocommit=False) as cur:
+            # Gaps get one look per run: only the first batch re-reads them, later ones carry them over
+            last_id, gaps = read_watermark(cur)
+            actions, new_ids = fetch_actions(cur, last_id, [] if gaps_read else gaps, batch_actions)
+            if not actions and (gaps_read or not gaps):
+                break
+
+            event_ids, ignored = affected_events(cur, actions)
+            removed, upserted = recompute_events(cur, event_ids)
+
+            new_gaps = next_gaps(gaps, last_id, new_ids, set(a[0] for a in actions), time.time())
+            write_watermark(cur, new_ids[-1] if new_ids else last_id, new_gaps)
+
+        summary['Batches'] += 1
+        summary['Actions'] += len(actions)
+        summary['Ignored'] += ignored
+        summary['Events'] += len(event_ids)
+        summary['Upserted'] += upserted
+        summary['Removed'] += removed
+        summary.update(Watermark=new_ids[-1] if new_ids else last_id, PendingGaps=len(new_gaps))
+        gaps_read = True
+
+        # Keep going only while there's a backlog past the watermark
+        if len(new_ids) < batch_actions:
+            break
+
+    summary['DurationMs'] = round((time.perf_counter() - started) * 1000, 3)
+    return summary
+
+
+def current_position(cur):
+# -----------------------------------------------------------------------------------------------------------------
+    """(last_change_id, pending_gaps) for a watermark starting from the current end of search_event_change."""
+    cur.execute('SELECT COALESCE(MAX(id), 0) FROM {0}'.format(CHANGE_TABLE))
+    last_id = cur.fetchone()[0]
+
+    # Holes among recently logged ids may belong to transactions still in flight
+    cur.execute('SELECT id FROM {0} WHERE row_creation_timestamp_ > now() - %s * interval \'1 second\' ORDER BY id'.format(CHANGE_TABLE),
+                (GAP_RETENTION_SECONDS,))
+    recent_ids = [row[0] for row in cur.fetchall()]
+    gaps = next_gaps([], recent_ids[0], recent_ids[1:], set(), time.time()) if recent_ids else []
+    return last_id, gaps
+
+
+def rebuild(pool):
+# -----------------------------------------------------------------------------------------------------------------
+    """Reload both tables from their source views and start the watermark from the current end of search_event_change."""
+    started = time.perf_counter()
+    with pool.cursor(autocommit=False) as cur:
+        # Watermark and reload from the same snapshot
+        cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        last_id, gaps = current_position(cur)
+
+        cur.execute('TRUNCATE {0}, {1}'.format(TABLE, MARKS_TABLE))
+        cur.execute('INSERT INTO {0} SELECT * FROM {1}'.format(TABLE, SOURCE_VIEW))
+        rows = cur.rowcount
+        cur.execute(INSERT_MARKS)
+        mark_rows = cur.rowcount
+        write_watermark(cur, last_id, gaps)
+    with pool.cursor() as cur:
+        cur.execute('ANALYZE {0}'.format(TABLE))
+        cur.execute('ANALYZE {0}'.format(MARKS_TABLE))
+    return {'Rows': rows, 'MarkRows': mark_rows, 'Watermark': last_id, 'PendingGaps': len(gaps), 'DurationMs': round((time.perf_counter() - started) * 1000, 3)}
+
+
+def check(pool, repair=False, limit=100):
+# -----------------------------------------------------------------------------------------------------------------
+    """Diff both tables against a full recompute of their source views. Optionally recompute the events that differ."""
+    started = time.perf_counter()
+    with pool.cursor(autocommit=False) as cur:
+        # One snapshot for both sides, so in-flight changes can't show up as differences
+        cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        cur.execute('''
+            WITH expected AS (SELECT s.id, {expected} AS row_hash FROM {source} AS s),
+                 actual AS (SELECT t.id, {actual} AS row_hash FROM {table} AS t)
+            SELECT COALESCE(e.id, a.id)::text,
+                   CASE WHEN a.id IS NULL THEN 'Missing' WHEN e.id IS NULL THEN 'Extra' ELSE 'Different' END
+            FROM expected AS e
+            FULL OUTER JOIN actual AS a ON a.id = e.id
+            WHERE e.row_hash IS DISTINCT FROM a.row_hash'''.format(
+                expected=NORMALISED_ROW.format(alias='s'), actual=NORMALISED_ROW.format(alias='t'),
+                source=SOURCE_VIEW, table=TABLE))
+        differences = cur.fetchall()
+
+        # The mark configurations the table's events should have, by event
+        cur.execute('''
+            WITH expected AS (SELECT s.event_id, md5(to_jsonb(s)::text) AS row_hash FROM {source} AS s
+                              WHERE s.event_id IN (SELECT id FROM {table})),
+                 actual AS (SELECT m.event_id, md5(to_jsonb(m)::text) AS row_hash FROM {marks} AS m)
+            SELECT DISTINCT COALESCE(e.event_id, a.event_id)::text, 'MarkConfiguration'
+            FROM expected AS e
+            FULL OUTER JOIN actual AS a ON a.event_id = e.event_id AND a.row_hash = e.row_hash
+            WHERE e.row_hash IS NULL OR a.row_hash IS NULL'''.format(
+                source=MARKS_SOURCE_VIEW, table=TABLE, marks=MARKS_TABLE))
+        differences.extend(cur.fetchall())
+
+    report = {'Differences': len(differences), 'Consistent': not differences}
+    for kind in ('Missing', 'Extra', 'Different', 'MarkConfiguration'):
+        report[kind] = len([d for d in differences if d[1] == kind])
+    report['Sample'] = [{'EventId': d[0], 'Problem': d[1]} for d in differences[:limit]]
+
+    if repair and differences:
+        with pool.cursor(autocommit=False) as cur:
+            removed, upserted = recompute_events(cur, set(d[0] for d in differences))
+        report['Repaired'] = {'Removed': removed, 'Upserted': upserted}
+
+    report['DurationMs'] = round((time.perf_counter() - started) * 1000, 3)
+    return report
+
+
+def main():
+# -----------------------------------------------------------------------------------------------------------------
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=('sync', 'rebuild', 'check'))
+    parser.add_argument('--dsn', default=None, help='libpq connection string (default: $BIRDBANDING_DB_DSN / PG* env vars)')
+    parser.add_argument('--batch-actions', type=int, default=BATCH_ACTIONS)
+    parser.add_argument('--repair', action='store_true', help='check: recompute any rows that differ')
+    args = parser.parse_args()
+
+    with ConnectionPool(args.dsn, max_connections=1) as pool:
+        if args.command == 'sync':
+            result = sync(pool, args.batch_actions)
+        elif args.command == 'rebuild':
+            result = rebuild(pool)
+        else:
+            result = check(pool, repair=args.repair)
+
+    print(json.dumps(result, indent=2))
+    return 1 if args.command == 'check' and not result['Consistent'] and not args.repair else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,164 @@
+# Splitting the sql/ scripts into individual statements.
+#
+# The scripts are written for psql (one big file, statements separated by ';'), but tools that
+# run them through psycopg2 want one statement at a time so they can report exactly which one
+# failed and carry on past the ones that only make sense on Aurora. A plain split on ';' breaks
+# on the function bodies, so this understands just enough of PostgreSQL's lexical rules to
+# know when a ';' really ends a statement:
+#
+#   - -- line comments and /* block comments */ (which nest in PostgreSQL)
+#   - 'string literals' (with '' escapes) and E'escape strings' (with \' escapes)
+#   - "quoted identifiers"
+#   - $$dollar quoted$$ and $tag$dollar quoted$tag$ bodies
+#
+#   for line_number, statement in split_statements(open('sql/2_create_tables.sql').read()):
+#       ...
+
+import os
+import re
+
+SQL_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'sql'))
+SCHEMA_SCRIPTS = ['1_create_prereqs.sql', '2_create_tables.sql', '3_create_functions.sql',
+                  '4_create_materialized_views.sql', '5_create_views.sql']
+
+# A dollar quote tag: $$ or $name$ (names can't start with a digit, which keeps $1 parameters out)
+DOLLAR_TAG = re.compile(r'\$(?:[A-Za-z_][A-Za-z_0-9]*)?\$')
+
+# Statements that depend on the Aurora environment (its roles, its extensions) rather than on
+# anything the schema itself needs - the ones a local PostgreSQL is allowed to reject
+ENVIRONMENT_SPECIFIC = re.compile(r'''
+    ^\s*(
+        GRANT\b | REVOKE\b
+      | CREATE\s+(USER|ROLE)\b
+      | ALTER\s+(SCHEMA|TABLE)\s+\S+\s+OWNER\s+TO\b
+      | CREATE\s+EXTENSION\b.*\b(aws_s3|postgis_tiger_geocoder|postgis_topology)\b
+      | SELECT\s+exec\s*\(
+    )''', re.IGNORECASE | re.VERBOSE | re.DOTALL)
+
+
+def split_statements(text):
+# -----------------------------------------------------------------------------------------------------------------
+    """
+    Returns [(line_number, statement)] for every non-empty statement in text, in order.
+    line_number is where the statement starts (1-based); the statement keeps its comments but
+    not its terminating ';'.
+    """
+    statements = []
+    start = 0
+    i = 0
+    length = len(text)
+
+    def flush(end):
+        statement = text[start:end]
+        if _has_code(statement):
+            offset = start + (len(statement) - len(statement.lstrip()))
+            statements.append((text.count('\n', 0, offset) + 1, statement.strip()))
+
+    while i < length:
+        c = text[i]
+        if c == '-' and text.startswith('--', i):
+            newline = text.find('\n', i)
+            i = length if newline < 0 else newline + 1
+        elif c == '/' and text.startswith('/*', i):
+            i = _end_of_block_comment(text, i)
+        elif c == "'":
+            escapes = i > 0 and text[i - 1] in 'eE' and not _is_identifier_char(text, i - 2)
+            i = _end_of_quoted(text, i, "'", backslash_escapes=escapes)
+        elif c == '"':
+            i = _end_of_quoted(text, i, '"')
+        elif c == '$' and not _is_identifier_char(text, i - 1):
+            match = DOLLAR_TAG.match(text, i)
+            if match:
+                close = text.find(match.group(0), match.end())
+                i = length if close < 0 else close + len(match.group(0))
+            else:
+                i += 1
+        elif c == ';':
+            flush(i)
+            i += 1
+            start = i
+        else:
+            i += 1
+
+    flush(length)
+    return statements
+
+
+def _is_identifier_char(text, i):
+# -----------------------------------------------------------------------------------------------------------------
+    return i >= 0 and (text[i].isalnum() or text[i] in '_$')
+
+
+def _end_of_block_comment(text, i):
+# -----------------------------------------------------------------------------------------------------------------
+    depth = 0
+    length = len(text)
+    while i < length:
+        if text.startswith('/*', i):
+            depth += 1
+            i += 2
+        elif text.startswith('*/', i):
+            depth -= 1
+            i += 2
+            if depth == 0:
+                return i
+        else:
+            i += 1
+    return length
+
+
+def _end_of_quoted(text, i, quote, backslash_escapes=False):
+# -----------------------------------------------------------------------------------------------------------------
+    i += 1
+    length = len(text)
+    while i < length:
+        c = text[i]
+        if backslash_escapes and c == '\\':
+            i += 2
+        elif c == quote:
+            # A doubled quote is an escaped quote, not the end
+            if text.startswith(quote, i + 1):
+                i += 2
+            else:
+                return i + 1
+        else:
+            i += 1
+    return length
+
+
+def _has_code(statement):
+# -----------------------------------------------------------------------------------------------------------------
+    """True unless the statement is nothing but whitespace and comments."""
+    return bool(strip_comments(statement).strip())
+
+
+def strip_comments(statement):
+# -----------------------------------------------------------------------------------------------------------------
+    """The statement with its top-level comments removed (comments inside strings/bodies are kept)."""
+    out = []
+    i = 0
+    length = len(statement)
+    while i < length:
+        c = statement[i]
+        if c == '-' and statement.startswith('--', i):
+            newline = statement.find('\n', i)
+            i = length if newline < 0 else newline
+            out.append(' ')
+        elif c == '/' and statement.startswith('/*', i):
+            i = _end_of_block_comment(statement, i)
+            out.append(' ')
+        elif c in '\'"':
+            escapes = c == "'" and i > 0 and statement[i - 1] in 'eE' and not _is_identifier_char(statement, i - 2)
+            end = _end_of_quoted(statement, i, c, backslash_escapes=escapes)
+            out.append(statement[i:end])
+            i = end
+        elif c == '$' and not _is_identifier_char(statement, i - 1) and DOLLAR_TAG.match(statement, i):
+            tag = DOLLAR_TAG.match(statement, i).group(0)
+            close = statement.find(tag, i + len(tag))
+            end = length if close < 0 else close + len(tag)
+            out.append(statement[i:end])
+            i = end
+        else:
+            out.append(c)
+            i += 1
+    return ''.join(out)
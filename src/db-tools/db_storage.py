@@ -0,0 +1,128 @@
+# Where environment exports are written to / loaded from: an S3 bucket (s3://bucket/prefix) or,
+# for local runs, a directory laid out the same way (root/<key>).
+#
+# Objects are always written whole - a partly written object is never visible under its final
+# key - so anything that exists can be trusted to be complete.
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+READ_BLOCK_BYTES = 1024 * 1024
+
+
+class LocalStore(object):
+# -----------------------------------------------------------------------------------------------------------------
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def __repr__(self):
+        return self.root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.path(key))
+
+    def put_file(self, key, filename):
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Copy alongside then rename, so the final name only ever holds a complete file
+        partial = target + '.partial'
+        shutil.copyfile(filename, partial)
+        os.replace(partial, target)
+
+    def put_bytes(self, key, data):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(data)
+        try:
+            self.put_file(key, f.name)
+        finally:
+            os.unlink(f.name)
+
+    def get_bytes(self, key):
+        with open(self.path(key), 'rb') as f:
+            return f.read()
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def list(self, prefix=''):
+        base = self.path(prefix) if prefix else self.root
+        keys = []
+        for directory, _, files in os.walk(base):
+            for name in files:
+                if not name.endswith('.partial'):
+                    keys.append(os.path.relpath(os.path.join(directory, name), self.root).replace(os.sep, '/'))
+        return sorted(keys)
+
+
+class S3Store(object):
+# -----------------------------------------------------------------------------------------------------------------
+
+    def __init__(self, bucket, prefix=''):
+        # Only needed when actually talking to S3
+        import boto3
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.client = boto3.client('s3')
+
+    def __repr__(self):
+        return 's3://{0}/{1}'.format(self.bucket, self.prefix)
+
+    def _key(self, key):
+        return '{0}/{1}'.format(self.prefix, key) if self.prefix else key
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+            return True
+        except self.client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def size(self, key):
+        return self.client.head_object(Bucket=self.bucket, Key=self._key(key))['ContentLength']
+
+    def put_file(self, key, filename):
+        self.client.upload_file(filename, self.bucket, self._key(key))
+
+    def put_bytes(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data)
+
+    def get_bytes(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self._key(key))['Body'].read()
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self._key(key))['Body']
+
+    def list(self, prefix=''):
+        keys = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        strip = len(self.prefix) + 1 if self.prefix else 0
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(prefix)):
+            keys.extend(o['Key'][strip:] for o in page.get('Contents', []))
+        return sorted(keys)
+
+
+def open_store(location):
+# -----------------------------------------------------------------------------------------------------------------
+    if location.startswith('s3://'):
+        bucket, _, prefix = location[len('s3://'):].partition('/')
+        return S3Store(bucket, prefix)
+    return LocalStore(location)
+
+
+def sha256_of(stream):
+# -----------------------------------------------------------------------------------------------------------------
+    digest = hashlib.sha256()
+    for block in iter(lambda: stream.read(READ_BLOCK_BYTES), b''):
+        digest.update(block)
+    return digest.hexdigest()
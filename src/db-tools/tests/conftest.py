@@ -0,0 +1,18 @@
+# The tools are run as scripts from src/db-tools, so import them the same way here.
+#
+# Usage (from src/db-tools, with requirements.txt installed):
+#   python3 -m pytest tests
+#
+# Tests that need a database are skipped unless BIRDBANDING_DB_DSN is set (e.g. to a local
+# PostgreSQL with the ./sql scripts applied).
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_pool import DSN_ENV_VAR  # noqa: E402
+
+needs_database = pytest.mark.skipif(not os.environ.get(DSN_ENV_VAR), reason='{0} is not set'.format(DSN_ENV_VAR))
@@ -0,0 +1,177 @@
+# db_health's interval arithmetic and flagging on hand-built samples, plus one take_sample against
+# a real database when there is one.
+
+import datetime
+
+import db_health
+from db_pool import ConnectionPool
+
+from conftest import needs_database
+
+RESET = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+SETTINGS = {'autovacuum_vacuum_threshold': '50', 'autovacuum_vacuum_scale_factor': '0.2', 'track_functions': 'pl',
+            'track_counts': 'on'}
+
+
+def table_row(relid, relname, live=1000, dead=0, reloptions=None, **counters):
+# -----------------------------------------------------------------------------------------------------------------
+    row = dict((c, 0) for c in db_health.TABLE_COUNTERS)
+    row.update(relid=relid, schemaname='public', relname=relname, relkind='r', reloptions=reloptions,
+               n_live_tup=live, n_dead_tup=dead, n_mod_since_analyze=0, seconds_since_vacuum=None, total_bytes=8192)
+    row.update(counters)
+    return row
+
+
+def index_row(indexrelid, indexrelname, idx_scan=0, index_bytes=2 * 1024 * 1024, enforces_constraint=False):
+# -----------------------------------------------------------------------------------------------------------------
+    return {'indexrelid': indexrelid, 'schemaname': 'public', 'relname': 'event', 'indexrelname': indexrelname,
+            'idx_scan': idx_scan, 'idx_tup_read': 0, 'idx_tup_fetch': 0, 'index_bytes': index_bytes,
+            'enforces_constraint': enforces_constraint}
+
+
+def sample(taken_at, tables=(), indexes=(), functions=(), statements=None, stats_reset=RESET, settings=SETTINGS):
+# -----------------------------------------------------------------------------------------------------------------
+    return db_health.Sample(taken_at, 'birdbanding', stats_reset, settings,
+                            dict((t['relid'], t) for t in tables), dict((i['indexrelid'], i) for i in indexes),
+                            dict((f['funcid'], f) for f in functions), statements)
+
+
+def test_counter_deltas():
+# -----------------------------------------------------------------------------------------------------------------
+    previous = {1: {'calls': 10, 'total_time': 5.0}, 2: {'calls': 3, 'total_time': 1.0}}
+    current = {1: {'calls': 15, 'total_time': 7.5}, 2: {'calls': 3, 'total_time': 1.0}}
+
+    assert db_health.counter_deltas(previous, current, ('calls', 'total_time')) == {
+        1: {'calls': 5, 'total_time': 2.5}, 2: {'calls': 0, 'total_time': 0.0}}
+
+
+def test_counter_deltas_new_key_and_nulls():
+# -----------------------------------------------------------------------------------------------------------------
+    current = {1: {'calls': 4, 'total_time': None}}
+
+    assert db_health.counter_deltas({}, current, ('calls', 'total_time')) == {1: {'calls': 4, 'total_time': 0}}
+
+
+def test_counter_deltas_counts_a_reset_from_zero():
+# -----------------------------------------------------------------------------------------------------------------
+    # Any counter going backwards means the whole row was reset (or evicted and re-added)
+    previous = {1: {'calls': 100, 'rows': 50}}
+    current = {1: {'calls': 7, 'rows': 60}}
+
+    assert db_health.counter_deltas(previous, current, ('calls', 'rows')) == {1: {'calls': 7, 'rows': 60}}
+
+
+def test_tables_needing_vacuum():
+# -----------------------------------------------------------------------------------------------------------------
+    current = sample(0, tables=[
+        table_row(1, 'quiet', live=1000, dead=10),
+        # Trigger is 50 + 0.2 * 1000 = 250
+        table_row(2, 'behind', live=1000, dead=300),
+        # Three quarters dead as well
+        table_row(3, 'bloated', live=20000, dead=60000),
+        # A per-table scale factor wins over the server's
+        table_row(4, 'tuned', live=1000, dead=100, reloptions=['autovacuum_vacuum_scale_factor=0.01']),
+    ])
+
+    flagged = db_health.tables_needing_vacuum(current, dead_ratio=0.2, dead_tuples_min=1000)
+
+    assert [(f['Table'], f['Reasons']) for f in flagged] == [
+        ('bloated', ['AutovacuumBehind', 'HighDeadRatio']),
+        ('behind', ['AutovacuumBehind']),
+        ('tuned', ['AutovacuumBehind']),
+    ]
+    assert flagged[1]['AutovacuumTrigger'] == 250
+    assert flagged[2]['AutovacuumTrigger'] == 60
+
+
+def test_tables_needing_vacuum_dead_ratio_needs_enough_tuples():
+# -----------------------------------------------------------------------------------------------------------------
+    current = sample(0, tables=[table_row(1, 'tiny', live=10, dead=40, reloptions=['autovacuum_vacuum_threshold=1000'])])
+
+    assert db_health.tables_needing_vacuum(current, dead_ratio=0.2, dead_tuples_min=1000) == []
+
+
+def test_unused_indexes():
+# -----------------------------------------------------------------------------------------------------------------
+    current = sample(0, indexes=[
+        index_row(1, 'idx_used', idx_scan=5),
+        index_row(2, 'idx_unused', index_bytes=4 * 1024 * 1024),
+        index_row(3, 'idx_unused_small', index_bytes=8192),
+        index_row(4, 'event_pkey', enforces_constraint=True),
+        index_row(5, 'idx_unused_null_scans', idx_scan=None),
+    ])
+
+    flagged = db_health.unused_indexes(current, min_bytes=1024 * 1024)
+
+    assert [f['Index'] for f in flagged] == ['idx_unused', 'idx_unused_null_scans']
+    assert flagged[0] == {'Table': 'event', 'Index': 'idx_unused', 'IndexBytes': 4 * 1024 * 1024}
+
+
+def test_interval_records():
+# -----------------------------------------------------------------------------------------------------------------
+    function = {'funcid': 9, 'schemaname': 'public', 'funcname': 'rw_refresh_search_events', 'calls': 2,
+                'total_time': 100.0, 'self_time': 80.0}
+    previous = sample(1000.0, tables=[table_row(1, 'event', seq_scan=10, n_tup_ins=100)],
+                      indexes=[index_row(2, 'idx_event_bird_id', idx_scan=3)], functions=[function])
+    current = sample(1060.0, tables=[table_row(1, 'event', seq_scan=12, n_tup_ins=150, dead=300)],
+                     indexes=[index_row(2, 'idx_event_bird_id', idx_scan=3)],
+                     functions=[dict(function, calls=4, total_time=300.0, self_time=200.0)])
+
+    records = db_health.interval_records(previous, current, namespace='Test')
+
+    table, index, function_record, summary = records
+    assert table['Table'] == 'event' and table['SeqScans'] == 2 and table['Inserts'] == 50
+    assert table['_aws']['CloudWatchMetrics'][0]['Namespace'] == 'Test'
+    assert table['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['Database', 'Table']]
+    assert table['_aws']['Timestamp'] == 1060000
+    assert index['Index'] == 'idx_event_bird_id' and index['IndexScans'] == 0
+    assert function_record['Function'] == 'rw_refresh_search_events'
+    assert function_record['Calls'] == 2 and function_record['MeanTimeMs'] == 100.0
+    assert summary['IntervalSeconds'] == 60.0
+    assert summary['TablesNeedingVacuum'] == 1 and summary['UnusedIndexes'] == 0
+    assert summary['StatementsUnavailable'] is None
+
+
+def test_interval_records_after_stats_reset():
+# -----------------------------------------------------------------------------------------------------------------
+    # pg_stat_reset() between samples: everything counts from zero rather than from the old values
+    previous = sample(0.0, tables=[table_row(1, 'event', seq_scan=5)])
+    current = sample(60.0, tables=[table_row(1, 'event', seq_scan=8)], stats_reset=RESET + datetime.timedelta(days=1))
+
+    records = db_health.interval_records(previous, current)
+
+    assert records[0]['SeqScans'] == 8
+
+
+def test_interval_records_top_statements():
+# -----------------------------------------------------------------------------------------------------------------
+    def statement(queryid, calls, total_time):
+        return {'userid': 10, 'queryid': queryid, 'query': 'SELECT {0}'.format(queryid), 'calls': calls,
+                'total_time': total_time, 'rows': calls, 'shared_blks_hit': 0, 'shared_blks_read': 0}
+
+    previous = sample(0.0, statements={(10, 1): statement(1, 10, 100.0), (10, 2): statement(2, 10, 100.0)})
+    current = sample(60.0, statements={(10, 1): statement(1, 11, 110.0), (10, 2): statement(2, 20, 600.0),
+                                       (10, 3): statement(3, 1, 50.0)})
+
+    records = db_health.interval_records(previous, current, top=2)
+
+    ranked = [r for r in records if 'StatementRank' in r]
+    assert [(r['StatementRank'], r['QueryId']) for r in ranked] == [('1', '2'), ('2', '3')]
+    assert ranked[0]['Calls'] == 10 and ranked[0]['MeanTimeMs'] == 50.0
+
+
+@needs_database
+def test_take_sample():
+# -----------------------------------------------------------------------------------------------------------------
+    with ConnectionPool(max_connections=1) as pool:
+        with pool.cursor() as cur:
+            first = db_health.take_sample(cur)
+            cur.execute('SELECT 1')
+            second = db_health.take_sample(cur)
+
+    assert first.database == second.database
+    assert first.settings.get('track_counts') is not None
+    assert all('n_dead_tup' in row for row in second.tables.values())
+    assert (first.statements is None) == (first.statements_error is not None)
+    records = db_health.interval_records(first, second)
+    assert records[-1]['Database'] == second.database